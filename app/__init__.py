@@ -0,0 +1,10 @@
+"""
+JC1 Inference API.
+
+Importing the package applies configs/settings.yaml as environment defaults
+before any module reads its `os.getenv(...)` configuration.
+"""
+
+from app.utils.settings import load_settings
+
+load_settings()
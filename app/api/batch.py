@@ -0,0 +1,114 @@
+"""
+batch.py - Offline Batch Inference API for JC1
+-----------------------------------------------
+🔹 Features:
+- Submit a JSONL file of prompts as a background batch job
+- Query progress, throughput and ETA of one or all jobs
+- Cancel, resume after a restart, and download the results JSONL
+- Jobs are visible only to the tenant (JWT user) that submitted them
+
+📌 Dependencies:
+- fastapi (for API handling)
+- app.core.batch_jobs (job execution, checkpoints and progress)
+"""
+
+import os
+from typing import Optional
+from fastapi import APIRouter, File, Form, Header, HTTPException, UploadFile
+from fastapi.responses import FileResponse
+from app.core.batch_jobs import BATCH_JOB_MAX_TOKENS, batch_job_manager
+from app.utils.security import resolve_tenant
+
+# Initialize API router for batch jobs
+router = APIRouter()
+
+
+@router.post("/jobs")
+async def submit_batch_job(
+    file: UploadFile = File(...),
+    max_tokens: int = Form(BATCH_JOB_MAX_TOKENS),
+    temperature: float = Form(0.0),
+    authorization: Optional[str] = Header(None),
+):
+    """
+    API Endpoint: Starts a batch job over an uploaded JSONL file.
+
+    Each line holds `prompt` or `messages`, plus optional `id`, `max_tokens`
+    and `temperature` overriding the form defaults. Jobs run in the
+    scheduler's batch class, so they only use capacity interactive chat
+    traffic leaves idle.
+
+    Returns:
+        dict: The job's id and initial progress.
+    """
+    try:
+        job = batch_job_manager.create(data=await file.read(), max_tokens=max_tokens, temperature=temperature,
+                                       tenant=_job_tenant(authorization))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    batch_job_manager.start(job)
+    return {"status": "success", "job": job.progress()}
+
+
+@router.get("/jobs")
+async def list_batch_jobs(authorization: Optional[str] = Header(None)):
+    """
+    API Endpoint: Progress of the caller's batch jobs, newest first.
+    """
+    return {"jobs": batch_job_manager.list_jobs(tenant=_job_tenant(authorization))}
+
+
+@router.get("/jobs/{job_id}")
+async def get_batch_job(job_id: str, authorization: Optional[str] = Header(None)):
+    """
+    API Endpoint: Progress, throughput and ETA of one batch job.
+    """
+    return {"job": _get_job(job_id, authorization).progress()}
+
+
+@router.post("/jobs/{job_id}/cancel")
+async def cancel_batch_job(job_id: str, authorization: Optional[str] = Header(None)):
+    """
+    API Endpoint: Stops a job once its in-flight prompts finish (results so far are kept).
+    """
+    job = _get_job(job_id, authorization)
+    if not batch_job_manager.cancel(job_id):
+        raise HTTPException(status_code=409, detail=f"Job is already {job.status}.")
+    return {"status": "success", "job": job.progress()}
+
+
+@router.post("/jobs/{job_id}/resume")
+async def resume_batch_job(job_id: str, authorization: Optional[str] = Header(None)):
+    """
+    API Endpoint: Continues an interrupted or cancelled job from its output file.
+    """
+    job = _get_job(job_id, authorization)
+    if job.status == "completed":
+        raise HTTPException(status_code=409, detail="Job is already completed.")
+    batch_job_manager.start(job)
+    return {"status": "success", "job": job.progress()}
+
+
+@router.get("/jobs/{job_id}/output")
+async def download_batch_output(job_id: str, authorization: Optional[str] = Header(None)):
+    """
+    API Endpoint: Downloads the results JSONL written so far.
+    """
+    job = _get_job(job_id, authorization)
+    if not os.path.exists(job.output_path):
+        raise HTTPException(status_code=404, detail="No results yet.")
+    return FileResponse(job.output_path, media_type="application/x-ndjson", filename=f"{job.id}.jsonl")
+
+
+def _job_tenant(authorization: Optional[str]) -> str:
+    """Scheduling tenant of the caller's jobs, which also marks their owner."""
+    tenant, _ = resolve_tenant(authorization)
+    return f"batch:{tenant}"
+
+
+def _get_job(job_id: str, authorization: Optional[str]):
+    """The caller's job; other tenants' jobs are reported as unknown (404)."""
+    job = batch_job_manager.get(job_id)
+    if job is None or job.tenant != _job_tenant(authorization):
+        raise HTTPException(status_code=404, detail="Unknown batch job.")
+    return job
@@ -1,52 +1,318 @@
-from fastapi import APIRouter, HTTPException
-from pydantic import BaseModel
-from app.models.loader import load_model
-from app.models.tokenizer import tokenize_input
+import json
+import time
+import asyncio
+from typing import Literal, Optional
+from fastapi import APIRouter, Header, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
+from app.core.admission import admission_controller, estimate_chat_cost, estimate_text_tokens
+from app.core.context_window import CONTEXT_MEMORY_TOP_K, context_builder
+from app.core.fair_queue import FairShare
+from app.core.grammar import GrammarError, validate_response_format
+from app.core.semantic_cache import semantic_cache
+from app.core.session_store import Session, session_store
+from app.models.inference import MAX_SAMPLES, UnsupportedRequest, model_inference
 from app.utils.logger import log_request
-from app.utils.memory import retrieve_context, store_context
+from app.utils.security import get_role_weight, resolve_tenant
+from app.utils.memory import retrieve_session, store_context
 
 # Initialize router
 router = APIRouter()
 
-# Load model once and reuse it
-model, tokenizer = load_model()
-
 class ChatRequest(BaseModel):
     user_id: str  # Unique ID to maintain session memory
     message: str  # User input message
     history: list = []  # Previous conversation context
     max_tokens: int = 200  # Token limit for response
     temperature: float = 0.7  # Sampling temperature
+    priority: Literal["interactive", "batch"] = "interactive"  # Batch traffic yields to interactive
+    return_history: bool = True  # False: reply with the new turn only (the server keeps the history)
+    n: int = Field(1, ge=1, le=MAX_SAMPLES)  # Candidate replies, sampled from one shared prefill
+    best_of: Optional[int] = Field(None, ge=1, le=MAX_SAMPLES)  # Sample this many, return the n most likely
+    logprobs: bool = False  # Include per-token log-probabilities of each candidate
+    response_format: Optional[dict] = None  # {"type": "json_schema", "schema": ...} / {"type": "regex", "pattern": ...}
+
+    @property
+    def samples(self) -> int:
+        """Sequences the request generates (the most of n and best_of)."""
+        return max(self.n, self.best_of or 0)
+
+class CacheFeedback(BaseModel):
+    tenant_id: str  # Tenant the semantic hit was served to
+    entry_id: int  # Value of the X-Cache-Entry header
+
+def _build_context(user_id: str, messages: list, session: Optional[Session] = None):
+    """
+    Packs recent turns (plus retrieved memory, if enabled) into the prompt token budget.
+
+    Returns the window and, when it holds the whole session history, the
+    prompt token ids extended from the session's cached ids (else None).
+    """
+    memory = None
+    if CONTEXT_MEMORY_TOP_K > 0:
+        from app.api.memory import retrieve_memory  # Vector store is optional
+        memory = retrieve_memory(user_id, messages[-1]["content"], top_k=CONTEXT_MEMORY_TOP_K)
+    window = context_builder.build(messages, memory, session_id=user_id)
+    prompt_tokens = None
+    if session is not None and window.messages == messages:
+        prompt_tokens = session_store.prompt_tokens(session, messages)
+    return window, prompt_tokens
+
+def _fair_share(request: ChatRequest, authorization: Optional[str]) -> FairShare:
+    """Scheduling identity: JWT user and role when present, else the shared anonymous tenant."""
+    tenant, role = resolve_tenant(authorization)
+    return FairShare(tenant, get_role_weight(role), request.priority)
 
 @router.post("/chat")
-def chat_endpoint(request: ChatRequest):
-    """Handles chat requests and generates model responses."""
+async def chat_endpoint(request: ChatRequest, response: Response,
+                        authorization: Optional[str] = Header(None)):
+    """
+    Handles chat requests and generates model responses.
+
+    Deterministic requests (temperature 0) may be answered from the response
+    cache; the `X-Cache` header reports HIT, MISS or BYPASS. With the
+    semantic cache enabled, first-turn messages similar to a recent prompt
+    of the same tenant (JWT user) with the same `max_tokens` and `temperature`
+    get `X-Cache: SEMANTIC-HIT` plus the similarity and entry id (for
+    `/chat/cache-feedback`).
+
+    Under overload the request waits for capacity or gets a 429 with Retry-After.
+    Waiting requests are served fairly per tenant (JWT user, weighted by role;
+    unauthenticated callers share one tenant), interactive before batch.
+
+    Long histories are cut to the most recent turns that fit the context
+    token budget; `X-Context-Tokens` / `X-Context-Dropped-Tokens` report
+    the prompt size and what was left out.
+
+    The server keeps the session history (with its token ids, so only new
+    turns are tokenized); `return_history=false` returns just the new turn.
+
+    `n` > 1 (or `best_of`, or `logprobs`) samples several candidates from one
+    shared prefill and returns them as `choices`, ranked by mean token
+    log-probability when `best_of` > n; `response` is the first choice.
+
+    `response_format` constrains the reply to a JSON schema, any JSON object
+    or a regex; an invalid format or schema gets a 400.
+    """
+    if request.best_of is not None and request.best_of < request.n:
+        raise HTTPException(status_code=400, detail="best_of must be at least n.")
     try:
         # Log request
         log_request(user_id=request.user_id, message=request.message)
         
         # Retrieve memory context (previous messages)
-        history = retrieve_context(request.user_id)
-        history.append({"role": "user", "content": request.message})
-        
-        # Tokenize input
-        tokenized_input = tokenize_input(history, tokenizer)
-        
-        # Generate response from model
-        output = model.generate(
-            inputs=tokenized_input,
-            max_new_tokens=request.max_tokens,
-            temperature=request.temperature,
-            do_sample=True
-        )
-        
-        # Decode response
-        response_text = tokenizer.decode(output[0], skip_special_tokens=True)
-        
-        # Store updated history
-        history.append({"role": "assistant", "content": response_text})
-        store_context(request.user_id, history)
-        
-        return {"response": response_text, "history": history}
+        session = retrieve_session(request.user_id)
+        history = list(session.messages)
+        # The prompt is packed into the context budget, so that bounds its cost
+        prompt_tokens = estimate_text_tokens(request.message + json.dumps(history))
+        cost = min(prompt_tokens, context_builder.budget) + request.max_tokens * request.samples
+        share = _fair_share(request, authorization)
+        async with admission_controller.admit(cost, share=share):
+            return await _chat(request, response, session, history, share)
+    except HTTPException:
+        raise
+    except (GrammarError, UnsupportedRequest) as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+
+async def _chat(request: ChatRequest, response: Response, session: Session, history: list,
+                share: FairShare) -> dict:
+    """Answers one admitted chat request and stores the updated history."""
+    sampled = request.n > 1 or request.best_of is not None or request.logprobs
+    # Paraphrase matching ignores context and output constraints
+    use_semantic = semantic_cache.enabled and not history and not sampled and not request.response_format
+    choices = None
+    history.append({"role": "user", "content": request.message})
+    
+    tenant = share.tenant  # Authenticated tenant, never taken from the request body
+    cache_params = {"max_tokens": request.max_tokens, "temperature": request.temperature}
+    loop = asyncio.get_running_loop()
+    if use_semantic:
+        hit, embedding = await loop.run_in_executor(None, semantic_cache.lookup, tenant, request.message,
+                                                    cache_params)
+    else:
+        hit, embedding = None, None
+
+    if hit is not None:
+        response_text = hit.response
+        response.headers["X-Cache"] = "SEMANTIC-HIT"
+        response.headers["X-Cache-Similarity"] = f"{hit.similarity:.4f}"
+        response.headers["X-Cache-Entry"] = str(hit.entry_id)
+    else:
+        window, prompt_tokens = await loop.run_in_executor(None, _build_context, request.user_id, history,
+                                                          session)
+        response.headers["X-Context-Tokens"] = str(window.used_tokens)
+        response.headers["X-Context-Dropped-Tokens"] = str(window.dropped_tokens)
+
+        if sampled:
+            # Several candidates from one prefill (never cached)
+            choices = await model_inference.chat_n(
+                window.messages,
+                n=request.n,
+                best_of=request.best_of,
+                max_new_tokens=request.max_tokens,
+                temperature=request.temperature,
+                session_id=request.user_id,
+                share=share,
+                prompt_tokens=prompt_tokens,
+                response_format=request.response_format,
+            )
+            if not request.logprobs:
+                for choice in choices:
+                    choice.pop("token_logprobs")
+            response_text, cache_status = choices[0]["text"], "BYPASS"
+        else:
+            # Generate response (batched scheduler + response cache)
+            response_text, cache_status = await model_inference.chat(
+                window.messages,
+                max_new_tokens=request.max_tokens,
+                temperature=request.temperature,
+                session_id=request.user_id,
+                share=share,
+                prompt_tokens=prompt_tokens,
+                response_format=request.response_format,
+            )
+        response.headers["X-Cache"] = cache_status
+        if use_semantic:
+            await loop.run_in_executor(
+                None, semantic_cache.add, tenant, request.message, response_text, embedding, cache_params
+            )
+    
+    # Store updated history
+    history.append({"role": "assistant", "content": response_text})
+    await loop.run_in_executor(None, store_context, request.user_id, history, session)
+
+    if not request.return_history:
+        result = {"response": response_text, "turn": history[-2:], "history_length": len(history)}
+    else:
+        result = {"response": response_text, "history": history}
+    if choices is not None:
+        result["choices"] = choices
+    return result
+
+
+@router.post("/chat/cache-feedback")
+async def cache_feedback_endpoint(feedback: CacheFeedback, authorization: Optional[str] = Header(None)):
+    """
+    Reports a semantic-cache answer that did not fit the prompt; the entry is dropped.
+
+    Only the tenant the answer was served to (per its JWT) may report it.
+    """
+    tenant, _ = resolve_tenant(authorization)
+    if feedback.tenant_id != tenant:
+        raise HTTPException(status_code=403, detail="Feedback must come from the entry's tenant.")
+    if not semantic_cache.report_false_hit(tenant, feedback.entry_id):
+        raise HTTPException(status_code=404, detail="Unknown semantic cache entry.")
+    return {"status": "success"}
+
+
+class _AdmittedStream(StreamingResponse):
+    """
+    StreamingResponse that returns its admission budget however the response ends,
+    including a client that disconnects before the first body chunk.
+    """
+
+    def __init__(self, content, release, **kwargs):
+        super().__init__(content, **kwargs)
+        self._release = release
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self._release()
+
+
+def _sse_event(payload: dict, event: str = None) -> str:
+    """Formats one Server-Sent Event frame."""
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+@router.post("/chat/stream")
+async def chat_stream_endpoint(
+    request: ChatRequest,
+    http_request: Request,
+    format: str = Query("sse", description="Stream format: sse or json (newline-delimited JSON chunks)"),
+    authorization: Optional[str] = Header(None),
+):
+    """
+    Streams the model response token by token.
+
+    - `sse`: `data: {"delta": ...}` frames, then an `event: done` frame with timing stats
+    - `json`: one JSON object per line, ending with `{"done": true, ...}`
+
+    Generation is cancelled as soon as the client disconnects. Admission
+    happens before the stream starts, so overload still yields a 429. Like
+    `/chat`, the prompt comes from the server-side session history, packed
+    into the context token budget; a completed reply is stored in the
+    session before the final frame, which carries the context report.
+    """
+    if format not in ("sse", "json"):
+        raise HTTPException(status_code=400, detail="format must be 'sse' or 'json'")
+    if request.n > 1 or request.best_of is not None or request.logprobs:
+        raise HTTPException(status_code=400, detail="n, best_of and logprobs are not supported for streaming.")
+    try:
+        validate_response_format(request.response_format)  # Cheap syntax check before admission
+    except GrammarError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    log_request(user_id=request.user_id, message=request.message)
+    loop = asyncio.get_running_loop()
+    session = retrieve_session(request.user_id)
+    history = list(session.messages) + [{"role": "user", "content": request.message}]
+    window, prompt_tokens = await loop.run_in_executor(None, _build_context, request.user_id, history, session)
+    cost = estimate_chat_cost(json.dumps(window.messages), request.max_tokens)
+    share = _fair_share(request, authorization)
+    await admission_controller.acquire(cost, share=share)
+    try:
+        # Compiled before the response starts, so a format the vocabulary cannot produce is still a 400
+        grammar = await model_inference.compile_grammar(request.response_format)
+    except (GrammarError, UnsupportedRequest) as e:
+        admission_controller.release(cost)
+        raise HTTPException(status_code=400, detail=str(e))
+    except BaseException:
+        admission_controller.release(cost)
+        raise
+
+    async def event_stream():
+        start = time.perf_counter()
+        first_token_ms = None
+        chunks = 0
+        reply = []
+        deltas = model_inference.stream_chat(
+            window.messages, max_new_tokens=request.max_tokens, temperature=request.temperature,
+            session_id=request.user_id, share=share, grammar=grammar, prompt_tokens=prompt_tokens,
+        )
+        try:
+            async for delta in deltas:
+                if await http_request.is_disconnected():
+                    return
+                if first_token_ms is None:
+                    first_token_ms = (time.perf_counter() - start) * 1000
+                chunks += 1
+                reply.append(delta)
+                yield _sse_event({"delta": delta}) if format == "sse" else json.dumps({"delta": delta}) + "\n"
+
+            # Store the completed turn, so the next /chat or /chat/stream call continues from it
+            history.append({"role": "assistant", "content": "".join(reply)})
+            await loop.run_in_executor(None, store_context, request.user_id, history, session)
+            summary = {
+                "ttft_ms": round(first_token_ms, 1) if first_token_ms is not None else None,
+                "total_ms": round((time.perf_counter() - start) * 1000, 1),
+                "chunks": chunks,
+                "context": window.report(),
+            }
+            yield _sse_event(summary, event="done") if format == "sse" else json.dumps({"done": True, **summary}) + "\n"
+        finally:
+            await deltas.aclose()  # Cancels the sequence if we stopped early
+
+    media_type = "text/event-stream" if format == "sse" else "application/x-ndjson"
+    try:
+        return _AdmittedStream(event_stream(), lambda: admission_controller.release(cost), media_type=media_type,
+                               headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    except BaseException:
+        admission_controller.release(cost)
+        raise
@@ -14,7 +14,7 @@ memory.py - Context Memory Retrieval for JC1
 import os
 import chromadb
 from fastapi import APIRouter, HTTPException, Query
-from sentence_transformers import SentenceTransformer
+from app.models.registry import model_registry
 from app.utils.logger import logger
 
 # Initialize API router for memory management
@@ -27,9 +27,6 @@ MEMORY_DB_PATH = os.getenv("MEMORY_DB_PATH", "./data/memory_db")
 chroma_client = chromadb.PersistentClient(path=MEMORY_DB_PATH)
 memory_collection = chroma_client.get_or_create_collection("jc1_memory")
 
-# Load embedding model (used for vectorizing text)
-embedding_model = SentenceTransformer("all-MiniLM-L6-v2")
-
 
 def store_memory(user_id: str, conversation: str):
     """
@@ -42,7 +39,8 @@ def store_memory(user_id: str, conversation: str):
     Returns:
         str: Confirmation message.
     """
-    embedding = embedding_model.encode(conversation).tolist()
+    with model_registry.use("embedder") as embedder:
+        embedding = embedder.encode(conversation).tolist()
 
     try:
         memory_collection.add(
@@ -69,12 +67,14 @@ def retrieve_memory(user_id: str, query: str, top_k: int = 3):
     Returns:
         list: Retrieved memory fragments.
     """
-    embedding = embedding_model.encode(query).tolist()
+    with model_registry.use("embedder") as embedder:
+        embedding = embedder.encode(query).tolist()
 
     try:
         results = memory_collection.query(
             query_embeddings=[embedding],
             n_results=top_k,
+            where={"user_id": user_id},  # Only this user's memories
         )
         return [res["text"] for res in results["metadatas"][0]]
     
@@ -18,15 +18,13 @@ using an Automatic Speech Recognition (ASR) model.
 from fastapi import APIRouter, File, UploadFile, HTTPException
 import torch
 import torchaudio
-from app.models.loader import load_asr_model
+from app.core.admission import AUDIO_TOKENS_PER_MB, admission_controller, estimate_media_cost
+from app.models.registry import model_registry
 from app.utils.logger import logger
 
 # Initialize FastAPI router for Speech-to-Text API
 router = APIRouter()
 
-# Load ASR model (Whisper, Wav2Vec2, DeepSpeech, etc.)
-asr_model = load_asr_model()
-
 # Supported audio formats
 ALLOWED_AUDIO_FORMATS = {"audio/wav", "audio/mp3", "audio/flac", "audio/ogg"}
 
@@ -88,17 +86,23 @@ async def speech_to_text(file: UploadFile = File(...)):
 
         # Save uploaded file temporarily
         temp_audio_path = f"temp_audio/{file.filename}"
+        audio_bytes = file.file.read()
         with open(temp_audio_path, "wb") as audio_file:
-            audio_file.write(file.file.read())
+            audio_file.write(audio_bytes)
 
-        # Preprocess audio file
-        waveform, sample_rate = preprocess_audio(temp_audio_path)
+        # Wait for capacity (or shed with 429) before the expensive part
+        async with admission_controller.admit(estimate_media_cost(len(audio_bytes), AUDIO_TOKENS_PER_MB)):
+            # Preprocess audio file
+            waveform, sample_rate = preprocess_audio(temp_audio_path)
 
-        # Run ASR inference
-        transcription = asr_model.transcribe(waveform, sample_rate)
+            # Run ASR inference
+            with model_registry.use("asr") as asr_model:
+                transcription = asr_model.transcribe(waveform, sample_rate)
 
         return {"filename": file.filename, "transcription": transcription}
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Speech-to-text error: {e}")
         raise HTTPException(status_code=500, detail="Failed to process speech")
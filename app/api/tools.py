@@ -14,6 +14,7 @@ tools.py - External Tool Integrations for JC1
 
 import os
 import requests
+from typing import Optional
 from fastapi import APIRouter, HTTPException, Query
 from app.core.retriever import retrieve_documents
 from app.utils.logger import logger
@@ -119,18 +120,23 @@ async def search_tool(
 
 
 @router.get("/retrieve/")
-async def retrieve_knowledge(query: str = Query(..., description="Query for document retrieval")):
+async def retrieve_knowledge(query: str = Query(..., description="Query for document retrieval"),
+                             top_k: int = Query(5, ge=1, le=100),
+                             nprobe: Optional[int] = Query(None, ge=1, description="IVF lists to scan"),
+                             ef_search: Optional[int] = Query(None, ge=1, description="HNSW candidate list size")):
     """
     API Endpoint: Retrieve relevant documents using RAG.
 
     Args:
         query (str): The search query.
+        top_k (int): Number of documents to return.
+        nprobe / ef_search (int): Recall-vs-latency knobs of approximate indexes.
 
     Returns:
-        dict: Retrieved document content.
+        dict: Retrieved documents (id, text, source, distance), closest first.
     """
     try:
-        retrieved_docs = retrieve_documents(query)
+        retrieved_docs = retrieve_documents(query, top_k, nprobe, ef_search)
         return {"query": query, "retrieved_documents": retrieved_docs}
     
     except Exception as e:
@@ -16,23 +16,16 @@ import io
 import torch
 from fastapi import APIRouter, File, UploadFile, HTTPException
 from PIL import Image
-from transformers import BlipProcessor, BlipForConditionalGeneration, VisionEncoderDecoderModel, ViTImageProcessor
+from app.core.admission import IMAGE_TOKENS_PER_MB, admission_controller, estimate_media_cost
+from app.models.registry import model_registry
 from app.utils.logger import logger
 
 # Initialize API router for vision processing
 router = APIRouter()
 
-# Load pre-trained vision-language models
+# Vision-language models (BLIP captioning, TrOCR) are loaded by the model registry on first use
 device = "cuda" if torch.cuda.is_available() else "cpu"
 
-# Image Captioning Model
-caption_processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-large")
-caption_model = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-large").to(device)
-
-# OCR Model
-ocr_model = VisionEncoderDecoderModel.from_pretrained("microsoft/trocr-base-handwritten").to(device)
-ocr_processor = ViTImageProcessor.from_pretrained("microsoft/trocr-base-handwritten")
-
 
 def process_image(image: UploadFile):
     """
@@ -50,9 +43,10 @@ def generate_caption(image: Image.Image):
     """
     Generates a caption for the given image using BLIP.
     """
-    inputs = caption_processor(images=image, return_tensors="pt").to(device)
-    output = caption_model.generate(**inputs)
-    caption = caption_processor.batch_decode(output, skip_special_tokens=True)[0]
+    with model_registry.use("caption") as (caption_processor, caption_model):
+        inputs = caption_processor(images=image, return_tensors="pt").to(device)
+        output = caption_model.generate(**inputs)
+        caption = caption_processor.batch_decode(output, skip_special_tokens=True)[0]
     return caption
 
 
@@ -60,9 +54,10 @@ def extract_text(image: Image.Image):
     """
     Performs OCR (Optical Character Recognition) on the given image.
     """
-    pixel_values = ocr_processor(image, return_tensors="pt").pixel_values.to(device)
-    output = ocr_model.generate(pixel_values)
-    extracted_text = ocr_processor.batch_decode(output, skip_special_tokens=True)[0]
+    with model_registry.use("ocr") as (ocr_processor, ocr_model):
+        pixel_values = ocr_processor(image, return_tensors="pt").pixel_values.to(device)
+        output = ocr_model.generate(pixel_values)
+        extracted_text = ocr_processor.batch_decode(output, skip_special_tokens=True)[0]
     return extracted_text
 
 
@@ -78,7 +73,8 @@ async def api_generate_caption(image: UploadFile = File(...)):
         dict: Generated caption.
     """
     image_data = process_image(image)
-    caption = generate_caption(image_data)
+    async with admission_controller.admit(estimate_media_cost(image.size, IMAGE_TOKENS_PER_MB)):
+        caption = generate_caption(image_data)
     return {"status": "success", "caption": caption}
 
 
@@ -94,5 +90,6 @@ async def api_extract_text(image: UploadFile = File(...)):
         dict: Extracted text.
     """
     image_data = process_image(image)
-    extracted_text = extract_text(image_data)
+    async with admission_controller.admit(estimate_media_cost(image.size, IMAGE_TOKENS_PER_MB)):
+        extracted_text = extract_text(image_data)
     return {"status": "success", "extracted_text": extracted_text}
@@ -0,0 +1,232 @@
+"""
+admission.py - Load Shedding & Admission Control
+-------------------------------------------------
+🔹 Features:
+- Estimates the cost of each request in tokens (prompt + max_tokens, or media size)
+- Keeps the tokens of in-flight work under a fixed budget
+- Over budget, requests wait up to a deadline in a per-tenant weighted fair queue
+- Full queue or missed deadline → HTTP 429 with a Retry-After estimate
+- Queue depth, wait times and rejection counters for monitoring
+
+📌 Dependencies:
+- asyncio (all callers run on the API event loop)
+- FastAPI (HTTPException for the 429 response)
+"""
+
+import os
+import math
+import time
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Optional
+
+from fastapi import HTTPException
+
+from app.core.fair_queue import DEFAULT_SHARE, FairQueue, FairShare
+from app.utils.logger import logger
+
+### 🔧 CONFIGURATION ###
+ADMISSION_MAX_INFLIGHT_TOKENS = int(os.getenv("ADMISSION_MAX_INFLIGHT_TOKENS", 32768))  # In-flight token budget
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", 256))  # Requests allowed to wait for budget
+ADMISSION_MAX_QUEUE_PER_TENANT = int(os.getenv("ADMISSION_MAX_QUEUE_PER_TENANT", 64))  # One tenant's share of it
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", 5.0))  # Max seconds spent waiting
+IMAGE_TOKENS_PER_MB = int(os.getenv("IMAGE_TOKENS_PER_MB", 512))  # Cost of vision requests per MB uploaded
+AUDIO_TOKENS_PER_MB = int(os.getenv("AUDIO_TOKENS_PER_MB", 1024))  # Cost of speech requests per MB uploaded
+CHARS_PER_TOKEN = 4  # Rough English average; avoids tokenizing twice just to estimate cost
+THROUGHPUT_WINDOW = 30.0  # Seconds of completions used to estimate Retry-After
+
+
+### 📏 COST ESTIMATES ###
+def estimate_text_tokens(text: str) -> int:
+    """Approximate token count of `text` without running the tokenizer."""
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def estimate_chat_cost(prompt: str, max_tokens: int) -> int:
+    """Prompt tokens plus the most the model may generate."""
+    return estimate_text_tokens(prompt) + max_tokens
+
+
+def estimate_media_cost(num_bytes: Optional[int], tokens_per_mb: int) -> int:
+    """Token-equivalent cost of an uploaded image or audio file."""
+    return max(1, math.ceil((num_bytes or 0) / (1024 * 1024) * tokens_per_mb))
+
+
+class AdmissionRejected(HTTPException):
+    """
+    429 response for requests shed by the admission controller.
+    """
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(status_code=429, detail=f"Server overloaded ({reason}), retry later.",
+                         headers={"Retry-After": str(retry_after)})
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+### 📂 ADMISSION CONTROLLER CLASS ###
+class AdmissionController:
+    """
+    Token-budgeted admission for API requests.
+
+    A request is admitted right away while the in-flight token total plus
+    its cost fits the budget (or nothing else is running, so oversized
+    requests cannot starve). Otherwise it queues; queued requests are
+    admitted in weighted-fair order across tenants (interactive before
+    batch), and rejected when the queue (or the tenant's share of it) is
+    full or their wait exceeds the timeout.
+    """
+
+    def __init__(self, max_inflight_tokens: int = ADMISSION_MAX_INFLIGHT_TOKENS,
+                 max_queue: int = ADMISSION_MAX_QUEUE, queue_timeout: float = ADMISSION_QUEUE_TIMEOUT,
+                 max_queue_per_tenant: int = ADMISSION_MAX_QUEUE_PER_TENANT):
+        self.max_inflight_tokens = max_inflight_tokens
+        self.max_queue = max_queue
+        self.max_queue_per_tenant = max_queue_per_tenant
+        self.queue_timeout = queue_timeout
+        self.inflight_tokens = 0
+        self.inflight_requests = 0
+        self._queued_tokens = 0
+        self._waiters = FairQueue()  # [cost, future] per waiting request
+        self._completed = deque()  # (finish time, cost) within THROUGHPUT_WINDOW
+        self.stats = {"admitted": 0, "queued": 0, "rejected_queue_full": 0, "rejected_timeout": 0,
+                      "abandoned": 0, "queue_wait_seconds": 0.0, "max_queue_wait_seconds": 0.0}
+
+    async def acquire(self, cost: int, timeout: Optional[float] = None, share: FairShare = DEFAULT_SHARE) -> float:
+        """
+        Waits until `cost` tokens fit the budget.
+
+        Returns:
+            float: Seconds spent queued.
+
+        Raises:
+            AdmissionRejected: Queue full, or still queued after `timeout` seconds.
+        """
+        if not self._waiters and self._fits(cost):
+            self._grant(cost)
+            return 0.0
+        if (len(self._waiters) >= self.max_queue
+                or self._waiters.tenant_size(share.tenant) >= self.max_queue_per_tenant):
+            self.stats["rejected_queue_full"] += 1
+            raise AdmissionRejected("queue full", self.retry_after(cost))
+
+        loop = asyncio.get_running_loop()
+        waiter = [cost, loop.create_future()]
+        self._waiters.put(waiter, cost, share)
+        self._queued_tokens += cost
+        self.stats["queued"] += 1
+        expiry = loop.call_later(self.queue_timeout if timeout is None else timeout, self._expire, waiter)
+        start = time.perf_counter()
+        try:
+            await waiter[1]
+        except asyncio.CancelledError:
+            # Client went away: give back the grant if it raced with the cancellation
+            future = waiter[1]
+            if future.done() and not future.cancelled() and future.exception() is None:
+                self.release(cost)
+            else:
+                self._remove(waiter)  # A timeout rejection is read above, so it is not logged as lost
+            self.stats["abandoned"] += 1
+            raise
+        finally:
+            expiry.cancel()
+
+        waited = time.perf_counter() - start
+        self.stats["queue_wait_seconds"] += waited
+        self.stats["max_queue_wait_seconds"] = max(self.stats["max_queue_wait_seconds"], waited)
+        return waited
+
+    def release(self, cost: int):
+        """
+        Returns `cost` tokens to the budget and admits queued requests that now fit.
+        """
+        self.inflight_tokens -= cost
+        self.inflight_requests -= 1
+        now = time.monotonic()
+        self._completed.append((now, cost))
+        while self._completed and self._completed[0][0] < now - THROUGHPUT_WINDOW:
+            self._completed.popleft()
+        self._drain()
+
+    @asynccontextmanager
+    async def admit(self, cost: int, timeout: Optional[float] = None, share: FairShare = DEFAULT_SHARE):
+        """
+        `async with admission_controller.admit(cost, share=...):` holds the budget for the block.
+        """
+        await self.acquire(cost, timeout, share)
+        try:
+            yield
+        finally:
+            self.release(cost)
+
+    def retry_after(self, cost: int = 0) -> int:
+        """
+        Seconds until the queued backlog should have drained, from recent throughput (1-60).
+        """
+        now = time.monotonic()
+        recent = [c for t, c in self._completed if t >= now - THROUGHPUT_WINDOW]
+        if not recent:
+            return 1
+        throughput = sum(recent) / THROUGHPUT_WINDOW
+        backlog = self.queued_tokens + self.inflight_tokens + cost - self.max_inflight_tokens
+        return int(min(60, max(1, math.ceil(backlog / throughput))))
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    @property
+    def queued_tokens(self) -> int:
+        return self._queued_tokens
+
+    def get_stats(self) -> dict:
+        """
+        Returns in-flight usage, queue depth and admission / rejection counters.
+        """
+        return {
+            **self.stats,
+            "inflight_tokens": self.inflight_tokens,
+            "inflight_requests": self.inflight_requests,
+            "max_inflight_tokens": self.max_inflight_tokens,
+            "queue_depth": self.queue_depth,
+            "queued_tokens": self.queued_tokens,
+            "retry_after": self.retry_after(),
+            "fair_queue": self._waiters.get_stats(),
+        }
+
+    def _fits(self, cost: int) -> bool:
+        return self.inflight_requests == 0 or self.inflight_tokens + cost <= self.max_inflight_tokens
+
+    def _grant(self, cost: int):
+        self.inflight_tokens += cost
+        self.inflight_requests += 1
+        self.stats["admitted"] += 1
+
+    def _drain(self):
+        while True:
+            waiter = self._waiters.peek()  # Next in fair order
+            if waiter is None or not self._fits(waiter[0]):
+                return
+            self._waiters.get_nowait()
+            self._queued_tokens -= waiter[0]
+            if not waiter[1].done():
+                self._grant(waiter[0])
+                waiter[1].set_result(True)
+
+    def _remove(self, waiter: list):
+        if self._waiters.remove(waiter):
+            self._queued_tokens -= waiter[0]
+            self._drain()  # The head may have changed
+
+    def _expire(self, waiter: list):
+        if waiter[1].done():
+            return
+        self._remove(waiter)
+        self.stats["rejected_timeout"] += 1
+        logger.warning(f"⚠️ Request of {waiter[0]} tokens shed: no capacity before its queue deadline.")
+        waiter[1].set_exception(AdmissionRejected("queue timeout", self.retry_after(waiter[0])))
+
+
+# Shared admission controller for every API route
+admission_controller = AdmissionController()
@@ -0,0 +1,372 @@
+"""
+batch_jobs.py - Offline Batch Inference Jobs
+---------------------------------------------
+🔹 Features:
+- Runs a JSONL file of prompts through the model and writes a JSONL of results
+- Sorts prompts by token length (within a bounded window) so the scheduler
+  prefills similar lengths together and wastes little compute on padding
+- Keeps a fixed number of requests per job in flight, queued in the
+  scheduler's "batch" class: jobs soak up idle capacity, interactive
+  traffic is always served first
+- Results are appended and flushed as they complete; after a crash a job
+  resumes from its output file (finished ids are skipped, a torn last line dropped)
+- Progress, throughput and ETA per job
+
+📌 Dependencies:
+- asyncio (jobs run on the API event loop or in the CLI's own loop)
+- ModelInference / Tokenizer (generation and batched prompt encoding)
+"""
+
+import os
+import json
+import time
+import uuid
+import asyncio
+from typing import Awaitable, Callable, Dict, Iterator, List, Optional
+
+from app.core.fair_queue import FairShare
+from app.utils.logger import logger
+
+### 🔧 CONFIGURATION ###
+BATCH_JOBS_DIR = os.getenv("BATCH_JOBS_DIR", "data/batch_jobs")  # One directory per job
+BATCH_JOB_MAX_INFLIGHT = int(os.getenv("BATCH_JOB_MAX_INFLIGHT", 8))  # Requests per job queued or decoding
+BATCH_JOB_SORT_WINDOW = int(os.getenv("BATCH_JOB_SORT_WINDOW", 4096))  # Prompts tokenized and sorted together
+BATCH_JOB_MAX_TOKENS = int(os.getenv("BATCH_JOB_MAX_TOKENS", 256))  # Default max_tokens of a job's prompts
+BATCH_JOBS_AUTO_RESUME = os.getenv("BATCH_JOBS_AUTO_RESUME", "true").lower() == "true"  # Restart on API startup
+BATCH_JOB_STATE_INTERVAL = 2.0  # Seconds between progress writes to job.json
+
+FINAL_STATES = ("completed", "failed", "cancelled")
+
+# generate(messages, prompt_tokens, max_tokens, temperature, share) -> (text, completion tokens)
+GenerateFn = Callable[[List[dict], List[int], int, float, FairShare], Awaitable[tuple]]
+
+
+class BatchJob:
+    """
+    One batch job and its progress, persisted as `job.json` next to its input and output.
+    """
+
+    def __init__(self, job_id: str, directory: str, max_tokens: int = BATCH_JOB_MAX_TOKENS,
+                 temperature: float = 0.0, tenant: Optional[str] = None, input_path: Optional[str] = None,
+                 output_path: Optional[str] = None):
+        self.id = job_id
+        self.directory = directory
+        self.input_path = input_path or os.path.join(directory, "input.jsonl")
+        self.output_path = output_path or os.path.join(directory, "output.jsonl")
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.tenant = tenant or f"batch:{job_id}"
+        self.status = "queued"
+        self.error = None
+        self.total = 0
+        self.completed = 0  # Results written, including failed prompts
+        self.failed = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._run_started = None  # This run's start and completions, for throughput after a resume
+        self._run_completed = 0
+        self._run_tokens = 0
+
+    @property
+    def state_path(self) -> str:
+        return os.path.join(self.directory, "job.json")
+
+    def progress(self) -> dict:
+        """Job state with completion counts, throughput of the current run and ETA."""
+        elapsed = time.time() - self._run_started if self._run_started else 0.0
+        rate = self._run_completed / elapsed if elapsed > 0 else 0.0
+        remaining = max(self.total - self.completed, 0)
+        return {
+            "id": self.id,
+            "status": self.status,
+            "error": self.error,
+            "total": self.total,
+            "completed": self.completed,
+            "failed": self.failed,
+            "percent": round(100 * self.completed / self.total, 1) if self.total else 0.0,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "requests_per_second": round(rate, 3),
+            "tokens_per_second": round(self._run_tokens / elapsed, 1) if elapsed > 0 else 0.0,
+            "eta_seconds": round(remaining / rate, 1) if rate > 0 and self.status == "running" else None,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "output_path": self.output_path,
+        }
+
+    def save(self):
+        """Writes job.json atomically (a crash never leaves it half written)."""
+        state = {key: value for key, value in self.__dict__.items() if not key.startswith("_")}
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+    @classmethod
+    def load(cls, directory: str) -> "BatchJob":
+        with open(os.path.join(directory, "job.json")) as f:
+            state = json.load(f)
+        job = cls(state["id"], state["directory"])
+        job.__dict__.update(state)
+        return job
+
+
+### 📂 BATCH JOB MANAGER CLASS ###
+class BatchJobManager:
+    """
+    Creates, runs, resumes and reports on batch jobs.
+
+    Input lines are JSON objects with `prompt` (a string) or `messages` (a
+    chat history), plus optional `id`, `max_tokens` and `temperature`.
+    Output lines carry the same `id` with `response`, `prompt_tokens` and
+    `completion_tokens`, or an `error`, in completion order.
+    """
+
+    def __init__(self, jobs_dir: str = BATCH_JOBS_DIR, generate: Optional[GenerateFn] = None, tokenizer=None,
+                 max_inflight: int = BATCH_JOB_MAX_INFLIGHT, sort_window: int = BATCH_JOB_SORT_WINDOW):
+        self.jobs_dir = jobs_dir
+        self._generate = generate
+        self._tokenizer = tokenizer
+        self.max_inflight = max_inflight
+        self.sort_window = sort_window
+        self._jobs: Dict[str, BatchJob] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    ### 📥 JOB LIFECYCLE ###
+    def create(self, data: Optional[bytes] = None, input_path: Optional[str] = None,
+               output_path: Optional[str] = None, max_tokens: int = BATCH_JOB_MAX_TOKENS,
+               temperature: float = 0.0, tenant: Optional[str] = None) -> BatchJob:
+        """
+        Registers a job for uploaded JSONL `data` or an existing `input_path`.
+
+        Raises:
+            ValueError: Neither (or both) inputs given, or the input file is missing.
+        """
+        if (data is None) == (input_path is None):
+            raise ValueError("Provide either JSONL data or an input path.")
+        if input_path is not None and not os.path.isfile(input_path):
+            raise ValueError(f"Input file not found: {input_path}")
+
+        job_id = uuid.uuid4().hex[:12]
+        directory = os.path.join(self.jobs_dir, job_id)
+        os.makedirs(directory, exist_ok=True)
+        job = BatchJob(job_id, directory, max_tokens, temperature, tenant, input_path, output_path)
+        if data is not None:
+            with open(job.input_path, "wb") as f:
+                f.write(data)
+        job.total = sum(1 for _ in self._read_input(job))
+        job.save()
+        self._jobs[job_id] = job
+        logger.info(f"✅ Batch job {job_id} created with {job.total} prompts.")
+        return job
+
+    def start(self, job: BatchJob) -> asyncio.Task:
+        """Runs (or resumes) a job in the background on the current event loop."""
+        task = self._tasks.get(job.id)
+        if task is not None and not task.done():
+            return task
+        self._jobs[job.id] = job
+        task = self._tasks[job.id] = asyncio.get_running_loop().create_task(self.run(job))
+        return task
+
+    def cancel(self, job_id: str) -> bool:
+        """Stops a job after its in-flight prompts; returns False if it is not running."""
+        job = self.get(job_id)
+        if job is None or job.status in FINAL_STATES:
+            return False
+        task = self._tasks.get(job_id)
+        if task is None or task.done():  # Interrupted job: nothing running to stop
+            job.status, job.finished_at = "cancelled", time.time()
+            job.save()
+        else:
+            job.status = "cancelling"
+        return True
+
+    def get(self, job_id: str) -> Optional[BatchJob]:
+        """Returns a job of this process, or one found on disk (e.g. from before a restart)."""
+        job = self._jobs.get(job_id)
+        if job is None:
+            directory = os.path.join(self.jobs_dir, os.path.basename(job_id))
+            if os.path.isfile(os.path.join(directory, "job.json")):
+                job = self._jobs[job_id] = BatchJob.load(directory)
+        return job
+
+    def list_jobs(self, tenant: Optional[str] = None) -> List[dict]:
+        """Progress of every job on disk (or only `tenant`'s), newest first."""
+        if os.path.isdir(self.jobs_dir):
+            for name in os.listdir(self.jobs_dir):
+                self.get(name)
+        jobs = [job for job in self._jobs.values() if tenant is None or job.tenant == tenant]
+        return [job.progress() for job in sorted(jobs, key=lambda j: -j.created_at)]
+
+    def interrupted(self) -> List[BatchJob]:
+        """Jobs on disk that were queued or running when their process stopped."""
+        self.list_jobs()
+        return [job for job in self._jobs.values()
+                if job.status not in FINAL_STATES and job.id not in self._tasks]
+
+    ### 🚀 EXECUTION ###
+    async def run(self, job: BatchJob):
+        """
+        Processes every prompt of `job` not yet in its output file.
+
+        Prompts are read in windows of `sort_window`, tokenized in one
+        batched call per window, and submitted shortest first, at most
+        `max_inflight` at a time.
+        """
+        done = self._recover_output(job)
+        job.status, job.error = "running", None
+        job.started_at = job.started_at or time.time()
+        job._run_started, job._run_completed, job._run_tokens = time.time(), 0, 0
+        job.save()
+        if done:
+            logger.info(f"🔄 Resuming batch job {job.id}: {len(done)}/{job.total} prompts already done.")
+
+        share = FairShare(job.tenant, priority="batch")
+        last_save = time.monotonic()
+        try:
+            with open(job.output_path, "a", encoding="utf-8") as out:
+                for window in self._windows(job, done):
+                    prompt_tokens = await asyncio.get_running_loop().run_in_executor(
+                        None, self._tokenize, [record["messages"] for record in window])
+                    order = sorted(range(len(window)), key=lambda i: len(prompt_tokens[i]))
+                    pending = iter(order)
+
+                    async def worker():
+                        nonlocal last_save
+                        for i in pending:
+                            if job.status == "cancelling":
+                                return
+                            result = await self._process(job, window[i], prompt_tokens[i], share)
+                            out.write(json.dumps(result, ensure_ascii=False) + "\n")
+                            out.flush()
+                            if time.monotonic() - last_save >= BATCH_JOB_STATE_INTERVAL:
+                                last_save = time.monotonic()
+                                job.save()
+
+                    workers = [asyncio.ensure_future(worker()) for _ in range(min(self.max_inflight, len(window)))]
+                    try:
+                        await asyncio.gather(*workers)
+                    except BaseException:
+                        for task in workers:  # One worker failed (e.g. disk full): stop the others too
+                            task.cancel()
+                        await asyncio.gather(*workers, return_exceptions=True)
+                        raise
+                    if job.status == "cancelling":
+                        break
+            job.status = "cancelled" if job.status == "cancelling" else "completed"
+        except Exception as e:
+            logger.error(f"❌ Batch job {job.id} failed: {e}")
+            job.status, job.error = "failed", str(e)
+        job.finished_at = time.time()
+        job.save()
+        icon = "❌" if job.status == "failed" else "✅"
+        logger.info(f"{icon} Batch job {job.id} {job.status}: {job.completed}/{job.total} prompts "
+                    f"({job.progress()['tokens_per_second']} tokens/s).")
+        return job
+
+    async def _process(self, job: BatchJob, record: dict, prompt_tokens: List[int], share: FairShare) -> dict:
+        try:
+            if record["messages"] is None:
+                raise ValueError(record["error"])
+            max_tokens = int(record.get("max_tokens", job.max_tokens))
+            temperature = float(record.get("temperature", job.temperature))
+            text, completion_tokens = await self._generate_fn(record["messages"], prompt_tokens, max_tokens,
+                                                              temperature, share)
+            result = {"id": record["id"], "response": text, "prompt_tokens": len(prompt_tokens),
+                      "completion_tokens": completion_tokens}
+            job.prompt_tokens += len(prompt_tokens)
+            job.completion_tokens += completion_tokens
+            job._run_tokens += completion_tokens
+        except Exception as e:
+            result = {"id": record["id"], "error": str(e)}
+            job.failed += 1
+        job.completed += 1
+        job._run_completed += 1
+        return result
+
+    ### 📄 FILES ###
+    def _read_input(self, job: BatchJob) -> Iterator[dict]:
+        """Yields normalized input records; malformed lines become records carrying their error."""
+        with open(job.input_path, encoding="utf-8") as f:
+            for line_number, line in enumerate(f):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                    if "messages" not in record:
+                        record["messages"] = [{"role": "user", "content": str(record["prompt"])}]
+                except (ValueError, KeyError, TypeError) as e:
+                    record = {"messages": None, "error": f"Invalid input line {line_number + 1}: {e}"}
+                record["id"] = str(record.get("id", line_number))
+                yield record
+
+    def _windows(self, job: BatchJob, done: set) -> Iterator[List[dict]]:
+        window = []
+        for record in self._read_input(job):
+            if record["id"] in done:
+                continue
+            window.append(record)
+            if len(window) >= self.sort_window:
+                yield window
+                window = []
+        if window:
+            yield window
+
+    @staticmethod
+    def _recover_output(job: BatchJob) -> set:
+        """
+        Ids already in the output file; drops a torn last line and recounts progress from the file.
+        """
+        done = set()
+        job.completed = job.failed = job.prompt_tokens = job.completion_tokens = 0
+        if not os.path.exists(job.output_path):
+            return done
+        valid_bytes = 0
+        with open(job.output_path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    break
+                valid_bytes += len(line)
+                done.add(str(result["id"]))
+                job.completed += 1
+                job.failed += "error" in result
+                job.prompt_tokens += result.get("prompt_tokens", 0)
+                job.completion_tokens += result.get("completion_tokens", 0)
+        if valid_bytes < os.path.getsize(job.output_path):
+            with open(job.output_path, "r+b") as f:
+                f.truncate(valid_bytes)
+        return done
+
+    ### 🤖 MODEL ACCESS ###
+    def _tokenize(self, conversations: List[Optional[List[dict]]]) -> List[List[int]]:
+        tokenizer = self._tokenizer
+        if tokenizer is None:
+            from app.models.tokenizer import get_tokenizer
+            tokenizer = get_tokenizer()
+        valid = [i for i, messages in enumerate(conversations) if messages]
+        encoded = tokenizer.encode_chat_batch([conversations[i] for i in valid]) if valid else []
+        prompt_tokens = [[] for _ in conversations]
+        for i, ids in zip(valid, encoded):
+            prompt_tokens[i] = ids
+        return prompt_tokens
+
+    async def _generate_fn(self, messages, prompt_tokens, max_tokens, temperature, share):
+        if self._generate is not None:
+            return await self._generate(messages, prompt_tokens, max_tokens, temperature, share)
+        from app.models.inference import model_inference
+        text, _ = await model_inference.chat(messages, max_new_tokens=max_tokens, temperature=temperature,
+                                             share=share, prompt_tokens=prompt_tokens)
+        return text, model_inference.tokenizer.count_tokens(text)
+
+
+# Shared job manager for the API
+batch_job_manager = BatchJobManager()
@@ -6,22 +6,34 @@ cache.py - Implements Key-Value Caching & Session Handling
 - Uses Redis (optional) for persistent caching across sessions
 - Handles automatic expiration of cache entries
 - Supports multi-turn conversation memory
+- Bounded, size-aware in-process LRU tier with a background TTL sweeper
+- Two-tier lookups (in-process L1 in front of Redis L2)
+- `get_or_compute` coalesces concurrent misses for one key (singleflight)
 
 📌 Dependencies:
 - Redis (for distributed caching)
-- Pickle (for serialization)
+- Pickle (for serialization; raw bytes for callers with their own format)
 """
 
 import os
 import time
 import pickle
+import asyncio
+import threading
 import redis
-from typing import Optional
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Optional
+from app.utils.logger import logger
 
 ### 🔧 CONFIGURATION ###
 REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
 REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
 CACHE_TTL = 300  # Cache expiry in seconds (5 minutes)
+CACHE_SIZE = int(os.getenv("CACHE_SIZE", 500))  # Max in-process entries (settings.yaml → cache.cache_size)
+CACHE_MAX_MB = float(os.getenv("CACHE_MAX_MB", 64))  # Max pickled bytes held in-process
+CACHE_SWEEP_INTERVAL = float(os.getenv("CACHE_SWEEP_INTERVAL", 30))  # Seconds between TTL sweeps
+CACHE_L1_TTL = int(os.getenv("CACHE_L1_TTL", 5))  # In-process TTL for entries also held in Redis
 
 # Try connecting to Redis if available
 try:
@@ -31,14 +43,206 @@ except redis.ConnectionError:
     redis_available = False
 
 
+### 🗃️ LOCAL CACHE CLASS ###
+class LocalCache:
+    """
+    Bounded in-process cache of pickled values.
+
+    Entries are evicted least-recently-used first whenever either the entry
+    limit or the byte budget (pickled value + key) is exceeded. Expired
+    entries are removed on access and by a background sweeper thread, so
+    keys nobody reads again do not pile up.
+    """
+
+    def __init__(self, max_entries: int = CACHE_SIZE, max_bytes: int = int(CACHE_MAX_MB * 1024 * 1024),
+                 sweep_interval: Optional[float] = CACHE_SWEEP_INTERVAL):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self._entries = OrderedDict()  # key -> (serialized value, expiry timestamp, size)
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "rejections": 0}
+
+        self._stop_sweeper = threading.Event()
+        if sweep_interval:
+            sweeper = threading.Thread(target=self._sweep_loop, args=(sweep_interval,),
+                                       name="jc1-cache-sweeper", daemon=True)
+            sweeper.start()
+
+    def set(self, key: str, serialized_value: bytes, ttl: Optional[int] = CACHE_TTL):
+        """
+        Stores an already-pickled value; values larger than the whole budget are rejected.
+        """
+        size = len(serialized_value) + len(key)
+        expiry = time.time() + ttl if ttl else float("inf")
+        with self._lock:
+            self._remove(key)
+            if size > self.max_bytes:
+                self.stats["rejections"] += 1
+                return
+            while self._entries and (len(self._entries) >= self.max_entries
+                                     or self.used_bytes + size > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                self.stats["evictions"] += 1
+            self._entries[key] = (serialized_value, expiry, size)
+            self.used_bytes += size
+
+    def get(self, key: str) -> Optional[bytes]:
+        """
+        Returns the pickled value, or None if missing or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            if entry[1] <= time.time():
+                self._remove(key)
+                self.stats["expirations"] += 1
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[0]
+
+    def delete(self, key: str):
+        """Removes a key if present."""
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        """Removes every entry."""
+        with self._lock:
+            self._entries.clear()
+            self.used_bytes = 0
+
+    def sweep(self) -> int:
+        """
+        Removes every expired entry and returns how many were dropped.
+        """
+        now = time.time()
+        with self._lock:
+            expired = [key for key, (_, expiry, _) in self._entries.items() if expiry <= now]
+            for key in expired:
+                self._remove(key)
+            self.stats["expirations"] += len(expired)
+        return len(expired)
+
+    def close(self):
+        """Stops the background sweeper."""
+        self._stop_sweeper.set()
+
+    def get_stats(self) -> dict:
+        """Returns hit/miss/eviction counters plus entry count and bytes held."""
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return {
+                **self.stats,
+                "hit_rate": self.stats["hits"] / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": self.used_bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+            }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key: str):
+        return key in self._entries
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.used_bytes -= entry[2]
+
+    def _sweep_loop(self, interval: float):
+        while not self._stop_sweeper.wait(interval):
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f"Cache sweep failed: {e}")
+
+
+### 🚦 REQUEST COALESCING ###
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key into a single execution.
+
+    The first caller (the leader) runs the function; callers arriving while
+    it is in flight wait for and share its result or exception.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}  # key -> concurrent.futures.Future (threads)
+        self._async_calls = {}  # key -> asyncio.Future (event loop)
+        self.stats = {"executions": 0, "coalesced": 0}
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        """
+        Runs `fn` once per key across threads calling concurrently.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+                self.stats["executions"] += 1
+            else:
+                self.stats["coalesced"] += 1
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+    async def do_async(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Awaits `fn()` once per key across coroutines calling concurrently.
+
+        `fn()` runs as its own task that every caller awaits through a shield,
+        so a cancelled caller (even the first) never cancels the others' result.
+        """
+        task = self._async_calls.get(key)
+        if task is not None:
+            self.stats["coalesced"] += 1
+        else:
+            task = self._async_calls[key] = asyncio.ensure_future(fn())
+            self.stats["executions"] += 1
+
+            def finished(done: asyncio.Future):
+                if self._async_calls.get(key) is done:
+                    del self._async_calls[key]
+                done.cancelled() or done.exception()  # Retrieved even when every caller has gone
+
+            task.add_done_callback(finished)
+        return await asyncio.shield(task)
+
+
 ### 📂 CACHE MANAGER CLASS ###
 class CacheManager:
     """
     Handles key-value caching for inference responses and session data.
+
+    Two tiers: a bounded in-process L1 (`LocalCache`) in front of Redis (L2).
+    With Redis the L1 keeps entries only for `CACHE_L1_TTL` seconds so other
+    workers' writes become visible quickly; without Redis the L1 is the
+    whole cache and uses the caller's TTL.
     """
 
     def __init__(self):
-        self.local_cache = {}  # Fallback dictionary if Redis is unavailable
+        self.local_cache = LocalCache()  # L1 tier
+        self._flight = SingleFlight()
+        self.stats = {"l1_hits": 0, "l2_hits": 0, "misses": 0, "l2_errors": 0}
         if redis_available:
             print(f"✅ Redis connected at {REDIS_HOST}:{REDIS_PORT}")
         else:
@@ -46,47 +250,137 @@ class CacheManager:
 
     def set(self, key: str, value: dict, ttl: Optional[int] = CACHE_TTL):
         """
-        Stores a value in cache (either Redis or local).
+        Stores a value in cache (L2 when Redis is available, and L1).
         """
-        serialized_value = pickle.dumps(value)
-        if redis_available:
-            redis_client.setex(key, ttl, serialized_value)
-        else:
-            self.local_cache[key] = (serialized_value, time.time() + ttl)
+        self.set_bytes(key, pickle.dumps(value), ttl)
 
     def get(self, key: str) -> Optional[dict]:
         """
-        Retrieves a value from cache.
+        Retrieves a value from cache, checking L1 before Redis.
+        """
+        cached_value = self.get_bytes(key)
+        return pickle.loads(cached_value) if cached_value is not None else None
+
+    def set_bytes(self, key: str, serialized_value: bytes, ttl: Optional[int] = CACHE_TTL):
+        """
+        Stores an already-encoded value as is (for callers with their own compact format).
         """
         if redis_available:
-            cached_value = redis_client.get(key)
-            return pickle.loads(cached_value) if cached_value else None
+            try:
+                if ttl:
+                    redis_client.setex(key, ttl, serialized_value)
+                else:  # No expiry
+                    redis_client.set(key, serialized_value)
+            except redis.RedisError as e:
+                self.stats["l2_errors"] += 1
+                logger.error(f"Redis set failed for {key}: {e}")
+            self.local_cache.set(key, serialized_value, min(ttl, CACHE_L1_TTL) if ttl else CACHE_L1_TTL)
         else:
-            if key in self.local_cache:
-                value, expiry = self.local_cache[key]
-                if time.time() < expiry:
-                    return pickle.loads(value)
-                else:
-                    del self.local_cache[key]  # Remove expired entry
+            self.local_cache.set(key, serialized_value, ttl)
+
+    def get_bytes(self, key: str) -> Optional[bytes]:
+        """
+        Returns the stored bytes of a key, checking L1 before Redis.
+        """
+        cached_value = self.local_cache.get(key)
+        if cached_value is not None:
+            self.stats["l1_hits"] += 1
+            return cached_value
+
+        if redis_available:
+            try:
+                cached_value = redis_client.get(key)
+            except redis.RedisError as e:
+                self.stats["l2_errors"] += 1
+                logger.error(f"Redis get failed for {key}: {e}")
+                cached_value = None
+            if cached_value:
+                self.stats["l2_hits"] += 1
+                self.local_cache.set(key, cached_value, CACHE_L1_TTL)  # Promote hot key
+                return cached_value
+
+        self.stats["misses"] += 1
         return None
 
+    def get_or_compute(self, key: str, compute_fn: Callable[[], Any], ttl: Optional[int] = CACHE_TTL) -> Any:
+        """
+        Returns the cached value or computes, stores and returns it.
+
+        Concurrent misses for the same key (from different threads) share a
+        single `compute_fn` call, so a cold key cannot stampede the model.
+        `None` results are returned but never cached.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        def load():
+            value = self.get(key)  # A previous leader may have just filled it
+            if value is None:
+                value = compute_fn()
+                if value is not None:
+                    self.set(key, value, ttl)
+            return value
+
+        return self._flight.do(key, load)
+
+    async def aget_or_compute(self, key: str, compute_fn: Callable[[], Awaitable[Any]],
+                              ttl: Optional[int] = CACHE_TTL) -> Any:
+        """
+        Async variant of `get_or_compute` for coroutine producers (e.g. model calls).
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        async def load():
+            value = self.get(key)
+            if value is None:
+                value = await compute_fn()
+                if value is not None:
+                    self.set(key, value, ttl)
+            return value
+
+        return await self._flight.do_async(key, load)
+
     def delete(self, key: str):
         """
-        Deletes a key from the cache.
+        Deletes a key from both tiers.
         """
+        self.local_cache.delete(key)
         if redis_available:
-            redis_client.delete(key)
-        elif key in self.local_cache:
-            del self.local_cache[key]
+            try:
+                redis_client.delete(key)
+            except redis.RedisError as e:
+                self.stats["l2_errors"] += 1
+                logger.error(f"Redis delete failed for {key}: {e}")
 
     def clear_cache(self):
         """
         Clears all cache entries.
         """
+        self.local_cache.clear()
         if redis_available:
-            redis_client.flushdb()
-        else:
-            self.local_cache.clear()
+            try:
+                redis_client.flushdb()
+            except redis.RedisError as e:
+                self.stats["l2_errors"] += 1
+                logger.error(f"Redis flush failed: {e}")
+
+    def get_stats(self) -> dict:
+        """
+        Returns per-tier hit/miss counters, coalescing counters and L1 memory usage.
+        """
+        return {
+            "backend": "redis+local" if redis_available else "local",
+            **self.stats,
+            **self._flight.stats,
+            "local": self.local_cache.get_stats(),
+        }
+
+
+# Shared cache instance
+cache_manager = CacheManager()
 
 
 ### 🛠️ EXAMPLE USAGE ###
@@ -0,0 +1,171 @@
+"""
+chunking.py - Token-Aware Chunking and Near-Duplicate Filtering for Ingestion
+------------------------------------------------------------------------------
+🔹 Features:
+- Splits documents into overlapping chunks of at most CHUNK_MAX_TOKENS tokens
+  of the embedder's own tokenizer, so nothing is silently truncated at embedding time
+- Chunks are exact slices of the original text (tokenizer offsets), not decoded tokens
+- Exact duplicates: hash of the whitespace / case-normalized text
+- Near duplicates: MinHash signatures over word shingles with LSH banding;
+  a candidate counts when its estimated Jaccard similarity reaches DEDUP_THRESHOLD
+- Signatures are plain uint32 arrays with fixed hash seeds, so they can be
+  stored and compared against later: an optional store answers for the texts
+  of earlier ingestions (indexed band keys), and texts it holds can be
+  forgotten, so memory stays bounded by what is not stored yet
+
+📌 Dependencies:
+- Hugging Face tokenizers (token offsets)
+- NumPy (MinHash)
+"""
+
+import os
+import re
+import zlib
+import hashlib
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+### 🔧 CONFIGURATION ###
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", 254))  # MiniLM's 256-token window minus [CLS] / [SEP]
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", 32))  # Tokens repeated at the start of the next chunk
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", 0.85))  # Estimated Jaccard similarity of near duplicates
+DEDUP_NUM_PERM = int(os.getenv("DEDUP_NUM_PERM", 64))  # MinHash functions per signature
+DEDUP_BANDS = int(os.getenv("DEDUP_BANDS", 16))  # LSH bands; candidates from about (1 / bands) ** (1 / rows) similarity
+DEDUP_SHINGLE_WORDS = 5  # Words per shingle
+MINHASH_SEED = 1  # Fixed so that stored signatures stay comparable across runs
+
+_WORDS = re.compile(r"\w+")
+
+
+### ✂️ TOKEN CHUNKER CLASS ###
+class TokenChunker:
+    """
+    Splits text into windows of `max_tokens` tokens that overlap by `overlap` tokens.
+    """
+
+    def __init__(self, tokenizer, max_tokens: int = CHUNK_MAX_TOKENS, overlap: int = CHUNK_OVERLAP_TOKENS):
+        if not 0 <= overlap < max_tokens:
+            raise ValueError(f"Chunk overlap must be in [0, {max_tokens}); got {overlap}.")
+        self.tokenizer = tokenizer
+        self.max_tokens = max_tokens
+        self.overlap = overlap
+
+    def split(self, text: str) -> List[str]:
+        """The chunks of `text`, in order; short texts come back whole."""
+        try:
+            encoding = self.tokenizer(text, add_special_tokens=False, return_offsets_mapping=True, verbose=False)
+            offsets = encoding["offset_mapping"]
+        except NotImplementedError:  # Slow (Python) tokenizers have no offsets
+            encoding, offsets = self.tokenizer(text, add_special_tokens=False, verbose=False), None
+        ids = encoding["input_ids"]
+        if len(ids) <= self.max_tokens:
+            return [text]
+        chunks = []
+        step = self.max_tokens - self.overlap
+        for start in range(0, len(ids), step):
+            end = min(start + self.max_tokens, len(ids))
+            if offsets is not None:
+                chunks.append(text[offsets[start][0]:offsets[end - 1][1]])
+            else:
+                chunks.append(self.tokenizer.decode(ids[start:end]))
+            if end == len(ids):
+                break
+        return chunks
+
+
+### ♻️ NEAR-DUPLICATE FILTER CLASS ###
+class NearDuplicateFilter:
+    """
+    Remembers the texts added so far and flags exact and near duplicates of them.
+
+    Each text gets a MinHash signature; its `bands` slices are hashed into
+    buckets, and only texts sharing a bucket are compared, so checking
+    stays constant-time per text however many have been added.
+
+    A `store` (e.g. DocumentRetriever) is asked about the texts that are not
+    in memory: `store.dedup_lookup(content hash, band keys)` returns whether
+    the hash is stored and the signature bytes of the stored texts sharing a band.
+    """
+
+    def __init__(self, threshold: float = DEDUP_THRESHOLD, num_perm: int = DEDUP_NUM_PERM,
+                 bands: int = DEDUP_BANDS, shingle_words: int = DEDUP_SHINGLE_WORDS, store=None):
+        if num_perm % bands:
+            raise ValueError(f"MinHash size {num_perm} is not a multiple of the band count {bands}.")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.shingle_words = shingle_words
+        self.store = store
+        rng = np.random.default_rng(MINHASH_SEED)
+        self._a = rng.integers(1, 2 ** 63, num_perm, dtype=np.uint64) | np.uint64(1)  # Odd multipliers
+        self._b = rng.integers(0, 2 ** 63, num_perm, dtype=np.uint64)
+        self._hashes = set()
+        self._entries: "OrderedDict[int, Tuple[str, np.ndarray]]" = OrderedDict()  # Oldest first
+        self._next_entry = 0
+        self._buckets: List[Dict[bytes, List[int]]] = [{} for _ in range(bands)]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def check(self, text: str) -> Tuple[Optional[str], str, np.ndarray]:
+        """
+        Returns (duplicate, content hash, signature); duplicate is "exact", "near" or None.
+
+        The text is not remembered; `add` it if it is kept.
+        """
+        normalized = " ".join(text.lower().split())
+        content_hash = hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+        if content_hash in self._hashes:
+            return "exact", content_hash, None
+        signature = self.signature(normalized)
+        keys = self._band_keys(signature)
+        for band, key in enumerate(keys):
+            for candidate in self._buckets[band].get(key, ()):
+                if self._similar(self._entries[candidate][1], signature):
+                    return "near", content_hash, signature
+        if self.store is not None:
+            stored, candidates = self.store.dedup_lookup(content_hash, keys)
+            if stored:
+                return "exact", content_hash, None
+            for minhash in candidates:
+                if self._similar(np.frombuffer(minhash, dtype=np.uint32), signature):
+                    return "near", content_hash, signature
+        return None, content_hash, signature
+
+    def add(self, content_hash: str, signature: np.ndarray):
+        """Remembers a kept text by its `check` results."""
+        self._hashes.add(content_hash)
+        for band, key in enumerate(self._band_keys(signature)):
+            self._buckets[band].setdefault(key, []).append(self._next_entry)
+        self._entries[self._next_entry] = (content_hash, signature)
+        self._next_entry += 1
+
+    def forget(self, count: int):
+        """Drops the `count` oldest added texts, once the store answers for them."""
+        for _ in range(min(count, len(self._entries))):
+            entry, (content_hash, signature) = self._entries.popitem(last=False)
+            self._hashes.discard(content_hash)
+            for band, key in enumerate(self._band_keys(signature)):
+                bucket = self._buckets[band][key]
+                bucket.remove(entry)  # The oldest, so at the front
+                if not bucket:
+                    del self._buckets[band][key]
+
+    def signature(self, text: str) -> np.ndarray:
+        """MinHash of the text's word shingles: [num_perm] uint32."""
+        words = _WORDS.findall(text.lower())
+        n = self.shingle_words
+        shingles = {" ".join(words[i:i + n]) for i in range(max(1, len(words) - n + 1))}
+        x = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingles), dtype=np.uint64, count=len(shingles))
+        # Multiply-shift hashing: the high 32 bits of a * x + b (mod 2 ** 64)
+        hashed = (self._a[:, None] * x[None, :] + self._b[:, None]) >> np.uint64(32)
+        return hashed.min(axis=1).astype(np.uint32)
+
+    def _similar(self, candidate: np.ndarray, signature: np.ndarray) -> bool:
+        """Estimated Jaccard similarity reaches the threshold (signatures of another size never do)."""
+        return len(candidate) == self.num_perm and np.mean(candidate == signature) >= self.threshold
+
+    def _band_keys(self, signature: np.ndarray) -> List[bytes]:
+        return [band.tobytes() for band in signature.reshape(self.bands, -1)]
@@ -0,0 +1,206 @@
+"""
+context_window.py - Token-Budgeted Conversation Context
+--------------------------------------------------------
+🔹 Features:
+- Packs the most recent chat turns plus retrieved memory into a token budget
+- Caches per-turn token counts, so old turns are never re-tokenized
+- Keeps leading system prompts and the newest user message unconditionally
+- Trims to a low-water mark and keeps the window start stable per session,
+  so the session's prefix KV cache stays reusable between trims
+- Reports how many turns, memory fragments and tokens were dropped
+
+📌 Dependencies:
+- Tokenizer wrapper (`count_tokens`) from the model registry
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, List, Optional
+
+from app.utils.logger import logger
+
+### 🔧 CONFIGURATION ###
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 1536))  # Prompt tokens; keep below MAX_TOKEN_LENGTH
+CONTEXT_MEMORY_BUDGET = int(os.getenv("CONTEXT_MEMORY_BUDGET", 256))  # Share of the budget for retrieved memory
+CONTEXT_MEMORY_TOP_K = int(os.getenv("CONTEXT_MEMORY_TOP_K", 0))  # Memory fragments retrieved per turn, 0 = off
+CONTEXT_TRIM_RATIO = float(os.getenv("CONTEXT_TRIM_RATIO", 0.75))  # Fill to this fraction when turns must go
+CONTEXT_COUNT_CACHE_SIZE = int(os.getenv("CONTEXT_COUNT_CACHE_SIZE", 20000))  # Cached per-turn token counts
+CONTEXT_TRACKED_SESSIONS = int(os.getenv("CONTEXT_TRACKED_SESSIONS", 10000))  # Sessions with a pinned window start
+TURN_OVERHEAD_TOKENS = 4  # Chat-template role markers around each message
+MEMORY_HEADER = "Relevant memory:"
+
+
+class ContextWindow:
+    """
+    Messages to send to the model plus the accounting of what was left out.
+    """
+
+    def __init__(self, messages: List[dict], used_tokens: int, dropped_turns: int, dropped_tokens: int,
+                 memory_used: int, memory_dropped: int, budget: int):
+        self.messages = messages
+        self.used_tokens = used_tokens
+        self.dropped_turns = dropped_turns
+        self.dropped_tokens = dropped_tokens  # Turns and memory fragments that did not fit
+        self.memory_used = memory_used
+        self.memory_dropped = memory_dropped
+        self.budget = budget
+
+    def report(self) -> dict:
+        return {
+            "budget": self.budget,
+            "used_tokens": self.used_tokens,
+            "dropped_turns": self.dropped_turns,
+            "dropped_tokens": self.dropped_tokens,
+            "memory_used": self.memory_used,
+            "memory_dropped": self.memory_dropped,
+        }
+
+
+### 📂 CONTEXT WINDOW BUILDER CLASS ###
+class ContextWindowBuilder:
+    """
+    Builds bounded prompts for long-lived chat sessions.
+
+    Every message is counted once (`count_tokens(content)` plus a fixed
+    template overhead) and the count is cached by (role, content), so a
+    session's history costs one tokenization per new turn. Recent turns are
+    kept newest-first as a contiguous suffix; when they overflow, the window
+    is trimmed to `trim_ratio * budget` and that start is remembered per
+    session, so the following turns extend the same prefix instead of
+    sliding it (and invalidating its cached KV) on every request.
+    """
+
+    def __init__(self, count_tokens: Optional[Callable[[str], int]] = None, budget: int = CONTEXT_TOKEN_BUDGET,
+                 memory_budget: int = CONTEXT_MEMORY_BUDGET, trim_ratio: float = CONTEXT_TRIM_RATIO,
+                 cache_size: int = CONTEXT_COUNT_CACHE_SIZE, max_sessions: int = CONTEXT_TRACKED_SESSIONS):
+        self._count_tokens = count_tokens
+        self.budget = budget
+        self.memory_budget = memory_budget
+        self.trim_ratio = trim_ratio
+        self.cache_size = cache_size
+        self.max_sessions = max_sessions
+        self._counts = OrderedDict()  # (role, content) -> tokens including template overhead
+        self._starts = OrderedDict()  # session id -> index of the first history turn kept last time
+        self._lock = threading.Lock()
+        self.stats = {"builds": 0, "trims": 0, "count_hits": 0, "count_misses": 0,
+                      "dropped_turns": 0, "dropped_tokens": 0}
+
+    def count(self, message: dict) -> int:
+        """Tokens `message` adds to the prompt, from the cache when seen before."""
+        key = (message["role"], message["content"])
+        with self._lock:
+            tokens = self._counts.get(key)
+            if tokens is not None:
+                self._counts.move_to_end(key)
+                self.stats["count_hits"] += 1
+                return tokens
+        tokens = self._tokenize(message["content"]) + TURN_OVERHEAD_TOKENS
+        with self._lock:
+            self.stats["count_misses"] += 1
+            self._counts[key] = tokens
+            while len(self._counts) > self.cache_size:
+                self._counts.popitem(last=False)
+        return tokens
+
+    def build(self, messages: List[dict], memory: Optional[List[str]] = None,
+              session_id: Optional[str] = None) -> ContextWindow:
+        """
+        Fits `messages` (history ending with the new user turn) and `memory` into the budget.
+
+        Leading system messages and the last message are always kept;
+        memory fragments (best first) go into one system message right before
+        the latest turn, up to `memory_budget` tokens, so they never change
+        the cached prefix of the history.
+        """
+        n_system = 0
+        while n_system < len(messages) - 1 and messages[n_system]["role"] == "system":
+            n_system += 1
+        system, turns, latest = messages[:n_system], messages[n_system:-1], messages[-1]
+        fixed = sum(self.count(m) for m in system) + self.count(latest)
+
+        memory_message, memory_tokens, memory_used, memory_dropped_tokens = None, 0, 0, 0
+        if memory:
+            kept = []
+            memory_tokens = self._tokenize(MEMORY_HEADER) + TURN_OVERHEAD_TOKENS
+            limit = min(self.memory_budget, self.budget - fixed)
+            for fragment in memory:
+                tokens = self.count({"role": "memory", "content": fragment}) - TURN_OVERHEAD_TOKENS + 1
+                if memory_tokens + tokens <= limit:
+                    kept.append(fragment)
+                    memory_tokens += tokens
+                else:
+                    memory_dropped_tokens += tokens
+            if kept:
+                content = "\n".join([MEMORY_HEADER] + [f"- {fragment}" for fragment in kept])
+                memory_message = {"role": "system", "content": content}
+                memory_used = len(kept)
+            else:
+                memory_tokens = 0
+
+        counts = [self.count(m) for m in turns]
+        available = self.budget - fixed - memory_tokens
+        start = self._window_start(session_id, counts, available)
+        used = fixed + memory_tokens + sum(counts[start:])
+
+        packed = system + turns[start:] + ([memory_message] if memory_message else []) + [latest]
+        window = ContextWindow(packed, used, start, sum(counts[:start]) + memory_dropped_tokens,
+                               memory_used, len(memory or []) - memory_used, self.budget)
+        with self._lock:
+            self.stats["builds"] += 1
+            self.stats["dropped_turns"] += window.dropped_turns
+            self.stats["dropped_tokens"] += window.dropped_tokens
+        if used > self.budget:
+            logger.warning(f"⚠️ Context of {used} tokens exceeds the {self.budget}-token budget "
+                           f"(system prompt and latest message alone do not fit).")
+        return window
+
+    def forget(self, session_id: str):
+        """Drops the remembered window start of a session (e.g. history was cleared)."""
+        with self._lock:
+            self._starts.pop(session_id, None)
+
+    def get_stats(self) -> dict:
+        """Returns build, trim and token-count cache counters."""
+        with self._lock:
+            return {**self.stats, "cached_counts": len(self._counts), "tracked_sessions": len(self._starts),
+                    "budget": self.budget, "memory_budget": self.memory_budget}
+
+    def _window_start(self, session_id: Optional[str], counts: List[int], available: int) -> int:
+        """
+        Index of the oldest turn to keep: the session's previous start while the
+        suffix from it still fits, otherwise a fresh trim to the low-water mark.
+        """
+        total = sum(counts)
+        with self._lock:
+            previous = self._starts.get(session_id) if session_id is not None else None
+        if total <= available and not previous:
+            return 0
+        if previous is not None and previous <= len(counts) and sum(counts[previous:]) <= available:
+            start = previous
+        else:
+            start, kept = len(counts), 0
+            target = max(0, int(available * self.trim_ratio)) if total > available else available
+            while start > 0 and kept + counts[start - 1] <= target:
+                start -= 1
+                kept += counts[start]
+            if start:
+                with self._lock:
+                    self.stats["trims"] += 1
+        if session_id is not None:
+            with self._lock:
+                self._starts[session_id] = start
+                self._starts.move_to_end(session_id)
+                while len(self._starts) > self.max_sessions:
+                    self._starts.popitem(last=False)
+        return start
+
+    def _tokenize(self, text: str) -> int:
+        if self._count_tokens is None:
+            from app.models.tokenizer import get_tokenizer
+            return get_tokenizer().count_tokens(text)
+        return self._count_tokens(text)
+
+
+# Shared builder for the chat routes (token counts come from the registry tokenizer)
+context_builder = ContextWindowBuilder()
@@ -0,0 +1,234 @@
+"""
+fair_queue.py - Per-Tenant Weighted Fair Queueing
+--------------------------------------------------
+🔹 Features:
+- One queue per tenant, served by deficit round robin (DRR) over token cost
+- Tenant weights (e.g. by JWT role) scale each tenant's share of tokens
+- Strict priority classes: interactive traffic is always served before batch
+- Per-tenant and per-class queue wait-time histograms
+- Thread-safe, with a blocking `get` mirroring `queue.Queue`
+
+📌 Dependencies:
+- threading (the scheduler worker and API handlers share the queue)
+"""
+
+import os
+import time
+import queue
+import threading
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from typing import Any, Callable, Dict, List, Optional
+
+### 🔧 CONFIGURATION ###
+FAIR_QUEUE_QUANTUM = int(os.getenv("FAIR_QUEUE_QUANTUM", 512))  # Tokens credited per DRR round at weight 1
+FAIR_QUEUE_TRACKED_TENANTS = int(os.getenv("FAIR_QUEUE_TRACKED_TENANTS", 1000))  # Tenants with wait stats
+PRIORITY_CLASSES = ("interactive", "batch")  # Served in this order
+WAIT_BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]  # Seconds (last bucket is "more")
+
+
+class FairShare:
+    """
+    Who a request belongs to and how it should be scheduled.
+    """
+
+    def __init__(self, tenant: str = "default", weight: float = 1.0, priority: str = "interactive"):
+        if priority not in PRIORITY_CLASSES:
+            raise ValueError(f"priority must be one of {PRIORITY_CLASSES}")
+        if weight <= 0:
+            raise ValueError("weight must be positive")
+        self.tenant = tenant
+        self.weight = weight
+        self.priority = priority
+
+
+DEFAULT_SHARE = FairShare()
+
+
+class _Entry:
+    __slots__ = ("item", "cost", "share", "enqueued_at")
+
+    def __init__(self, item: Any, cost: int, share: FairShare):
+        self.item = item
+        self.cost = cost
+        self.share = share
+        self.enqueued_at = time.monotonic()
+
+
+class _TenantQueue:
+    __slots__ = ("tenant", "weight", "entries", "deficit", "credited")
+
+    def __init__(self, tenant: str, weight: float):
+        self.tenant = tenant
+        self.weight = weight
+        self.entries = deque()
+        self.deficit = 0.0
+        self.credited = False  # Received its quantum in the current visit
+
+
+### 📂 FAIR QUEUE CLASS ###
+class FairQueue:
+    """
+    Deficit-round-robin queue over tenants, inside strict priority classes.
+
+    Each visit to a tenant credits it `quantum * weight` tokens; it is
+    served while its deficit covers the cost of its head request, then the
+    next tenant gets a turn. Over time every backlogged tenant receives
+    tokens in proportion to its weight, however many requests it queues.
+    """
+
+    def __init__(self, quantum: int = FAIR_QUEUE_QUANTUM, max_tracked_tenants: int = FAIR_QUEUE_TRACKED_TENANTS):
+        self.quantum = quantum
+        self.max_tracked_tenants = max_tracked_tenants
+        self._classes: Dict[str, "OrderedDict[str, _TenantQueue]"] = {c: OrderedDict() for c in PRIORITY_CLASSES}
+        self._entries: Dict[int, List[_Entry]] = {}  # id(item) -> queued entries of that item, for removal
+        self._size = 0
+        self._cond = threading.Condition()
+        self._tenant_stats: "OrderedDict[str, dict]" = OrderedDict()
+        self._class_stats = {c: self._new_stats() for c in PRIORITY_CLASSES}
+
+    ### 📥 QUEUE API ###
+    def put(self, item: Any, cost: int, share: FairShare = DEFAULT_SHARE):
+        """Queues `item` costing `cost` tokens for `share.tenant`."""
+        entry = _Entry(item, max(1, cost), share)
+        with self._cond:
+            tenants = self._classes[share.priority]
+            tenant_queue = tenants.get(share.tenant)
+            if tenant_queue is None:
+                tenant_queue = tenants[share.tenant] = _TenantQueue(share.tenant, share.weight)
+            tenant_queue.weight = share.weight  # Latest role wins
+            tenant_queue.entries.append(entry)
+            self._entries.setdefault(id(item), []).append(entry)
+            self._size += 1
+            self._cond.notify()
+
+    def get(self, block: bool = True, timeout: Optional[float] = None,
+            accept: Optional[Callable[[Any], bool]] = None) -> Any:
+        """
+        Removes and returns the next item in fair order.
+
+        With `accept`, the next item is only removed if `accept(item)` is true;
+        otherwise it stays first in line. The check runs under the queue's lock,
+        so the item checked is the item returned.
+
+        Raises:
+            queue.Empty: Nothing queued (after `timeout` seconds when blocking),
+                or the next item was not accepted.
+        """
+        with self._cond:
+            if block and not self._cond.wait_for(lambda: self._size > 0, timeout):
+                raise queue.Empty
+            tenant_queue = self._select()
+            if tenant_queue is None or (accept is not None and not accept(tenant_queue.entries[0].item)):
+                raise queue.Empty
+            return self._pop(tenant_queue)
+
+    def get_nowait(self) -> Any:
+        return self.get(block=False)
+
+    def peek(self) -> Any:
+        """Returns the item `get` would return next, without removing it (None if empty)."""
+        with self._cond:
+            tenant_queue = self._select()
+            return tenant_queue.entries[0].item if tenant_queue is not None else None
+
+    def remove(self, item: Any) -> bool:
+        """Drops a queued item (e.g. cancelled or timed out); returns False if not queued."""
+        with self._cond:
+            entries = self._entries.get(id(item))
+            if not entries:
+                return False
+            entry = entries[0]
+            self._forget(entry)
+            tenants = self._classes[entry.share.priority]
+            tenant_queue = tenants[entry.share.tenant]
+            tenant_queue.entries.remove(entry)
+            self._size -= 1
+            if not tenant_queue.entries:
+                del tenants[entry.share.tenant]
+            return True
+
+    def qsize(self) -> int:
+        return self._size
+
+    def tenant_size(self, tenant: str) -> int:
+        """Number of queued items of `tenant` across priority classes."""
+        with self._cond:
+            return sum(len(t[tenant].entries) for t in self._classes.values() if tenant in t)
+
+    def __len__(self):
+        return self._size
+
+    ### 📊 STATS ###
+    def get_stats(self) -> dict:
+        """
+        Returns queue depth and wait-time histograms per priority class and per tenant
+        (bucket upper bounds in seconds under `buckets`).
+        """
+        with self._cond:
+            return {
+                "queued": self._size,
+                "queued_by_class": {c: sum(len(t.entries) for t in tenants.values())
+                                    for c, tenants in self._classes.items()},
+                "buckets": WAIT_BUCKETS,
+                "classes": {c: self._export(s) for c, s in self._class_stats.items()},
+                "tenants": {t: self._export(s) for t, s in self._tenant_stats.items()},
+            }
+
+    ### 🔒 INTERNALS (caller holds the condition) ###
+    def _select(self) -> Optional[_TenantQueue]:
+        """
+        Advances DRR until some tenant can afford its head request; leaves it first in line.
+        """
+        for tenants in self._classes.values():
+            while tenants:
+                tenant_queue = next(iter(tenants.values()))
+                if not tenant_queue.credited:
+                    tenant_queue.deficit += self.quantum * tenant_queue.weight
+                    tenant_queue.credited = True
+                if tenant_queue.deficit >= tenant_queue.entries[0].cost:
+                    return tenant_queue
+                tenant_queue.credited = False  # Turn over; keeps its deficit for the next visit
+                tenants.move_to_end(tenant_queue.tenant)
+        return None
+
+    def _pop(self, tenant_queue: _TenantQueue) -> Any:
+        entry = tenant_queue.entries.popleft()
+        tenant_queue.deficit -= entry.cost
+        self._forget(entry)
+        self._size -= 1
+        if not tenant_queue.entries:
+            # Idle tenants do not bank credit
+            del self._classes[entry.share.priority][tenant_queue.tenant]
+        self._record(entry)
+        return entry.item
+
+    def _forget(self, entry: _Entry):
+        entries = self._entries[id(entry.item)]
+        entries.remove(entry)
+        if not entries:
+            del self._entries[id(entry.item)]
+
+    @staticmethod
+    def _new_stats() -> dict:
+        return {"served": 0, "tokens": 0, "wait_seconds": 0.0, "histogram": [0] * (len(WAIT_BUCKETS) + 1)}
+
+    def _record(self, entry: _Entry):
+        wait = time.monotonic() - entry.enqueued_at
+        tenant_stats = self._tenant_stats.get(entry.share.tenant)
+        if tenant_stats is None:
+            if len(self._tenant_stats) >= self.max_tracked_tenants:
+                self._tenant_stats.popitem(last=False)
+            tenant_stats = self._tenant_stats[entry.share.tenant] = self._new_stats()
+        self._tenant_stats.move_to_end(entry.share.tenant)
+        bucket = bisect_left(WAIT_BUCKETS, wait)
+        for stats in (tenant_stats, self._class_stats[entry.share.priority]):
+            stats["served"] += 1
+            stats["tokens"] += entry.cost
+            stats["wait_seconds"] += wait
+            stats["histogram"][bucket] += 1
+
+    @staticmethod
+    def _export(stats: dict) -> dict:
+        return {**stats, "histogram": list(stats["histogram"]),
+                "mean_wait_seconds": stats["wait_seconds"] / stats["served"] if stats["served"] else 0.0}
@@ -0,0 +1,884 @@
+"""
+grammar.py - Constrained Decoding
+----------------------------------
+🔹 Features:
+- Compiles a regex or a JSON schema into a token-level automaton over the tokenizer vocabulary
+- Character DFA over classes of equivalent characters, by subset construction
+- Allowed-token masks computed once per automaton state (all tokens walked
+  through the DFA in one vectorized pass), so a decode step is a mask lookup
+- The end-of-sequence token is only allowed where the output is complete, and
+  generation stops on its own once nothing can follow
+- LRU cache of compiled grammars keyed by the hash of the response format
+
+📌 Dependencies:
+- numpy (vectorized token walks)
+- torch (boolean token masks)
+"""
+
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import torch
+
+from app.utils.logger import logger
+
+### 🔧 CONFIGURATION ###
+GRAMMAR_CACHE_SIZE = int(os.getenv("GRAMMAR_CACHE_SIZE", 64))  # Compiled grammars kept
+GRAMMAR_MAX_STATES = int(os.getenv("GRAMMAR_MAX_STATES", 2048))  # Larger automata are rejected
+GRAMMAR_MAX_REPEAT = int(os.getenv("GRAMMAR_MAX_REPEAT", 256))  # Largest {m,n} bound (each copy adds states)
+GRAMMAR_JSON_DEPTH = int(os.getenv("GRAMMAR_JSON_DEPTH", 2))  # Nesting allowed for free-form JSON values
+MAX_SCHEMA_DEPTH = 16  # Guards against recursive $refs
+
+DEAD = -1  # Automaton state with no way to a match
+
+
+class GrammarError(ValueError):
+    """An invalid or unsupported response format, schema or pattern (answered with a 400)."""
+
+
+### 🔤 REGULAR EXPRESSIONS ###
+class CharSet:
+    """A set of characters: explicit characters and ranges, optionally negated."""
+
+    __slots__ = ("chars", "ranges", "negated")
+
+    def __init__(self, chars=(), ranges=(), negated: bool = False):
+        self.chars = frozenset(chars)
+        self.ranges = tuple(ranges)
+        self.negated = negated
+
+    def __contains__(self, ch: str) -> bool:
+        hit = ch in self.chars or any(lo <= ch <= hi for lo, hi in self.ranges)
+        return hit != self.negated
+
+
+_DIGITS = [("0", "9")]
+_WORD = [("a", "z"), ("A", "Z"), ("0", "9")]
+_SPACE = " \t\n\r\f\v"
+_CLASS_ESCAPES = {
+    "d": CharSet(ranges=_DIGITS), "D": CharSet(ranges=_DIGITS, negated=True),
+    "w": CharSet("_", _WORD), "W": CharSet("_", _WORD, negated=True),
+    "s": CharSet(_SPACE), "S": CharSet(_SPACE, negated=True),
+}
+_LITERAL_ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "f": "\f", "v": "\v", "0": "\0"}
+_ANY = CharSet("\n", negated=True)
+
+
+class _RegexParser:
+    """
+    Recursive-descent parser for the regex subset used by schemas: literals,
+    escapes, `.`, classes, groups, `|` and the `* + ? {m,n}` quantifiers.
+
+    Produces a small AST of tuples: ("char", CharSet), ("cat", [nodes]),
+    ("alt", [nodes]) and ("repeat", node, min, max-or-None). Anchors are
+    ignored since the pattern always has to match the whole output.
+    """
+
+    def __init__(self, pattern: str):
+        self.pattern = pattern
+        self.pos = 0
+
+    def parse(self):
+        node = self._alternation()
+        if self.pos != len(self.pattern):
+            raise GrammarError(f"Unexpected '{self.pattern[self.pos]}' at position {self.pos} of the pattern.")
+        return node
+
+    def _peek(self) -> Optional[str]:
+        return self.pattern[self.pos] if self.pos < len(self.pattern) else None
+
+    def _next(self) -> str:
+        if self.pos >= len(self.pattern):
+            raise GrammarError("Unexpected end of the pattern.")
+        ch = self.pattern[self.pos]
+        self.pos += 1
+        return ch
+
+    def _alternation(self):
+        branches = [self._sequence()]
+        while self._peek() == "|":
+            self.pos += 1
+            branches.append(self._sequence())
+        return branches[0] if len(branches) == 1 else ("alt", branches)
+
+    def _sequence(self):
+        items = []
+        while self._peek() not in (None, "|", ")"):
+            items.append(self._quantified(self._atom()))
+        return ("cat", items)
+
+    def _atom(self):
+        ch = self._next()
+        if ch == "(":
+            if self.pattern.startswith("?:", self.pos):
+                self.pos += 2
+            node = self._alternation()
+            if self._peek() != ")":
+                raise GrammarError("Unbalanced parenthesis in the pattern.")
+            self.pos += 1
+            return node
+        if ch == "[":
+            return ("char", self._class())
+        if ch == ".":
+            return ("char", _ANY)
+        if ch == "\\":
+            return ("char", self._escape())
+        if ch in "^$":
+            return ("cat", [])
+        if ch in "*+?{":
+            raise GrammarError(f"Nothing to repeat at position {self.pos - 1} of the pattern.")
+        return ("char", CharSet(ch))
+
+    def _quantified(self, node):
+        while True:
+            ch = self._peek()
+            if ch == "*":
+                lo, hi = 0, None
+            elif ch == "+":
+                lo, hi = 1, None
+            elif ch == "?":
+                lo, hi = 0, 1
+            elif ch == "{":
+                end = self.pattern.find("}", self.pos)
+                spec = self.pattern[self.pos + 1:end] if end > 0 else ""
+                low, comma, high = spec.partition(",")
+                try:
+                    lo = int(low)
+                    hi = int(high) if high.strip() else (None if comma else lo)
+                except ValueError:
+                    raise GrammarError(f"Invalid repetition at position {self.pos} of the pattern.")
+                if (hi is not None and hi < lo) or max(lo, hi or 0) > GRAMMAR_MAX_REPEAT:
+                    raise GrammarError(f"Repetition {{{spec}}} is out of range (max {GRAMMAR_MAX_REPEAT}).")
+                self.pos = end
+            else:
+                return node
+            self.pos += 1
+            if self._peek() == "?":
+                self.pos += 1  # Lazy quantifiers match the same language
+            node = ("repeat", node, lo, hi)
+
+    def _class(self) -> CharSet:
+        negated = self._peek() == "^"
+        if negated:
+            self.pos += 1
+        chars, ranges = set(), []
+        first = True
+        while True:
+            ch = self._next()
+            if ch == "]" and not first:
+                return CharSet(chars, ranges, negated)
+            first = False
+            if ch == "\\":
+                escaped = self._escape()
+                if escaped.negated:
+                    raise GrammarError("Negated class escapes are not supported inside [...].")
+                if escaped.ranges or len(escaped.chars) != 1:
+                    chars |= escaped.chars
+                    ranges.extend(escaped.ranges)
+                    continue
+                ch = next(iter(escaped.chars))
+            if self._peek() == "-" and self.pattern[self.pos + 1:self.pos + 2] not in ("]", ""):
+                self.pos += 1
+                hi = self._next()
+                if hi == "\\":
+                    escaped = self._escape()
+                    if escaped.negated or escaped.ranges or len(escaped.chars) != 1:
+                        raise GrammarError("Invalid range in character class.")
+                    hi = next(iter(escaped.chars))
+                if hi < ch:
+                    raise GrammarError(f"Invalid range {ch}-{hi} in character class.")
+                ranges.append((ch, hi))
+            else:
+                chars.add(ch)
+
+    def _escape(self) -> CharSet:
+        ch = self._next()
+        if ch in _CLASS_ESCAPES:
+            return _CLASS_ESCAPES[ch]
+        if ch in "ux":
+            size = 4 if ch == "u" else 2
+            digits = self.pattern[self.pos:self.pos + size]
+            if len(digits) != size or any(c not in "0123456789abcdefABCDEF" for c in digits):
+                raise GrammarError(f"Invalid \\{ch} escape in the pattern.")
+            self.pos += size
+            return CharSet(chr(int(digits, 16)))
+        if ch in _LITERAL_ESCAPES:
+            return CharSet(_LITERAL_ESCAPES[ch])
+        if ch.isalnum():
+            raise GrammarError(f"Unsupported escape \\{ch} in the pattern.")
+        return CharSet(ch)
+
+
+class _NFA:
+    """Thompson-style NFA: epsilon moves plus character-set edges."""
+
+    def __init__(self, ast):
+        self.eps: List[List[int]] = []
+        self.edges: List[List[tuple]] = []
+        self.start = self._state()
+        self.accept = self._state()
+        self._build(ast, self.start, self.accept)
+
+    def _state(self) -> int:
+        self.eps.append([])
+        self.edges.append([])
+        return len(self.eps) - 1
+
+    def _build(self, node, start: int, end: int):
+        kind = node[0]
+        if kind == "char":
+            self.edges[start].append((node[1], end))
+        elif kind == "alt":
+            for branch in node[1]:
+                self._build(branch, start, end)
+        elif kind == "cat":
+            current = start
+            for item in node[1]:
+                nxt = self._state()
+                self._build(item, current, nxt)
+                current = nxt
+            self.eps[current].append(end)
+        else:  # repeat
+            _, item, lo, hi = node
+            current = start
+            for _ in range(lo):
+                nxt = self._state()
+                self._build(item, current, nxt)
+                current = nxt
+            if hi is None:
+                loop = self._state()
+                self.eps[current].append(loop)
+                self._build(item, loop, loop)
+                self.eps[loop].append(end)
+                return
+            for _ in range(hi - lo):
+                nxt = self._state()
+                self._build(item, current, nxt)
+                self.eps[current].append(end)
+                current = nxt
+            self.eps[current].append(end)
+
+    def closure(self, states) -> frozenset:
+        seen = set(states)
+        stack = list(states)
+        while stack:
+            for nxt in self.eps[stack.pop()]:
+                if nxt not in seen:
+                    seen.add(nxt)
+                    stack.append(nxt)
+        return frozenset(seen)
+
+
+class CharAutomaton:
+    """
+    Character-level DFA of a regex, built lazily from its NFA.
+
+    DFA states are numbered as they are discovered; every live NFA state can
+    still reach the accept state, so any non-empty state is a viable prefix.
+    """
+
+    def __init__(self, pattern: str):
+        self._nfa = _NFA(_RegexParser(pattern).parse())
+        self._sets: List[frozenset] = []
+        self._ids: Dict[frozenset, int] = {}
+        self._transitions: Dict[tuple, int] = {}
+        self.accepting: List[bool] = []
+        self.start = self._intern(self._nfa.closure([self._nfa.start]))
+
+    def _intern(self, states: frozenset) -> int:
+        state = self._ids.get(states)
+        if state is None:
+            state = self._ids[states] = len(self._sets)
+            self._sets.append(states)
+            self.accepting.append(self._nfa.accept in states)
+        return state
+
+    def step(self, state: int, ch: str) -> int:
+        """Next state after reading `ch`, or DEAD."""
+        key = (state, ch)
+        nxt = self._transitions.get(key)
+        if nxt is None:
+            edges = self._nfa.edges
+            targets = [target for s in self._sets[state] for chars, target in edges[s] if ch in chars]
+            nxt = self._intern(self._nfa.closure(targets)) if targets else DEAD
+            self._transitions[key] = nxt
+        return nxt
+
+    def edge_sets(self):
+        """Every character set on an NFA edge."""
+        return [chars for edges in self._nfa.edges for chars, _ in edges]
+
+    def matches(self, text: str) -> bool:
+        """True when `text` as a whole matches the pattern."""
+        state = self.start
+        for ch in text:
+            state = self.step(state, ch)
+            if state == DEAD:
+                return False
+        return self.accepting[state]
+
+
+### 🧾 JSON SCHEMA ###
+_WS = "[ ]?"  # One optional space around separators; the model picks compact or spaced JSON
+_STRING_CHAR = r'([^"\\\x00-\x1f]|\\["\\/bfnrt]|\\u[0-9a-fA-F]{4})'
+_STRING = f'"{_STRING_CHAR}*"'
+_ESCAPED_IN_STRING = CharSet('"\\', [("\x00", "\x1f")])  # Never written raw inside a JSON string
+_NOTHING = "[^\\u0000-\U0010ffff]"  # Matches no character
+_INTEGER = r"-?(0|[1-9][0-9]*)"
+_NUMBER = r"-?(0|[1-9][0-9]*)(\.[0-9]+)?([eE][+-]?[0-9]+)?"
+_FORMATS = {
+    "date": r'"[0-9]{4}-[0-9]{2}-[0-9]{2}"',
+    "time": r'"[0-9]{2}:[0-9]{2}:[0-9]{2}(\.[0-9]+)?(Z|[+-][0-9]{2}:[0-9]{2})?"',
+    "date-time": r'"[0-9]{4}-[0-9]{2}-[0-9]{2}T[0-9]{2}:[0-9]{2}:[0-9]{2}(\.[0-9]+)?(Z|[+-][0-9]{2}:[0-9]{2})?"',
+    "uuid": r'"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}"',
+}
+
+
+def _string_pattern(pattern: str) -> str:
+    """
+    A schema `pattern` limited to characters a JSON string holds unescaped.
+
+    The pattern is parsed and written back with `"`, `\\` and control
+    characters removed from every character set, so a match can neither end
+    the string early nor start an escape. Values needing those characters
+    cannot be produced; everything else the pattern allows still can.
+    """
+    return _regex_of(_RegexParser(pattern).parse())
+
+
+def _regex_of(node) -> str:
+    """Regex text of a parsed pattern, with character sets restricted to unescaped string characters."""
+    kind = node[0]
+    if kind == "char":
+        return _class_of(node[1])
+    if kind == "cat":
+        return "(" + "".join(_regex_of(item) for item in node[1]) + ")"
+    if kind == "alt":
+        return "(" + "|".join(_regex_of(branch) for branch in node[1]) + ")"
+    _, item, lo, hi = node
+    return _regex_of(item) + "{%d,%s}" % (lo, "" if hi is None else hi)
+
+
+def _class_of(chars: CharSet) -> str:
+    """`[...]` text of `chars` minus the characters a JSON string must escape."""
+    if chars.negated:
+        singles, ranges = set(chars.chars) | {'"', "\\"}, list(chars.ranges) + [("\x00", "\x1f")]
+    else:
+        singles, ranges = {c for c in chars.chars if c not in _ESCAPED_IN_STRING}, []
+        for lo, hi in chars.ranges:
+            lo = max(lo, " ")
+            for cut in ('"', "\\"):  # Split the range around each excluded character
+                if lo <= cut <= hi:
+                    if lo < cut:
+                        ranges.append((lo, chr(ord(cut) - 1)))
+                    lo = chr(ord(cut) + 1)
+            if lo <= hi:
+                ranges.append((lo, hi))
+        if not singles and not ranges:
+            return _NOTHING  # Only escaped characters: this branch of the pattern can never match
+    body = "".join(map(_class_char, sorted(singles))) + "".join(f"{_class_char(lo)}-{_class_char(hi)}"
+                                                                  for lo, hi in ranges)
+    return ("[^" if chars.negated else "[") + body + "]"
+
+
+def _class_char(ch: str) -> str:
+    """One character inside `[...]`, escaped when the class syntax or the parser needs it."""
+    if ch in "]\\^-" or ch < " ":
+        return "\\u%04x" % ord(ch)
+    return ch
+
+
+def _literal(value) -> str:
+    return re.escape(json.dumps(value, ensure_ascii=False))
+
+
+def _json_value(depth: int) -> str:
+    """Any JSON value, with objects and arrays nested at most `depth` levels."""
+    options = [_STRING, _NUMBER, "true", "false", "null"]
+    if depth > 0:
+        inner = _json_value(depth - 1)
+        options.append(_object_of(inner))
+        options.append(_array_of(inner))
+    return "(" + "|".join(options) + ")"
+
+
+def _object_of(value: str) -> str:
+    pair = f"{_STRING}{_WS}:{_WS}{value}"
+    return rf"\{{{_WS}({pair}({_WS},{_WS}{pair})*)?{_WS}\}}"
+
+
+def _array_of(item: str, min_items: int = 0, max_items: Optional[int] = None) -> str:
+    sep = f"{_WS},{_WS}"
+    if max_items == 0:
+        return rf"\[{_WS}\]"
+    more_lo = max(min_items - 1, 0)
+    more = f"({sep}{item})" + ("{%d,%s}" % (more_lo, "" if max_items is None else max_items - 1))
+    items = f"{item}{more}"
+    return rf"\[{_WS}" + (items if min_items > 0 else f"({items})?") + rf"{_WS}\]"
+
+
+def schema_to_regex(schema: dict, root: Optional[dict] = None, depth: int = 0) -> str:
+    """
+    Translates a JSON schema into a regex over its JSON serializations.
+
+    Supports type (including lists), enum, const, anyOf / oneOf, local
+    $refs, string length / pattern / common formats, arrays with item
+    counts and objects whose properties appear in schema order (optional
+    ones may be left out). Schemas without a type accept any JSON value up
+    to `GRAMMAR_JSON_DEPTH` levels of nesting.
+
+    Raises:
+        GrammarError: The schema uses something that cannot be expressed.
+    """
+    root = schema if root is None else root
+    if depth > MAX_SCHEMA_DEPTH:
+        raise GrammarError("Schema nesting is too deep (recursive $ref?).")
+    if not isinstance(schema, dict):
+        if schema is True:
+            return _json_value(GRAMMAR_JSON_DEPTH)
+        raise GrammarError(f"Unsupported schema: {schema!r}")
+
+    if "$ref" in schema:
+        return schema_to_regex(_resolve_ref(schema["$ref"], root), root, depth + 1)
+    if "const" in schema:
+        return _literal(schema["const"])
+    if "enum" in schema:
+        return "(" + "|".join(_literal(v) for v in schema["enum"]) + ")"
+    for key in ("anyOf", "oneOf"):
+        if key in schema:
+            return "(" + "|".join(schema_to_regex(s, root, depth + 1) for s in schema[key]) + ")"
+    if "allOf" in schema and len(schema["allOf"]) == 1:
+        return schema_to_regex(schema["allOf"][0], root, depth + 1)
+
+    kind = schema.get("type")
+    if isinstance(kind, list):
+        return "(" + "|".join(schema_to_regex({**schema, "type": k}, root, depth + 1) for k in kind) + ")"
+    if kind == "string":
+        if "pattern" in schema:
+            return f'"({_string_pattern(schema["pattern"])})"'
+        if schema.get("format") in _FORMATS:
+            return _FORMATS[schema["format"]]
+        lo, hi = schema.get("minLength", 0), schema.get("maxLength")
+        if lo == 0 and hi is None:
+            return _STRING
+        return f'"{_STRING_CHAR}' + "{%d,%s}" % (lo, "" if hi is None else hi) + '"'
+    if kind == "integer":
+        return _INTEGER
+    if kind == "number":
+        return _NUMBER
+    if kind == "boolean":
+        return "(true|false)"
+    if kind == "null":
+        return "null"
+    if kind == "array":
+        items = schema.get("items")
+        item = _json_value(GRAMMAR_JSON_DEPTH - 1) if items is None else schema_to_regex(items, root, depth + 1)
+        return _array_of(item, schema.get("minItems", 0), schema.get("maxItems"))
+    if kind == "object":
+        return _object_regex(schema, root, depth)
+    if kind is None:
+        return _json_value(GRAMMAR_JSON_DEPTH)
+    raise GrammarError(f"Unsupported schema type: {kind!r}")
+
+
+def _object_regex(schema: dict, root: dict, depth: int) -> str:
+    properties = schema.get("properties") or {}
+    if not properties:
+        extra = schema.get("additionalProperties", True)
+        if extra is False:
+            return rf"\{{{_WS}\}}"
+        value = _json_value(GRAMMAR_JSON_DEPTH - 1) if extra in (True, {}) else schema_to_regex(extra, root, depth + 1)
+        return _object_of(value)
+
+    required = set(schema.get("required", []))
+    sep = f"{_WS},{_WS}"
+    pairs = [(f"{_literal(name)}{_WS}:{_WS}{schema_to_regex(sub, root, depth + 1)}", name in required)
+             for name, sub in properties.items()]
+    # One alternative per property that can come first; the ones after it keep their order
+    alternatives = []
+    for first, (pair, is_required) in enumerate(pairs):
+        rest = "".join(f"({sep}{p})" if req else f"({sep}{p})?" for p, req in pairs[first + 1:])
+        alternatives.append(f"({pair}{rest})")
+        if is_required:
+            break  # Later properties cannot come first
+    body = "(" + "|".join(alternatives) + ")"
+    if not required.intersection(properties):
+        body += "?"
+    return rf"\{{{_WS}{body}{_WS}\}}"
+
+
+def _resolve_ref(ref: str, root: dict) -> dict:
+    if not ref.startswith("#/"):
+        raise GrammarError(f"Only local $refs are supported, got {ref!r}.")
+    node = root
+    for part in ref[2:].split("/"):
+        if not isinstance(node, dict) or part not in node:
+            raise GrammarError(f"Unresolvable $ref {ref!r}.")
+        node = node[part]
+    return node
+
+
+def response_format_pattern(response_format: Optional[dict]) -> Optional[str]:
+    """
+    The regex a response format constrains output to; None for free text.
+
+    Accepted formats: `{"type": "json_schema", "schema": {...}}` (or the
+    OpenAI-style `{"json_schema": {"schema": {...}}}`), `{"type": "json_object"}`
+    and `{"type": "regex", "pattern": "..."}`.
+
+    Raises:
+        GrammarError: Unknown format type or unsupported schema.
+    """
+    if not response_format:
+        return None
+    kind = response_format.get("type")
+    if kind in (None, "text"):
+        return None
+    if kind == "json_object":
+        return _object_of(_json_value(GRAMMAR_JSON_DEPTH))
+    if kind == "json_schema":
+        schema = response_format.get("schema")
+        if schema is None:
+            schema = (response_format.get("json_schema") or {}).get("schema")
+        if schema is None:
+            raise GrammarError("json_schema response format needs a schema.")
+        return schema_to_regex(schema)
+    if kind == "regex":
+        if not response_format.get("pattern"):
+            raise GrammarError("regex response format needs a pattern.")
+        return response_format["pattern"]
+    raise GrammarError(f"Unknown response format type: {kind!r}")
+
+
+def validate_response_format(response_format: Optional[dict]):
+    """
+    Checks a response format without compiling it against a vocabulary.
+
+    Raises:
+        GrammarError: Unknown format type, unsupported schema or invalid pattern.
+    """
+    pattern = response_format_pattern(response_format)
+    if pattern is not None:
+        _RegexParser(pattern).parse()
+
+
+### 🧩 TOKEN AUTOMATON ###
+class TokenVocabulary:
+    """
+    Text of every token id, laid out for walking all tokens through a DFA at once.
+
+    Entries are None for tokens that cannot appear in constrained output
+    (special tokens, byte fragments of multi-byte characters). Usable tokens
+    are sorted longest first, so column j (the j-th character, as an index
+    into `alphabet`, of every token longer than j) covers a prefix of `order`.
+    """
+
+    def __init__(self, strings: Sequence[Optional[str]], eos_token_id: Optional[int] = None):
+        self.strings = list(strings)
+        self.size = len(self.strings)
+        self.eos_token_id = eos_token_id
+        usable = sorted((i for i, text in enumerate(self.strings) if text), key=lambda i: -len(self.strings[i]))
+        self.order = np.array(usable, dtype=np.int64)
+
+        index: Dict[str, int] = {}
+        columns: List[list] = []
+        digest = hashlib.sha256()
+        for token_id in usable:
+            for j, ch in enumerate(self.strings[token_id]):
+                if j == len(columns):
+                    columns.append([])
+                columns[j].append(index.setdefault(ch, len(index)))
+        for text in self.strings:
+            digest.update((text or "").encode("utf-8", "surrogatepass") + b"\x00")
+        digest.update(str(eos_token_id).encode())
+        self.alphabet = list(index)  # Distinct characters of the vocabulary
+        self.columns = [np.array(column, dtype=np.int32) for column in columns]
+        self.fingerprint = digest.hexdigest()[:16]
+
+
+class Grammar:
+    """
+    Token-level automaton: which token ids may follow in each state, and where they lead.
+
+    Compilation partitions the vocabulary's characters into classes the
+    pattern cannot tell apart, builds the full DFA over those classes, and
+    then, per state, walks every token through the transition table in one
+    vectorized pass. States from which the vocabulary cannot complete a
+    match are pruned, so the model is never steered into a dead end. Masks
+    are stored as packed bits, deduplicated across states, and unpacked
+    once per device; a decode step is a lookup.
+    """
+
+    def __init__(self, pattern: str, vocab: TokenVocabulary, key: str = "", max_states: int = GRAMMAR_MAX_STATES):
+        started = time.perf_counter()
+        self.pattern = pattern
+        self.vocab = vocab
+        self.key = key
+        self.dfa = CharAutomaton(pattern)
+        self.stats = {"mask_lookups": 0}
+
+        classes, representatives = self._char_classes()
+        table = []
+        while len(table) < len(self.dfa.accepting):  # States are numbered as they are discovered
+            if len(table) >= max_states:
+                raise GrammarError(f"Pattern needs more than {max_states} automaton states.")
+            table.append([self.dfa.step(len(table), ch) for ch in representatives])
+        self._dead = len(table)  # Absorbing row standing in for DEAD
+        self._table = np.array(table + [[self._dead] * len(representatives)], dtype=np.int32)
+        self._table[self._table == DEAD] = self._dead
+        self._build_trie(classes)
+
+        # Character-level liveness is exact when the vocabulary spells every character on its own
+        n_states = len(table)
+        self._live = self._char_live()
+        if not self._live[self.dfa.start]:
+            raise GrammarError("The pattern cannot be matched with characters of the vocabulary.")
+        self._mask_ids = [-1] * n_states  # State -> index into the deduplicated packed masks
+        self._packed: List[np.ndarray] = []
+        self._final = [True] * n_states
+        successors = {}
+        unique: Dict[bytes, int] = {}
+        for state in np.flatnonzero(self._live[:n_states]).tolist():
+            ends = self._walk(state)
+            reached = np.zeros(len(self._live), dtype=bool)
+            reached[ends] = True
+            successors[state] = np.flatnonzero(reached & self._live)
+            self._set_mask(state, self._live[ends], unique)
+
+        # A state the vocabulary cannot finish from must not be entered (e.g. no token for "m" in "name")
+        token_live = np.zeros_like(self._live)
+        token_live[:n_states] = np.array(self.dfa.accepting[:n_states]) & self._live[:n_states]
+        changed = True
+        while changed:
+            changed = False
+            for state, nxt in successors.items():
+                if not token_live[state] and token_live[nxt].any():
+                    token_live[state] = changed = True
+        if not token_live[self.dfa.start]:
+            raise GrammarError("No token sequence of the vocabulary can match the pattern.")
+        if (token_live != self._live).any():
+            self._live = token_live
+            for state, nxt in successors.items():
+                if token_live[state] and not token_live[nxt].all():
+                    self._set_mask(state, self._live[self._walk(state)], unique)
+        self._device_masks: Dict[tuple, torch.Tensor] = {}
+        self.compile_ms = (time.perf_counter() - started) * 1000
+
+    @property
+    def start(self) -> int:
+        return self.dfa.start
+
+    def begin(self) -> "GrammarState":
+        """A fresh per-sequence cursor at the start state."""
+        return GrammarState(self)
+
+    def next_state(self, state: int, token_id: int) -> int:
+        """State after emitting `token_id` (DEAD if the token was not allowed)."""
+        text = self.vocab.strings[token_id] if 0 <= token_id < self.vocab.size else None
+        if state == DEAD or not text:
+            return DEAD
+        for ch in text:
+            state = self.dfa.step(state, ch)
+            if state == DEAD:
+                return DEAD
+        return state if self._live[state] else DEAD
+
+    def is_final(self, state: int) -> bool:
+        """True when nothing but end-of-sequence can follow."""
+        return state == DEAD or self._final[state]
+
+    def is_accepting(self, state: int) -> bool:
+        return state != DEAD and self.dfa.accepting[state]
+
+    def mask(self, state: int, size: int, device="cpu") -> torch.Tensor:
+        """
+        Boolean mask of allowed token ids, sized to the model's logits (extra ids are never allowed).
+        """
+        self.stats["mask_lookups"] += 1
+        key = (self._mask_ids[state], size, str(device))
+        mask = self._device_masks.get(key)
+        if mask is None:
+            bits = np.unpackbits(self._packed[key[0]], count=self.vocab.size).astype(bool)
+            mask = torch.zeros(size, dtype=torch.bool)
+            n = min(size, self.vocab.size)
+            mask[:n] = torch.from_numpy(bits[:n])
+            mask = self._device_masks[key] = mask.to(device)
+        return mask
+
+    def matches(self, text: str) -> bool:
+        """True when `text` is a complete match (e.g. to validate a finished output)."""
+        return self.dfa.matches(text)
+
+    def get_stats(self) -> dict:
+        return {**self.stats, "states": int(self._live.sum()), "unique_masks": len(self._packed),
+                "char_classes": self._table.shape[1], "trie_nodes": self._nodes, "compile_ms": round(self.compile_ms, 1)}
+
+    def _set_mask(self, state: int, viable: np.ndarray, unique: Dict[bytes, int]):
+        """Stores a state's allowed tokens as packed bits, shared with every state allowing the same set."""
+        allowed = np.zeros(self.vocab.size, dtype=bool)
+        allowed[self.vocab.order[viable]] = True
+        eos = self.vocab.eos_token_id
+        if self.dfa.accepting[state] and eos is not None and eos < self.vocab.size:
+            allowed[eos] = True
+        packed = np.packbits(allowed)
+        self._mask_ids[state] = unique.setdefault(packed.tobytes(), len(unique))
+        if self._mask_ids[state] == len(self._packed):
+            self._packed.append(packed)
+        self._final[state] = not viable.any()
+
+    def _char_live(self) -> np.ndarray:
+        """States that reach an accepting state over characters of the vocabulary (DEAD row last)."""
+        live = np.array(self.dfa.accepting[:self._dead] + [False])
+        while True:
+            grown = live | live[self._table].any(axis=1)
+            grown[self._dead] = False
+            if (grown == live).all():
+                return live
+            live = grown
+
+    def _char_classes(self):
+        """
+        Maps every vocabulary character to a class of characters the pattern treats alike.
+
+        Returns:
+            tuple: (class index per alphabet entry, one representative character per class)
+        """
+        literals, complex_sets = set(), {}
+        for edges in self.dfa.edge_sets():
+            if not edges.negated and not edges.ranges:
+                literals |= edges.chars
+            else:
+                complex_sets[(edges.chars, edges.ranges, edges.negated)] = edges
+        complex_sets = list(complex_sets.values())
+        signatures: Dict[tuple, int] = {}
+        representatives: List[str] = []
+        classes = np.empty(len(self.vocab.alphabet), dtype=np.int32)
+        for i, ch in enumerate(self.vocab.alphabet):
+            signature = (ch if ch in literals else None, tuple(ch in chars for chars in complex_sets))
+            cls = signatures.get(signature)
+            if cls is None:
+                cls = signatures[signature] = len(representatives)
+                representatives.append(ch)
+            classes[i] = cls
+        return classes, representatives
+
+    def _build_trie(self, classes: np.ndarray):
+        """
+        Merges tokens with equal class prefixes into a trie, stored level by level.
+
+        Tokens the pattern cannot tell apart share all their nodes, so a
+        walk costs one table lookup per distinct prefix instead of one per
+        character of the vocabulary.
+        """
+        n_classes = max(self._table.shape[1], 1)
+        node = np.full(len(self.vocab.order), -1, dtype=np.int64)  # Current trie node of each token
+        self._levels = []  # (first node index, parent node per node, class per node)
+        offset = 0
+        for column in self.vocab.columns:
+            n = len(column)
+            keys, inverse = np.unique((node[:n] + 1) * n_classes + classes[column], return_inverse=True)
+            self._levels.append((offset, keys // n_classes - 1, (keys % n_classes).astype(np.int64)))
+            node[:n] = offset + inverse.reshape(-1)
+            offset += len(keys)
+        self._nodes = offset
+        self._token_node = node
+
+    def _walk(self, state: int) -> np.ndarray:
+        """End state of every usable token (in `vocab.order`) read from `state`."""
+        flat, width = self._table.ravel(), self._table.shape[1]
+        node_states = np.empty(self._nodes, dtype=np.int64)
+        for offset, parents, node_classes in self._levels:
+            index = node_states.take(parents) * width if offset else np.int64(state * width)
+            node_states[offset:offset + len(parents)] = flat.take(index + node_classes)
+        return node_states.take(self._token_node)
+
+
+class GrammarState:
+    """
+    One sequence's position in a grammar; the scheduler masks its logits and advances it per token.
+    """
+
+    __slots__ = ("grammar", "state")
+
+    def __init__(self, grammar: Grammar):
+        self.grammar = grammar
+        self.state = grammar.start
+
+    def mask(self, size: int, device="cpu") -> torch.Tensor:
+        return self.grammar.mask(self.state, size, device)
+
+    def advance(self, token_id: int) -> bool:
+        """
+        Moves past `token_id`; returns True when the sequence must end here.
+        """
+        if token_id == self.grammar.vocab.eos_token_id:
+            return True
+        self.state = self.grammar.next_state(self.state, token_id)
+        return self.grammar.is_final(self.state)
+
+
+### 📂 GRAMMAR CACHE CLASS ###
+class GrammarCache:
+    """
+    Compiled grammars keyed by the hash of their response format and vocabulary.
+
+    Compilation happens outside the lock; two requests racing on the same
+    new schema may both compile it, and the first result is kept.
+    """
+
+    def __init__(self, max_size: int = GRAMMAR_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, Grammar]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "compile_ms": 0.0}
+
+    @staticmethod
+    def key(response_format: dict, vocab: TokenVocabulary) -> str:
+        canonical = json.dumps(response_format, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(f"{vocab.fingerprint}:{canonical}".encode("utf-8")).hexdigest()
+
+    def get(self, response_format: Optional[dict], vocab: TokenVocabulary) -> Optional[Grammar]:
+        """
+        Returns the grammar for a response format (None for free text), compiling it on a miss.
+
+        Raises:
+            GrammarError: Invalid response format, schema or pattern.
+        """
+        key = self.key(response_format or {}, vocab)
+        with self._lock:
+            grammar = self._entries.get(key)
+            if grammar is not None:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return grammar
+
+        pattern = response_format_pattern(response_format)
+        if pattern is None:
+            return None
+        grammar = Grammar(pattern, vocab, key=key)
+        logger.info(f"✅ Compiled grammar {key[:12]} in {grammar.compile_ms:.0f}ms "
+                    f"({grammar.get_stats()['states']} states).")
+        with self._lock:
+            self.stats["misses"] += 1
+            self.stats["compile_ms"] += grammar.compile_ms
+            grammar = self._entries.setdefault(key, grammar)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+        return grammar
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {**self.stats, "compile_ms": round(self.stats["compile_ms"], 1), "entries": len(self._entries)}
+
+
+# Shared cache of compiled grammars
+grammar_cache = GrammarCache()
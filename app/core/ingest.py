@@ -0,0 +1,309 @@
+"""
+ingest.py - Bulk Document Ingestion for the Retriever
+------------------------------------------------------
+🔹 Features:
+- Streams documents from JSONL files (one {"text", "source"} object per line)
+  and plain-text files (one document per file), walking directories
+- Encodes INGEST_BATCH_SIZE texts per SentenceTransformer call, in-process or
+  in INGEST_WORKERS worker processes that embed ahead while earlier batches are stored
+- Stores INGEST_COMMIT_EVERY documents per SQLite transaction (executemany)
+  and adds their vectors to the index as one block
+- Long documents are cut into token-bounded overlapping chunks (embedder's
+  tokenizer); chunks reference their stored parent document
+- Exact and near-duplicate chunks (MinHash over shingles, also against earlier
+  ingestions via the retriever's indexed band keys) are dropped before embedding;
+  only chunks not yet committed are held in memory. The index space and
+  embedding time this saves are reported
+- Resumable: per-file checkpoints are committed together with the documents,
+  so rerunning after a crash skips exactly what was already stored
+- Throughput report: documents, docs/s, time spent embedding and storing
+
+📌 Dependencies:
+- DocumentRetriever (metadata database + vector index)
+- TokenChunker / NearDuplicateFilter (app.core.chunking)
+- SentenceTransformers (embeddings; the registry's in-process, one copy per worker otherwise)
+"""
+
+import os
+import json
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from app.core.chunking import NearDuplicateFilter, TokenChunker
+from app.core.retriever import EMBEDDING_MODEL, DocumentRetriever
+from app.models.registry import model_registry
+from app.utils.logger import logger
+
+### 🔧 CONFIGURATION ###
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", 256))  # Texts per embedding call
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", 0))  # Embedding processes; 0 = encode in-process
+INGEST_COMMIT_EVERY = int(os.getenv("INGEST_COMMIT_EVERY", 10000))  # Documents per transaction / index block
+INGEST_EXTENSIONS = (".jsonl", ".txt", ".md")  # Files picked up when walking a directory
+INGEST_CHUNKING = os.getenv("INGEST_CHUNKING", "true").lower() == "true"  # Split long documents into chunks
+INGEST_DEDUP = os.getenv("INGEST_DEDUP", "true").lower() == "true"  # Drop exact / near-duplicate chunks
+
+# text, source, input path, records of that path consumed up to and including this one
+Record = Tuple[str, str, str, int]
+
+
+def iter_files(paths: Iterable[str]) -> Iterator[str]:
+    """Absolute paths of the given files and of the supported files under the given directories."""
+    for path in paths:
+        if not os.path.isdir(path):
+            yield os.path.abspath(path)
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if name.endswith(INGEST_EXTENSIONS):
+                    yield os.path.abspath(os.path.join(root, name))
+
+
+def iter_documents(paths: Iterable[str], checkpoints: Optional[Dict[str, int]] = None) -> Iterator[Record]:
+    """
+    Streams documents from `paths`, skipping the records `checkpoints` says were already consumed.
+
+    A JSONL record is one line; a blank or invalid line, or one without
+    "text", is skipped. Any other file is a single document.
+    """
+    checkpoints = checkpoints or {}
+    for path in iter_files(paths):
+        done = checkpoints.get(path, 0)
+        if not path.endswith(".jsonl"):
+            if not done:
+                with open(path, encoding="utf-8", errors="replace") as f:
+                    text = f.read().strip()
+                if text:
+                    yield text, path, path, 1
+            continue
+        with open(path, encoding="utf-8") as f:
+            for position, line in enumerate(f, 1):
+                if position <= done or not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(f"⚠️ Skipping invalid JSON at {path}:{position}.")
+                    continue
+                text = record.get("text") if isinstance(record, dict) else None
+                if text:
+                    yield text, str(record.get("source") or path), path, position
+
+
+class Chunk:
+    """A piece of an input record on its way to the index."""
+
+    __slots__ = ("text", "record", "number", "content_hash", "signature", "last")
+
+    def __init__(self, text: str, record: Record, number: Optional[int], content_hash: Optional[str] = None,
+                 signature: Optional[np.ndarray] = None):
+        self.text = text
+        self.record = record
+        self.number = number  # Position in the parent document; None when the record was not split
+        self.content_hash = content_hash
+        self.signature = signature
+        self.last = False  # Last kept chunk of its record: the record's checkpoint may be committed
+
+
+### 🧵 EMBEDDING WORKERS ###
+_worker_embedder = None
+
+
+def load_embedder():
+    """The embedding model for a worker process (CPU; in-process encoding uses the registry's)."""
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(EMBEDDING_MODEL, device="cpu")
+
+
+def _init_worker(embedder_factory: Callable):
+    global _worker_embedder
+    _worker_embedder = embedder_factory()
+
+
+def _encode_in_worker(texts: List[str], batch_size: int) -> Tuple[np.ndarray, float]:
+    """The batch's vectors and the seconds spent encoding them (queueing not included)."""
+    started = time.time()
+    vectors = np.asarray(_worker_embedder.encode(texts, batch_size=batch_size), dtype=np.float32)
+    return vectors, time.time() - started
+
+
+### 📥 BULK INGESTER CLASS ###
+class BulkIngester:
+    """
+    Embeds and stores a stream of documents into a DocumentRetriever in large batches.
+    """
+
+    def __init__(self, retriever: DocumentRetriever, embedder=None, batch_size: int = INGEST_BATCH_SIZE,
+                 workers: int = INGEST_WORKERS, commit_every: int = INGEST_COMMIT_EVERY,
+                 embedder_factory: Callable = load_embedder, chunker: Optional[TokenChunker] = None,
+                 chunking: bool = INGEST_CHUNKING, dedup: bool = INGEST_DEDUP):
+        if batch_size < 1 or commit_every < 1:
+            raise ValueError("batch_size and commit_every must be at least 1.")
+        self.retriever = retriever
+        self.batch_size = batch_size
+        self.workers = workers
+        self.commit_every = commit_every
+        self.chunking = chunking
+        self.dedup = dedup
+        self._embedder = embedder
+        self._embedder_factory = embedder_factory
+        self._chunker = chunker
+
+    def ingest(self, paths: Iterable[str], on_progress: Optional[Callable[[dict], None]] = None) -> dict:
+        """
+        Ingests every document under `paths`, resuming after any earlier (interrupted) run.
+
+        `on_progress` receives the running stats after every transaction.
+
+        Returns:
+            dict: records read, chunks cut, exact / near duplicates dropped, documents
+                  (chunks stored), parents, transactions, resumed_files, seconds,
+                  docs_per_second, embed_seconds, store_seconds, index_bytes_saved,
+                  embed_seconds_saved (estimated from the measured embedding rate).
+        """
+        checkpoints = self.retriever.ingest_checkpoints()
+        chunker = self._get_chunker() if self.chunking else None
+        dedup = NearDuplicateFilter(store=self.retriever) if self.dedup else None
+        stats = {"records": 0, "chunks": 0, "exact_duplicates": 0, "near_duplicates": 0, "documents": 0,
+                 "parents": 0, "transactions": 0, "resumed_files": len(checkpoints), "seconds": 0.0,
+                 "docs_per_second": 0.0, "embed_seconds": 0.0, "store_seconds": 0.0}
+        start = time.time()
+        chunks = self._chunks(iter_documents(paths, checkpoints), chunker, dedup, stats)
+        pending: List[Chunk] = []
+        pending_vectors: List[np.ndarray] = []
+        for batch, vectors in self._embedded_batches(chunks, stats):
+            pending += batch
+            pending_vectors.append(vectors)
+            if len(pending) >= self.commit_every:
+                pending, pending_vectors = self._store(pending, pending_vectors, stats, start, on_progress, dedup)
+        if pending:
+            self._store(pending, pending_vectors, stats, start, on_progress, dedup)
+        self._update_rate(stats, start)
+
+        dropped = stats["exact_duplicates"] + stats["near_duplicates"]
+        embedded = stats["chunks"] - dropped
+        stats["index_bytes_saved"] = dropped * (self.retriever.vector_dim * 4 + 8)  # float32 vector + id
+        stats["embed_seconds_saved"] = round(dropped * stats["embed_seconds"] / embedded, 3) if embedded else 0.0
+        logger.info(f"✅ Ingested {stats['documents']} chunks of {stats['records']} documents in "
+                    f"{stats['seconds']:.1f}s ({stats['docs_per_second']} chunks/s, "
+                    f"embedding {stats['embed_seconds']:.1f}s).")
+        if dropped:
+            logger.info(f"♻️ Dropped {stats['exact_duplicates']} exact and {stats['near_duplicates']} near-duplicate "
+                        f"chunks: {stats['index_bytes_saved'] / 1e6:.1f} MB of index, "
+                        f"~{stats['embed_seconds_saved']:.1f}s of embedding saved.")
+        return stats
+
+    def _chunks(self, records: Iterator[Record], chunker: Optional[TokenChunker],
+                dedup: Optional[NearDuplicateFilter], stats: dict) -> Iterator[Chunk]:
+        """Splits records into chunks and drops the duplicates, before anything is embedded."""
+        for record in records:
+            pieces = chunker.split(record[0]) if chunker is not None else [record[0]]
+            kept = []
+            for number, piece in enumerate(pieces):
+                content_hash = signature = None
+                if dedup is not None:
+                    duplicate, content_hash, signature = dedup.check(piece)
+                    if duplicate:
+                        stats[f"{duplicate}_duplicates"] += 1
+                        continue
+                    dedup.add(content_hash, signature)
+                kept.append(Chunk(piece, record, number if len(pieces) > 1 else None, content_hash, signature))
+            stats["records"] += 1
+            stats["chunks"] += len(pieces)
+            if kept:
+                kept[-1].last = True
+                yield from kept
+
+    def _get_chunker(self) -> TokenChunker:
+        """The injected chunker, else one on the embedder's tokenizer."""
+        if self._chunker is None:
+            tokenizer = getattr(self._embedder, "tokenizer", None)
+            if tokenizer is None:
+                from transformers import AutoTokenizer
+                tokenizer = AutoTokenizer.from_pretrained(EMBEDDING_MODEL)
+            self._chunker = TokenChunker(tokenizer)
+        return self._chunker
+
+    def _embedded_batches(self, chunks: Iterator[Chunk], stats: dict) -> Iterator[Tuple[List[Chunk], np.ndarray]]:
+        """(chunks, vectors) per batch, in input order."""
+        batches = iter(lambda: list(islice(chunks, self.batch_size)), [])
+        if self.workers <= 0:
+            for batch in batches:
+                started = time.time()
+                vectors = self._encode([chunk.text for chunk in batch])
+                stats["embed_seconds"] += time.time() - started
+                yield batch, vectors
+            return
+
+        with ProcessPoolExecutor(self.workers, initializer=_init_worker,
+                                 initargs=(self._embedder_factory,)) as pool:
+            inflight = deque()
+            for batch in batches:
+                inflight.append((batch, pool.submit(_encode_in_worker, [c.text for c in batch], self.batch_size)))
+                if len(inflight) >= 2 * self.workers:  # Keep every worker busy, bound memory
+                    yield self._wait(inflight.popleft(), stats)
+            while inflight:
+                yield self._wait(inflight.popleft(), stats)
+
+    def _wait(self, entry, stats: dict) -> Tuple[List[Chunk], np.ndarray]:
+        batch, future = entry
+        vectors, seconds = future.result()
+        stats["embed_seconds"] += seconds  # Summed over workers, so it can exceed the wall time
+        return batch, vectors
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        """Embeds one batch with the injected embedder, else the registry's shared one."""
+        if self._embedder is not None:
+            return np.asarray(self._embedder.encode(texts, batch_size=self.batch_size), dtype=np.float32)
+        with model_registry.use("embedder") as embedder:
+            return np.asarray(embedder.encode(texts, batch_size=self.batch_size), dtype=np.float32)
+
+    def _store(self, chunks: List[Chunk], vectors: List[np.ndarray], stats: dict, start: float,
+               on_progress: Optional[Callable[[dict], None]],
+               dedup: Optional[NearDuplicateFilter] = None) -> Tuple[List[Chunk], List[np.ndarray]]:
+        """
+        One transaction for the pending chunks of every complete record, with the
+        checkpoints they reach; returns the chunks (and vectors) of a record still in progress.
+
+        The filter forgets the stored chunks: the database answers for them from then on.
+        """
+        vectors = np.concatenate(vectors)
+        cut = next((i + 1 for i in range(len(chunks) - 1, -1, -1) if chunks[i].last), 0)
+        if not cut:
+            return chunks, [vectors]
+        parents, parent_of, checkpoints, rows = [], {}, {}, []
+        for chunk in chunks[:cut]:
+            text, source, path, position = chunk.record
+            checkpoints[path] = position
+            parent = None
+            if chunk.number is not None:
+                parent = parent_of.setdefault((path, position), len(parents))
+                if parent == len(parents):
+                    parents.append((text, source))
+            signature = chunk.signature.tobytes() if chunk.signature is not None else None
+            rows.append((parent, chunk.number, chunk.content_hash, signature))
+        started = time.time()
+        self.retriever.add_documents([c.text for c in chunks[:cut]], [c.record[1] for c in chunks[:cut]],
+                                     vectors[:cut], checkpoints, parents, rows)
+        stats["store_seconds"] += time.time() - started
+        if dedup is not None:
+            dedup.forget(cut)  # Kept chunks were added in the order they are stored
+        stats["documents"] += cut
+        stats["parents"] += len(parents)
+        stats["transactions"] += 1
+        self._update_rate(stats, start)
+        if on_progress is not None:
+            on_progress(dict(stats))
+        return chunks[cut:], [vectors[cut:]]
+
+    @staticmethod
+    def _update_rate(stats: dict, start: float):
+        stats["seconds"] = round(time.time() - start, 3)
+        stats["docs_per_second"] = round(stats["documents"] / stats["seconds"], 1) if stats["seconds"] else 0.0
+        stats["embed_seconds"] = round(stats["embed_seconds"], 3)
+        stats["store_seconds"] = round(stats["store_seconds"], 3)
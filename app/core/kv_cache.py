@@ -0,0 +1,204 @@
+"""
+kv_cache.py - Past-Key-Values Utilities for the Native PyTorch Backend
+-----------------------------------------------------------------------
+🔹 Features:
+- Normalizes Hugging Face KV caches (legacy tuples or `DynamicCache`) into per-layer (key, value) pairs
+- Row selection, left-padding and concatenation for batches whose members come and go
+- Rebuilds a cache object in the format the model expects
+- Per-session prefix cache so a new chat turn only prefills its appended tokens
+
+📌 Dependencies:
+- torch (tensor ops)
+- transformers (optional `DynamicCache`, used when available)
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import torch
+import torch.nn.functional as F
+
+try:
+    from transformers import DynamicCache
+except ImportError:  # transformers < 4.36 only knows legacy tuples
+    DynamicCache = None
+
+### 🔧 CONFIGURATION ###
+PREFIX_CACHE_MB = int(os.getenv("PREFIX_CACHE_MB", 512))  # Memory budget for cached session KV
+
+# One (key, value) pair per layer, each shaped [batch, heads, seq_len, head_dim]
+KVLayers = List[Tuple[torch.Tensor, torch.Tensor]]
+
+
+def kv_layers(past) -> KVLayers:
+    """
+    Converts a model's `past_key_values` into a list of (key, value) pairs.
+    """
+    if hasattr(past, "layers"):  # transformers >= 4.56
+        return [(layer.keys, layer.values) for layer in past.layers]
+    if hasattr(past, "key_cache"):  # DynamicCache before the layer refactor
+        return list(zip(past.key_cache, past.value_cache))
+    return [(layer[0], layer[1]) for layer in past]
+
+
+def build_kv(layers: KVLayers, legacy: bool = False):
+    """
+    Builds a `past_key_values` object from (key, value) pairs.
+
+    Args:
+        layers (KVLayers): Per-layer key/value tensors.
+        legacy (bool): Return the tuple format instead of a `DynamicCache`.
+    """
+    if legacy or DynamicCache is None:
+        return tuple(layers)
+    cache = DynamicCache()
+    for layer_idx, (key, value) in enumerate(layers):
+        cache.update(key, value, layer_idx)
+    return cache
+
+
+def kv_seq_len(layers: KVLayers) -> int:
+    """Returns the sequence length covered by the cache."""
+    return layers[0][0].shape[2] if layers else 0
+
+
+def kv_select_rows(layers: KVLayers, rows: torch.Tensor) -> KVLayers:
+    """Keeps only the given batch rows."""
+    return [(k.index_select(0, rows), v.index_select(0, rows)) for k, v in layers]
+
+
+def kv_left_pad(layers: KVLayers, length: int) -> KVLayers:
+    """Left-pads every layer with zeros along the sequence axis up to `length`."""
+    pad = length - kv_seq_len(layers)
+    if pad <= 0:
+        return layers
+    return [(F.pad(k, (0, 0, pad, 0)), F.pad(v, (0, 0, pad, 0))) for k, v in layers]
+
+
+def kv_trim_left(layers: KVLayers, start: int) -> KVLayers:
+    """Drops the first `start` positions (e.g. columns that are padding for every row)."""
+    if start <= 0:
+        return layers
+    return [(k[:, :, start:], v[:, :, start:]) for k, v in layers]
+
+
+def kv_crop(layers: KVLayers, length: int) -> KVLayers:
+    """Keeps only the first `length` positions (e.g. after rejected speculative tokens)."""
+    return [(k[:, :, :length], v[:, :, :length]) for k, v in layers]
+
+
+def kv_concat_rows(parts: Sequence[KVLayers]) -> KVLayers:
+    """
+    Stacks several caches along the batch axis, left-padding them to a common length.
+    """
+    parts = [p for p in parts if p]
+    if not parts:
+        return []
+    length = max(kv_seq_len(p) for p in parts)
+    parts = [kv_left_pad(p, length) for p in parts]
+    return [
+        (torch.cat([p[i][0] for p in parts], dim=0), torch.cat([p[i][1] for p in parts], dim=0))
+        for i in range(len(parts[0]))
+    ]
+
+
+def kv_nbytes(layers: KVLayers) -> int:
+    """Total memory held by the key/value tensors."""
+    return sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in layers)
+
+
+### 📂 PREFIX CACHE CLASS ###
+class PrefixCache:
+    """
+    Keeps the KV cache of each conversation's last turn, keyed by session id.
+
+    A follow-up prompt usually starts with the previous prompt and reply, so
+    the longest common token prefix can be restored from here and only the
+    remaining tokens need a prefill. Entries are evicted least-recently-used
+    first once the memory budget is exceeded.
+    """
+
+    def __init__(self, budget_bytes: int = PREFIX_CACHE_MB * 1024 * 1024):
+        self.budget_bytes = budget_bytes
+        self.used_bytes = 0
+        self._entries: "OrderedDict[str, Tuple[List[int], KVLayers, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"lookups": 0, "hits": 0, "misses": 0, "evictions": 0,
+                      "prefill_tokens_saved": 0, "prefill_tokens_total": 0}
+
+    def lookup(self, session_id: str, prompt_ids: List[int]) -> Optional[Tuple[KVLayers, int]]:
+        """
+        Returns (kv, cached_len) covering the longest reusable prefix of `prompt_ids`.
+
+        At least one prompt token is always left uncached so the caller has
+        logits to sample from. Returns None on a miss.
+        """
+        with self._lock:
+            self.stats["lookups"] += 1
+            self.stats["prefill_tokens_total"] += len(prompt_ids)
+            entry = self._entries.get(session_id)
+            cached_len = 0
+            if entry is not None:
+                token_ids, layers, _ = entry
+                limit = min(len(token_ids), len(prompt_ids) - 1)
+                while cached_len < limit and token_ids[cached_len] == prompt_ids[cached_len]:
+                    cached_len += 1
+
+            if cached_len == 0:
+                self.stats["misses"] += 1
+                return None
+
+            self._entries.move_to_end(session_id)
+            self.stats["hits"] += 1
+            self.stats["prefill_tokens_saved"] += cached_len
+            return [(k[:, :, :cached_len], v[:, :, :cached_len]) for k, v in layers], cached_len
+
+    def store(self, session_id: str, token_ids: List[int], layers: KVLayers):
+        """
+        Saves a batch-1 KV cache covering `token_ids`, replacing the session's previous entry.
+        """
+        layers = [(k.detach().clone(), v.detach().clone()) for k, v in layers]
+        nbytes = kv_nbytes(layers)
+        with self._lock:
+            self._drop(session_id)
+            if nbytes > self.budget_bytes:
+                return
+            while self.used_bytes + nbytes > self.budget_bytes and self._entries:
+                self._drop(next(iter(self._entries)))
+                self.stats["evictions"] += 1
+            self._entries[session_id] = (list(token_ids), layers, nbytes)
+            self.used_bytes += nbytes
+
+    def invalidate(self, session_id: str):
+        """Forgets a session (e.g. when its history is edited or cleared)."""
+        with self._lock:
+            self._drop(session_id)
+
+    def clear(self):
+        """Drops every cached session."""
+        with self._lock:
+            self._entries.clear()
+            self.used_bytes = 0
+
+    def _drop(self, session_id: str):
+        entry = self._entries.pop(session_id, None)
+        if entry is not None:
+            self.used_bytes -= entry[2]
+
+    def get_stats(self) -> Dict[str, float]:
+        """
+        Returns counters plus hit rate, saved-prefill ratio and memory usage.
+        """
+        with self._lock:
+            stats = dict(self.stats)
+            stats["hit_rate"] = stats["hits"] / stats["lookups"] if stats["lookups"] else 0.0
+            stats["prefill_saved_ratio"] = (
+                stats["prefill_tokens_saved"] / stats["prefill_tokens_total"]
+                if stats["prefill_tokens_total"] else 0.0
+            )
+            stats["sessions"] = len(self._entries)
+            stats["used_bytes"] = self.used_bytes
+            stats["budget_bytes"] = self.budget_bytes
+            return stats
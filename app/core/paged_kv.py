@@ -0,0 +1,306 @@
+"""
+paged_kv.py - Paged KV-Cache Manager for the Native PyTorch Backend
+--------------------------------------------------------------------
+🔹 Features:
+- One preallocated pool of fixed-size KV blocks shared by all sequences
+- Per-sequence block tables: a sequence holds ceil(length / block size) blocks,
+  with no padding to the longest row and no up-front reservation for max_new_tokens
+- Copy-on-write sharing: n > 1 samples and cached session prefixes reference
+  the same blocks; a shared block is copied only when a sequence writes into it
+- Free-list allocator with reference counts and usage / copy counters
+- Session prefixes kept as shared block tables, evicted least-recently-used
+  when the pool runs out of free blocks
+- The per-step contiguous view handed to the model is gathered layer by layer
+  and capped at PAGED_KV_GATHER_MB, so transient KV copies stay bounded
+
+📌 Dependencies:
+- torch (block pool tensors)
+"""
+
+import os
+from collections import Counter, OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import torch
+
+from app.core.kv_cache import KVLayers, kv_seq_len
+
+### 🔧 CONFIGURATION ###
+PAGED_KV_MB = int(os.getenv("PAGED_KV_MB", 0))  # Block pool size; 0 keeps contiguous per-batch KV tensors
+KV_BLOCK_SIZE = int(os.getenv("KV_BLOCK_SIZE", 16))  # Token positions per block
+PAGED_KV_GATHER_MB = int(os.getenv("PAGED_KV_GATHER_MB", 0))  # Cap on the gathered batch view; 0 = pool size
+
+
+class BlockAllocator:
+    """
+    Free list of block ids with reference counts.
+
+    A block goes back on the free list when its last reference is released.
+    """
+
+    def __init__(self, num_blocks: int):
+        self.num_blocks = num_blocks
+        self._free = list(range(num_blocks - 1, -1, -1))  # pop() hands out low ids first
+        self._refs = [0] * num_blocks
+        self.stats = {"allocations": 0, "frees": 0, "peak_used": 0, "cow_copies": 0}
+
+    @property
+    def num_free(self) -> int:
+        return len(self._free)
+
+    def allocate(self) -> int:
+        """
+        Takes a block off the free list.
+
+        Raises:
+            RuntimeError: No free block is left.
+        """
+        if not self._free:
+            raise RuntimeError("Out of KV cache blocks.")
+        block = self._free.pop()
+        self._refs[block] = 1
+        self.stats["allocations"] += 1
+        self.stats["peak_used"] = max(self.stats["peak_used"], self.num_blocks - len(self._free))
+        return block
+
+    def share(self, block: int):
+        """Adds a reference to an allocated block."""
+        self._refs[block] += 1
+
+    def release(self, block: int):
+        """Drops a reference; the block is freed with its last one."""
+        self._refs[block] -= 1
+        if self._refs[block] == 0:
+            self._free.append(block)
+            self.stats["frees"] += 1
+
+    def is_shared(self, block: int) -> bool:
+        return self._refs[block] > 1
+
+    def ref_count(self, block: int) -> int:
+        return self._refs[block]
+
+    def get_stats(self) -> dict:
+        used = self.num_blocks - len(self._free)
+        return {**self.stats, "blocks": self.num_blocks, "free_blocks": len(self._free), "used_blocks": used,
+                "shared_blocks": sum(1 for refs in self._refs if refs > 1),
+                "utilization": used / self.num_blocks if self.num_blocks else 0.0}
+
+
+class BlockTable:
+    """The blocks holding one sequence's KV, in position order, and how many positions are filled."""
+
+    __slots__ = ("blocks", "length")
+
+    def __init__(self, blocks: Optional[List[int]] = None, length: int = 0):
+        self.blocks = blocks if blocks is not None else []
+        self.length = length
+
+
+### 📂 PAGED KV CACHE CLASS ###
+class PagedKVCache:
+    """
+    Block pool plus the operations the scheduler needs on block tables.
+
+    Keys and values live in two tensors shaped [layers, blocks * block_size,
+    heads, head_dim]; a token position is one row of the slot axis. Hugging
+    Face attention still wants contiguous tensors, so `gather` assembles a
+    left-padded batch view for each forward pass and `append` writes the new
+    position back; only the pool persists between steps. The view is one
+    tensor per layer, so the model's cache update can free each layer's
+    copy as it goes, and the scheduler keeps it under `gather_budget_bytes`.
+    """
+
+    def __init__(self, num_layers: int, num_heads: int, head_dim: int,
+                 budget_bytes: int = PAGED_KV_MB * 1024 * 1024, block_size: int = KV_BLOCK_SIZE,
+                 dtype: torch.dtype = torch.float32, device="cpu",
+                 gather_budget_bytes: int = PAGED_KV_GATHER_MB * 1024 * 1024):
+        element_size = torch.empty(0, dtype=dtype).element_size()
+        self.block_size = block_size
+        self.block_bytes = 2 * num_layers * num_heads * head_dim * element_size * block_size
+        num_blocks = budget_bytes // self.block_bytes
+        if num_blocks < 1:
+            raise ValueError(f"A KV block needs {self.block_bytes} bytes; the budget is {budget_bytes}.")
+        self.gather_budget_bytes = gather_budget_bytes or num_blocks * self.block_bytes
+        self.num_layers = num_layers
+        self.keys = torch.zeros(num_layers, num_blocks * block_size, num_heads, head_dim, dtype=dtype, device=device)
+        self.values = torch.zeros_like(self.keys)
+        self.allocator = BlockAllocator(num_blocks)
+        self._prefixes: "OrderedDict[str, Tuple[List[int], BlockTable]]" = OrderedDict()
+        self.stats = {"prefix_lookups": 0, "prefix_hits": 0, "prefix_evictions": 0, "prefill_tokens_saved": 0,
+                      "peak_gather_bytes": 0}
+
+    @classmethod
+    def for_model(cls, model, budget_bytes: int = PAGED_KV_MB * 1024 * 1024, block_size: int = KV_BLOCK_SIZE,
+                  device="cpu", gather_budget_bytes: int = PAGED_KV_GATHER_MB * 1024 * 1024) -> "PagedKVCache":
+        """Sizes the pool from a Hugging Face model's config (layers, KV heads, head dim, dtype)."""
+        config = model.config
+        heads = getattr(config, "num_key_value_heads", None) or config.num_attention_heads
+        head_dim = getattr(config, "head_dim", None) or config.hidden_size // config.num_attention_heads
+        return cls(config.num_hidden_layers, heads, head_dim, budget_bytes, block_size,
+                   dtype=getattr(model, "dtype", torch.float32), device=device,
+                   gather_budget_bytes=gather_budget_bytes)
+
+    @property
+    def num_blocks(self) -> int:
+        return self.allocator.num_blocks
+
+    @property
+    def num_free_blocks(self) -> int:
+        return self.allocator.num_free
+
+    @property
+    def num_available_blocks(self) -> int:
+        """Free blocks plus the blocks that evicting every session prefix would free (nothing is evicted)."""
+        prefix_refs = Counter(block for _, table in self._prefixes.values() for block in table.blocks)
+        reclaimable = sum(1 for block, refs in prefix_refs.items() if self.allocator.ref_count(block) == refs)
+        return self.allocator.num_free + reclaimable
+
+    def gather_bytes(self, rows: int, length: int) -> int:
+        """Size of a gathered batch view of `rows` rows padded to `length` positions."""
+        return rows * length * self.block_bytes // self.block_size
+
+    def blocks_for(self, num_tokens: int) -> int:
+        """Blocks that hold `num_tokens` positions."""
+        return -(-num_tokens // self.block_size)
+
+    def blocks_needed(self, table: BlockTable, num_tokens: int) -> int:
+        """Free blocks an append of `num_tokens` positions to `table` takes (including a copy-on-write)."""
+        needed = self.blocks_for(table.length + num_tokens) - len(table.blocks)
+        if table.length % self.block_size and self.allocator.is_shared(table.blocks[-1]):
+            needed += 1
+        return needed
+
+    def reserve(self, num_blocks: int) -> bool:
+        """
+        Makes sure `num_blocks` are free, evicting least-recently-used session prefixes if needed.
+        """
+        while self.allocator.num_free < num_blocks and self._prefixes:
+            _, (_, table) = self._prefixes.popitem(last=False)
+            self.free(table)
+            self.stats["prefix_evictions"] += 1
+        return self.allocator.num_free >= num_blocks
+
+    ### ✍️ BLOCK TABLES ###
+    def write(self, table: BlockTable, layers: KVLayers, start: int = 0):
+        """
+        Appends positions `start:` of a batch-1 cache ([1, heads, len, dim] per layer) to `table`.
+        """
+        count = kv_seq_len(layers) - start
+        if count <= 0:
+            return
+        slots = self._claim(table, count)
+        self.keys[:, slots] = torch.stack([k[0, :, start:] for k, _ in layers]).transpose(1, 2)
+        self.values[:, slots] = torch.stack([v[0, :, start:] for _, v in layers]).transpose(1, 2)
+
+    def append(self, tables: Sequence[BlockTable], layers: KVLayers):
+        """
+        Writes the last position of every row of a batch cache to the row's table (one decode step).
+        """
+        slots = torch.cat([self._claim(table, 1) for table in tables])
+        self.keys[:, slots] = torch.stack([k[:, :, -1] for k, _ in layers])
+        self.values[:, slots] = torch.stack([v[:, :, -1] for _, v in layers])
+
+    def fork(self, table: BlockTable, length: Optional[int] = None) -> BlockTable:
+        """
+        A new table sharing the blocks of `table`'s first `length` positions (no copy).
+        """
+        length = table.length if length is None else length
+        blocks = table.blocks[:self.blocks_for(length)]
+        for block in blocks:
+            self.allocator.share(block)
+        return BlockTable(list(blocks), length)
+
+    def free(self, table: BlockTable):
+        """Releases a table's blocks and empties it."""
+        for block in table.blocks:
+            self.allocator.release(block)
+        table.blocks = []
+        table.length = 0
+
+    def gather(self, tables: Sequence[BlockTable]) -> Tuple[KVLayers, torch.Tensor]:
+        """
+        Assembles left-padded [batch, heads, len, dim] KV tensors, one pair per layer, and their attention mask.
+        """
+        length = max(table.length for table in tables)
+        device = self.keys.device
+        index = torch.zeros((len(tables), length), dtype=torch.long)
+        attention_mask = torch.zeros((len(tables), length), dtype=torch.long)
+        for row, table in enumerate(tables):
+            if table.length:
+                index[row, length - table.length:] = self._slots(table)[:table.length]
+                attention_mask[row, length - table.length:] = 1
+        index = index.to(device)
+        self.stats["peak_gather_bytes"] = max(self.stats["peak_gather_bytes"], self.gather_bytes(len(tables), length))
+        layers = [(self.keys[i, index].transpose(1, 2), self.values[i, index].transpose(1, 2))
+                  for i in range(self.num_layers)]
+        return layers, attention_mask.to(device)
+
+    ### 💬 SESSION PREFIXES ###
+    def lookup_prefix(self, session_id: str, prompt_ids: List[int]) -> Optional[Tuple[BlockTable, int]]:
+        """
+        Returns (table, cached_len): a fork of the session's stored prefix covering
+        the longest common prefix with `prompt_ids`, leaving at least one token to prefill.
+        """
+        self.stats["prefix_lookups"] += 1
+        entry = self._prefixes.get(session_id)
+        if entry is None:
+            return None
+        token_ids, table = entry
+        cached_len = 0
+        limit = min(len(token_ids), len(prompt_ids) - 1)
+        while cached_len < limit and token_ids[cached_len] == prompt_ids[cached_len]:
+            cached_len += 1
+        if cached_len == 0:
+            return None
+        self._prefixes.move_to_end(session_id)
+        self.stats["prefix_hits"] += 1
+        self.stats["prefill_tokens_saved"] += cached_len
+        return self.fork(table, cached_len), cached_len
+
+    def store_prefix(self, session_id: str, token_ids: List[int], table: BlockTable):
+        """
+        Keeps the session's KV for `token_ids` by sharing `table`'s blocks, replacing its previous entry.
+        """
+        self.drop_prefix(session_id)
+        self._prefixes[session_id] = (list(token_ids), self.fork(table, len(token_ids)))
+
+    def drop_prefix(self, session_id: str):
+        """Forgets a session's stored prefix."""
+        entry = self._prefixes.pop(session_id, None)
+        if entry is not None:
+            self.free(entry[1])
+
+    def get_stats(self) -> Dict[str, float]:
+        """
+        Returns allocator counters (free / used / shared blocks, copy-on-writes) and prefix reuse.
+        """
+        return {**self.allocator.get_stats(), **self.stats, "block_size": self.block_size,
+                "block_bytes": self.block_bytes, "sessions": len(self._prefixes)}
+
+    def _claim(self, table: BlockTable, count: int) -> torch.Tensor:
+        """
+        Slot indices for the next `count` positions of `table`, allocating blocks as needed.
+
+        A partially filled last block that is shared gets copied first.
+        """
+        if table.length % self.block_size and self.allocator.is_shared(table.blocks[-1]):
+            table.blocks[-1] = self._copy_block(table.blocks[-1])
+        while len(table.blocks) < self.blocks_for(table.length + count):
+            table.blocks.append(self.allocator.allocate())
+        slots = self._slots(table)[table.length:table.length + count]
+        table.length += count
+        return slots.to(self.keys.device)
+
+    def _slots(self, table: BlockTable) -> torch.Tensor:
+        blocks = torch.tensor(table.blocks, dtype=torch.long).unsqueeze(-1)
+        return (blocks * self.block_size + torch.arange(self.block_size)).flatten()
+
+    def _copy_block(self, block: int) -> int:
+        copy = self.allocator.allocate()
+        size = self.block_size
+        self.keys[:, copy * size:(copy + 1) * size] = self.keys[:, block * size:(block + 1) * size]
+        self.values[:, copy * size:(copy + 1) * size] = self.values[:, block * size:(block + 1) * size]
+        self.allocator.release(block)
+        self.allocator.stats["cow_copies"] += 1
+        return copy
@@ -0,0 +1,86 @@
+"""
+response_cache.py - Exact-Match Inference Response Cache
+---------------------------------------------------------
+🔹 Features:
+- Caches generated text for deterministic (temperature 0) requests
+- Keys on a canonical hash of model id, model version, prompt token ids & sampling params
+- Bumping `MODEL_VERSION` invalidates every previous entry
+- Concurrent identical misses share one generation (via `CacheManager.aget_or_compute`)
+- Reports HIT / MISS / BYPASS per request for the `X-Cache` header
+
+📌 Dependencies:
+- app.core.cache (two-tier cache with request coalescing)
+"""
+
+import os
+import json
+import hashlib
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+from app.core.cache import CacheManager
+
+### 🔧 CONFIGURATION ###
+MODEL_VERSION = os.getenv("MODEL_VERSION", "1")  # Bump on weight/tokenizer changes to invalidate
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", 3600))  # Seconds a cached answer stays valid
+
+
+### 📂 RESPONSE CACHE CLASS ###
+class ResponseCache:
+    """
+    Exact-match cache of model outputs for deterministic requests.
+    """
+
+    def __init__(self, cache: CacheManager, model_id: str, model_version: str = MODEL_VERSION,
+                 ttl: int = RESPONSE_CACHE_TTL):
+        self.cache = cache
+        self.namespace = f"resp:{model_id}:{model_version}"
+        self.ttl = ttl
+        self.stats = {"hits": 0, "misses": 0, "bypassed": 0}
+
+    @staticmethod
+    def is_cacheable(temperature: float) -> bool:
+        """Only greedy decoding produces the same output for the same input."""
+        return temperature <= 0
+
+    def make_key(self, prompt_ids: List[int], params: Dict[str, Any]) -> str:
+        """
+        Builds the cache key from the tokenized prompt and sampling params.
+        """
+        payload = json.dumps({"prompt": list(prompt_ids), "params": params},
+                             sort_keys=True, separators=(",", ":"))
+        return f"{self.namespace}:{hashlib.sha256(payload.encode()).hexdigest()}"
+
+    async def get_or_generate(self, prompt_ids: List[int], params: Dict[str, Any],
+                              generate_fn: Callable[[], Awaitable[str]]) -> Tuple[str, str]:
+        """
+        Returns (text, status) where status is "HIT", "MISS" or "BYPASS".
+        """
+        if not self.is_cacheable(params.get("temperature", 0.0)):
+            self.stats["bypassed"] += 1
+            return await generate_fn(), "BYPASS"
+
+        key = self.make_key(prompt_ids, params)
+        cached = self.cache.get(key)
+        if cached is not None:
+            self.stats["hits"] += 1
+            return cached, "HIT"
+
+        self.stats["misses"] += 1
+        return await self.cache.aget_or_compute(key, generate_fn, self.ttl), "MISS"
+
+    def get_or_generate_sync(self, prompt_ids: List[int], params: Dict[str, Any],
+                             generate_fn: Callable[[], str]) -> str:
+        """
+        Blocking variant for synchronous callers; params must describe a greedy request.
+        """
+        key = self.make_key(prompt_ids, params)
+        cached = self.cache.get(key)
+        if cached is not None:
+            self.stats["hits"] += 1
+            return cached
+        self.stats["misses"] += 1
+        return self.cache.get_or_compute(key, generate_fn, self.ttl)
+
+    def get_stats(self) -> Dict[str, float]:
+        """Returns hit/miss/bypass counters and the hit rate among cacheable requests."""
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {**self.stats, "hit_rate": self.stats["hits"] / lookups if lookups else 0.0}
@@ -4,7 +4,17 @@ retriever.py - Implements Retrieval-Augmented Generation (RAG)
 🔹 Features:
 - Retrieves relevant context for better LLM responses
 - Supports keyword + semantic search (Hybrid RAG)
-- Uses FAISS for fast vector retrieval
+- Uses FAISS for fast vector retrieval, keyed by the documents' row ids
+- Results carry their distance; metadata for all hits is fetched in one query
+- Exact, IVF-Flat, IVF-PQ or HNSW index (VECTOR_INDEX_TYPE), tunable per query
+- Recall@k-versus-latency report of the index against exact search
+- Bulk inserts: many documents per transaction, vectors added as one block,
+  with resumable ingestion checkpoints (see app.core.ingest)
+- Chunks keep a reference to their parent document; hits carry `parent_id`
+- Deduplicating ingestions store LSH band keys in an indexed table, so new
+  chunks are checked against the corpus without loading its signatures
+- Index persisted under DB_PATH (snapshots + add / delete log), memory-mapped at startup
+- IVF indexes are retrained from the stored vectors as the corpus outgrows their training size
 - Integrates with external knowledge sources
 
 📌 Dependencies:
@@ -14,32 +24,46 @@ retriever.py - Implements Retrieval-Augmented Generation (RAG)
 """
 
 import os
-import faiss
 import sqlite3
+import threading
 import numpy as np
-from sentence_transformers import SentenceTransformer
-from typing import List
+from typing import Dict, List, Optional, Tuple
+from app.core.chunking import DEDUP_BANDS
+from app.core.vector_store import VECTOR_INDEX_TYPE, VectorIndex, fetch_rows, recall_report, train_sample_size
+from app.models.registry import model_registry
+from app.utils.logger import logger
 
 ### 🔧 CONFIGURATION ###
 DB_PATH = "data/embeddings/document_index"
 METADATA_DB = "data/embeddings/document_metadata.db"
-EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
-
-# Load embedding model
-embedder = SentenceTransformer(EMBEDDING_MODEL)
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"  # Shared "embedder" in the model registry
+CHUNK_COLUMNS = (("parent_id", "INTEGER"), ("chunk", "INTEGER"), ("content_hash", "TEXT"), ("minhash", "BLOB"))
+SYNC_BATCH_SIZE = 10000  # Stored vectors added to the index per batch when catching up with SQLite
 
 
 ### 📂 DOCUMENT RETRIEVER CLASS ###
 class DocumentRetriever:
     """
     Implements Hybrid RAG: FAISS-based vector retrieval + keyword search.
+
+    Vectors are stored under their SQLite row id, so deletes never shift
+    the mapping between index entries and documents. With an `index_path`
+    the index is reopened from its snapshot and log at startup; documents
+    it has not seen yet are added from the vectors stored in SQLite.
     """
 
-    def __init__(self, vector_dim=384):
+    def __init__(self, vector_dim=384, metadata_db: str = METADATA_DB, embedder=None,
+                 index_type: str = VECTOR_INDEX_TYPE, index_path: Optional[str] = DB_PATH):
         self.vector_dim = vector_dim
-        self.index = faiss.IndexFlatL2(vector_dim)  # L2 Distance Index
-        self.metadata_conn = sqlite3.connect(METADATA_DB)
+        self.index = VectorIndex(vector_dim, index_type, path=index_path)
+        if os.path.dirname(metadata_db):
+            os.makedirs(os.path.dirname(metadata_db), exist_ok=True)
+        self.metadata_conn = sqlite3.connect(metadata_db, check_same_thread=False)
+        self._embedder = embedder
+        self._lock = threading.Lock()
         self._setup_db()
+        self._sync_index()
+        self._maybe_retrain()
 
     def _setup_db(self):
         """Initialize metadata database for document storage."""
@@ -50,78 +74,324 @@ class DocumentRetriever:
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 text TEXT,
                 vector BLOB,
+                source TEXT,
+                parent_id INTEGER,
+                chunk INTEGER,
+                content_hash TEXT,
+                minhash BLOB
+            )
+            """
+        )
+        columns = {row[1] for row in cursor.execute("PRAGMA table_info(documents)")}
+        for column, kind in CHUNK_COLUMNS:
+            if column not in columns:  # Databases created before chunked ingestion
+                cursor.execute(f"ALTER TABLE documents ADD COLUMN {column} {kind}")
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS parent_documents (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                text TEXT,
                 source TEXT
             )
             """
         )
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS ingest_progress (
+                path TEXT PRIMARY KEY,
+                records INTEGER
+            )
+            """
+        )
+        backfill = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='dedup_bands'"
+        ).fetchone() is None
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS dedup_bands (
+                band INTEGER,
+                key BLOB,
+                document_id INTEGER
+            )
+            """
+        )
+        cursor.execute("CREATE INDEX IF NOT EXISTS dedup_bands_key ON dedup_bands (band, key)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS dedup_bands_document ON dedup_bands (document_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS documents_content_hash ON documents (content_hash)")
+        if backfill:  # Signatures stored before the band table existed
+            self._index_bands(first_id=0)
         self.metadata_conn.commit()
 
-    def add_document(self, text: str, source: str):
+    def _index_bands(self, first_id: int):
+        """Stores the LSH band keys of the MinHash signatures of documents from `first_id` on."""
+        for band in range(DEDUP_BANDS):
+            self.metadata_conn.execute(
+                "INSERT INTO dedup_bands (band, key, document_id) "
+                "SELECT ?, substr(minhash, ? * (length(minhash) / ?) + 1, length(minhash) / ?), id "
+                "FROM documents WHERE id >= ? AND minhash IS NOT NULL",
+                (band, band, DEDUP_BANDS, DEDUP_BANDS, first_id),
+            )
+
+    def _sync_index(self):
+        """Adds documents newer than the index's last id from their stored vectors (no re-embedding)."""
+        added = 0
+        for ids, vectors in self._stored_vectors(after=self.index.max_id):
+            self.index.add(ids, vectors, snapshot=False)
+            added += len(ids)
+        self.index.maybe_snapshot()  # One snapshot for the whole catch-up, if it outgrew the delta
+        if added:
+            logger.info(f"✅ Added {added} stored documents missing from the vector index.")
+
+    def _maybe_retrain(self):
         """
-        Stores document & vector embedding in FAISS.
+        Retrains an IVF index that has outgrown the size it was trained for,
+        on a random sample of the vectors stored in SQLite (call under `_lock`).
         """
-        vector = embedder.encode([text])[0].astype(np.float32)
-        self.index.add(np.array([vector]))  # Add vector to FAISS
-        cursor = self.metadata_conn.cursor()
-        cursor.execute(
-            "INSERT INTO documents (text, vector, source) VALUES (?, ?, ?)",
-            (text, vector.tobytes(), source),
-        )
-        self.metadata_conn.commit()
+        if not self.index.needs_retrain:
+            return
+        count = self.metadata_conn.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+        sample = [row[0] for row in self.metadata_conn.execute(
+            "SELECT vector FROM documents ORDER BY RANDOM() LIMIT ?", (train_sample_size(count),)
+        )]
+        self.index.retrain(np.frombuffer(b"".join(sample), dtype=np.float32), self._stored_vectors(), count)
+
+    def _stored_vectors(self, after: int = 0):
+        """Yields (ids, [n, dim] vectors) batches of the stored documents with ids above `after`."""
+        cursor = self.metadata_conn.execute("SELECT id, vector FROM documents WHERE id > ? ORDER BY id", (after,))
+        while True:
+            rows = cursor.fetchmany(SYNC_BATCH_SIZE)
+            if not rows:
+                return
+            vectors = np.frombuffer(b"".join(row[1] for row in rows), dtype=np.float32)
+            yield [row[0] for row in rows], vectors.reshape(len(rows), self.vector_dim)
+
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        """Embeds texts with the injected embedder, else the registry's shared one."""
+        if self._embedder is not None:
+            vectors = self._embedder.encode(texts)
+        else:
+            with model_registry.use("embedder") as embedder:
+                vectors = embedder.encode(texts)
+        return np.asarray(vectors, dtype=np.float32).reshape(len(texts), self.vector_dim)
+
+    def add_document(self, text: str, source: str) -> int:
+        """
+        Stores document & vector embedding in FAISS; returns the document id.
+        """
+        vector = self._embed([text])[0]
+        with self._lock:
+            cursor = self.metadata_conn.cursor()
+            cursor.execute(
+                "INSERT INTO documents (text, vector, source) VALUES (?, ?, ?)",
+                (text, vector.tobytes(), source),
+            )
+            self.metadata_conn.commit()
+            self.index.add([cursor.lastrowid], vector)  # Add vector to FAISS under its row id
+            self._maybe_retrain()
+        return cursor.lastrowid
+
+    def add_documents(self, texts: List[str], sources: List[str], vectors: Optional[np.ndarray] = None,
+                      checkpoints: Optional[Dict[str, int]] = None, parents: Optional[List[Tuple[str, str]]] = None,
+                      chunks: Optional[List[tuple]] = None) -> List[int]:
+        """
+        Stores documents in one transaction and adds their vectors as one block; returns their ids.
+
+        `vectors` are used as given instead of embedding `texts`. `checkpoints`
+        ({input path: records consumed}) are committed in the same transaction,
+        so an interrupted bulk ingestion resumes right after the stored documents.
+
+        For chunked ingestion, `parents` are the (text, source) of the whole
+        documents and `chunks` holds, per text, (index into `parents` or None,
+        chunk number, content hash, MinHash signature bytes).
+        """
+        if vectors is None:
+            vectors = self._embed(texts)
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(len(texts), self.vector_dim)
+        chunks = chunks or [(None, None, None, None)] * len(texts)
+        with self._lock:
+            with self.metadata_conn:  # Commits on success, rolls back on error
+                # Write lock first, so no other connection takes the ids read from sqlite_sequence
+                self.metadata_conn.execute("BEGIN IMMEDIATE")
+                parent_ids = self._next_ids("parent_documents", len(parents or []))
+                if parents:
+                    self.metadata_conn.executemany(
+                        "INSERT INTO parent_documents (id, text, source) VALUES (?, ?, ?)",
+                        [(parent_id, text, source) for parent_id, (text, source) in zip(parent_ids, parents)],
+                    )
+                ids = self._next_ids("documents", len(texts))
+                self.metadata_conn.executemany(
+                    "INSERT INTO documents (id, text, vector, source, parent_id, chunk, content_hash, minhash) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [(doc_id, text, vector.tobytes(), source, None if parent is None else parent_ids[parent],
+                      number, content_hash, minhash)
+                     for doc_id, text, vector, source, (parent, number, content_hash, minhash)
+                     in zip(ids, texts, vectors, sources, chunks)],
+                )
+                if ids and any(chunk[3] is not None for chunk in chunks):
+                    self._index_bands(first_id=ids[0])
+                if checkpoints:
+                    self.metadata_conn.executemany(
+                        "INSERT OR REPLACE INTO ingest_progress (path, records) VALUES (?, ?)",
+                        checkpoints.items(),
+                    )
+            self.index.add(ids, vectors)
+            self._maybe_retrain()
+        return ids
+
+    def _next_ids(self, table: str, count: int) -> List[int]:
+        """The next `count` AUTOINCREMENT ids of `table` (call after BEGIN IMMEDIATE of the inserting transaction)."""
+        first = self.metadata_conn.execute(
+            "SELECT COALESCE((SELECT seq FROM sqlite_sequence WHERE name = ?), 0) + 1", (table,)
+        ).fetchone()[0]
+        return list(range(first, first + count))
+
+    def ingest_checkpoints(self) -> Dict[str, int]:
+        """Records consumed per input path by earlier bulk ingestions."""
+        with self._lock:
+            return dict(self.metadata_conn.execute("SELECT path, records FROM ingest_progress").fetchall())
+
+    def dedup_lookup(self, content_hash: str, band_keys: List[bytes]) -> Tuple[bool, List[bytes]]:
+        """
+        Whether a document with this content hash is stored, else the MinHash bytes
+        of the stored documents sharing an LSH band key with it (NearDuplicateFilter store).
+        """
+        with self._lock:
+            if self.metadata_conn.execute(
+                "SELECT 1 FROM documents WHERE content_hash=? LIMIT 1", (content_hash,)
+            ).fetchone():
+                return True, []
+            rows = self.metadata_conn.execute(
+                "SELECT DISTINCT documents.minhash FROM dedup_bands "
+                "JOIN documents ON documents.id = dedup_bands.document_id WHERE "
+                + " OR ".join(["(dedup_bands.band = ? AND dedup_bands.key = ?)"] * len(band_keys)),
+                [value for band, key in enumerate(band_keys) for value in (band, key)],
+            ).fetchall() if band_keys else []
+        return False, [row[0] for row in rows]
+
+    def get_parent(self, parent_id: int) -> Optional[dict]:
+        """The whole document a chunk was cut from: {"id", "text", "source"}, or None."""
+        with self._lock:
+            row = self.metadata_conn.execute(
+                "SELECT text, source FROM parent_documents WHERE id=?", (parent_id,)
+            ).fetchone()
+        return {"id": parent_id, "text": row[0], "source": row[1]} if row else None
+
+    def delete_document(self, doc_id: int) -> bool:
+        """Removes a document and its vector; returns False if it did not exist."""
+        with self._lock:
+            cursor = self.metadata_conn.execute("DELETE FROM documents WHERE id=?", (doc_id,))
+            self.metadata_conn.execute("DELETE FROM dedup_bands WHERE document_id=?", (doc_id,))
+            self.metadata_conn.commit()
+            self.index.remove([doc_id])
+        return cursor.rowcount > 0
+
+    def search(self, query: str, top_k=5, nprobe: Optional[int] = None,
+               ef_search: Optional[int] = None) -> List[dict]:
+        """
+        Top-k documents for a query, closest first.
+
+        `nprobe` (IVF) / `ef_search` (HNSW) trade latency for recall on this query only.
+
+        Returns:
+            list: {"id", "text", "source", "parent_id", "distance"} dicts (squared L2; lower is
+                  closer). `parent_id` is set for chunks of a longer document (see `get_parent`).
+        """
+        query_vector = self._embed([query])[0]
+        with self._lock:
+            hits = self.index.search(query_vector, top_k, nprobe, ef_search)  # FAISS search
+            rows = fetch_rows(self.metadata_conn, "documents", ("text", "source", "parent_id"),
+                              [i for i, _ in hits])
+        return [{"id": doc_id, "text": rows[doc_id][0], "source": rows[doc_id][1], "parent_id": rows[doc_id][2],
+                 "distance": distance}
+                for doc_id, distance in hits if doc_id in rows]
 
     def retrieve_documents(self, query: str, top_k=5) -> List[str]:
         """
         Retrieves top-k relevant documents for a given query.
         """
-        query_vector = embedder.encode([query])[0].astype(np.float32)
-        D, I = self.index.search(np.array([query_vector]), top_k)  # FAISS search
-        results = []
-        cursor = self.metadata_conn.cursor()
-        for idx in I[0]:
-            if idx == -1:
-                continue  # No match found
-            cursor.execute("SELECT text FROM documents WHERE id=?", (idx + 1,))
-            result = cursor.fetchone()
-            if result:
-                results.append(result[0])
-        return results
+        return [hit["text"] for hit in self.search(query, top_k)]
 
     def hybrid_search(self, query: str, top_k=5) -> List[str]:
         """
         Hybrid search combining FAISS vector search with keyword-based filtering.
         """
-        query_vector = embedder.encode([query])[0].astype(np.float32)
-        D, I = self.index.search(np.array([query_vector]), top_k)  # FAISS search
-
         # Retrieve vector-based results
-        vector_results = []
-        cursor = self.metadata_conn.cursor()
-        for idx in I[0]:
-            if idx == -1:
-                continue
-            cursor.execute("SELECT text FROM documents WHERE id=?", (idx + 1,))
-            result = cursor.fetchone()
-            if result:
-                vector_results.append(result[0])
+        vector_results = self.retrieve_documents(query, top_k)
 
         # Retrieve keyword-based results
-        keyword_results = []
-        cursor.execute(
-            "SELECT text FROM documents WHERE text LIKE ? LIMIT ?",
-            (f"%{query}%", top_k),
-        )
-        keyword_results = [row[0] for row in cursor.fetchall()]
+        with self._lock:
+            cursor = self.metadata_conn.execute(
+                "SELECT text FROM documents WHERE text LIKE ? LIMIT ?",
+                (f"%{query}%", top_k),
+            )
+            keyword_results = [row[0] for row in cursor.fetchall()]
 
         # Combine results
-        combined_results = list(set(vector_results + keyword_results))
+        combined_results = list(dict.fromkeys(vector_results + keyword_results))
         return combined_results[:top_k]
 
+    def index_report(self, num_queries: int = 100, top_k: int = 10, settings=None) -> List[dict]:
+        """
+        Recall@k versus latency of the vector index (see `vector_store.recall_report`).
+
+        Ground truth comes from the exact vectors stored in SQLite; the queries
+        are a random sample of stored documents.
+        """
+        with self._lock:
+            rows = self.metadata_conn.execute("SELECT id, vector FROM documents").fetchall()
+        if not rows:
+            return []
+        ids = [row[0] for row in rows]
+        vectors = np.frombuffer(b"".join(row[1] for row in rows), dtype=np.float32).reshape(len(rows), -1)
+        sample = np.random.default_rng(0).choice(len(rows), min(num_queries, len(rows)), replace=False)
+        return recall_report(self.index, ids, vectors, vectors[sample], top_k, settings)
+
     def clear_documents(self):
         """Clears stored documents."""
-        self.index.reset()
-        cursor = self.metadata_conn.cursor()
-        cursor.execute("DELETE FROM documents")
-        self.metadata_conn.commit()
+        with self._lock:
+            self.metadata_conn.execute("DELETE FROM documents")
+            self.metadata_conn.execute("DELETE FROM parent_documents")
+            self.metadata_conn.execute("DELETE FROM ingest_progress")
+            self.metadata_conn.execute("DELETE FROM dedup_bands")
+            self.metadata_conn.commit()
+            self.index.reset()
+
+    def close(self):
+        """Snapshots the vector index and closes the metadata database."""
+        with self._lock:
+            self.index.close()
+            self.metadata_conn.close()
+
+
+### 🌐 SHARED RETRIEVER ###
+_retriever: Optional[DocumentRetriever] = None
+_retriever_lock = threading.Lock()
+
+
+def get_retriever() -> DocumentRetriever:
+    """Returns the process-wide retriever, opening its metadata database on first use."""
+    global _retriever
+    with _retriever_lock:
+        if _retriever is None:
+            _retriever = DocumentRetriever()
+        return _retriever
+
+
+def close_retriever():
+    """Closes the shared retriever, if it was opened (application shutdown)."""
+    global _retriever
+    with _retriever_lock:
+        if _retriever is not None:
+            _retriever.close()
+            _retriever = None
+
+
+def retrieve_documents(query: str, top_k: int = 5, nprobe: Optional[int] = None,
+                       ef_search: Optional[int] = None) -> List[dict]:
+    """
+    Top-k documents with their distances from the shared retriever (see `DocumentRetriever.search`).
+    """
+    return get_retriever().search(query, top_k, nprobe, ef_search)
 
 
 ### 🛠️ EXAMPLE USAGE ###
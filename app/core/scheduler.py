@@ -0,0 +1,833 @@
+"""
+scheduler.py - Continuous-Batching Request Scheduler
+-----------------------------------------------------
+🔹 Features:
+- Thread-safe request queue shared by sync and async callers
+- Free batch slots go to tenants by weighted fair queueing (interactive before batch)
+- Groups waiting requests into dynamic batches under a max-wait window
+- New sequences join the running batch at decode-step boundaries as finished ones leave
+- Each caller's future resolves on its own as soon as its sequence ends
+- Token streaming with cancellation at step boundaries (e.g. client disconnects)
+- Optional per-session prefix cache: follow-up turns only prefill appended tokens
+- Parallel sampling (n > 1): one prefill, KV rows forked across n continuations
+- Optional per-token log-probabilities of the sampled tokens
+- Constrained decoding: a grammar's allowed-token mask is applied before sampling
+- Optional paged KV (see `app.core.paged_kv`): sequences hold blocks of a shared
+  pool, are admitted by free blocks and preempted (then re-prefilled) when it runs out
+- Exclusive requests (e.g. speculative decoding) run their own decoder on the
+  worker thread, in fair-queue order, while no batch is on the model
+
+📌 Dependencies:
+- torch (PyTorch backend)
+- transformers (any Hugging Face causal LM returning `past_key_values`)
+"""
+
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import CancelledError, Future
+from typing import AsyncIterator, Callable, List, Optional, Sequence
+
+import torch
+import torch.nn.functional as F
+
+from app.core.fair_queue import DEFAULT_SHARE, FairQueue, FairShare
+from app.core.kv_cache import (
+    KVLayers,
+    PrefixCache,
+    build_kv,
+    kv_concat_rows,
+    kv_layers,
+    kv_select_rows,
+    kv_trim_left,
+)
+from app.core.paged_kv import BlockTable, PagedKVCache
+from app.utils.logger import logger
+
+### 🔧 CONFIGURATION ###
+DEFAULT_BATCH_SIZE = 8  # Max sequences decoded together (settings.yaml → inference.batch_size)
+DEFAULT_MAX_WAIT_MS = 10  # How long an idle scheduler waits to fill a batch
+IDLE_POLL_SECONDS = 0.1  # Queue poll interval while nothing is running
+
+
+def sample_next_tokens(
+    logits: torch.Tensor,
+    temperatures: Sequence[float],
+    top_ps: Sequence[float],
+    generator: Optional[torch.Generator] = None,
+) -> torch.Tensor:
+    """
+    Picks the next token for every row of a [batch, vocab] logits tensor.
+
+    Rows with temperature <= 0 are decoded greedily; the others use
+    temperature scaling followed by nucleus (top-p) sampling.
+    """
+    greedy = logits.argmax(dim=-1)
+    if all(t <= 0 for t in temperatures):
+        return greedy
+
+    temps = torch.tensor(temperatures, dtype=logits.dtype, device=logits.device)
+    top_p = torch.tensor(top_ps, dtype=logits.dtype, device=logits.device)
+    probs = torch.softmax(logits / temps.clamp(min=1e-5).unsqueeze(-1), dim=-1)
+
+    sorted_probs, sorted_idx = probs.sort(dim=-1, descending=True)
+    cumulative = sorted_probs.cumsum(dim=-1)
+    sorted_probs[(cumulative - sorted_probs) > top_p.unsqueeze(-1)] = 0.0
+    choice = torch.multinomial(sorted_probs, 1, generator=generator)
+    sampled = sorted_idx.gather(-1, choice).squeeze(-1)
+
+    return torch.where(temps <= 0, greedy, sampled)
+
+
+class SequenceRequest:
+    """
+    A single generation request tracked by the scheduler.
+    """
+
+    def __init__(self, prompt_ids: List[int], max_new_tokens: int, temperature: float = 0.0,
+                 top_p: float = 1.0, eos_token_id: Optional[int] = None,
+                 on_token: Optional[Callable[[int], None]] = None, session_id: Optional[str] = None,
+                 share: FairShare = DEFAULT_SHARE, logprobs: bool = False, grammar=None,
+                 runner: Optional[Callable[[List[int], int], List[int]]] = None):
+        self.prompt_ids = list(prompt_ids)
+        self.session_id = session_id
+        self.share = share
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.eos_token_id = eos_token_id
+        self.on_token = on_token
+        self.output_ids: List[int] = []
+        self.logprobs = logprobs
+        self.output_logprobs: List[float] = []  # Model log-probability of each sampled token
+        self.forks: List["SequenceRequest"] = []  # Siblings sharing this request's prefill (n > 1)
+        self.constraint = grammar.begin() if grammar is not None else None  # Position in the output grammar
+        self.runner = runner  # Decodes the request by itself instead of in the batch (see `run_alone`)
+        self.finished = False
+        self.cancelled = False
+        self.future: Future = Future()
+        self.arrival_time = time.time()
+        self.first_token_time: Optional[float] = None
+
+    @property
+    def context_ids(self) -> List[int]:
+        """Tokens to prefill: the prompt, plus the output so far for a preempted sequence."""
+        return self.prompt_ids + self.output_ids
+
+    @property
+    def group(self) -> List["SequenceRequest"]:
+        """The sequences a prefill of this request starts (forks only on its first prefill)."""
+        return [self] + self.forks if not self.output_ids else [self]
+
+    @property
+    def width(self) -> int:
+        """Batch rows the request occupies once admitted (itself plus its forks)."""
+        return len(self.group)
+
+    def append_token(self, token_id: int, logprob: Optional[float] = None):
+        """
+        Records a sampled token and marks the sequence finished on EOS or length limit.
+        """
+        if self.first_token_time is None:
+            self.first_token_time = time.time()
+        self.output_ids.append(token_id)
+        if logprob is not None:
+            self.output_logprobs.append(logprob)
+        if token_id == self.eos_token_id or len(self.output_ids) >= self.max_new_tokens:
+            self.finished = True
+        if self.constraint is not None and self.constraint.advance(token_id):
+            self.finished = True  # The grammar is complete (or cannot continue)
+        if self.on_token is not None and not self.cancelled:
+            self.on_token(token_id)
+
+    def cancel(self):
+        """
+        Abandons the request; the scheduler drops it at the next step boundary.
+        """
+        self.cancelled = True
+        self.future.cancel()  # Only succeeds while still queued
+        for fork in self.forks:
+            fork.cancel()
+
+
+### 📂 BATCH SCHEDULER CLASS ###
+class BatchScheduler:
+    """
+    Continuous (iteration-level) batching on top of a Hugging Face causal LM.
+
+    A background worker owns the running batch: one left-padded KV cache,
+    its attention mask and the last sampled token of every row. Between
+    decode steps it prefills newly admitted requests, stacks them onto the
+    batch and drops rows whose sequences have finished. Requests for n
+    samples are prefilled once; their KV row is then copied into n rows
+    that decode independently.
+
+    With `paged_kv`, rows keep their KV in block tables instead and the
+    batch view is gathered for every step. Forks share their leader's
+    blocks, a request is admitted only while free blocks cover its prompt,
+    and when decoding runs out of blocks the newest sequence is preempted:
+    its blocks are freed and it is requeued to re-prefill its prompt plus
+    the tokens generated so far.
+    """
+
+    def __init__(self, model, device: str = "cpu", batch_size: int = DEFAULT_BATCH_SIZE,
+                 max_wait_ms: float = DEFAULT_MAX_WAIT_MS, eos_token_id: Optional[int] = None,
+                 prefix_cache: Optional[PrefixCache] = None, paged_kv: Optional[PagedKVCache] = None):
+        self.model = model
+        self.prefix_cache = prefix_cache
+        self.paged_kv = paged_kv
+        self.device = device
+        self.batch_size = batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.eos_token_id = eos_token_id
+
+        self._waiting = FairQueue()  # SequenceRequests, costed by prompt + max_new_tokens
+        self._running: List[SequenceRequest] = []
+        self._past = None
+        self._legacy_kv = False
+        self._attention_mask: Optional[torch.Tensor] = None
+        self._next_tokens: Optional[torch.Tensor] = None
+        self._tables: List[BlockTable] = []  # Paged KV: one block table per running row
+
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._stopped = threading.Event()
+
+        self._stats_lock = threading.Lock()  # Counters are bumped by callers and by the worker
+        self.stats = {"requests": 0, "completed": 0, "cancelled": 0, "failed": 0,
+                      "decode_steps": 0, "decoded_tokens": 0, "forked_sequences": 0, "prefill_tokens_shared": 0,
+                      "constrained_tokens": 0, "preempted": 0, "peak_running": 0, "exclusive_runs": 0}
+
+    ### 🚦 LIFECYCLE ###
+    def start(self):
+        """
+        Starts the background worker (idempotent).
+        """
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="jc1-batch-scheduler", daemon=True)
+            self._thread.start()
+            logger.info(f"✅ Batch scheduler started (batch_size={self.batch_size}, "
+                        f"max_wait={self.max_wait * 1000:.0f}ms).")
+
+    def stop(self, timeout: Optional[float] = None):
+        """
+        Stops the worker; running and queued requests are failed.
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        error = RuntimeError("Batch scheduler stopped.")
+        self._fail_running(error)
+        while True:
+            try:
+                request = self._waiting.get_nowait()
+            except queue.Empty:
+                break
+            for member in [request] + request.forks:
+                if not member.future.done():
+                    member.future.set_exception(error)
+
+    ### 📥 SUBMISSION ###
+    def enqueue(self, prompt_ids: List[int], max_new_tokens: int, temperature: float = 0.0,
+                top_p: float = 1.0, on_token: Optional[Callable[[int], None]] = None,
+                session_id: Optional[str] = None, share: FairShare = DEFAULT_SHARE, grammar=None) -> SequenceRequest:
+        """
+        Queues a request and returns its handle.
+
+        `on_token` is called from the worker thread for every sampled token.
+        `session_id` enables prefix-cache reuse across turns of one conversation.
+        `share` names the tenant, weight and priority class used to order the queue.
+        `grammar` (see `app.core.grammar`) restricts the output to its language.
+        """
+        if not prompt_ids:
+            raise ValueError("prompt_ids must contain at least one token.")
+        if max_new_tokens < 1:
+            raise ValueError("max_new_tokens must be >= 1.")
+
+        request = SequenceRequest(prompt_ids, max_new_tokens, temperature, top_p,
+                                  self.eos_token_id, on_token, session_id, share, grammar=grammar)
+        self.start()
+        self._count("requests")
+        self._waiting.put(request, len(request.prompt_ids) + max_new_tokens, share)
+        return request
+
+    def enqueue_n(self, prompt_ids: List[int], n: int, max_new_tokens: int, temperature: float = 0.0,
+                  top_p: float = 1.0, session_id: Optional[str] = None, share: FairShare = DEFAULT_SHARE,
+                  logprobs: bool = False, grammar=None) -> List[SequenceRequest]:
+        """
+        Queues `n` samples of one prompt that share a single prefill.
+
+        The first handle carries the group (cancelling it cancels all);
+        only it may reuse or refresh the session's prefix cache.
+        """
+        if not prompt_ids:
+            raise ValueError("prompt_ids must contain at least one token.")
+        if max_new_tokens < 1 or n < 1:
+            raise ValueError("max_new_tokens and n must be >= 1.")
+
+        leader = SequenceRequest(prompt_ids, max_new_tokens, temperature, top_p, self.eos_token_id,
+                                 session_id=session_id, share=share, logprobs=logprobs, grammar=grammar)
+        leader.forks = [SequenceRequest(prompt_ids, max_new_tokens, temperature, top_p, self.eos_token_id,
+                                        share=share, logprobs=logprobs, grammar=grammar) for _ in range(n - 1)]
+        self.start()
+        self._count("requests")
+        self._waiting.put(leader, len(leader.prompt_ids) + n * max_new_tokens, share)
+        return [leader] + leader.forks
+
+    def submit(self, prompt_ids: List[int], max_new_tokens: int, temperature: float = 0.0,
+               top_p: float = 1.0, session_id: Optional[str] = None, share: FairShare = DEFAULT_SHARE,
+               grammar=None) -> Future:
+        """
+        Queues a request and returns a future resolving to the generated token ids.
+        """
+        return self.enqueue(prompt_ids, max_new_tokens, temperature, top_p, session_id=session_id,
+                            share=share, grammar=grammar).future
+
+    async def generate(self, prompt_ids: List[int], max_new_tokens: int, temperature: float = 0.0,
+                       top_p: float = 1.0, session_id: Optional[str] = None,
+                       share: FairShare = DEFAULT_SHARE, grammar=None) -> List[int]:
+        """
+        Async wrapper around `submit` that awaits the generated token ids.
+        """
+        return await asyncio.wrap_future(
+            self.submit(prompt_ids, max_new_tokens, temperature, top_p, session_id, share, grammar)
+        )
+
+    async def generate_n(self, prompt_ids: List[int], n: int, max_new_tokens: int, temperature: float = 0.0,
+                         top_p: float = 1.0, session_id: Optional[str] = None, share: FairShare = DEFAULT_SHARE,
+                         logprobs: bool = False, grammar=None) -> List[SequenceRequest]:
+        """
+        Awaits `n` sampled continuations of one prompt (see `enqueue_n`).
+
+        Returns the finished requests; read `output_ids` and `output_logprobs`.
+        """
+        requests = self.enqueue_n(prompt_ids, n, max_new_tokens, temperature, top_p, session_id, share, logprobs,
+                                  grammar)
+        try:
+            await asyncio.gather(*(asyncio.wrap_future(r.future) for r in requests))
+        except BaseException:
+            requests[0].cancel()
+            raise
+        return requests
+
+    async def stream(self, prompt_ids: List[int], max_new_tokens: int, temperature: float = 0.0,
+                     top_p: float = 1.0, session_id: Optional[str] = None,
+                     share: FairShare = DEFAULT_SHARE, grammar=None) -> AsyncIterator[int]:
+        """
+        Yields token ids as soon as they are sampled.
+
+        Closing the iterator early (e.g. the HTTP client went away) cancels
+        the sequence so it stops consuming batch slots.
+        """
+        loop = asyncio.get_running_loop()
+        tokens: asyncio.Queue = asyncio.Queue()
+
+        def push(item: Optional[int]):
+            try:
+                loop.call_soon_threadsafe(tokens.put_nowait, item)
+            except RuntimeError:  # Consumer's event loop already closed
+                pass
+
+        request = self.enqueue(prompt_ids, max_new_tokens, temperature, top_p,
+                               on_token=push, session_id=session_id, share=share, grammar=grammar)
+        # Runs after the last token callback, so the sentinel always arrives last
+        request.future.add_done_callback(lambda _: push(None))
+        try:
+            while True:
+                token_id = await tokens.get()
+                if token_id is None:
+                    break
+                yield token_id
+            request.future.result()  # Surface worker errors to the consumer
+        finally:
+            if not request.future.done():
+                request.cancel()
+
+    async def run_alone(self, prompt_ids: List[int], max_new_tokens: int,
+                        runner: Callable[[List[int], int], List[int]], share: FairShare = DEFAULT_SHARE) -> List[int]:
+        """
+        Awaits `runner(prompt_ids, max_new_tokens)`, a decoder that drives the same
+        model itself (e.g. speculative decoding), run on the worker thread.
+
+        The request waits its fair turn in the queue like any other and starts
+        only once the running batch has drained; nothing else decodes meanwhile.
+        """
+        if not prompt_ids:
+            raise ValueError("prompt_ids must contain at least one token.")
+        request = SequenceRequest(prompt_ids, max_new_tokens, eos_token_id=self.eos_token_id, share=share,
+                                  runner=runner)
+        self.start()
+        self._count("requests")
+        self._waiting.put(request, len(request.prompt_ids) + max_new_tokens, share)
+        try:
+            return await asyncio.wrap_future(request.future)
+        except BaseException:
+            request.cancel()
+            raise
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of requests waiting to join the batch."""
+        return self._waiting.qsize()
+
+    def get_stats(self) -> dict:
+        """A consistent copy of the scheduler counters."""
+        with self._stats_lock:
+            return dict(self.stats)
+
+    def queue_stats(self) -> dict:
+        """Per-class and per-tenant wait-time histograms of the waiting queue."""
+        return self._waiting.get_stats()
+
+    @property
+    def running(self) -> int:
+        """Number of sequences currently being decoded."""
+        return len(self._running)
+
+    ### 🔁 WORKER LOOP ###
+    def _run(self):
+        while not self._stopped.is_set():
+            admitted = self._admit()
+            if not admitted and not self._running:
+                continue
+            try:
+                with torch.no_grad():
+                    if admitted and admitted[0].runner is not None:
+                        self._run_alone(admitted[0])
+                    elif admitted:
+                        self._prefill(admitted)
+                        self._retire_finished()
+                    if self._running:
+                        self._decode_step()
+                        self._retire_finished()
+            except Exception as e:
+                logger.error(f"❌ Batch step failed: {e}")
+                self._fail_running(e)
+                for request in admitted:
+                    for member in [request] + request.forks:
+                        if not member.future.done():
+                            member.future.set_exception(e)
+
+    def _admit(self) -> List[SequenceRequest]:
+        """
+        Pulls waiting requests into free batch slots.
+
+        An idle scheduler blocks for the first request and then waits up to
+        `max_wait` to fill the batch; a busy one only takes what is already
+        queued so running sequences are never stalled. Every request, also
+        one arriving during a wait, is taken only if its rows are free and
+        (paged KV) its blocks fit; otherwise it stays first in line.
+        """
+        free = self.batch_size - len(self._running)
+        admitted: List[SequenceRequest] = []
+        if free <= 0:
+            return admitted
+
+        def admissible(request: SequenceRequest) -> bool:
+            alone = not admitted and not self._running  # An oversized group still runs, alone
+            if request.runner is not None:
+                return alone  # Exclusive requests wait for the batch to drain
+            if not alone and request.width > free - len(admitted):
+                return False  # A group of n samples waits until n rows are free
+            return self._fits(request, admitted)  # Otherwise not enough free KV blocks yet
+
+        deadline = None
+        if not self._running:
+            deadline = time.monotonic() + IDLE_POLL_SECONDS
+        while len(admitted) < free:
+            try:
+                if deadline is None:
+                    request = self._waiting.get(block=False, accept=admissible)
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    request = self._waiting.get(timeout=remaining, accept=admissible)
+            except queue.Empty:
+                if not admitted and not self._running:
+                    self._reject_oversized()
+                break
+            if not admitted and not self._running:
+                deadline = time.monotonic() + self.max_wait
+            admitted.append(request)
+            free -= request.width - 1
+            if request.runner is not None:
+                break  # Runs by itself
+
+        # Callers may have cancelled their futures while queued (preempted ones are already running)
+        admitted = [r for r in admitted if r.future.running() or r.future.set_running_or_notify_cancel()]
+        for request in admitted:
+            if not request.output_ids:
+                request.forks = [f for f in request.forks if f.future.set_running_or_notify_cancel()]
+        if self.paged_kv is not None and admitted and admitted[0].runner is None:
+            self.paged_kv.reserve(self._blocks_needed(admitted))  # Evicts session prefixes only now
+        return admitted
+
+    def _run_alone(self, request: SequenceRequest):
+        """Runs an exclusive request's own decoder; the batch is empty meanwhile."""
+        try:
+            request.output_ids = list(request.runner(request.prompt_ids, request.max_new_tokens))
+        except Exception as e:
+            logger.error(f"❌ Exclusive request failed: {e}")
+            self._count("failed")
+            request.future.set_exception(e)
+            return
+        request.finished = True
+        request.future.set_result(list(request.output_ids))
+        self._count("completed")
+        self._count("exclusive_runs")
+
+    def _fits(self, request: SequenceRequest, admitted: List[SequenceRequest]) -> bool:
+        """
+        Paged KV only: whether free (or reclaimable prefix) blocks cover the admitted
+        contexts, `request`'s and one block of growth per row (forks copy their
+        leader's last block), and the next step's gathered view stays within budget.
+        Nothing is evicted here; see `_admit`.
+        """
+        if self.paged_kv is None:
+            return True
+        requests = admitted + [request]
+        if self._blocks_needed(requests) > self.paged_kv.num_available_blocks:
+            return False
+        rows = len(self._running) + sum(r.width for r in requests)
+        length = max([table.length for table in self._tables] + [len(r.context_ids) for r in requests]) + 1
+        return self.paged_kv.gather_bytes(rows, length) <= self.paged_kv.gather_budget_bytes
+
+    def _blocks_needed(self, requests: List[SequenceRequest]) -> int:
+        return len(self._running) + sum(
+            self.paged_kv.blocks_for(len(r.context_ids) + 1) + r.width - 1 for r in requests
+        )
+
+    def _reject_oversized(self):
+        """Rejects the head request if it does not fit even into an empty paged KV cache."""
+        head = self._waiting.peek()
+        if head is not None and not self._fits(head, []) and self._waiting.remove(head):
+            self._reject(head, RuntimeError("Sequence does not fit in the paged KV cache."))
+
+    @staticmethod
+    def _reject(request: SequenceRequest, error: Exception):
+        for member in [request] + request.forks:
+            if not member.future.done():
+                member.future.set_exception(error)
+
+    def _prefill(self, requests: List[SequenceRequest]):
+        """
+        Prefills newly admitted requests and stacks them onto the running batch.
+
+        Requests whose session prefix is in the prefix cache only prefill
+        their new tokens; the rest share one left-padded prefill.
+        """
+        parts, misses = [], []
+        for request in requests:
+            cached = None
+            if request.session_id is not None:
+                if self.paged_kv is not None:
+                    cached = self.paged_kv.lookup_prefix(request.session_id, request.context_ids)
+                elif self.prefix_cache is not None:
+                    cached = self.prefix_cache.lookup(request.session_id, request.context_ids)
+            if cached is None:
+                misses.append(request)
+            else:
+                parts.append(self._prefill_cached(request, *cached))
+        if misses:
+            parts.insert(0, self._prefill_batch(misses))
+
+        admitted = [r for part in parts for r in part[0]]  # Forks included
+        if self.paged_kv is not None:
+            # Prefilled KV already lives in block tables; only the token column is batched
+            tables = [table for part in parts for table in part[1]]
+            next_tokens = torch.cat([part[3] for part in parts])
+            if self._running:
+                next_tokens = torch.cat([self._next_tokens, next_tokens])
+            self._tables.extend(tables)
+            self._next_tokens = next_tokens
+            self._running.extend(admitted)
+            self._count_peak(len(self._running))
+            return
+
+        if self._running:
+            parts.insert(0, (self._running, kv_layers(self._past), self._attention_mask, self._next_tokens))
+
+        if len(parts) == 1:
+            _, kv, attention_mask, next_tokens = parts[0]
+        else:
+            kv = kv_concat_rows([part[1] for part in parts])
+            width = kv[0][0].shape[2]
+            attention_mask = torch.cat([F.pad(part[2], (width - part[2].shape[1], 0)) for part in parts])
+            next_tokens = torch.cat([part[3] for part in parts])
+
+        self._past = build_kv(kv, self._legacy_kv)
+        self._attention_mask = attention_mask
+        self._next_tokens = next_tokens
+        self._running.extend(admitted)
+        self._count_peak(len(self._running))
+
+    def _prefill_batch(self, requests: List[SequenceRequest]):
+        """
+        One left-padded forward pass over several full prompts.
+        """
+        length = max(len(r.context_ids) for r in requests)
+        input_ids = torch.zeros((len(requests), length), dtype=torch.long)
+        attention_mask = torch.zeros((len(requests), length), dtype=torch.long)
+        for row, request in enumerate(requests):
+            context_ids = request.context_ids
+            input_ids[row, length - len(context_ids):] = torch.tensor(context_ids)
+            attention_mask[row, length - len(context_ids):] = 1
+        input_ids = input_ids.to(self.device)
+        attention_mask = attention_mask.to(self.device)
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+
+        output = self.model(input_ids=input_ids, attention_mask=attention_mask,
+                            position_ids=position_ids, use_cache=True)
+        self._legacy_kv = isinstance(output.past_key_values, tuple)
+        return self._finish_prefill(requests, kv_layers(output.past_key_values), attention_mask,
+                                    output.logits[:, -1, :])
+
+    def _prefill_cached(self, request: SequenceRequest, cached, cached_len: int):
+        """
+        Prefills only the tokens after a cached prefix of the request's prompt.
+
+        `cached` is the prefix's KV, or its block table with paged KV.
+        """
+        table = None
+        if isinstance(cached, BlockTable):
+            table = cached
+            cached, _ = self.paged_kv.gather([table])
+        context_ids = request.context_ids
+        input_ids = torch.tensor([context_ids[cached_len:]], device=self.device)
+        attention_mask = torch.ones((1, len(context_ids)), dtype=torch.long, device=self.device)
+        position_ids = torch.arange(cached_len, len(context_ids), device=self.device).unsqueeze(0)
+
+        output = self.model(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids,
+                            past_key_values=build_kv(cached, self._legacy_kv), use_cache=True)
+        return self._finish_prefill([request], kv_layers(output.past_key_values), attention_mask,
+                                    output.logits[:, -1, :], [table])
+
+    def _finish_prefill(self, requests: List[SequenceRequest], kv: KVLayers, attention_mask: torch.Tensor,
+                        logits: torch.Tensor, tables: Optional[List[Optional[BlockTable]]] = None):
+        """
+        Forks prefilled rows for n > 1 requests, then samples and records every row's first token.
+
+        With paged KV the rows are written to block tables (extending `tables`,
+        if given, past their cached prefix) and returned in place of the KV;
+        forks share their leader's blocks instead of copying the row.
+        """
+        if self.paged_kv is not None:
+            kv = self._write_tables(requests, kv, attention_mask, tables or [None] * len(requests))
+        if any(r.width > 1 for r in requests):
+            rows = [row for row, r in enumerate(requests) for _ in range(r.width)]
+            for r in requests:
+                self._count("forked_sequences", r.width - 1)
+                self._count("prefill_tokens_shared", (r.width - 1) * len(r.prompt_ids))
+            requests = [member for r in requests for member in r.group]
+            rows = torch.tensor(rows, device=attention_mask.device)
+            if self.paged_kv is None:
+                kv = kv_select_rows(kv, rows)
+                attention_mask = attention_mask.index_select(0, rows)
+            logits = logits.index_select(0, rows)
+        logits = self._constrain(logits, requests)
+        next_tokens = self._sample(logits, requests)
+        self._record(requests, next_tokens, logits)
+        return requests, kv, attention_mask, next_tokens
+
+    def _write_tables(self, requests: List[SequenceRequest], kv: KVLayers, attention_mask: torch.Tensor,
+                      tables: List[Optional[BlockTable]]) -> List[BlockTable]:
+        """
+        Paged KV: stores each prefilled row (without left padding) in its block table
+        and gives every fork a table sharing its leader's blocks.
+        """
+        members = []
+        for row, (request, table) in enumerate(zip(requests, tables)):
+            table = table if table is not None else BlockTable()
+            length = int(attention_mask[row].sum())
+            self.paged_kv.write(table, [(k[row:row + 1, :, -length:], v[row:row + 1, :, -length:]) for k, v in kv],
+                                start=table.length)
+            members.append(table)
+            members.extend(self.paged_kv.fork(table) for _ in range(request.width - 1))
+        return members
+
+    def _decode_step(self):
+        """
+        Feeds the last sampled token of every running row through the model once.
+        """
+        if self.paged_kv is not None:
+            if not self._reserve_decode_blocks():
+                return
+            kv, attention_mask = self.paged_kv.gather(self._tables)
+            past = build_kv(kv, self._legacy_kv)
+            del kv  # The cache update can then free each layer's gathered copy
+        else:
+            past, attention_mask = self._past, self._attention_mask
+        batch = len(self._running)
+        attention_mask = torch.cat([attention_mask, attention_mask.new_ones((batch, 1))], dim=1)
+        position_ids = attention_mask.sum(-1, keepdim=True) - 1
+
+        output = self.model(input_ids=self._next_tokens.unsqueeze(-1), attention_mask=attention_mask,
+                            position_ids=position_ids, past_key_values=past, use_cache=True)
+        logits = self._constrain(output.logits[:, -1, :], self._running)
+        next_tokens = self._sample(logits, self._running)
+
+        if self.paged_kv is not None:
+            self.paged_kv.append(self._tables, kv_layers(output.past_key_values))
+        else:
+            self._past = output.past_key_values
+            self._attention_mask = attention_mask
+        self._next_tokens = next_tokens
+        self._record(self._running, next_tokens, logits)
+        self._count("decode_steps")
+        self._count("decoded_tokens", batch)
+
+    def _reserve_decode_blocks(self) -> bool:
+        """
+        Paged KV: frees blocks for one more position per row, preempting the newest
+        sequences while they are short or the gathered view outgrows its budget.
+        Returns False if nothing is left to decode.
+        """
+        while self._running:
+            needed = sum(self.paged_kv.blocks_needed(table, 1) for table in self._tables)
+            length = max(table.length for table in self._tables) + 1
+            within_budget = self.paged_kv.gather_bytes(len(self._tables), length) <= self.paged_kv.gather_budget_bytes
+            if within_budget and self.paged_kv.reserve(needed):
+                return True
+            if len(self._running) == 1:
+                logger.warning("⚠️ Paged KV cache is full; ending the only running sequence early.")
+                self._running[0].finished = True
+                self._retire_finished()
+                return False
+            self._preempt(len(self._running) - 1)
+        return False
+
+    def _preempt(self, row: int):
+        """
+        Frees a row's blocks and requeues its request to resume from prompt + output later.
+        """
+        request = self._running.pop(row)
+        self.paged_kv.free(self._tables.pop(row))
+        keep = torch.tensor([r for r in range(len(self._running) + 1) if r != row], device=self._next_tokens.device)
+        self._next_tokens = self._next_tokens.index_select(0, keep)
+        self._waiting.put(request, len(request.context_ids) + request.max_new_tokens - len(request.output_ids),
+                          request.share)
+        self._count("preempted")
+
+    def _constrain(self, logits: torch.Tensor, requests: List[SequenceRequest]) -> torch.Tensor:
+        """
+        Masks, per row, the tokens its grammar does not allow in its current state.
+        """
+        rows = [row for row, r in enumerate(requests) if r.constraint is not None]
+        if not rows:
+            return logits
+        allowed = torch.stack([requests[row].constraint.mask(logits.shape[-1], logits.device) for row in rows])
+        index = torch.tensor(rows, device=logits.device)
+        logits = logits.clone()
+        logits[index] = logits[index].masked_fill(~allowed, float("-inf"))
+        self._count("constrained_tokens", len(rows))
+        return logits
+
+    def _sample(self, logits: torch.Tensor, requests: List[SequenceRequest]) -> torch.Tensor:
+        return sample_next_tokens(
+            logits, [r.temperature for r in requests], [r.top_p for r in requests]
+        )
+
+    @staticmethod
+    def _record(requests: List[SequenceRequest], tokens: torch.Tensor, logits: torch.Tensor):
+        logprobs = [None] * len(requests)
+        if any(r.logprobs for r in requests):
+            logprobs = torch.log_softmax(logits.float(), dim=-1).gather(-1, tokens.unsqueeze(-1)).squeeze(-1).tolist()
+        for request, token, logprob in zip(requests, tokens.tolist(), logprobs):
+            request.append_token(token, logprob if request.logprobs else None)
+
+    def _retire_finished(self):
+        """
+        Resolves finished futures and removes their rows from the batch.
+        """
+        if not any(r.finished or r.cancelled for r in self._running):
+            return
+
+        keep = []
+        for row, request in enumerate(self._running):
+            if request.cancelled:
+                if not request.future.done():
+                    request.future.set_exception(CancelledError())
+                self._count("cancelled")
+            elif request.finished:
+                self._save_prefix(row, request)
+                if not request.future.done():
+                    request.future.set_result(list(request.output_ids))
+                self._count("completed")
+            else:
+                keep.append(row)
+
+        if not keep:
+            self._reset_batch()
+            return
+
+        if self.paged_kv is not None:
+            kept = set(keep)
+            for row, table in enumerate(self._tables):
+                if row not in kept:
+                    self.paged_kv.free(table)
+            self._tables = [self._tables[row] for row in keep]
+            self._next_tokens = self._next_tokens.index_select(0, torch.tensor(keep, device=self._next_tokens.device))
+            self._running = [self._running[row] for row in keep]
+            return
+
+        rows = torch.tensor(keep, device=self._attention_mask.device)
+        kv = kv_select_rows(kv_layers(self._past), rows)
+        attention_mask = self._attention_mask.index_select(0, rows)
+
+        # Drop columns that are left padding for every remaining row
+        start = int((attention_mask.sum(0) == 0).long().cumprod(0).sum())
+        self._past = build_kv(kv_trim_left(kv, start), self._legacy_kv)
+        self._attention_mask = attention_mask[:, start:]
+        self._next_tokens = self._next_tokens.index_select(0, rows)
+        self._running = [self._running[row] for row in keep]
+
+    def _save_prefix(self, row: int, request: SequenceRequest):
+        """
+        Hands a finished row's KV (without its left padding) to the prefix cache.
+        """
+        if request.session_id is None:
+            return
+        if self.paged_kv is not None:
+            table = self._tables[row]  # Shared, not copied; the blocks outlive the row
+            self.paged_kv.store_prefix(request.session_id, (request.prompt_ids + request.output_ids)[:table.length],
+                                       table)
+            return
+        if self.prefix_cache is None:
+            return
+        cached_len = int(self._attention_mask[row].sum())
+        rows = torch.tensor([row], device=self._attention_mask.device)
+        kv = kv_select_rows(kv_layers(self._past), rows)
+        kv = kv_trim_left(kv, kv[0][0].shape[2] - cached_len)
+        # The last sampled token has not been fed through the model yet
+        self.prefix_cache.store(request.session_id, (request.prompt_ids + request.output_ids)[:cached_len], kv)
+
+    def _fail_running(self, error: Exception):
+        for request in self._running:
+            if not request.future.done():
+                request.future.set_exception(error)
+            self._count("failed")
+        self._reset_batch()
+
+    def _reset_batch(self):
+        if self.paged_kv is not None:
+            for table in self._tables:
+                self.paged_kv.free(table)
+        self._tables = []
+        self._running = []
+        self._past = None
+        self._attention_mask = None
+        self._next_tokens = None
+
+    def _count(self, key: str, amount: int = 1):
+        with self._stats_lock:
+            self.stats[key] += amount
+
+    def _count_peak(self, running: int):
+        with self._stats_lock:
+            self.stats["peak_running"] = max(self.stats["peak_running"], running)
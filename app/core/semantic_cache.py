@@ -0,0 +1,208 @@
+"""
+semantic_cache.py - Embedding-Similarity Response Cache
+--------------------------------------------------------
+🔹 Features:
+- Answers paraphrased prompts from cache ("capital of France?" ≈ "what's France's capital")
+- Embeds messages with all-MiniLM-L6-v2 and searches a small FAISS index of recent prompts
+- Per-tenant indexes, bounded in size with least-recently-used eviction
+- Answers are reused only for the generation parameters they were made with
+- Hit / miss / false-hit counters and a similarity histogram for threshold tuning
+
+📌 Dependencies:
+- FAISS (inner-product search over normalized embeddings = cosine similarity)
+- SentenceTransformers (embeddings, shared via the model registry)
+"""
+
+import os
+import time
+import itertools
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+import faiss
+import numpy as np
+
+### 🔧 CONFIGURATION ###
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.92))  # Min cosine similarity
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", 1000))  # Entries per tenant
+SEMANTIC_CACHE_TENANTS = int(os.getenv("SEMANTIC_CACHE_TENANTS", 1000))  # Tenants kept in memory
+SEMANTIC_CACHE_TTL = int(os.getenv("SEMANTIC_CACHE_TTL", 3600))  # Seconds an answer stays valid
+SEMANTIC_CACHE_CANDIDATES = 4  # Nearest prompts checked for an entry with matching parameters
+HISTOGRAM_BUCKETS = [0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.92, 0.94, 0.96, 0.98, 1.0]
+
+
+class SemanticHit:
+    """
+    A cached answer returned for a similar prompt.
+    """
+
+    def __init__(self, entry_id: int, prompt: str, response: str, similarity: float):
+        self.entry_id = entry_id
+        self.prompt = prompt
+        self.response = response
+        self.similarity = similarity
+
+
+class _TenantIndex:
+    """FAISS index plus entry metadata for one tenant."""
+
+    def __init__(self, dim: int):
+        self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(dim))
+        self.entries = OrderedDict()  # entry id -> (prompt, response, created_at, params)
+        self.hit_similarity: Dict[int, float] = {}  # entry id -> similarity of its latest hit
+
+    def remove(self, entry_id: int) -> Optional[float]:
+        """Drops an entry; returns the similarity of its latest hit, if it had one."""
+        if self.entries.pop(entry_id, None) is not None:
+            self.index.remove_ids(np.array([entry_id], dtype=np.int64))
+        return self.hit_similarity.pop(entry_id, None)
+
+
+### 📂 SEMANTIC CACHE CLASS ###
+class SemanticCache:
+    """
+    Per-tenant cache of (prompt embedding → answer) pairs.
+
+    Lookups return the nearest cached prompt made with the same `params`
+    (e.g. max_tokens and temperature) when its cosine similarity reaches
+    `threshold`. Clients report wrong answers with `report_false_hit`,
+    which drops the entry and feeds the false-hit rate.
+    """
+
+    def __init__(self, embedder=None, threshold: float = SEMANTIC_CACHE_THRESHOLD,
+                 max_entries: int = SEMANTIC_CACHE_SIZE, max_tenants: int = SEMANTIC_CACHE_TENANTS,
+                 ttl: int = SEMANTIC_CACHE_TTL, enabled: bool = SEMANTIC_CACHE_ENABLED):
+        self.enabled = enabled
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.max_tenants = max_tenants
+        self.ttl = ttl
+        self._embedder = embedder
+        self._tenants: "OrderedDict[str, _TenantIndex]" = OrderedDict()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.stats = {"lookups": 0, "hits": 0, "misses": 0, "false_hits": 0, "evictions": 0}
+        self._histogram = {"lookups": [0] * len(HISTOGRAM_BUCKETS), "false_hits": [0] * len(HISTOGRAM_BUCKETS)}
+
+    def embed(self, text: str) -> np.ndarray:
+        """Returns the L2-normalized float32 embedding of `text` (registry embedder unless one was injected)."""
+        if self._embedder is not None:
+            vector = self._embedder.encode([text])
+        else:
+            from app.models.registry import model_registry
+            with model_registry.use("embedder") as embedder:
+                vector = embedder.encode([text])
+        vector = np.asarray(vector, dtype=np.float32)
+        faiss.normalize_L2(vector)
+        return vector
+
+    def lookup(self, tenant: str, message: str,
+               params: Optional[dict] = None) -> Tuple[Optional[SemanticHit], np.ndarray]:
+        """
+        Searches the tenant's cache for a similar prompt answered with the same `params`.
+
+        Returns:
+            tuple: (hit or None, the message embedding for a later `add`)
+        """
+        vector = self.embed(message)
+        with self._lock:
+            self.stats["lookups"] += 1
+            tenant_index = self._tenants.get(tenant)
+            hit = None
+            if tenant_index is not None and tenant_index.index.ntotal:
+                self._tenants.move_to_end(tenant)
+                scores, ids = tenant_index.index.search(vector, min(SEMANTIC_CACHE_CANDIDATES,
+                                                                    tenant_index.index.ntotal))
+                self._histogram["lookups"][self._bucket(float(scores[0][0]))] += 1
+                for similarity, entry_id in zip(scores[0].tolist(), ids[0].tolist()):
+                    if similarity < self.threshold:
+                        break
+                    entry = tenant_index.entries.get(entry_id)
+                    if entry is not None and time.time() - entry[2] > self.ttl:
+                        tenant_index.remove(entry_id)
+                        continue
+                    if entry is not None and entry[3] == (params or {}):
+                        tenant_index.entries.move_to_end(entry_id)
+                        tenant_index.hit_similarity[entry_id] = similarity
+                        hit = SemanticHit(entry_id, entry[0], entry[1], similarity)
+                        break
+
+            self.stats["hits" if hit else "misses"] += 1
+        return hit, vector
+
+    def add(self, tenant: str, message: str, response: str, vector: Optional[np.ndarray] = None,
+            params: Optional[dict] = None) -> int:
+        """
+        Caches `response` for `message`, generated with `params`; returns the new entry id.
+        """
+        if vector is None:
+            vector = self.embed(message)
+        with self._lock:
+            tenant_index = self._tenants.get(tenant)
+            if tenant_index is None:
+                if len(self._tenants) >= self.max_tenants:
+                    _, evicted = self._tenants.popitem(last=False)
+                    self.stats["evictions"] += len(evicted.entries)
+                tenant_index = self._tenants[tenant] = _TenantIndex(vector.shape[1])
+            self._tenants.move_to_end(tenant)
+
+            while len(tenant_index.entries) >= self.max_entries:
+                oldest = next(iter(tenant_index.entries))
+                tenant_index.remove(oldest)
+                self.stats["evictions"] += 1
+
+            entry_id = next(self._ids)
+            tenant_index.index.add_with_ids(vector, np.array([entry_id], dtype=np.int64))
+            tenant_index.entries[entry_id] = (message, response, time.time(), dict(params or {}))
+            return entry_id
+
+    def report_false_hit(self, tenant: str, entry_id: int) -> bool:
+        """
+        Records that a cached answer did not fit the new prompt and drops it.
+        """
+        with self._lock:
+            tenant_index = self._tenants.get(tenant)
+            if tenant_index is None or entry_id not in tenant_index.entries:
+                return False
+            similarity = tenant_index.remove(entry_id)
+            self.stats["false_hits"] += 1
+            if similarity is not None:
+                self._histogram["false_hits"][self._bucket(similarity)] += 1
+            return True
+
+    def clear(self, tenant: Optional[str] = None):
+        """Drops one tenant's entries, or everything."""
+        with self._lock:
+            if tenant is None:
+                self._tenants.clear()
+            else:
+                self._tenants.pop(tenant, None)
+
+    def get_stats(self) -> dict:
+        """
+        Returns counters, hit / false-hit rates and similarity histograms
+        (bucket upper bounds in `buckets`).
+        """
+        with self._lock:
+            stats = dict(self.stats)
+            stats["hit_rate"] = stats["hits"] / stats["lookups"] if stats["lookups"] else 0.0
+            stats["false_hit_rate"] = stats["false_hits"] / stats["hits"] if stats["hits"] else 0.0
+            stats["threshold"] = self.threshold
+            stats["tenants"] = len(self._tenants)
+            stats["entries"] = sum(len(t.entries) for t in self._tenants.values())
+            stats["similarity_histogram"] = {"buckets": HISTOGRAM_BUCKETS,
+                                             **{k: list(v) for k, v in self._histogram.items()}}
+            return stats
+
+    @staticmethod
+    def _bucket(similarity: float) -> int:
+        for idx, upper in enumerate(HISTOGRAM_BUCKETS):
+            if similarity <= upper:
+                return idx
+        return len(HISTOGRAM_BUCKETS) - 1
+
+
+# Shared semantic cache (disabled unless SEMANTIC_CACHE_ENABLED=true)
+semantic_cache = SemanticCache()
@@ -0,0 +1,216 @@
+"""
+session_store.py - Chat Session State
+--------------------------------------
+🔹 Features:
+- Keeps each user's message list together with its chat-template token ids
+- New turns tokenize only the appended text, never the whole history
+- Compact binary encoding (struct header, uint32 token ids, UTF-8 messages,
+  zlib above a size threshold) instead of pickled dicts
+- Sliding TTL: a session expires after `SESSION_TTL` seconds of inactivity
+- Stored on the shared CacheManager (in-process L1, Redis L2 when available)
+
+📌 Dependencies:
+- numpy (token id arrays)
+- zlib (compression of large sessions)
+- Tokenizer wrapper (`encode_chat_incremental`) from the model registry
+"""
+
+import os
+import zlib
+import struct
+import numpy as np
+from typing import List, Optional
+
+from app.core.cache import cache_manager
+from app.utils.logger import logger
+
+### 🔧 CONFIGURATION ###
+SESSION_TTL = int(os.getenv("SESSION_TTL", 3600))  # Seconds of inactivity before a session expires
+SESSION_MAX_MESSAGES = int(os.getenv("SESSION_MAX_MESSAGES", 200))  # Oldest turns beyond this are dropped
+SESSION_COMPRESS_MIN_BYTES = int(os.getenv("SESSION_COMPRESS_MIN_BYTES", 1024))  # zlib larger payloads
+SESSION_KEY_PREFIX = "session:"
+
+_MAGIC = b"JS"
+_VERSION = 1
+_FLAG_ZLIB = 1
+_HEADER = struct.Struct("<2sBBIII")  # magic, version, flags, messages, messages covered by tokens, tokens
+_MESSAGE = struct.Struct("<BI")  # role code, content bytes
+_ROLES = ["system", "user", "assistant", "tool"]
+_OTHER_ROLE = 255  # Followed by a one-byte length and the role name
+
+
+class Session:
+    """
+    One user's conversation: messages plus the token ids of their rendering.
+
+    `token_ids` encode `messages[:token_messages]` through the chat template
+    (without the generation prompt); they may cover fewer messages than
+    stored, or none, after a trim or when no tokenizer was available.
+    """
+
+    __slots__ = ("messages", "token_ids", "token_messages")
+
+    def __init__(self, messages: Optional[List[dict]] = None, token_ids: Optional[np.ndarray] = None,
+                 token_messages: int = 0):
+        self.messages = messages if messages is not None else []
+        self.token_ids = token_ids if token_ids is not None else np.zeros(0, dtype=np.uint32)
+        self.token_messages = token_messages if len(self.token_ids) else 0
+
+
+### 📦 BINARY ENCODING ###
+def encode_session(session: Session) -> bytes:
+    """Serializes a session to the compact binary format."""
+    parts = [np.asarray(session.token_ids, dtype="<u4").tobytes()]
+    for message in session.messages:
+        content = message["content"].encode("utf-8")
+        role = message["role"]
+        if role in _ROLES:
+            parts.append(_MESSAGE.pack(_ROLES.index(role), len(content)))
+        else:
+            name = role.encode("utf-8")[:255]
+            parts.append(_MESSAGE.pack(_OTHER_ROLE, len(content)) + bytes([len(name)]) + name)
+        parts.append(content)
+    body = b"".join(parts)
+    flags = 0
+    if len(body) >= SESSION_COMPRESS_MIN_BYTES:
+        body, flags = zlib.compress(body, 1), _FLAG_ZLIB
+    header = _HEADER.pack(_MAGIC, _VERSION, flags, len(session.messages), session.token_messages,
+                          len(session.token_ids))
+    return header + body
+
+
+def decode_session(data: bytes) -> Session:
+    """
+    Parses `encode_session` output.
+
+    Raises:
+        ValueError: Not a session payload of a known version.
+    """
+    magic, version, flags, n_messages, token_messages, n_tokens = _HEADER.unpack_from(data)
+    if magic != _MAGIC or version != _VERSION:
+        raise ValueError("Unknown session encoding.")
+    body = memoryview(data)[_HEADER.size:]
+    if flags & _FLAG_ZLIB:
+        body = memoryview(zlib.decompress(body))
+
+    token_ids = np.frombuffer(body, dtype="<u4", count=n_tokens)
+    offset = n_tokens * 4
+    messages = []
+    for _ in range(n_messages):
+        code, size = _MESSAGE.unpack_from(body, offset)
+        offset += _MESSAGE.size
+        if code == _OTHER_ROLE:
+            name_size = body[offset]
+            role = bytes(body[offset + 1:offset + 1 + name_size]).decode("utf-8")
+            offset += 1 + name_size
+        else:
+            role = _ROLES[code]
+        messages.append({"role": role, "content": bytes(body[offset:offset + size]).decode("utf-8")})
+        offset += size
+    return Session(messages, token_ids, token_messages)
+
+
+### 📂 SESSION STORE CLASS ###
+class SessionStore:
+    """
+    Per-user chat state on top of the shared CacheManager.
+
+    `save` extends the stored token ids by tokenizing only the messages
+    added since the last save, and `prompt_tokens` builds the next prompt
+    from them the same way, so a long session costs one tokenization of
+    each turn rather than one of the whole history per request.
+    """
+
+    def __init__(self, cache=cache_manager, tokenizer=None, ttl: int = SESSION_TTL,
+                 max_messages: int = SESSION_MAX_MESSAGES):
+        self.cache = cache
+        self._tokenizer = tokenizer
+        self.ttl = ttl
+        self.max_messages = max_messages
+        self.stats = {"loads": 0, "misses": 0, "saves": 0, "tokens_reused": 0, "tokens_encoded": 0,
+                      "trims": 0, "bytes_written": 0}
+
+    def load(self, user_id: str) -> Session:
+        """Returns the user's session, or an empty one if none is stored (or it expired)."""
+        self.stats["loads"] += 1
+        data = self.cache.get_bytes(SESSION_KEY_PREFIX + user_id)
+        if data is None:
+            self.stats["misses"] += 1
+            return Session()
+        try:
+            return decode_session(data)
+        except (ValueError, struct.error, zlib.error, UnicodeDecodeError) as e:
+            logger.error(f"❌ Dropping unreadable session of {user_id}: {e}")
+            self.delete(user_id)
+            self.stats["misses"] += 1
+            return Session()
+
+    def save(self, user_id: str, messages: List[dict], previous: Optional[Session] = None) -> Session:
+        """
+        Stores `messages` as the user's session (resetting its TTL).
+
+        Token ids carry over from `previous` (default: the stored session)
+        when its messages are a prefix of `messages`; only the rest is
+        tokenized. Beyond `max_messages` the oldest turns are dropped down to
+        three quarters of the limit, which costs one full re-tokenization.
+        """
+        messages = [{"role": m["role"], "content": m["content"]} for m in messages]
+        if len(messages) > self.max_messages:
+            messages = messages[len(messages) - self.max_messages * 3 // 4:]
+            previous = Session()
+            self.stats["trims"] += 1
+        elif previous is None:
+            previous = self.load(user_id)
+
+        session = Session(messages)
+        cached = previous.token_messages
+        if cached and messages[:cached] != previous.messages[:cached]:
+            cached = 0  # History was edited; the old ids no longer apply
+        token_ids = self._encode(messages, previous.token_ids if cached else None, cached, False)
+        if token_ids is not None:
+            session = Session(messages, np.asarray(token_ids, dtype=np.uint32), len(messages))
+
+        data = encode_session(session)
+        self.cache.set_bytes(SESSION_KEY_PREFIX + user_id, data, self.ttl)
+        self.stats["saves"] += 1
+        self.stats["bytes_written"] += len(data)
+        return session
+
+    def prompt_tokens(self, session: Session, messages: List[dict]) -> Optional[List[int]]:
+        """
+        Prompt token ids for `messages` (the session's history plus new turns), ending
+        with the assistant turn; None when no tokenizer is available.
+        """
+        cached = session.token_messages
+        if cached and messages[:cached] != session.messages[:cached]:
+            cached = 0
+        return self._encode(messages, session.token_ids if cached else None, cached, True)
+
+    def delete(self, user_id: str):
+        """Forgets the user's session."""
+        self.cache.delete(SESSION_KEY_PREFIX + user_id)
+
+    def get_stats(self) -> dict:
+        """Returns load / save counters and how many tokens were reused instead of re-encoded."""
+        return dict(self.stats)
+
+    def _encode(self, messages, cached_ids, cached_messages, add_generation_prompt) -> Optional[List[int]]:
+        tokenizer = self._tokenizer
+        if tokenizer is None:
+            from app.models.registry import model_registry
+            if not model_registry.is_loaded("tokenizer"):
+                return None  # Never load the tokenizer just to store a session
+            tokenizer = model_registry.get("tokenizer")
+        token_ids = tokenizer.encode_chat_incremental(messages, cached_ids, cached_messages, add_generation_prompt)
+        reused = 0
+        if cached_ids is not None and cached_messages:  # Shared prefix (the tokenizer re-encodes the last turn)
+            shared = min(len(cached_ids), len(token_ids))
+            diverged = np.flatnonzero(np.asarray(token_ids[:shared]) != np.asarray(cached_ids[:shared]))
+            reused = int(diverged[0]) if len(diverged) else shared
+        self.stats["tokens_reused"] += reused
+        self.stats["tokens_encoded"] += len(token_ids) - reused
+        return token_ids
+
+
+# Shared session store for the chat routes
+session_store = SessionStore()
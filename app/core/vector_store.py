@@ -0,0 +1,567 @@
+"""
+vector_store.py - ID-Mapped FAISS Index with Bulk Metadata Lookup
+------------------------------------------------------------------
+🔹 Features:
+- FAISS vectors addressed by stable 64-bit ids (the SQLite row ids), not insertion order
+- Deletes remove single vectors without shifting the ids of the others
+- Search returns (id, distance) pairs; metadata for all hits comes from one
+  `WHERE id IN (...)` query instead of one query per hit
+- Index types: exact (flat), IVF-Flat, IVF-PQ and HNSW; approximate indexes are
+  trained automatically once enough vectors exist (exact search until then)
+- IVF lists and PQ codes are sized for the vectors at training time; the owner
+  retrains from its exact vectors once the index has grown past that size
+- Per-search `nprobe` (IVF) / `efSearch` (HNSW), safe under concurrent queries
+- Recall@k-versus-latency report against exact search, for choosing those settings
+- Optional persistence: periodic snapshots plus an append-only add / delete log;
+  startup memory-maps the snapshot and replays the log tail
+- Adds on top of a mapped snapshot are folded into a new one before their exact
+  "delta" index grows large; a lock file keeps other processes off the directory
+- Shared by the document retriever and conversation memory
+
+📌 Dependencies:
+- FAISS (vector search)
+- SQLite (metadata storage)
+"""
+
+import os
+import json
+import fcntl
+import math
+import time
+import zlib
+import struct
+import sqlite3
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import faiss
+import numpy as np
+
+from app.utils.logger import logger
+
+### 🔧 CONFIGURATION ###
+SQLITE_MAX_PARAMS = 900  # Ids per IN (...) query; older SQLite builds allow at most 999 variables
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw")
+VECTOR_INDEX_TYPE = os.getenv("VECTOR_INDEX_TYPE", "flat")  # Document retriever's index type
+VECTOR_TRAIN_MIN = int(os.getenv("VECTOR_TRAIN_MIN", 4096))  # Vectors before an approximate index is built
+VECTOR_IVF_NLIST = int(os.getenv("VECTOR_IVF_NLIST", 0))  # IVF lists; 0 = about 4 * sqrt(vectors) when trained
+VECTOR_RETRAIN_GROWTH = float(os.getenv("VECTOR_RETRAIN_GROWTH", 4))  # Retrain IVF after growing this much; 0 = never
+VECTOR_PQ_M = int(os.getenv("VECTOR_PQ_M", 16))  # PQ sub-quantizers (rounded down to a divisor of the dim)
+VECTOR_PQ_BITS = int(os.getenv("VECTOR_PQ_BITS", 8))  # Bits per PQ code
+VECTOR_HNSW_M = int(os.getenv("VECTOR_HNSW_M", 32))  # HNSW graph neighbours per node
+VECTOR_HNSW_EF_CONSTRUCTION = int(os.getenv("VECTOR_HNSW_EF_CONSTRUCTION", 200))
+VECTOR_NPROBE = int(os.getenv("VECTOR_NPROBE", 8))  # Default IVF lists scanned per query
+VECTOR_EF_SEARCH = int(os.getenv("VECTOR_EF_SEARCH", 64))  # Default HNSW candidate list per query
+HNSW_MAX_TOMBSTONES = 0.1  # HNSW cannot delete; rebuild once this fraction of entries is deleted
+MIN_POINTS_PER_CENTROID = 39  # FAISS k-means warns below this many training points per centroid
+TRAIN_POINTS_PER_CENTROID = 256  # FAISS k-means samples at most this many; more training vectors are wasted
+VECTOR_SNAPSHOT_EVERY = int(os.getenv("VECTOR_SNAPSHOT_EVERY", 10000))  # Logged adds / deletes between snapshots
+VECTOR_DELTA_MAX = int(os.getenv("VECTOR_DELTA_MAX", 50000))  # Vectors searched exactly on top of a snapshot
+DELTA_MAX_FRACTION = 0.1  # ... or this fraction of the snapshot, if smaller (but at least DELTA_MIN_VECTORS)
+DELTA_MIN_VECTORS = 1024
+SNAPSHOT_FILE, LOG_FILE, META_FILE, LOCK_FILE = "snapshot.faiss", "log", "index.json", "lock"
+TOMBSTONE_FILE = "tombstones"  # int64 ids deleted from an HNSW snapshot, one file per generation
+LOG_ADD, LOG_DELETE = b"A", b"D"
+LOG_HEADER = struct.Struct("<cII")  # op, vector count, CRC32 of the payload
+
+
+def ivf_nlist(num_vectors: int) -> int:
+    """IVF lists for `num_vectors` training vectors: VECTOR_IVF_NLIST or about 4 * sqrt(n), as data allows."""
+    nlist = VECTOR_IVF_NLIST or int(4 * math.sqrt(num_vectors))
+    return max(1, min(nlist, num_vectors // MIN_POINTS_PER_CENTROID))
+
+
+def pq_bits(num_vectors: int) -> int:
+    """Bits per PQ code: VECTOR_PQ_BITS, fewer while there are too few vectors to train 2**bits centroids."""
+    return max(1, min(VECTOR_PQ_BITS, int(math.log2(max(2, num_vectors // MIN_POINTS_PER_CENTROID)))))
+
+
+def train_sample_size(num_vectors: int) -> int:
+    """Training vectors worth drawing out of `num_vectors` for an IVF (and PQ) index."""
+    return min(num_vectors, TRAIN_POINTS_PER_CENTROID * max(ivf_nlist(num_vectors), 2 ** pq_bits(num_vectors)))
+
+
+def create_index(index_type: str, dim: int, num_vectors: int) -> faiss.Index:
+    """
+    An untrained FAISS index of `index_type`, sized for about `num_vectors` vectors.
+    """
+    if index_type == "flat":
+        return faiss.IndexFlatL2(dim)
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, VECTOR_HNSW_M)
+        index.hnsw.efConstruction = VECTOR_HNSW_EF_CONSTRUCTION
+        return index
+    nlist = ivf_nlist(num_vectors)
+    if index_type == "ivf_flat":
+        return faiss.IndexIVFFlat(faiss.IndexFlatL2(dim), dim, nlist)
+    if index_type == "ivf_pq":
+        m = max(d for d in range(1, min(VECTOR_PQ_M, dim) + 1) if dim % d == 0)
+        return faiss.IndexIVFPQ(faiss.IndexFlatL2(dim), dim, nlist, m, pq_bits(num_vectors))
+    raise ValueError(f"Unknown vector index type {index_type!r}; expected one of {', '.join(INDEX_TYPES)}.")
+
+
+### 📂 VECTOR INDEX CLASS ###
+class VectorIndex:
+    """
+    L2 index whose entries carry the row id of their metadata.
+
+    Starts as an exact flat index; for approximate types the first `add`
+    that reaches `train_min` vectors trains the configured index on
+    everything stored so far and moves the vectors over. IVF lists and PQ
+    codes are sized for that count, so once the index has grown
+    `VECTOR_RETRAIN_GROWTH` times past it, `needs_retrain` is set and the
+    owner calls `retrain()` with the exact vectors (which IVF-PQ no longer has).
+
+    With a `path` the index survives restarts: every add / delete is
+    appended to a log, and every `VECTOR_SNAPSHOT_EVERY` logged operations
+    the whole index is written as a new snapshot and the log restarts.
+    Opening memory-maps the latest snapshot (read-only, so searchable
+    without reading it into RAM) and replays the log tail on top of it:
+    adds go to a small exact "delta" index, deletes of snapshot entries
+    become tombstones, and the next snapshot folds both back in. HNSW
+    cannot delete, so its tombstones are saved with the snapshot instead
+    and the graph is rebuilt only past `HNSW_MAX_TOMBSTONES`. Since
+    every query scans the delta in full, a delta past its size limit
+    (see `delta_limit`) also triggers a snapshot, however few operations
+    added it. The directory is locked while open: a second process (say
+    the ingestion CLI next to the server) gets an error instead of
+    deleting generations the first one still uses.
+    """
+
+    def __init__(self, dim: int, index_type: str = "flat", train_min: int = VECTOR_TRAIN_MIN,
+                 path: Optional[str] = None):
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"Unknown vector index type {index_type!r}; expected one of {', '.join(INDEX_TYPES)}.")
+        self.dim = dim
+        self.index_type = index_type
+        self.train_min = train_min
+        self.active_type = "flat"  # Becomes index_type once trained
+        self.index = faiss.IndexIDMap2(faiss.IndexFlatL2(dim))
+        self._writable = True  # False while `index` is a memory-mapped snapshot
+        self._delta = None  # Adds on top of a memory-mapped snapshot
+        self._tombstones = set()  # Deleted ids still in `index` (HNSW, memory-mapped snapshots)
+        self._index_ids = None  # Sorted ids of a memory-mapped snapshot, for delete lookups
+        self.max_id = 0  # Highest id ever added; rows above it are missing from the index
+        self.trained_vectors = 0  # Vectors the approximate index was sized and trained for
+
+        self.path = path
+        self._log = None
+        self._generation = 0
+        self._logged_ops = 0
+        self._replaying = False
+        self._lock_file = None
+        if path is not None:
+            self._open()
+
+    def __len__(self) -> int:
+        delta = self._delta.ntotal if self._delta is not None else 0
+        return self.index.ntotal + delta - len(self._tombstones)
+
+    @property
+    def delta_limit(self) -> int:
+        """Delta size that triggers a snapshot: VECTOR_DELTA_MAX, or less for a small snapshot."""
+        return min(VECTOR_DELTA_MAX, max(DELTA_MIN_VECTORS, int(DELTA_MAX_FRACTION * self.index.ntotal)))
+
+    @property
+    def needs_retrain(self) -> bool:
+        """True once an IVF index holds VECTOR_RETRAIN_GROWTH times the vectors it was trained for."""
+        return (self.active_type.startswith("ivf") and VECTOR_RETRAIN_GROWTH > 0
+                and len(self) >= VECTOR_RETRAIN_GROWTH * max(1, self.trained_vectors))
+
+    def add(self, ids: Sequence[int], vectors: np.ndarray, snapshot: bool = True):
+        """
+        Adds [n, dim] vectors under the given ids.
+
+        `snapshot=False` leaves the automatic snapshot to a later
+        `maybe_snapshot()`, so a long run of adds writes one instead of several.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(ids):
+            return
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        (self.index if self._writable else self._delta).add_with_ids(vectors, ids)
+        self.max_id = max(self.max_id, int(ids.max()))
+        self._record(LOG_ADD, ids, vectors)
+        if self.active_type == "flat" != self.index_type and len(self) >= self.train_min:
+            self._rebuild(self.index_type)
+            if self.path is not None and not self._replaying:
+                self.snapshot()  # Training is expensive; never redo it on replay
+        if snapshot:
+            self.maybe_snapshot()
+
+    def remove(self, ids: Iterable[int]) -> int:
+        """Removes the vectors stored under `ids`; returns how many were found."""
+        ids = np.asarray(list(ids), dtype=np.int64)
+        found = self._delta.remove_ids(ids) if self._delta is not None else 0
+        if self._writable and self.active_type != "hnsw":
+            found += self.index.remove_ids(ids)
+        else:
+            tombstones = {int(i) for i in ids[self._index_contains(ids)]} - self._tombstones
+            self._tombstones |= tombstones
+            found += len(tombstones)
+        self._record(LOG_DELETE, ids)
+        if self._writable and len(self._tombstones) > HNSW_MAX_TOMBSTONES * self.index.ntotal:
+            self._rebuild("hnsw")
+        self.maybe_snapshot()
+        return found
+
+    def search(self, vector: np.ndarray, top_k: int, nprobe: Optional[int] = None,
+               ef_search: Optional[int] = None) -> List[Tuple[int, float]]:
+        """
+        Returns up to `top_k` (id, squared L2 distance) pairs, closest first.
+
+        `nprobe` / `ef_search` override the configured defaults for this query
+        (higher = better recall, slower); the exact index ignores them.
+        """
+        if len(self) == 0 or top_k <= 0:
+            return []
+        query = np.ascontiguousarray(vector, dtype=np.float32).reshape(1, self.dim)
+        hits = []
+        if self.index.ntotal:
+            k = min(top_k + len(self._tombstones), self.index.ntotal)
+            distances, ids = self.index.search(query, k, params=self._search_params(k, nprobe, ef_search))
+            hits = [(int(i), float(d)) for i, d in zip(ids[0], distances[0])
+                    if i != -1 and int(i) not in self._tombstones]
+        if self._delta is not None and self._delta.ntotal:
+            distances, ids = self._delta.search(query, min(top_k, self._delta.ntotal))
+            hits = sorted(hits + [(int(i), float(d)) for i, d in zip(ids[0], distances[0]) if i != -1],
+                          key=lambda hit: hit[1])
+        return hits[:top_k]
+
+    def retrain(self, sample: np.ndarray, batches: Iterable[Tuple[Sequence[int], np.ndarray]], num_vectors: int):
+        """
+        Rebuilds the IVF index for `num_vectors` vectors: lists (and PQ codebooks)
+        sized for that count are trained on `sample` (see `train_sample_size`),
+        then every vector is added from `batches` of (ids, vectors). The caller
+        supplies the exact vectors, e.g. from SQLite; snapshots when persistent.
+        """
+        start = time.time()
+        index = create_index(self.active_type, self.dim, num_vectors)
+        index.train(np.ascontiguousarray(sample, dtype=np.float32).reshape(-1, self.dim))
+        added = 0
+        for ids, vectors in batches:
+            index.add_with_ids(np.ascontiguousarray(vectors, dtype=np.float32).reshape(-1, self.dim),
+                               np.asarray(ids, dtype=np.int64))
+            added += len(ids)
+        self.index, self.trained_vectors = index, added
+        self._writable, self._delta, self._tombstones, self._index_ids = True, None, set(), None
+        logger.info(f"✅ Retrained {self.active_type} vector index over {added} vectors "
+                    f"(nlist {index.nlist}) in {time.time() - start:.2f}s.")
+        if self.path is not None:
+            self.snapshot()
+
+    def reset(self):
+        """Drops every vector (and, when persistent, every snapshot and log)."""
+        self.active_type = "flat"
+        self.index = faiss.IndexIDMap2(faiss.IndexFlatL2(self.dim))
+        self._writable, self._delta, self._tombstones, self._index_ids = True, None, set(), None
+        self.max_id = self.trained_vectors = 0
+        if self.path is not None:
+            self.snapshot()
+
+    def get_stats(self) -> dict:
+        stats = {"type": self.active_type, "configured_type": self.index_type, "vectors": len(self)}
+        if self.active_type.startswith("ivf"):
+            stats["nlist"] = faiss.extract_index_ivf(self.index).nlist
+            stats["trained_vectors"] = self.trained_vectors
+        if self._tombstones:
+            stats["tombstones"] = len(self._tombstones)
+        if self.path is not None:
+            stats.update({"generation": self._generation, "logged_ops": self._logged_ops,
+                          "memory_mapped": not self._writable,
+                          "delta": self._delta.ntotal if self._delta is not None else 0})
+        return stats
+
+    ### 💾 PERSISTENCE ###
+    def snapshot(self):
+        """
+        Writes the whole index as a new snapshot generation, starts an empty log
+        and memory-maps the snapshot. A crash at any point leaves either the
+        previous snapshot + log or the new one readable.
+        """
+        if self.path is None:
+            raise RuntimeError("VectorIndex has no path to snapshot to.")
+        start = time.time()
+        index = self._materialize()
+        generation = self._generation + 1
+        snapshot = self._file(SNAPSHOT_FILE, generation)
+        faiss.write_index(index, snapshot + ".tmp")
+        os.replace(snapshot + ".tmp", snapshot)
+        tombstones = np.array(sorted(self._tombstones), dtype=np.int64)  # Left by _materialize for HNSW only
+        if len(tombstones):
+            path = self._file(TOMBSTONE_FILE, generation)
+            tombstones.tofile(path + ".tmp")
+            os.replace(path + ".tmp", path)
+        meta = {"dim": self.dim, "generation": generation, "active_type": self.active_type,
+                "max_id": self.max_id, "vectors": index.ntotal, "trained_vectors": self.trained_vectors,
+                "tombstones": len(tombstones)}
+        with open(os.path.join(self.path, META_FILE + ".tmp"), "w") as f:
+            json.dump(meta, f)
+        os.replace(os.path.join(self.path, META_FILE + ".tmp"), os.path.join(self.path, META_FILE))
+
+        if self._log is not None:
+            self._log.close()
+        self._generation, self._logged_ops = generation, 0
+        self._log = open(self._file(LOG_FILE, generation), "wb")
+        self._remove_old_generations()
+        self._map(snapshot, tombstones)
+        logger.info(f"✅ Vector index snapshot {generation} ({index.ntotal} vectors) in {time.time() - start:.2f}s.")
+
+    def maybe_snapshot(self):
+        """Snapshots once the log has `VECTOR_SNAPSHOT_EVERY` operations or the delta outgrew `delta_limit`."""
+        if self._log is None or self._replaying:
+            return
+        delta = self._delta.ntotal if self._delta is not None else 0
+        if self._logged_ops >= VECTOR_SNAPSHOT_EVERY or delta >= self.delta_limit:
+            self.snapshot()
+
+    def close(self):
+        """
+        Snapshots pending log records (so the next start replays nothing),
+        closes the log and unlocks the directory.
+        """
+        if self._log is None:
+            return
+        if self._logged_ops:
+            self.snapshot()
+        self._log.close()
+        self._log = None
+        self._lock_file.close()  # Releases the lock
+        self._lock_file = None
+
+    def _open(self):
+        """Locks the directory, memory-maps the latest snapshot and replays its log."""
+        os.makedirs(self.path, exist_ok=True)
+        self._lock()
+        meta_path = os.path.join(self.path, META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            if meta["dim"] != self.dim:
+                raise ValueError(f"Vector index at {self.path} has dim {meta['dim']}, expected {self.dim}.")
+            self._generation, self.max_id = meta["generation"], meta["max_id"]
+            self.active_type = meta["active_type"]
+            self.trained_vectors = meta.get("trained_vectors", meta["vectors"])
+            tombstones = ()
+            if meta.get("tombstones"):
+                tombstones = np.fromfile(self._file(TOMBSTONE_FILE, self._generation), dtype=np.int64)
+            self._map(self._file(SNAPSHOT_FILE, self._generation), tombstones)
+        self._remove_old_generations()
+
+        start, replayed = time.time(), 0
+        log_path = self._file(LOG_FILE, self._generation)
+        self._replaying = True
+        try:
+            for op, ids, vectors in read_log(log_path, self.dim):
+                if op == LOG_ADD:
+                    self.add(ids, vectors)
+                else:
+                    self.remove(ids)
+                replayed += 1
+        finally:
+            self._replaying = False
+        self._logged_ops = replayed
+        self._log = open(log_path, "ab")
+        logger.info(f"✅ Vector index opened at {self.path}: {len(self)} vectors, "
+                    f"{replayed} log records replayed in {time.time() - start:.2f}s.")
+        self.maybe_snapshot()  # Replay never snapshots; fold a delta or log that outgrew its limit now
+
+    def _lock(self):
+        """Takes the directory's exclusive lock; released by close() or when the process exits."""
+        self._lock_file = open(os.path.join(self.path, LOCK_FILE), "a")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock_file.close()
+            self._lock_file = None
+            raise RuntimeError(f"Vector index at {self.path} is open in another process "
+                               f"(e.g. the server and the ingestion CLI); close that one first.") from None
+
+    def _map(self, snapshot: str, tombstones: Iterable[int] = ()):
+        self.index = faiss.read_index(snapshot, faiss.IO_FLAG_MMAP_IFC)  # Read-only view of the file
+        self._writable, self._tombstones, self._index_ids = False, {int(i) for i in tombstones}, None
+        self._delta = faiss.IndexIDMap2(faiss.IndexFlatL2(self.dim))
+
+    def _materialize(self) -> faiss.Index:
+        """
+        An owned copy of the current contents: snapshot + delta - tombstones.
+
+        HNSW keeps its tombstones (they are saved next to the snapshot) until
+        they pass `HNSW_MAX_TOMBSTONES`; only then is the graph rebuilt.
+        """
+        hnsw = self.active_type == "hnsw"
+        if self._writable and (hnsw or not self._tombstones):
+            return self.index
+        if self.active_type == "flat" or (hnsw and len(self._tombstones) > HNSW_MAX_TOMBSTONES * self.index.ntotal):
+            self._rebuild(self.active_type)  # Reconstructs from the mapped storage; HNSW cannot delete
+            return self.index
+        index = faiss.read_index(self._file(SNAPSHOT_FILE, self._generation))  # Copy into RAM
+        if self._tombstones and not hnsw:
+            index.remove_ids(np.fromiter(self._tombstones, dtype=np.int64))
+        if self._delta.ntotal:
+            index.add_with_ids(self._delta.index.reconstruct_n(0, self._delta.ntotal),
+                               faiss.vector_to_array(self._delta.id_map).astype(np.int64))
+        self.index, self._writable, self._delta, self._index_ids = index, True, None, None
+        if not hnsw:
+            self._tombstones = set()
+        return index
+
+    def _record(self, op: bytes, ids: np.ndarray, vectors: Optional[np.ndarray] = None):
+        if self._log is None or self._replaying:
+            return
+        append_log(self._log, op, ids, vectors)
+        self._logged_ops += 1
+
+    def _file(self, name: str, generation: int) -> str:
+        return os.path.join(self.path, f"{name}.{generation}")
+
+    def _remove_old_generations(self):
+        for name in os.listdir(self.path):
+            prefix, _, generation = name.rpartition(".")
+            if prefix in (SNAPSHOT_FILE, LOG_FILE, TOMBSTONE_FILE) and generation.isdigit() and int(generation) < self._generation:
+                os.remove(os.path.join(self.path, name))
+
+    ### 🔎 INTERNALS ###
+    def _index_contains(self, ids: np.ndarray) -> np.ndarray:
+        """Which `ids` are stored in the main index (not the delta)."""
+        if self._writable:
+            return np.isin(ids, stored_ids(self.index))
+        if self._index_ids is None:
+            self._index_ids = np.sort(stored_ids(self.index))
+        positions = np.searchsorted(self._index_ids, ids).clip(max=max(0, len(self._index_ids) - 1))
+        return self._index_ids[positions] == ids if len(self._index_ids) else np.zeros(len(ids), dtype=bool)
+
+    def _search_params(self, k: int, nprobe: Optional[int], ef_search: Optional[int]):
+        if self.active_type.startswith("ivf"):
+            return faiss.SearchParametersIVF(nprobe=nprobe or VECTOR_NPROBE)
+        if self.active_type == "hnsw":
+            return faiss.SearchParametersHNSW(efSearch=max(ef_search or VECTOR_EF_SEARCH, k))
+        return None
+
+    def _rebuild(self, index_type: str):
+        """
+        Builds (and trains) a fresh `index_type` index from the stored vectors
+        (main index + delta), dropping tombstones. The main index must be flat or HNSW.
+        """
+        ids = stored_ids(self.index)
+        vectors = self.index.index.reconstruct_n(0, self.index.ntotal)  # Flat / HNSW storage is exact
+        if self._tombstones:
+            live = ~np.isin(ids, np.fromiter(self._tombstones, dtype=np.int64))
+            ids, vectors = ids[live], vectors[live]
+        if self._delta is not None and self._delta.ntotal:
+            ids = np.concatenate([ids, stored_ids(self._delta)])
+            vectors = np.concatenate([vectors, self._delta.index.reconstruct_n(0, self._delta.ntotal)])
+        start = time.time()
+        index = create_index(index_type, self.dim, len(ids))
+        if not index.is_trained:
+            index.train(vectors)
+        # IVF stores ids itself; an IDMap over it would renumber wrongly on removal
+        rebuilt = index if index_type.startswith("ivf") else faiss.IndexIDMap2(index)
+        if len(ids):
+            rebuilt.add_with_ids(vectors, ids)
+        self.index, self.active_type = rebuilt, index_type
+        if index_type.startswith("ivf"):
+            self.trained_vectors = len(ids)
+        self._writable, self._delta, self._tombstones, self._index_ids = True, None, set(), None
+        logger.info(f"✅ Built {index_type} vector index over {len(ids)} vectors in {time.time() - start:.2f}s.")
+
+
+def stored_ids(index: faiss.Index) -> np.ndarray:
+    """All ids held by an ID-mapped or IVF index."""
+    if hasattr(index, "id_map"):
+        return faiss.vector_to_array(index.id_map).astype(np.int64)
+    invlists = faiss.extract_index_ivf(index).invlists
+    lists = [faiss.rev_swig_ptr(invlists.get_ids(i), invlists.list_size(i)).copy()
+             for i in range(invlists.nlist) if invlists.list_size(i)]
+    return np.concatenate(lists).astype(np.int64) if lists else np.zeros(0, dtype=np.int64)
+
+
+def append_log(f, op: bytes, ids: np.ndarray, vectors: Optional[np.ndarray] = None):
+    """
+    Appends one add / delete record: op, count and CRC32 header, then ids (and vectors).
+    """
+    payload = ids.astype(np.int64).tobytes()
+    if vectors is not None:
+        payload += np.ascontiguousarray(vectors, dtype=np.float32).tobytes()
+    f.write(LOG_HEADER.pack(op, len(ids), zlib.crc32(payload)) + payload)
+    f.flush()  # Survives a process crash; SQLite remains the source of truth on power loss
+
+
+def read_log(path: str, dim: int) -> Iterator[Tuple[bytes, np.ndarray, Optional[np.ndarray]]]:
+    """
+    Yields (op, ids, vectors) records; a torn or corrupt tail is cut off the file.
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, "rb") as f:
+        data = f.read()
+    offset = 0
+    while offset + LOG_HEADER.size <= len(data):
+        op, count, crc = LOG_HEADER.unpack_from(data, offset)
+        size = count * 8 + (count * dim * 4 if op == LOG_ADD else 0)
+        payload = data[offset + LOG_HEADER.size:offset + LOG_HEADER.size + size]
+        if op not in (LOG_ADD, LOG_DELETE) or len(payload) < size or zlib.crc32(payload) != crc:
+            break
+        ids = np.frombuffer(payload[:count * 8], dtype=np.int64)
+        vectors = np.frombuffer(payload[count * 8:], dtype=np.float32).reshape(count, dim) if op == LOG_ADD else None
+        yield op, ids, vectors
+        offset += LOG_HEADER.size + size
+    if offset < len(data):
+        logger.warning(f"⚠️ Dropping {len(data) - offset} bytes of torn vector index log at {path}.")
+        with open(path, "r+b") as f:
+            f.truncate(offset)
+
+
+def recall_report(index: VectorIndex, ids: Sequence[int], vectors: np.ndarray, queries: np.ndarray,
+                  top_k: int = 10, settings: Optional[Sequence[int]] = None) -> List[dict]:
+    """
+    Recall@k and mean single-query latency of `index` for a sweep of search settings.
+
+    Ground truth is exact search over `vectors` (the authoritative copies,
+    e.g. from SQLite), so lossy PQ codes are measured honestly. `settings`
+    are nprobe values for IVF or efSearch values for HNSW.
+
+    Returns:
+        list: {"setting", "value", "recall", "latency_ms"} rows, exact search first.
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    queries = np.ascontiguousarray(queries, dtype=np.float32).reshape(-1, index.dim)
+    exact = faiss.IndexFlatL2(index.dim)
+    exact.add(np.ascontiguousarray(vectors, dtype=np.float32))
+    start = time.perf_counter()
+    truth = [exact.search(q.reshape(1, -1), top_k)[1][0] for q in queries]
+    rows = [{"setting": "exact", "value": None, "recall": 1.0,
+             "latency_ms": round((time.perf_counter() - start) * 1000 / len(queries), 4)}]
+    truth = [set(ids[t[t >= 0]].tolist()) for t in truth]
+
+    if index.active_type.startswith("ivf"):
+        name, nlist = "nprobe", faiss.extract_index_ivf(index.index).nlist
+        values = [v for v in (settings or (1, 2, 4, 8, 16, 32, 64, 128)) if v <= nlist]
+    elif index.active_type == "hnsw":
+        name, values = "ef_search", list(settings or (16, 32, 64, 128, 256))
+    else:
+        name, values = index.active_type, [None]
+    for value in values:
+        kwargs = {name: value} if name in ("nprobe", "ef_search") else {}
+        found, start = 0, time.perf_counter()
+        for query, expected in zip(queries, truth):
+            found += len(expected & {i for i, _ in index.search(query, top_k, **kwargs)})
+        rows.append({"setting": name, "value": value,
+                     "recall": round(found / max(1, sum(len(t) for t in truth)), 4),
+                     "latency_ms": round((time.perf_counter() - start) * 1000 / len(queries), 4)})
+    return rows
+
+
+def fetch_rows(conn: sqlite3.Connection, table: str, columns: Sequence[str],
+               ids: Sequence[int]) -> Dict[int, tuple]:
+    """
+    Fetches `columns` for all `ids` at once; returns {id: row}. Missing ids are left out.
+    """
+    rows = {}
+    ids = list(ids)
+    select = ", ".join(["id"] + list(columns))
+    for start in range(0, len(ids), SQLITE_MAX_PARAMS):
+        chunk = ids[start:start + SQLITE_MAX_PARAMS]
+        placeholders = ", ".join("?" * len(chunk))
+        for row in conn.execute(f"SELECT {select} FROM {table} WHERE id IN ({placeholders})", chunk):
+            rows[row[0]] = row[1:]
+    return rows
@@ -6,14 +6,17 @@ main.py - JC1 Inference API (FastAPI Entry Point)
 - Uses FastAPI for high-performance async API handling
 - Implements Cross-Origin Resource Sharing (CORS)
 - Includes logging and authentication middleware
+- Warms up the shared model registry at startup (`WARMUP_MODELS`)
+- Offline batch jobs; interrupted ones resume at startup (`BATCH_JOBS_AUTO_RESUME`)
 
 📌 Dependencies:
 - `fastapi` → For API handling
 - `uvicorn` → For ASGI server
 - `pydantic` → For request validation
-- `app.api.chat`, `app.api.vision`, `app.api.speech` → API modules
+- `app.api.chat`, `app.api.vision`, `app.api.speech`, `app.api.batch` → API modules
 """
 
+import asyncio
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
@@ -22,6 +25,16 @@ import uvicorn
 from app.api.chat import router as chat_router
 from app.api.vision import router as vision_router
 from app.api.speech import router as speech_router
+from app.api.batch import router as batch_router
+from app.core.admission import admission_controller
+from app.core.batch_jobs import BATCH_JOBS_AUTO_RESUME, batch_job_manager
+from app.core.context_window import context_builder
+from app.core.grammar import grammar_cache
+from app.core.retriever import close_retriever
+from app.core.semantic_cache import semantic_cache
+from app.core.session_store import session_store
+from app.models.inference import model_inference
+from app.models.registry import WARMUP_MODELS, model_registry
 
 # Initialize FastAPI App
 app = FastAPI(
@@ -43,12 +56,49 @@ app.add_middleware(
 app.include_router(chat_router, prefix="/api/chat", tags=["Chat LLM"])
 app.include_router(vision_router, prefix="/api/vision", tags=["Vision Processing"])
 app.include_router(speech_router, prefix="/api/speech", tags=["Speech-to-Text"])
+app.include_router(batch_router, prefix="/api/batch", tags=["Batch Jobs"])
+
+### 🔥 Model Warmup ###
+@app.on_event("startup")
+async def warmup_models():
+    """Loads the models listed in WARMUP_MODELS once, off the event loop; the rest load on first use."""
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, model_registry.warmup, WARMUP_MODELS)
+    if model_registry.is_loaded("llm"):
+        await loop.run_in_executor(None, model_inference.ensure_loaded)
+
+### 🔄 Batch Job Recovery ###
+@app.on_event("startup")
+async def resume_batch_jobs():
+    """Restarts batch jobs that were queued or running when the previous process stopped."""
+    if not BATCH_JOBS_AUTO_RESUME:
+        return
+    for job in batch_job_manager.interrupted():
+        batch_job_manager.start(job)
+
+### 💾 Shutdown ###
+@app.on_event("shutdown")
+def snapshot_vector_index():
+    """Snapshots the document index so the next start has no log to replay."""
+    close_retriever()
 
 ### 📍 Root Endpoint ###
 @app.get("/", tags=["Health Check"])
 async def root():
     return {"message": "🚀 JC1 Inference API is running!"}
 
+### 📊 Stats Endpoint ###
+@app.get("/stats", tags=["Health Check"])
+async def stats():
+    """Inference engine counters (batching, prefix cache hit rate, prefill tokens saved), admission
+    queue depth / rejections and model load state / memory."""
+    return {**model_inference.get_stats(), "semantic_cache": semantic_cache.get_stats(),
+            "admission": admission_controller.get_stats(),
+            "context_window": context_builder.get_stats(),
+            "sessions": session_store.get_stats(),
+            "grammar_cache": grammar_cache.get_stats(),
+            "models": model_registry.get_stats()}
+
 ### 🚀 Run API ###
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000, log_level="info")
@@ -6,6 +6,15 @@ inference.py - Optimized Model Inference Execution
 - Uses DeepSpeed & vLLM for optimized GPU inference
 - Handles tokenization, decoding, and post-processing
 - Async execution for handling multiple requests
+- Continuous batching scheduler for the PyTorch & DeepSpeed backends
+- Token streaming with cancellation on client disconnect
+- Per-session prefix KV cache so follow-up chat turns only prefill new tokens
+- Optional paged KV block pool (PAGED_KV_MB) for more concurrent sequences per GB
+- Exact-match response cache for deterministic (temperature 0) requests
+- Optional speculative decoding with a small draft model for greedy requests
+- Parallel sampling (n / best_of) with one shared prefill and log-prob scoring
+- Constrained decoding to a JSON schema or regex (`response_format`)
+- Lazy: weights come from the shared model registry on first use (or at warmup)
 
 📌 Dependencies:
 - transformers (Hugging Face model loader)
@@ -15,91 +24,330 @@ inference.py - Optimized Model Inference Execution
 """
 
 import os
+import asyncio
+import threading
 import torch
-import deepspeed
-import vllm
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from app.core.cache import cache_manager
+from app.core.fair_queue import DEFAULT_SHARE
+from app.core.grammar import grammar_cache
+from app.core.kv_cache import PrefixCache
+from app.core.paged_kv import PAGED_KV_MB, PagedKVCache
+from app.core.response_cache import ResponseCache
+from app.core.scheduler import BatchScheduler
+from app.models.registry import DRAFT_MODEL_NAME, model_registry
+from app.models.speculative import SpeculativeDecoder
 from app.utils.logger import logger
-from app.models.tokenizer import tokenizer  # Import our tokenizer utility
 
 # Model Configuration
 MODEL_NAME = os.getenv("MODEL_NAME", "meta-llama/Llama-3-8B")
-USE_DEEPSPEED = os.getenv("USE_DEEPSPEED", "true").lower() == "true"
-USE_VLLM = os.getenv("USE_VLLM", "true").lower() == "true"
 MAX_NEW_TOKENS = int(os.getenv("MAX_NEW_TOKENS", 512))  # Limit token generation
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", 8))  # Max sequences decoded together
+MAX_BATCH_WAIT_MS = float(os.getenv("MAX_BATCH_WAIT_MS", 10))  # Wait window for filling a batch
+USE_SPECULATIVE = os.getenv("USE_SPECULATIVE", "false").lower() == "true"
+MAX_SAMPLES = int(os.getenv("MAX_SAMPLES", 8))  # Upper bound for n / best_of per request
+
+
+class UnsupportedRequest(ValueError):
+    """A request option the loaded backend cannot serve (answered with a 400)."""
+
 
 class ModelInference:
     """
     Handles optimized model inference using DeepSpeed, vLLM, or native PyTorch.
+
+    Construction is cheap: the model and tokenizer are shared handles from
+    `model_registry`, fetched the first time a request needs them.
     """
 
     def __init__(self):
         """
-        Initializes model based on selected backend.
+        Sets up caches; the model itself is attached by `ensure_loaded`.
         """
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.model = None
+        self.tokenizer = None
+        self.backend = None
+        self.scheduler = None
+        self.prefix_cache = None
+        self.paged_kv = None
+        self.speculative = None
+        self.response_cache = ResponseCache(cache_manager, MODEL_NAME)
+        self._load_lock = threading.Lock()
 
-        if USE_VLLM:
-            self.init_vllm()
-        elif USE_DEEPSPEED:
-            self.init_deepspeed()
-        else:
-            self.init_torch()
+    @property
+    def loaded(self) -> bool:
+        return self.model is not None
 
-    def init_vllm(self):
+    def ensure_loaded(self):
         """
-        Initializes vLLM for faster inference.
+        Attaches the registry's model and tokenizer and starts the scheduler (once).
         """
-        try:
-            self.model = vllm.LLM(MODEL_NAME, tensor_parallel_size=torch.cuda.device_count())
-            logger.info("✅ Loaded model with vLLM for optimized inference.")
-        except Exception as e:
-            logger.error(f"❌ Failed to initialize vLLM: {e}")
-            raise RuntimeError("vLLM loading failed.")
+        if self.loaded:
+            return
+        with self._load_lock:
+            if self.loaded:
+                return
+            loader = model_registry.get("llm")
+            self.tokenizer = model_registry.get("tokenizer")
+            self.device = loader.device
 
-    def init_deepspeed(self):
-        """
-        Initializes DeepSpeed for efficient model execution.
-        """
-        try:
-            self.model = AutoModelForCausalLM.from_pretrained(
-                MODEL_NAME, torch_dtype=torch.float16, device_map="auto"
-            )
-            self.model = deepspeed.init_inference(self.model, dtype=torch.float16)
-            logger.info("✅ Loaded model with DeepSpeed for efficient execution.")
-        except Exception as e:
-            logger.error(f"❌ Failed to initialize DeepSpeed: {e}")
-            raise RuntimeError("DeepSpeed initialization failed.")
+            # vLLM batches internally; the HF-based backends go through our scheduler
+            if loader.backend != "vllm":
+                if PAGED_KV_MB > 0:  # Session prefixes then live in the block pool too
+                    self.paged_kv = PagedKVCache.for_model(loader.model, device=self.device)
+                else:
+                    self.prefix_cache = PrefixCache()
+                self.scheduler = BatchScheduler(
+                    loader.model,
+                    device=self.device,
+                    batch_size=BATCH_SIZE,
+                    max_wait_ms=MAX_BATCH_WAIT_MS,
+                    eos_token_id=getattr(self.tokenizer.tokenizer, "eos_token_id", None),
+                    prefix_cache=self.prefix_cache,
+                    paged_kv=self.paged_kv,
+                )
+                if USE_SPECULATIVE:
+                    self.init_speculative(loader.model)
+            self.backend = loader.backend
+            self.model = loader.model
 
-    def init_torch(self):
+    async def _ensure_loaded_async(self):
+        """Loads in a worker thread so the event loop keeps serving."""
+        if not self.loaded:
+            await asyncio.get_running_loop().run_in_executor(None, self.ensure_loaded)
+
+    def init_speculative(self, target_model):
         """
-        Initializes model using basic PyTorch inference.
+        Attaches the draft model used for speculative decoding.
         """
         try:
-            self.model = AutoModelForCausalLM.from_pretrained(MODEL_NAME).to(self.device)
-            logger.info("✅ Loaded model with PyTorch (basic execution).")
+            draft_model = model_registry.get("draft_llm")
+            self.speculative = SpeculativeDecoder(target_model, draft_model, device=self.device)
+            logger.info(f"✅ Speculative decoding enabled with draft model {DRAFT_MODEL_NAME}.")
         except Exception as e:
-            logger.error(f"❌ Failed to load PyTorch model: {e}")
-            raise RuntimeError("PyTorch model loading failed.")
+            logger.error(f"❌ Failed to load draft model, speculative decoding disabled: {e}")
 
     def generate_response(self, input_text):
         """
         Generates model output for a given input text.
+
+        Decoding is greedy, so results are served from the response cache
+        when the same prompt was seen before.
+        """
+        self.ensure_loaded()
+        tokens = self.tokenizer.encode(input_text)
+
+        def generate():
+            input_tensor = torch.tensor([tokens]).to(self.device)
+            with torch.no_grad():
+                output_tokens = self.model.generate(input_tensor, max_new_tokens=MAX_NEW_TOKENS)
+            return self.tokenizer.decode(output_tokens[0].tolist())
+
+        params = {"max_new_tokens": MAX_NEW_TOKENS, "temperature": 0.0, "echo_prompt": True}
+        return self.response_cache.get_or_generate_sync(tokens, params, generate)
+
+    async def async_generate_response(self, input_text, max_new_tokens=MAX_NEW_TOKENS, temperature=0.0,
+                                      session_id=None, share=DEFAULT_SHARE):
+        """
+        Async generation for parallel request handling.
+
+        With the PyTorch/DeepSpeed backends the request is queued on the
+        continuous-batching scheduler and only the generated continuation is
+        returned; vLLM requests run in a worker thread so the event loop is
+        never blocked. `session_id` lets follow-up turns reuse cached KV;
+        `share` (tenant, weight, priority class) orders the scheduler queue.
+        """
+        await self._ensure_loaded_async()
+        if self.scheduler is None:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self.generate_response, input_text)
+
+        text, _ = await self._complete(self.tokenizer.encode(input_text), max_new_tokens, temperature,
+                                       session_id, share)
+        return text
+
+    async def chat(self, messages, max_new_tokens=MAX_NEW_TOKENS, temperature=0.0, session_id=None,
+                   share=DEFAULT_SHARE, prompt_tokens=None, response_format=None):
+        """
+        Generates the assistant reply to `messages`.
+
+        `prompt_tokens` may carry the already-tokenized prompt (e.g. built
+        incrementally by the session store) to skip encoding `messages`.
+        `response_format` constrains the reply to a JSON schema or regex
+        (see `app.core.grammar.response_format_pattern`).
+
+        Returns:
+            tuple: (reply text, response-cache status "HIT" / "MISS" / "BYPASS")
+        """
+        await self._ensure_loaded_async()
+        grammar = await self.compile_grammar(response_format)
+        if prompt_tokens is None:
+            prompt_tokens = self.tokenizer.encode_chat(messages)
+        if self.scheduler is None:
+            return await self._complete_vllm(prompt_tokens, max_new_tokens, temperature)
+        return await self._complete(prompt_tokens, max_new_tokens, temperature, session_id, share, grammar)
+
+    async def chat_n(self, messages, n=1, best_of=None, max_new_tokens=MAX_NEW_TOKENS, temperature=0.7,
+                     session_id=None, share=DEFAULT_SHARE, prompt_tokens=None, response_format=None):
+        """
+        Samples several replies to `messages`, prefilling the prompt only once.
+
+        With `best_of` > n, `best_of` candidates are sampled and the n with
+        the highest mean token log-probability are returned, best first.
+        Bypasses the response cache (the point is to get different samples).
+
+        Returns:
+            list: One dict per candidate with `text`, `completion_tokens`,
+            `logprob` (sum), `mean_logprob` and `token_logprobs`.
+
+        Raises:
+            UnsupportedRequest: The vLLM backend, which decodes greedily without
+                log-probs (n copies of one reply, nothing to rank by).
+        """
+        await self._ensure_loaded_async()
+        if self.scheduler is None:
+            raise UnsupportedRequest("n, best_of and logprobs need the PyTorch or DeepSpeed backend.")
+        grammar = await self.compile_grammar(response_format)
+        if prompt_tokens is None:
+            prompt_tokens = self.tokenizer.encode_chat(messages)
+        best_of = max(best_of or n, n)
+
+        requests = await self.scheduler.generate_n(
+            prompt_tokens, best_of, max_new_tokens, temperature, session_id=session_id, share=share, logprobs=True,
+            grammar=grammar,
+        )
+        texts = self.tokenizer.decode_batch([r.output_ids for r in requests])
+        candidates = [
+            {
+                "text": text,
+                "completion_tokens": len(r.output_ids),
+                "logprob": sum(r.output_logprobs),
+                "mean_logprob": sum(r.output_logprobs) / max(len(r.output_logprobs), 1),
+                "token_logprobs": list(r.output_logprobs),
+            }
+            for text, r in zip(texts, requests)
+        ]
+        if best_of > n:
+            candidates = sorted(candidates, key=lambda c: c["mean_logprob"], reverse=True)[:n]
+        return candidates
+
+    async def compile_grammar(self, response_format):
+        """
+        Compiled grammar for a response format (None for free text), from the shared grammar cache.
+
+        Raises:
+            GrammarError: Invalid format, schema or pattern.
+            UnsupportedRequest: The backend cannot constrain decoding (vLLM).
+        """
+        if not response_format or response_format.get("type", "text") == "text":
+            return None
+        await self._ensure_loaded_async()
+        if self.scheduler is None:
+            raise UnsupportedRequest("Constrained decoding needs the PyTorch or DeepSpeed backend.")
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, lambda: grammar_cache.get(response_format, self.tokenizer.vocabulary())
+        )
+
+    async def _complete(self, prompt_tokens, max_new_tokens, temperature, session_id, share=DEFAULT_SHARE,
+                        grammar=None):
+        """
+        Runs a tokenized prompt through the scheduler, behind the response cache.
+
+        Greedy requests arriving while the scheduler is idle may decode
+        speculatively instead; that run still goes through the scheduler's
+        queue and has the model to itself (see `BatchScheduler.run_alone`).
+        """
+        async def generate():
+            if (self.speculative is not None and grammar is None and temperature <= 0
+                    and not self.scheduler.running and not self.scheduler.queue_depth
+                    and self.speculative.should_speculate()):
+                eos_token_id = self.scheduler.eos_token_id
+                output_tokens = await self.scheduler.run_alone(
+                    prompt_tokens, max_new_tokens,
+                    lambda ids, limit: self.speculative.generate(ids, limit, eos_token_id), share=share,
+                )
+            else:
+                output_tokens = await self.scheduler.generate(
+                    prompt_tokens, max_new_tokens=max_new_tokens, temperature=temperature, session_id=session_id,
+                    share=share, grammar=grammar,
+                )
+            return self.tokenizer.decode(output_tokens)
+
+        params = {"max_new_tokens": max_new_tokens, "temperature": temperature}
+        if grammar is not None:
+            params["grammar"] = grammar.key
+        return await self.response_cache.get_or_generate(prompt_tokens, params, generate)
+
+    async def _complete_vllm(self, prompt_tokens, max_new_tokens, temperature):
+        """
+        `_complete` for the vLLM backend, which batches internally: the tokenized
+        prompt goes straight to the engine (in a worker thread), behind the same
+        response cache. Returns (continuation text, cache status).
+        """
+        def generate_sync():
+            from vllm import SamplingParams  # Only installed where vLLM serves
+            outputs = self.model.generate(sampling_params=SamplingParams(max_tokens=max_new_tokens,
+                                                                         temperature=temperature),
+                                          prompt_token_ids=[list(prompt_tokens)], use_tqdm=False)
+            return outputs[0].outputs[0].text
+
+        async def generate():
+            return await asyncio.get_running_loop().run_in_executor(None, generate_sync)
+
+        params = {"max_new_tokens": max_new_tokens, "temperature": temperature}
+        return await self.response_cache.get_or_generate(prompt_tokens, params, generate)
+
+    async def stream_chat(self, messages, max_new_tokens=MAX_NEW_TOKENS, temperature=0.0, session_id=None,
+                          share=DEFAULT_SHARE, grammar=None, prompt_tokens=None):
+        """
+        Streams the assistant reply to `messages` as incremental text deltas.
+
+        Closing the generator (client disconnect) cancels the sequence in the
+        scheduler so abandoned requests stop using compute. `grammar` comes
+        from `compile_grammar`, called before the stream starts so that an
+        invalid response format is still reported as an error status.
+        `prompt_tokens` may carry the already-tokenized prompt, as in `chat`.
         """
-        tokens = tokenizer.encode(input_text)
-        input_tensor = torch.tensor([tokens]).to(self.device)
+        await self._ensure_loaded_async()
+        if prompt_tokens is None:
+            prompt_tokens = self.tokenizer.encode_chat(messages)
+        if self.scheduler is None:
+            text, _ = await self._complete_vllm(prompt_tokens, max_new_tokens, temperature)
+            yield text  # vLLM path: the whole reply as one delta
+            return
 
-        with torch.no_grad():
-            output_tokens = self.model.generate(input_tensor, max_new_tokens=MAX_NEW_TOKENS)
-        
-        return tokenizer.decode(output_tokens[0].tolist())
+        detokenizer = self.tokenizer.detokenizer()
+        async for token_id in self.scheduler.stream(
+            prompt_tokens, max_new_tokens=max_new_tokens, temperature=temperature, session_id=session_id,
+            share=share, grammar=grammar,
+        ):
+            delta = detokenizer.add(token_id)
+            if delta:
+                yield delta
+        tail = detokenizer.flush()
+        if tail:
+            yield tail
 
-    async def async_generate_response(self, input_text):
+    def get_stats(self):
         """
-        Async version of generate_response for parallel request handling.
+        Returns scheduler, KV-cache, response-cache and tokenizer counters for monitoring.
         """
-        return self.generate_response(input_text)
+        tokenizer = self.tokenizer.get_stats() if self.tokenizer is not None else None
+        if self.scheduler is None:
+            return {"backend": self.backend, "response_cache": self.response_cache.get_stats(),
+                    "tokenizer": tokenizer}
+        return {
+            "backend": self.backend,
+            "response_cache": self.response_cache.get_stats(),
+            "tokenizer": tokenizer,
+            "scheduler": {**self.scheduler.get_stats(), "queue_depth": self.scheduler.queue_depth,
+                          "running": self.scheduler.running, "fair_queue": self.scheduler.queue_stats()},
+            "prefix_cache": self.prefix_cache.get_stats() if self.prefix_cache is not None else None,
+            "paged_kv": self.paged_kv.get_stats() if self.paged_kv is not None else None,
+            "speculative": self.speculative.get_stats() if self.speculative is not None else None,
+        }
 
 
-# Instantiate global inference handler
+# Instantiate global inference handler (no weights are loaded until first use)
 model_inference = ModelInference()
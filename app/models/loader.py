@@ -5,7 +5,9 @@ loader.py - Model Loader with DeepSpeed & vLLM (GPU Acceleration)
 - Loads model efficiently with vLLM or DeepSpeed
 - Supports multi-GPU execution
 - Fallbacks to PyTorch if DeepSpeed/vLLM are unavailable
+- int8 / bf16 CPU backend for GPU-less nodes, verified against fp32 at load
 - Handles memory optimization for large models
+- Shares the registry tokenizer instead of loading its own copy
 
 📌 Dependencies:
 - torch (PyTorch backend)
@@ -18,25 +20,39 @@ import os
 import torch
 import deepspeed
 import vllm
-from transformers import AutoModelForCausalLM, AutoTokenizer
+from transformers import AutoModelForCausalLM
+from app.models.quantization import PARITY_PROMPTS, parity_check, quantize_for_cpu
+from app.models.registry import model_registry
+from app.utils.config import config
 from app.utils.logger import logger
 
 # Load configurations from environment variables
 MODEL_NAME = os.getenv("MODEL_NAME", "meta-llama/Llama-3-8B")
 USE_VLLM = os.getenv("USE_VLLM", "true").lower() == "true"
 USE_DEEPSPEED = os.getenv("USE_DEEPSPEED", "true").lower() == "true"
+ASR_MODEL_NAME = os.getenv("ASR_MODEL_NAME", "base")  # Whisper checkpoint size
 
 class ModelLoader:
     """
     Loads the language model using vLLM, DeepSpeed, or PyTorch fallback.
+
+    On CPU-only nodes (vLLM and DeepSpeed need a GPU) the model is served
+    with int8 or bf16 weights unless `config.CPU_QUANTIZATION` is "none".
+
+    Built once by the model registry (`model_registry.get("llm")`); do not
+    instantiate it directly or the weights are loaded twice.
     """
 
     def __init__(self):
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         self.model = None
-        self.tokenizer = None
+        self.backend = None  # "vllm", "deepspeed", "torch", "cpu-int8" or "cpu-bf16" once loaded
+        self.parity = None  # Parity report of the CPU backend against fp32
+        self.tokenizer = model_registry.get("tokenizer").tokenizer
 
-        if USE_VLLM:
+        if self.device == "cpu" and config.CPU_QUANTIZATION != "none":
+            self.load_cpu_quantized()
+        elif USE_VLLM:
             self.load_vllm()
         elif USE_DEEPSPEED:
             self.load_deepspeed()
@@ -49,7 +65,7 @@ class ModelLoader:
         """
         try:
             self.model = vllm.LLM(MODEL_NAME, tensor_parallel_size=torch.cuda.device_count())
-            self.tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
+            self.backend = "vllm"
             logger.info("✅ Model loaded with vLLM for high-speed inference.")
         except Exception as e:
             logger.error(f"❌ vLLM loading failed: {e}. Switching to DeepSpeed.")
@@ -60,13 +76,13 @@ class ModelLoader:
         Loads the model using DeepSpeed for optimized execution.
         """
         try:
-            self.tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
             self.model = AutoModelForCausalLM.from_pretrained(
                 MODEL_NAME,
                 torch_dtype=torch.float16,
                 device_map="auto",
             )
             self.model = deepspeed.init_inference(self.model, dtype=torch.float16)
+            self.backend = "deepspeed"
             logger.info("✅ Model loaded with DeepSpeed.")
         except Exception as e:
             logger.error(f"❌ DeepSpeed loading failed: {e}. Switching to PyTorch fallback.")
@@ -77,11 +93,38 @@ class ModelLoader:
         Loads the model using PyTorch as a last-resort fallback.
         """
         try:
-            self.tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
             self.model = AutoModelForCausalLM.from_pretrained(MODEL_NAME).to(self.device)
+            self.backend = "torch"
             logger.info("✅ Model loaded using PyTorch fallback.")
         except Exception as e:
             logger.critical(f"❌ PyTorch model loading failed: {e}. Cannot proceed.")
+            raise RuntimeError("PyTorch model loading failed.")
+
+    def load_cpu_quantized(self):
+        """
+        Loads fp32 weights on CPU and converts them to `config.CPU_QUANTIZATION` (int8 or bf16).
+
+        With `config.CPU_PARITY_CHECK` the converted model is compared with
+        the fp32 one on a few prompts first; if it disagrees too often the
+        fp32 model is served instead.
+        """
+        mode = config.CPU_QUANTIZATION
+        try:
+            fp32_model = AutoModelForCausalLM.from_pretrained(MODEL_NAME, torch_dtype=torch.float32).eval()
+            model = quantize_for_cpu(fp32_model, mode, inplace=not config.CPU_PARITY_CHECK)
+            if config.CPU_PARITY_CHECK:
+                prompts = self.tokenizer(PARITY_PROMPTS)["input_ids"]  # One batched call
+                self.parity = parity_check(fp32_model, model, prompts)
+                if not self.parity["passed"]:
+                    logger.error(f"❌ {mode} model failed the fp32 parity check. Serving fp32 weights.")
+                    self.model, self.backend = fp32_model, "torch"
+                    return
+                del fp32_model
+            self.model, self.backend = model, f"cpu-{mode}"
+            logger.info(f"✅ Model loaded on CPU with {mode} weights.")
+        except Exception as e:
+            logger.error(f"❌ {mode} CPU loading failed: {e}. Switching to PyTorch fallback.")
+            self.load_torch()
 
     def get_model(self):
         """
@@ -90,5 +133,35 @@ class ModelLoader:
         return self.model, self.tokenizer
 
 
-# Instantiate model loader globally
-model_loader = ModelLoader()
+class WhisperASR:
+    """
+    Thin wrapper giving Whisper the `transcribe(waveform, sample_rate)` interface of the speech API.
+    """
+
+    def __init__(self, model_name: str = ASR_MODEL_NAME):
+        import whisper
+        self.model = whisper.load_model(model_name, device="cuda" if torch.cuda.is_available() else "cpu")
+
+    def transcribe(self, waveform: torch.Tensor, sample_rate: int = 16000) -> str:
+        """
+        Transcribes a mono 16 kHz waveform tensor.
+        """
+        if sample_rate != 16000:
+            raise ValueError("Whisper expects 16 kHz audio.")
+        return self.model.transcribe(waveform.squeeze(0).numpy())["text"].strip()
+
+
+def load_model():
+    """
+    Returns the shared (model, tokenizer) pair, loading it on first use.
+    """
+    return model_registry.get("llm").get_model()
+
+
+def load_asr_model():
+    """
+    Loads the Whisper speech-to-text model (called once by the model registry).
+    """
+    asr_model = WhisperASR()
+    logger.info(f"✅ Loaded Whisper ASR model ({ASR_MODEL_NAME}).")
+    return asr_model
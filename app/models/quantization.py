@@ -0,0 +1,112 @@
+"""
+quantization.py - Reduced-Precision CPU Inference
+--------------------------------------------------
+🔹 Features:
+- int8 dynamic quantization of every nn.Linear (weights int8, activations quantized on the fly)
+- bf16 weights for CPUs with native bfloat16 support (AVX512-BF16 / AMX)
+- Accuracy-parity check of a reduced-precision model against its fp32 original
+
+📌 Dependencies:
+- torch (torch.ao.quantization dynamic quantization)
+"""
+
+import os
+import copy
+from typing import Dict, List, Sequence
+
+import torch
+import torch.nn.functional as F
+
+from app.utils.logger import logger
+
+### 🔧 CONFIGURATION ###
+CPU_QUANTIZATION_MODES = ("int8", "bf16", "none")
+PARITY_MAX_KL = float(os.getenv("PARITY_MAX_KL", 0.05))  # Max mean KL(fp32 || reduced) per token, in nats
+PARITY_MAX_NEW_TOKENS = int(os.getenv("PARITY_MAX_NEW_TOKENS", 16))
+PARITY_PROMPTS = [
+    "The capital of France is",
+    "def fibonacci(n):",
+    "Summarize the following text in one sentence: The quick brown fox jumps over the lazy dog.",
+    "Q: What is 12 times 7?\nA:",
+]
+
+
+def quantize_for_cpu(model: torch.nn.Module, mode: str = "int8", inplace: bool = False) -> torch.nn.Module:
+    """
+    Returns `model` converted for CPU serving.
+
+    Args:
+        model: fp32 causal LM on CPU.
+        mode: "int8" (dynamic quantization), "bf16" or "none".
+        inplace: convert `model` itself instead of a copy (saves memory when no
+            fp32 reference is needed afterwards).
+    """
+    if mode not in CPU_QUANTIZATION_MODES:
+        raise ValueError(f"Unknown CPU quantization mode '{mode}', expected one of {CPU_QUANTIZATION_MODES}.")
+    model = model.eval()
+    if mode == "int8":
+        if "fbgemm" not in torch.backends.quantized.supported_engines:
+            torch.backends.quantized.engine = "qnnpack"  # ARM servers
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8,
+                                                      inplace=inplace)
+    if mode == "bf16":
+        if not inplace:
+            model = copy.deepcopy(model)
+        return model.to(torch.bfloat16)
+    return model
+
+
+@torch.no_grad()
+def _greedy(model: torch.nn.Module, prompt_ids: List[int], max_new_tokens: int) -> List[int]:
+    ids = torch.tensor([prompt_ids])
+    output = model(input_ids=ids, use_cache=True)
+    generated = []
+    for _ in range(max_new_tokens):
+        token = int(output.logits[0, -1].argmax())
+        generated.append(token)
+        output = model(input_ids=torch.tensor([[token]]), past_key_values=output.past_key_values, use_cache=True)
+    return generated
+
+
+@torch.no_grad()
+def parity_check(reference: torch.nn.Module, candidate: torch.nn.Module, prompts: Sequence[List[int]],
+                 max_new_tokens: int = PARITY_MAX_NEW_TOKENS,
+                 max_kl: float = PARITY_MAX_KL) -> Dict[str, float]:
+    """
+    Compares a reduced-precision model with its fp32 reference on tokenized prompts.
+
+    Returns:
+        dict: top1_agreement (teacher-forced argmax match over every prompt
+        position), mean_kl and max_logit_diff of the next-token distributions,
+        greedy_match_rate (prompts whose greedy continuation is identical) and
+        passed (mean_kl <= max_kl). The verdict uses KL rather than top-1
+        agreement because near-tied candidates can swap places under any
+        rounding without changing the output distribution meaningfully.
+    """
+    agree = positions = greedy_matches = 0
+    kl_total, max_diff = 0.0, 0.0
+    for prompt_ids in prompts:
+        ids = torch.tensor([list(prompt_ids)])
+        ref_logits = reference(input_ids=ids).logits[0].float()
+        cand_logits = candidate(input_ids=ids).logits[0].float()
+
+        agree += int((ref_logits.argmax(-1) == cand_logits.argmax(-1)).sum())
+        positions += ref_logits.shape[0]
+        kl_total += float(F.kl_div(F.log_softmax(cand_logits, -1), F.log_softmax(ref_logits, -1),
+                                   log_target=True, reduction="sum"))
+        max_diff = max(max_diff, float((ref_logits - cand_logits).abs().max()))
+        if max_new_tokens:
+            greedy_matches += _greedy(reference, prompt_ids, max_new_tokens) == _greedy(
+                candidate, prompt_ids, max_new_tokens)
+
+    report = {
+        "top1_agreement": agree / positions if positions else 1.0,
+        "mean_kl": kl_total / positions if positions else 0.0,
+        "max_logit_diff": max_diff,
+        "greedy_match_rate": greedy_matches / len(prompts) if prompts and max_new_tokens else None,
+    }
+    report["passed"] = report["mean_kl"] <= max_kl
+    log = logger.info if report["passed"] else logger.error
+    log(f"{'✅' if report['passed'] else '❌'} Parity vs fp32: top-1 agreement {report['top1_agreement']:.3f}, "
+        f"mean KL {report['mean_kl']:.4f}, greedy match {report['greedy_match_rate']}.")
+    return report
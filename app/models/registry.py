@@ -0,0 +1,369 @@
+"""
+registry.py - Process-Wide Model Registry
+------------------------------------------
+🔹 Features:
+- Loads every model at most once per process and hands out shared handles
+- Lazy loading on first use, or eager loading during a controlled warmup phase
+- Thread-safe: concurrent first requests wait for a single load
+- Exposes load state, load duration and last error per model
+- Tracks the estimated RAM / VRAM of each model against configurable budgets
+- Evicts (or offloads to CPU) the least recently used model when over budget;
+  evicted models are reloaded on demand, pinned models always stay resident
+
+📌 Dependencies:
+- app.models.loader (LLM backends), transformers, sentence-transformers, whisper
+"""
+
+import gc
+import os
+import time
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Optional
+
+import torch
+
+from app.utils.logger import logger
+
+### 🔧 CONFIGURATION ###
+WARMUP_MODELS = [m for m in os.getenv("WARMUP_MODELS", "tokenizer,llm").split(",") if m]
+PINNED_MODELS = [m for m in os.getenv("PINNED_MODELS", "tokenizer,llm,draft_llm").split(",") if m]
+MODEL_RAM_BUDGET_MB = float(os.getenv("MODEL_RAM_BUDGET_MB", 0))  # 0 = unlimited
+MODEL_VRAM_BUDGET_MB = float(os.getenv("MODEL_VRAM_BUDGET_MB", 0))  # 0 = unlimited
+MODEL_EVICTION_POLICY = os.getenv("MODEL_EVICTION_POLICY", "offload")  # offload (GPU → CPU first) or unload
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+CAPTION_MODEL = "Salesforce/blip-image-captioning-large"
+OCR_MODEL = "microsoft/trocr-base-handwritten"
+DRAFT_MODEL_NAME = os.getenv("DRAFT_MODEL_NAME", "meta-llama/Llama-3.2-1B")  # Must share the LLM tokenizer
+
+UNLOADED, LOADING, LOADED, OFFLOADED, FAILED = "unloaded", "loading", "loaded", "offloaded", "failed"
+MB = 1024 * 1024
+
+
+### 📏 MEMORY ESTIMATION ###
+def _modules(handle: Any, depth: int = 0):
+    """Yields the torch modules inside a handle (module, tuple of parts, or wrapper with `.model`)."""
+    if depth > 3 or handle is None:
+        return
+    if isinstance(handle, torch.nn.Module):
+        yield handle
+    elif isinstance(handle, (tuple, list)):
+        for part in handle:
+            yield from _modules(part, depth + 1)
+    elif hasattr(handle, "model"):
+        yield from _modules(handle.model, depth + 1)
+
+
+def estimate_memory(handle: Any) -> Dict[str, int]:
+    """
+    Returns the bytes of parameters and buffers held by `handle`, split into "cpu" and "cuda".
+    """
+    usage = {"cpu": 0, "cuda": 0}
+    seen = set()
+    for module in _modules(handle):
+        # state_dict also covers packed int8 weights, which are not parameters
+        for value in module.state_dict(keep_vars=True).values():
+            for tensor in value if isinstance(value, tuple) else (value,):
+                if not isinstance(tensor, torch.Tensor) or id(tensor) in seen:
+                    continue
+                seen.add(id(tensor))
+                device = "cuda" if tensor.is_cuda else "cpu"
+                usage[device] += tensor.numel() * tensor.element_size()
+    return usage
+
+
+def _move(handle: Any, device: str):
+    for module in _modules(handle):
+        module.to(device)
+
+
+class ModelEntry:
+    """
+    One registered model: its factory, the loaded handle and load bookkeeping.
+    """
+
+    def __init__(self, name: str, factory: Callable[[], Any], pinned: bool = False):
+        self.name = name
+        self.factory = factory
+        self.pinned = pinned
+        self.handle: Any = None
+        self.state = UNLOADED
+        self.load_seconds: Optional[float] = None
+        self.loaded_at: Optional[float] = None
+        self.last_used = 0.0
+        self.loads = 0
+        self.users = 0  # Callers currently inside `ModelRegistry.use`
+        self.memory = {"cpu": 0, "cuda": 0}
+        self.last_memory = {"cpu": 0, "cuda": 0}  # Size at the last load, used to make room before reloading
+        self.home_device = "cpu"  # Where the factory put it; offloaded models return here
+        self.error: Optional[str] = None
+        self.lock = threading.Lock()
+
+    @property
+    def resident(self) -> bool:
+        return self.state in (LOADED, OFFLOADED)
+
+    def status(self) -> Dict[str, Any]:
+        return {"state": self.state, "load_seconds": self.load_seconds,
+                "loaded_at": self.loaded_at, "loads": self.loads, "pinned": self.pinned,
+                "ram_mb": round(self.memory["cpu"] / MB, 1), "vram_mb": round(self.memory["cuda"] / MB, 1),
+                "error": self.error}
+
+
+### 📂 MODEL REGISTRY CLASS ###
+class ModelRegistry:
+    """
+    Maps model names to lazily-loaded, shared handles under a memory budget.
+
+    After every load the registry measures the model's parameters and, if
+    the RAM or VRAM budget is exceeded, frees the least recently used
+    unpinned model that nobody is currently `use`-ing. With the "offload"
+    policy GPU models are first moved to CPU (and moved back on their next
+    use); otherwise, or when RAM is short, they are unloaded and rebuilt by
+    their factory on demand.
+
+    Long-lived holders of a handle (the scheduler keeps the LLM) must pin
+    it; short-lived callers should wrap their work in `use(name)`.
+    """
+
+    def __init__(self, ram_budget_mb: float = MODEL_RAM_BUDGET_MB, vram_budget_mb: float = MODEL_VRAM_BUDGET_MB,
+                 eviction_policy: str = MODEL_EVICTION_POLICY, pinned: Iterable[str] = ()):
+        self.budgets = {"cpu": int(ram_budget_mb * MB), "cuda": int(vram_budget_mb * MB)}
+        self.eviction_policy = eviction_policy
+        self._pinned = set(pinned)
+        self._entries: Dict[str, ModelEntry] = {}
+        self._budget_lock = threading.RLock()
+        self.stats = {"evictions": 0, "offloads": 0, "restores": 0, "over_budget": 0}
+
+    def register(self, name: str, factory: Callable[[], Any], pinned: Optional[bool] = None):
+        """
+        Registers a zero-argument factory that builds the model handle.
+        """
+        self._entries[name] = ModelEntry(name, factory, name in self._pinned if pinned is None else pinned)
+
+    def pin(self, name: str, pinned: bool = True):
+        """Keeps a model resident (or makes it evictable again)."""
+        self._entry(name).pinned = pinned
+
+    def get(self, name: str) -> Any:
+        """
+        Returns the shared handle for `name`, loading (or restoring) it on first use.
+        """
+        entry = self._entry(name)
+        entry.last_used = time.monotonic()
+        if entry.state == LOADED:
+            return entry.handle
+        with entry.lock:
+            if entry.state == OFFLOADED:
+                self._restore(entry)
+            elif entry.state != LOADED:  # Not loaded by a concurrent caller while we waited
+                self._load(entry)
+            return entry.handle
+
+    @contextmanager
+    def use(self, name: str):
+        """
+        Context manager yielding the handle; the model is not evicted while inside it.
+        """
+        entry = self._entry(name)
+        with self._budget_lock:
+            entry.users += 1
+        try:
+            yield self.get(name)
+        finally:
+            with self._budget_lock:
+                entry.users -= 1
+
+    def is_loaded(self, name: str) -> bool:
+        return name in self._entries and self._entries[name].state == LOADED
+
+    def unload(self, name: str) -> bool:
+        """
+        Drops a model's handle so its memory can be reclaimed; returns False if it was not resident.
+        """
+        entry = self._entry(name)
+        with entry.lock:
+            return self._unload(entry)
+
+    def warmup(self, names: Iterable[str] = WARMUP_MODELS):
+        """
+        Loads the given models up front; failures are logged, not raised.
+        """
+        for name in names:
+            try:
+                self.get(name.strip())
+            except Exception as e:
+                logger.error(f"❌ Warmup of '{name}' failed: {e}")
+
+    def memory_usage(self) -> Dict[str, int]:
+        """Returns the estimated bytes held by resident models, per device type."""
+        usage = {"cpu": 0, "cuda": 0}
+        for entry in self._entries.values():
+            for device in usage:
+                usage[device] += entry.memory[device]
+        return usage
+
+    def status(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Returns load state, load duration and memory for every registered model.
+        """
+        return {name: entry.status() for name, entry in self._entries.items()}
+
+    def get_stats(self) -> dict:
+        """
+        Returns per-model status plus memory used against the budgets and eviction counters.
+        """
+        usage = self.memory_usage()
+        return {
+            **self.stats,
+            "eviction_policy": self.eviction_policy,
+            "ram_used_mb": round(usage["cpu"] / MB, 1),
+            "vram_used_mb": round(usage["cuda"] / MB, 1),
+            "ram_budget_mb": self.budgets["cpu"] / MB or None,
+            "vram_budget_mb": self.budgets["cuda"] / MB or None,
+            "models": self.status(),
+        }
+
+    ### 🔒 INTERNALS (caller holds entry.lock) ###
+    def _entry(self, name: str) -> ModelEntry:
+        if name not in self._entries:
+            raise KeyError(f"Unknown model '{name}'.")
+        return self._entries[name]
+
+    def _load(self, entry: ModelEntry):
+        self._make_room(entry.last_memory, keep=entry)
+        entry.state = LOADING
+        start = time.perf_counter()
+        try:
+            entry.handle = entry.factory()
+        except Exception as e:
+            entry.state, entry.error = FAILED, str(e)
+            logger.error(f"❌ Failed to load model '{entry.name}': {e}")
+            raise
+        entry.load_seconds = time.perf_counter() - start
+        entry.loaded_at = time.time()
+        entry.loads += 1
+        entry.memory = entry.last_memory = estimate_memory(entry.handle)
+        entry.home_device = "cuda" if entry.memory["cuda"] else "cpu"
+        entry.state, entry.error = LOADED, None
+        logger.info(f"✅ Model '{entry.name}' loaded in {entry.load_seconds:.2f}s "
+                    f"({entry.memory['cpu'] / MB:.0f} MB RAM, {entry.memory['cuda'] / MB:.0f} MB VRAM).")
+        self._make_room({"cpu": 0, "cuda": 0}, keep=entry)
+
+    def _restore(self, entry: ModelEntry):
+        """Moves an offloaded model back to its GPU."""
+        self._make_room({"cpu": 0, "cuda": entry.last_memory["cuda"]}, keep=entry)
+        _move(entry.handle, entry.home_device)
+        entry.memory = estimate_memory(entry.handle)
+        entry.state = LOADED
+        self.stats["restores"] += 1
+        logger.info(f"✅ Model '{entry.name}' restored to {entry.home_device}.")
+
+    def _unload(self, entry: ModelEntry) -> bool:
+        if not entry.resident:
+            return False
+        entry.handle = None
+        entry.memory = {"cpu": 0, "cuda": 0}
+        entry.state = UNLOADED
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        logger.info(f"⚠️ Model '{entry.name}' unloaded to free memory.")
+        return True
+
+    def _make_room(self, reserve: Dict[str, int], keep: ModelEntry):
+        """
+        Frees least recently used models until `reserve` more bytes fit in both budgets.
+        """
+        with self._budget_lock:
+            for device in ("cuda", "cpu"):  # Offloading GPU models adds to RAM, so settle VRAM first
+                budget = self.budgets[device]
+                if not budget:
+                    continue
+                while self.memory_usage()[device] + reserve.get(device, 0) > budget:
+                    victim = self._pick_victim(device, keep)
+                    if victim is None:
+                        self.stats["over_budget"] += 1
+                        logger.warning(f"⚠️ Model {device} budget exceeded and nothing left to evict.")
+                        break
+                    try:
+                        if device == "cuda" and self.eviction_policy == "offload":
+                            _move(victim.handle, "cpu")
+                            victim.memory = estimate_memory(victim.handle)
+                            victim.state = OFFLOADED
+                            self.stats["offloads"] += 1
+                            logger.info(f"⚠️ Model '{victim.name}' offloaded to CPU.")
+                        else:
+                            self._unload(victim)
+                            self.stats["evictions"] += 1
+                    finally:
+                        victim.lock.release()
+
+    def _pick_victim(self, device: str, keep: ModelEntry) -> Optional[ModelEntry]:
+        """
+        Returns (with its lock held) the least recently used evictable model holding `device` memory.
+        """
+        candidates = sorted(
+            (e for e in self._entries.values()
+             if e is not keep and e.resident and not e.pinned and not e.users and e.memory[device]),
+            key=lambda e: e.last_used,
+        )
+        for entry in candidates:
+            if entry.lock.acquire(blocking=False):  # Skip models busy loading or restoring
+                if entry.resident and not entry.users:
+                    return entry
+                entry.lock.release()
+        return None
+
+
+### 🏭 DEFAULT MODEL FACTORIES ###
+def _device() -> str:
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def _load_tokenizer():
+    from app.models.tokenizer import Tokenizer
+    return Tokenizer()
+
+
+def _load_llm():
+    from app.models.loader import ModelLoader
+    return ModelLoader()
+
+
+def _load_draft_llm():
+    from transformers import AutoModelForCausalLM
+    return AutoModelForCausalLM.from_pretrained(DRAFT_MODEL_NAME).to(_device()).eval()
+
+
+def _load_embedder():
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(EMBEDDING_MODEL)
+
+
+def _load_caption_model():
+    from transformers import BlipForConditionalGeneration, BlipProcessor
+    processor = BlipProcessor.from_pretrained(CAPTION_MODEL)
+    return processor, BlipForConditionalGeneration.from_pretrained(CAPTION_MODEL).to(_device())
+
+
+def _load_ocr_model():
+    from transformers import VisionEncoderDecoderModel, ViTImageProcessor
+    processor = ViTImageProcessor.from_pretrained(OCR_MODEL)
+    return processor, VisionEncoderDecoderModel.from_pretrained(OCR_MODEL).to(_device())
+
+
+def _load_asr_model():
+    from app.models.loader import load_asr_model
+    return load_asr_model()
+
+
+# Instantiate the process-wide registry
+model_registry = ModelRegistry(pinned=PINNED_MODELS)
+model_registry.register("tokenizer", _load_tokenizer)
+model_registry.register("llm", _load_llm)
+model_registry.register("draft_llm", _load_draft_llm)
+model_registry.register("embedder", _load_embedder)
+model_registry.register("caption", _load_caption_model)
+model_registry.register("ocr", _load_ocr_model)
+model_registry.register("asr", _load_asr_model)
@@ -0,0 +1,214 @@
+"""
+speculative.py - Speculative Decoding with a Draft Model
+---------------------------------------------------------
+🔹 Features:
+- A small draft model proposes `k` tokens; the target model verifies them in one forward pass
+- Greedy verification: output is token-for-token identical to plain greedy decoding
+- Per-request fallback to plain decoding when the rolling acceptance rate drops
+- Global gate that stops speculating while acceptance stays low (with periodic probes)
+- Exports acceptance rate and tokens/s
+
+📌 Dependencies:
+- torch (PyTorch backend)
+- transformers (target & draft causal LMs sharing one tokenizer)
+"""
+
+import os
+import time
+import threading
+from collections import deque
+from typing import List, Optional, Tuple
+
+import torch
+
+from app.core.kv_cache import KVLayers, build_kv, kv_crop, kv_layers
+from app.utils.logger import logger
+
+### 🔧 CONFIGURATION ###
+SPECULATIVE_K = int(os.getenv("SPECULATIVE_K", 4))  # Draft tokens proposed per round
+SPECULATIVE_MIN_ACCEPTANCE = float(os.getenv("SPECULATIVE_MIN_ACCEPTANCE", 0.3))  # Fallback threshold
+SPECULATIVE_WINDOW = int(os.getenv("SPECULATIVE_WINDOW", 8))  # Rounds in the rolling acceptance window
+SPECULATIVE_PROBE_INTERVAL = int(os.getenv("SPECULATIVE_PROBE_INTERVAL", 20))  # Requests between probes
+
+
+class _ModelState:
+    """KV cache of one model plus how many tokens it covers."""
+
+    def __init__(self, model, device: str):
+        self.model = model
+        self.device = device
+        self.kv: Optional[KVLayers] = None
+        self.length = 0
+        self.legacy = False
+
+    def forward(self, token_ids: List[int]) -> torch.Tensor:
+        """
+        Feeds `token_ids` after the cached prefix; returns their [len, vocab] logits.
+        """
+        total = self.length + len(token_ids)
+        input_ids = torch.tensor([token_ids], device=self.device)
+        position_ids = torch.arange(self.length, total, device=self.device).unsqueeze(0)
+        attention_mask = torch.ones((1, total), dtype=torch.long, device=self.device)
+        past = build_kv(self.kv, self.legacy) if self.kv else None
+
+        output = self.model(input_ids=input_ids, attention_mask=attention_mask,
+                            position_ids=position_ids, past_key_values=past, use_cache=True)
+        self.legacy = isinstance(output.past_key_values, tuple)
+        self.kv = kv_layers(output.past_key_values)
+        self.length = total
+        return output.logits[0]
+
+    def crop(self, length: int):
+        """Forgets cached positions from `length` on."""
+        if length < self.length:
+            self.kv = kv_crop(self.kv, length)
+            self.length = length
+
+
+### 📂 SPECULATIVE DECODER CLASS ###
+class SpeculativeDecoder:
+    """
+    Greedy speculative decoding for a single sequence.
+
+    Each round the draft model proposes `k` tokens autoregressively; the
+    target model scores the last accepted token plus all proposals at once.
+    The longest prefix of proposals that matches the target's argmax is
+    kept, followed by the target's own next token, so every round emits at
+    least one token and the result equals plain greedy decoding.
+    """
+
+    def __init__(self, target_model, draft_model, device: str = "cpu", k: int = SPECULATIVE_K,
+                 min_acceptance: float = SPECULATIVE_MIN_ACCEPTANCE, window: int = SPECULATIVE_WINDOW,
+                 probe_interval: int = SPECULATIVE_PROBE_INTERVAL):
+        self.target_model = target_model
+        self.draft_model = draft_model
+        self.device = device
+        self.k = k
+        self.min_acceptance = min_acceptance
+        self.window = window
+        self.probe_interval = probe_interval
+
+        self._lock = threading.Lock()
+        self._recent_rates = deque(maxlen=probe_interval)  # Acceptance rate of recent requests
+        self._skipped = 0
+        self.stats = {"requests": 0, "fallbacks": 0, "skipped": 0, "rounds": 0,
+                      "proposed_tokens": 0, "accepted_tokens": 0, "generated_tokens": 0,
+                      "decode_seconds": 0.0}
+
+    def should_speculate(self) -> bool:
+        """
+        False while recent requests' acceptance is below `min_acceptance`,
+        except for one probe request every `probe_interval` skips.
+        """
+        with self._lock:
+            if not self._recent_rates:
+                return True
+            if sum(self._recent_rates) / len(self._recent_rates) >= self.min_acceptance:
+                return True
+            self._skipped += 1
+            if self._skipped >= self.probe_interval:
+                self._skipped = 0
+                return True
+            self.stats["skipped"] += 1
+            return False
+
+    @torch.no_grad()
+    def generate(self, prompt_ids: List[int], max_new_tokens: int,
+                 eos_token_id: Optional[int] = None) -> List[int]:
+        """
+        Greedily generates up to `max_new_tokens` tokens after `prompt_ids`.
+        """
+        if not prompt_ids:
+            raise ValueError("prompt_ids must contain at least one token.")
+
+        start = time.perf_counter()
+        target = _ModelState(self.target_model, self.device)
+        draft = _ModelState(self.draft_model, self.device)
+        tokens = list(prompt_ids)
+        generated: List[int] = []
+        window = deque(maxlen=self.window)  # (proposed, accepted) per round
+        speculating = self.k > 0
+        rounds = proposed_total = accepted_total = 0
+
+        while len(generated) < max_new_tokens:
+            k = min(self.k, max_new_tokens - len(generated) - 1) if speculating else 0
+            proposals = self._propose(draft, tokens, k) if k > 0 else []
+            accepted, matched = self._verify(target, tokens, proposals)
+            rounds += 1
+
+            # The draft cache is valid up to the last proposal it was fed that matched
+            draft.crop(len(tokens) + min(matched, max(k - 1, 0)))
+            tokens.extend(accepted)
+            generated.extend(accepted)
+
+            if k > 0:
+                window.append((k, matched))
+                proposed_total += k
+                accepted_total += matched
+                if len(window) == self.window:
+                    rate = sum(a for _, a in window) / sum(p for p, _ in window)
+                    if rate < self.min_acceptance:
+                        speculating = False
+                        self.stats["fallbacks"] += 1
+                        logger.info(f"⚠️ Speculative acceptance {rate:.2f} below "
+                                    f"{self.min_acceptance:.2f}; falling back to plain decoding.")
+                        draft.kv, draft.length = None, 0
+
+            if eos_token_id is not None and eos_token_id in accepted:
+                del generated[generated.index(eos_token_id, len(generated) - len(accepted)) + 1:]
+                break
+
+        generated = generated[:max_new_tokens]
+        with self._lock:
+            self.stats["requests"] += 1
+            self.stats["rounds"] += rounds
+            self.stats["proposed_tokens"] += proposed_total
+            self.stats["accepted_tokens"] += accepted_total
+            self.stats["generated_tokens"] += len(generated)
+            self.stats["decode_seconds"] += time.perf_counter() - start
+            if proposed_total:
+                self._recent_rates.append(accepted_total / proposed_total)
+        return generated
+
+    def _propose(self, draft: _ModelState, tokens: List[int], k: int) -> List[int]:
+        """
+        Runs the draft model greedily for `k` tokens after `tokens`.
+        """
+        logits = draft.forward(tokens[draft.length:])
+        proposals = [int(logits[-1].argmax())]
+        while len(proposals) < k:
+            logits = draft.forward(proposals[-1:])
+            proposals.append(int(logits[-1].argmax()))
+        return proposals
+
+    def _verify(self, target: _ModelState, tokens: List[int],
+                proposals: List[int]) -> Tuple[List[int], int]:
+        """
+        Scores all proposals with one target forward pass.
+
+        Returns:
+            tuple: (tokens to emit, number of matched proposals)
+        """
+        logits = target.forward(tokens[target.length:] + proposals)
+        predictions = logits[-(len(proposals) + 1):].argmax(dim=-1).tolist()
+
+        matched = 0
+        while matched < len(proposals) and proposals[matched] == predictions[matched]:
+            matched += 1
+
+        # Keep KV for the matched proposals; the correction token is fed next round
+        target.crop(len(tokens) + matched)
+        return proposals[:matched] + [predictions[matched]], matched
+
+    def get_stats(self) -> dict:
+        """
+        Returns counters plus acceptance rate and tokens per second.
+        """
+        with self._lock:
+            stats = dict(self.stats)
+            stats["acceptance_rate"] = (stats["accepted_tokens"] / stats["proposed_tokens"]
+                                        if stats["proposed_tokens"] else 0.0)
+            stats["tokens_per_second"] = (stats["generated_tokens"] / stats["decode_seconds"]
+                                          if stats["decode_seconds"] else 0.0)
+            stats["k"] = self.k
+            return stats
@@ -5,22 +5,33 @@ tokenizer.py - Tokenization Utilities for LLM
 - Supports different tokenization methods (BPE, WordPiece, SentencePiece)
 - Loads tokenizers dynamically based on model configuration
 - Handles special token processing (padding, truncation)
-- Optimized for batch inference
+- Optimized for batch inference: `encode_batch` / `decode_batch` use the fast
+  tokenizer's batch path and return padded numpy / torch arrays with masks
+- LRU cache in front of encoding for repeated system prompts and templates
+- Incremental detokenizer for streaming (constant work per generated token)
+- Token-text vocabulary for constrained (grammar / JSON schema) decoding
 
 📌 Dependencies:
 - transformers (Hugging Face tokenizer)
 - sentencepiece (LLM-compatible tokenization)
+- numpy / torch (batch outputs)
 """
 
 import os
+import threading
+from collections import OrderedDict
+import numpy as np
 from transformers import AutoTokenizer
 import sentencepiece as spm
+from app.core.grammar import TokenVocabulary
 from app.utils.logger import logger
 
 # Model configuration
 MODEL_NAME = os.getenv("MODEL_NAME", "meta-llama/Llama-3-8B")
 TOKENIZER_TYPE = os.getenv("TOKENIZER_TYPE", "auto")  # Options: auto, bpe, wordpiece, sentencepiece
 MAX_LENGTH = int(os.getenv("MAX_TOKEN_LENGTH", 2048))  # Adjust for longer contexts
+ENCODE_CACHE_SIZE = int(os.getenv("TOKENIZER_CACHE_SIZE", 4096))  # Encoded texts kept (0 disables the cache)
+ENCODE_CACHE_MAX_CHARS = int(os.getenv("TOKENIZER_CACHE_MAX_CHARS", 8192))  # Longer texts are never cached
 
 class Tokenizer:
     """
@@ -29,6 +40,10 @@ class Tokenizer:
 
     def __init__(self):
         self.tokenizer = None
+        self._cache = OrderedDict()  # (text, special tokens, max length) -> token ID tuple
+        self._cache_lock = threading.Lock()
+        self.stats = {"cache_hits": 0, "cache_misses": 0, "batch_calls": 0}
+        self._vocabulary = None
         if TOKENIZER_TYPE == "bpe":
             self.load_bpe_tokenizer()
         elif TOKENIZER_TYPE == "wordpiece":
@@ -86,9 +101,210 @@ class Tokenizer:
         """
         Encodes input text into token IDs.
         """
+        return self._encode_many([text], True, MAX_LENGTH)[0]
+
+    def count_tokens(self, text):
+        """
+        Number of tokens in `text`, without special tokens or truncation.
+        """
+        return len(self._encode_many([text], False, None)[0])
+
+    def encode_batch(self, texts, return_tensors="np", add_special_tokens=True, max_length=MAX_LENGTH,
+                     padding_side="left"):
+        """
+        Encodes many texts in one tokenizer call (cached texts are not re-encoded).
+
+        Args:
+            return_tensors: "np" or "pt" for padded arrays, None for unpadded lists.
+            padding_side: "left" (default) keeps every prompt's last token
+                aligned, as decoder-only generation expects.
+
+        Returns:
+            dict: `input_ids` and `attention_mask` (batch x longest sequence).
+        """
+        ids = self._encode_many(list(texts), add_special_tokens, max_length)
+        if return_tensors is None:
+            return {"input_ids": ids, "attention_mask": [[1] * len(seq) for seq in ids]}
+
+        longest = max((len(seq) for seq in ids), default=0)
+        input_ids = np.full((len(ids), longest), self.pad_token_id, dtype=np.int64)
+        attention_mask = np.zeros((len(ids), longest), dtype=np.int64)
+        for row, seq in enumerate(ids):
+            if not seq:
+                continue
+            span = slice(longest - len(seq), longest) if padding_side == "left" else slice(0, len(seq))
+            input_ids[row, span] = seq
+            attention_mask[row, span] = 1
+        if return_tensors == "pt":
+            import torch
+            return {"input_ids": torch.from_numpy(input_ids), "attention_mask": torch.from_numpy(attention_mask)}
+        return {"input_ids": input_ids, "attention_mask": attention_mask}
+
+    def decode_batch(self, sequences):
+        """
+        Decodes many token ID sequences (lists, arrays or tensors) in one call.
+        """
+        sequences = [seq.tolist() if hasattr(seq, "tolist") else list(seq) for seq in sequences]
+        if isinstance(self.tokenizer, spm.SentencePieceProcessor):
+            return self.tokenizer.decode(sequences)
+        return self.tokenizer.batch_decode(sequences, skip_special_tokens=True)
+
+    def detokenizer(self):
+        """
+        Returns an `IncrementalDetokenizer` for one streamed output.
+        """
+        return IncrementalDetokenizer(self)
+
+    def vocabulary(self):
+        """
+        Returns the text of every token id as a `TokenVocabulary` (built once).
+
+        Special tokens and byte fragments of multi-byte characters map to
+        None, so constrained decoding never emits them.
+        """
+        if self._vocabulary is not None:
+            return self._vocabulary
+        if isinstance(self.tokenizer, spm.SentencePieceProcessor):
+            sp = self.tokenizer
+            strings = [None if sp.is_control(i) or sp.is_unknown(i) or sp.is_byte(i)
+                       else sp.id_to_piece(i).replace("\u2581", " ") for i in range(sp.get_piece_size())]
+            eos_token_id = sp.eos_id() if sp.eos_id() >= 0 else None
+        else:
+            special = set(self.tokenizer.all_special_ids)
+            strings = []
+            for token_id, token in enumerate(self.tokenizer.convert_ids_to_tokens(list(range(len(self.tokenizer))))):
+                if token is None or token_id in special:
+                    strings.append(None)
+                    continue
+                text = self.tokenizer.convert_tokens_to_string([token])
+                if token.startswith("\u2581") and not text.startswith(" "):
+                    text = " " + text  # SentencePiece-style tokenizers strip a leading space here
+                strings.append(text if text and "\ufffd" not in text else None)
+            eos_token_id = self.tokenizer.eos_token_id
+        self._vocabulary = TokenVocabulary(strings, eos_token_id)
+        return self._vocabulary
+
+    @property
+    def pad_token_id(self):
+        if isinstance(self.tokenizer, spm.SentencePieceProcessor):
+            return max(self.tokenizer.pad_id(), 0)
+        for token_id in (self.tokenizer.pad_token_id, self.tokenizer.eos_token_id):
+            if token_id is not None:
+                return token_id
+        return 0
+
+    def get_stats(self):
+        """
+        Returns encode-cache hits / misses and the number of batched tokenizer calls.
+        """
+        with self._cache_lock:
+            lookups = self.stats["cache_hits"] + self.stats["cache_misses"]
+            return {**self.stats, "cache_entries": len(self._cache),
+                    "cache_hit_rate": self.stats["cache_hits"] / lookups if lookups else 0.0}
+
+    def render_chat(self, messages, add_generation_prompt=True):
+        """
+        Renders chat messages into prompt text, optionally ending with the assistant turn.
+
+        Uses the model's chat template when it has one and a plain
+        "role: content" transcript otherwise.
+        """
+        if getattr(self.tokenizer, "chat_template", None):
+            return self.tokenizer.apply_chat_template(messages, tokenize=False,
+                                                      add_generation_prompt=add_generation_prompt)
+        transcript = "".join(f"{m['role']}: {m['content']}\n" for m in messages)
+        return transcript + "assistant:" if add_generation_prompt else transcript
+
+    def encode_chat(self, messages):
+        """
+        Renders chat messages into prompt token IDs, ending with the assistant turn.
+        """
+        prompt = self.render_chat(messages)
+        if getattr(self.tokenizer, "chat_template", None):
+            # The rendered template already carries BOS and friends
+            return self._encode_many([prompt], False, MAX_LENGTH)[0]
+        return self.encode(prompt)
+
+    def encode_chat_batch(self, conversations, max_length=MAX_LENGTH):
+        """
+        `encode_chat` for many conversations in one batched tokenizer call.
+
+        Prompts of offline jobs rarely repeat, so they bypass the encode cache.
+        """
+        prompts = [self.render_chat(messages) for messages in conversations]
+        template = bool(getattr(self.tokenizer, "chat_template", None))
+        return self._encode_many(prompts, not template, max_length, use_cache=False)
+
+    def encode_chat_incremental(self, messages, cached_tokens=None, cached_messages=0, add_generation_prompt=True):
+        """
+        Token IDs of `messages`, tokenizing only what follows an earlier rendering.
+
+        `cached_tokens` must be the output of this method for
+        `messages[:cached_messages]` with `add_generation_prompt=False`.
+        Tokenizing just the appended text would be wrong where tokens merge
+        across the old end (BPE) or where a piece at the start of a text gets
+        a "▁" prefix (SentencePiece), so the final cached message is encoded
+        again together with the new text. That restart point is only trusted
+        when the final message, encoded alone, gives exactly the cached tail;
+        otherwise everything is tokenized. No truncation: callers bound the history.
+        """
+        text = self.render_chat(messages, add_generation_prompt)
+        if cached_tokens is not None and len(cached_tokens) and cached_messages > 1:
+            cached_text = self.render_chat(messages[:cached_messages], add_generation_prompt=False)
+            start_text = self.render_chat(messages[:cached_messages - 1], add_generation_prompt=False)
+            if text.startswith(cached_text) and cached_text.startswith(start_text):
+                cached = cached_tokens.tolist() if hasattr(cached_tokens, "tolist") else list(cached_tokens)
+                last = self._encode_text(cached_text[len(start_text):], special_tokens=False)
+                start = len(cached) - len(last)
+                if start > 0 and cached[start:] == last:
+                    return cached[:start] + self._encode_text(text[len(start_text):], special_tokens=False)
+        return self._encode_text(text, special_tokens=not getattr(self.tokenizer, "chat_template", None))
+
+    def _encode_text(self, text, special_tokens):
+        if not text:
+            return []
+        return self._encode_many([text], special_tokens, None, use_cache=False)[0]
+
+    def _encode_many(self, texts, special_tokens, max_length, use_cache=True):
+        """
+        Token IDs of each text: cached ones from the LRU, the rest in one batched call.
+        """
+        results = [None] * len(texts)
+        misses = []
+        if use_cache and ENCODE_CACHE_SIZE > 0:
+            with self._cache_lock:
+                for i, text in enumerate(texts):
+                    cached = self._cache.get((text, special_tokens, max_length))
+                    if cached is None:
+                        misses.append(i)
+                    else:
+                        self._cache.move_to_end((text, special_tokens, max_length))
+                        results[i] = list(cached)
+                self.stats["cache_hits"] += len(texts) - len(misses)
+                self.stats["cache_misses"] += len(misses)
+        else:
+            misses = list(range(len(texts)))
+        if not misses:
+            return results
+
+        batch = [texts[i] for i in misses]
         if isinstance(self.tokenizer, spm.SentencePieceProcessor):
-            return self.tokenizer.encode(text, out_type=int)
-        return self.tokenizer.encode(text, truncation=True, padding=True, max_length=MAX_LENGTH)
+            encoded = self.tokenizer.encode(batch, out_type=int)
+            if max_length is not None:
+                encoded = [ids[:max_length] for ids in encoded]
+        else:
+            encoded = self.tokenizer(batch, add_special_tokens=special_tokens, truncation=max_length is not None,
+                                     max_length=max_length)["input_ids"]
+        self.stats["batch_calls"] += 1
+
+        with self._cache_lock:
+            for i, ids in zip(misses, encoded):
+                results[i] = list(ids)
+                if use_cache and ENCODE_CACHE_SIZE > 0 and len(texts[i]) <= ENCODE_CACHE_MAX_CHARS:
+                    self._cache[(texts[i], special_tokens, max_length)] = tuple(ids)
+            while len(self._cache) > ENCODE_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return results
 
     def decode(self, tokens):
         """
@@ -99,5 +315,55 @@ class Tokenizer:
         return self.tokenizer.decode(tokens, skip_special_tokens=True)
 
 
-# Instantiate global tokenizer
-tokenizer = Tokenizer()
+### 🌊 STREAMING DETOKENIZATION ###
+class IncrementalDetokenizer:
+    """
+    Turns a stream of generated token IDs into text deltas.
+
+    Decoding the whole output after every token costs O(n) per token. This
+    keeps two offsets instead: each step decodes only the tokens from
+    `prefix_offset` on (a handful) and emits what the newest tokens added.
+    Output ending in an incomplete multi-byte character ("\ufffd") is held
+    back until a later token completes it. The deltas add up to
+    `decode(all tokens)`, as the non-streaming path returns.
+    """
+
+    def __init__(self, tokenizer: Tokenizer):
+        self._decode = tokenizer.decode
+        self.tokens = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+        self._prefix_text = ""
+
+    def add(self, token_id) -> str:
+        """
+        Appends one token; returns the new text it completes (possibly "").
+        """
+        self.tokens.append(token_id)
+        text = self._decode(self.tokens[self.prefix_offset:])
+        if text.endswith("\ufffd") or len(text) <= len(self._prefix_text):
+            return ""
+        delta = text[len(self._prefix_text):]
+        # The window restarts at the previous read position
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.tokens)
+        self._prefix_text = self._decode(self.tokens[self.prefix_offset:self.read_offset])
+        return delta
+
+    def flush(self) -> str:
+        """
+        Returns text still held back at the end of the stream.
+        """
+        text = self._decode(self.tokens[self.prefix_offset:])
+        delta = text[len(self._prefix_text):] if len(text) > len(self._prefix_text) else ""
+        self.prefix_offset = self.read_offset = len(self.tokens)
+        self._prefix_text = ""
+        return delta
+
+
+def get_tokenizer() -> Tokenizer:
+    """
+    Returns the process-wide tokenizer held by the model registry.
+    """
+    from app.models.registry import model_registry
+    return model_registry.get("tokenizer")
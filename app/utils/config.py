@@ -27,6 +27,8 @@ class AppConfig(BaseSettings):
     USE_VLLM: bool = os.getenv("USE_VLLM", "true").lower() == "true"
     USE_DEEPSPEED: bool = os.getenv("USE_DEEPSPEED", "true").lower() == "true"
     MAX_TOKENS: int = int(os.getenv("MAX_TOKENS", 4096))
+    CPU_QUANTIZATION: str = os.getenv("CPU_QUANTIZATION", "int8")  # CPU-only nodes: int8, bf16 or none (fp32)
+    CPU_PARITY_CHECK: bool = os.getenv("CPU_PARITY_CHECK", "true").lower() == "true"  # Compare with fp32 at load
 
     # API Keys
     OPENAI_API_KEY: str = os.getenv("OPENAI_API_KEY", "your-default-key")
@@ -71,3 +71,10 @@ def get_logger(name="JC1-Logger"):
 # Initialize Logger
 logger = get_logger()
 logger.info("Logger initialized successfully.")
+
+
+def log_request(user_id: str, message: str):
+    """
+    Logs an incoming user request (message truncated to keep log lines small).
+    """
+    logger.info(f"Request from {user_id}: {message[:200]}")
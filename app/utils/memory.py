@@ -4,8 +4,11 @@ memory.py - Vector Database for Context Memory (RAG)
 🔹 Features:
 - Stores & retrieves conversation context using FAISS
 - Supports long-term memory for chat-based AI assistants
-- Uses vector embeddings for fast semantic search
+- Uses vector embeddings for fast semantic search, keyed by stable row ids
 - Integrates with LLM to maintain conversation history
+- Scored results; metadata for all hits is fetched in one query
+- Index persisted under DB_PATH (snapshots + add / delete log), memory-mapped at startup
+- Per-user chat sessions (messages + cached token ids) via the session store
 
 📌 Dependencies:
 - FAISS (for vector search)
@@ -14,31 +17,45 @@ memory.py - Vector Database for Context Memory (RAG)
 """
 
 import os
-import faiss
 import sqlite3
+import threading
 import numpy as np
-from sentence_transformers import SentenceTransformer
+from typing import Optional
+from app.core.context_window import context_builder
+from app.core.session_store import Session, session_store
+from app.core.vector_store import VectorIndex, fetch_rows
+from app.models.registry import model_registry
+from app.utils.logger import logger
 
 ### 🔧 CONFIGURATION ###
 DB_PATH = "data/embeddings/memory_index"
 METADATA_DB = "data/embeddings/memory_metadata.db"
-EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
-
-# Initialize embedding model
-embedder = SentenceTransformer(EMBEDDING_MODEL)
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"  # Shared "embedder" in the model registry
+SYNC_BATCH_SIZE = 10000  # Stored vectors added to the index per batch when catching up with SQLite
 
 
 ### 🧠 MEMORY INDEX SETUP ###
 class MemoryDB:
     """
     Manages conversation memory using FAISS vector storage.
+
+    Vectors are stored under their SQLite row id, so deletes never shift
+    the mapping between index entries and memories. With an `index_path`
+    the index is reopened from its snapshot and log at startup; entries it
+    has not seen yet are added from the vectors stored in SQLite.
     """
 
-    def __init__(self, vector_dim=384):
+    def __init__(self, vector_dim=384, metadata_db: str = METADATA_DB, embedder=None,
+                 index_path: Optional[str] = DB_PATH):
         self.vector_dim = vector_dim
-        self.index = faiss.IndexFlatL2(vector_dim)  # L2 Distance-based FAISS Index
-        self.metadata_conn = sqlite3.connect(METADATA_DB)
+        self.index = VectorIndex(vector_dim, path=index_path)
+        if os.path.dirname(metadata_db):
+            os.makedirs(os.path.dirname(metadata_db), exist_ok=True)
+        self.metadata_conn = sqlite3.connect(metadata_db, check_same_thread=False)
+        self._embedder = embedder
+        self._lock = threading.Lock()
         self._setup_db()
+        self._sync_index()
 
     def _setup_db(self):
         """Initialize metadata database for mapping conversations."""
@@ -55,42 +72,124 @@ class MemoryDB:
         )
         self.metadata_conn.commit()
 
-    def add_memory(self, conversation_id: str, text: str):
+    def _sync_index(self):
+        """Adds memories newer than the index's last id from their stored vectors (no re-embedding)."""
+        cursor = self.metadata_conn.execute(
+            "SELECT id, vector FROM memory WHERE id > ? ORDER BY id", (self.index.max_id,)
+        )
+        added = 0
+        while True:
+            rows = cursor.fetchmany(SYNC_BATCH_SIZE)
+            if not rows:
+                break
+            vectors = np.frombuffer(b"".join(row[1] for row in rows), dtype=np.float32)
+            self.index.add([row[0] for row in rows], vectors.reshape(len(rows), self.vector_dim), snapshot=False)
+            added += len(rows)
+        self.index.maybe_snapshot()  # One snapshot for the whole catch-up, if it outgrew the delta
+        if added:
+            logger.info(f"✅ Added {added} stored memories missing from the vector index.")
+
+    def _embed(self, text: str) -> np.ndarray:
+        """Embeds one text with the injected embedder, else the registry's shared one."""
+        if self._embedder is not None:
+            vectors = self._embedder.encode([text])
+        else:
+            with model_registry.use("embedder") as embedder:
+                vectors = embedder.encode([text])
+        return np.asarray(vectors, dtype=np.float32).reshape(self.vector_dim)
+
+    def add_memory(self, conversation_id: str, text: str) -> int:
         """
-        Stores text & its vector embedding in memory.
+        Stores text & its vector embedding in memory; returns the memory id.
         """
-        vector = embedder.encode([text])[0].astype(np.float32)
-        self.index.add(np.array([vector]))  # Add vector to FAISS
-        cursor = self.metadata_conn.cursor()
-        cursor.execute(
-            "INSERT INTO memory (text, vector, conversation_id) VALUES (?, ?, ?)",
-            (text, vector.tobytes(), conversation_id),
-        )
-        self.metadata_conn.commit()
+        vector = self._embed(text)
+        with self._lock:
+            cursor = self.metadata_conn.cursor()
+            cursor.execute(
+                "INSERT INTO memory (text, vector, conversation_id) VALUES (?, ?, ?)",
+                (text, vector.tobytes(), conversation_id),
+            )
+            self.metadata_conn.commit()
+            self.index.add([cursor.lastrowid], vector)  # Add vector to FAISS under its row id
+        return cursor.lastrowid
+
+    def delete_memory(self, memory_id: int) -> bool:
+        """Removes a memory entry and its vector; returns False if it did not exist."""
+        with self._lock:
+            cursor = self.metadata_conn.execute("DELETE FROM memory WHERE id=?", (memory_id,))
+            self.metadata_conn.commit()
+            self.index.remove([memory_id])
+        return cursor.rowcount > 0
+
+    def search_memory(self, query: str, top_k=5) -> list:
+        """
+        Top-k memory entries for a query, closest first.
+
+        Returns:
+            list: {"id", "text", "conversation_id", "distance"} dicts (squared L2; lower is closer).
+        """
+        query_vector = self._embed(query)
+        with self._lock:
+            hits = self.index.search(query_vector, top_k)  # FAISS search
+            rows = fetch_rows(self.metadata_conn, "memory", ("text", "conversation_id"), [i for i, _ in hits])
+        return [{"id": memory_id, "text": rows[memory_id][0], "conversation_id": rows[memory_id][1],
+                 "distance": distance} for memory_id, distance in hits if memory_id in rows]
 
     def retrieve_memory(self, query: str, top_k=5):
         """
         Retrieves top-k most relevant memory entries for a given query.
         """
-        query_vector = embedder.encode([query])[0].astype(np.float32)
-        D, I = self.index.search(np.array([query_vector]), top_k)  # FAISS search
-        results = []
-        cursor = self.metadata_conn.cursor()
-        for idx in I[0]:
-            if idx == -1:
-                continue  # No match found
-            cursor.execute("SELECT text FROM memory WHERE id=?", (idx + 1,))
-            result = cursor.fetchone()
-            if result:
-                results.append(result[0])
-        return results
+        return [hit["text"] for hit in self.search_memory(query, top_k)]
 
     def clear_memory(self):
         """Clears all stored conversation memory."""
-        self.index.reset()
-        cursor = self.metadata_conn.cursor()
-        cursor.execute("DELETE FROM memory")
-        self.metadata_conn.commit()
+        with self._lock:
+            self.metadata_conn.execute("DELETE FROM memory")
+            self.metadata_conn.commit()
+            self.index.reset()
+
+    def close(self):
+        """Snapshots the vector index and closes the metadata database."""
+        with self._lock:
+            self.index.close()
+            self.metadata_conn.close()
+
+
+### 💬 CHAT SESSIONS ###
+def retrieve_session(user_id: str) -> Session:
+    """
+    Returns the user's chat session (messages and their cached token ids).
+    """
+    return session_store.load(user_id)
+
+
+def retrieve_context(user_id: str) -> list:
+    """
+    Returns the user's conversation history (empty for new or expired sessions).
+    """
+    return retrieve_session(user_id).messages
+
+
+def store_context(user_id: str, history: list, previous: Session = None) -> Session:
+    """
+    Stores the updated conversation history; only turns added since `previous`
+    (default: the stored session) are tokenized.
+
+    When the store trims old turns the remaining ones move to new indices, so
+    the context builder's remembered window start for the user is dropped.
+    """
+    session = session_store.save(user_id, history, previous)
+    if len(session.messages) < len(history):
+        context_builder.forget(user_id)
+    return session
+
+
+def clear_context(user_id: str):
+    """
+    Forgets the user's conversation history.
+    """
+    session_store.delete(user_id)
+    context_builder.forget(user_id)
 
 
 ### 🛠️ EXAMPLE USAGE ###
@@ -5,6 +5,7 @@ security.py - Security & Access Control Module
 - JWT-based authentication for API access
 - Password hashing & verification using bcrypt
 - Role-based access control (RBAC)
+- Role weights for per-tenant fair scheduling
 - AES encryption for sensitive data
 
 📌 Dependencies:
@@ -18,6 +19,7 @@ import os
 import jwt
 import bcrypt
 from datetime import datetime, timedelta
+from typing import Optional, Tuple
 from cryptography.fernet import Fernet
 
 # Load security settings
@@ -90,6 +92,38 @@ def check_permission(role: str, action: str) -> bool:
     return action in ROLES_PERMISSIONS.get(role, [])
 
 
+### ⚖️ FAIR-SHARE WEIGHTS ###
+ROLE_WEIGHTS = {
+    "admin": 4.0,
+    "editor": 2.0,
+    "user": 1.0,
+}
+
+
+def get_role_weight(role: str) -> float:
+    """
+    Returns the scheduling weight of a role (unknown roles get the "user" weight).
+    """
+    return ROLE_WEIGHTS.get(role, ROLE_WEIGHTS["user"])
+
+
+ANONYMOUS_TENANT = "anonymous"  # Shared by every caller without a valid JWT
+
+
+def resolve_tenant(authorization: Optional[str]) -> Tuple[str, str]:
+    """
+    Returns (tenant id, role) from a "Bearer <JWT>" header.
+
+    Callers without a valid token all share ANONYMOUS_TENANT as plain "user"s,
+    so picking a new user_id per request cannot buy extra fair-share turns.
+    """
+    if authorization and authorization.lower().startswith("bearer "):
+        payload = verify_jwt_token(authorization[7:].strip())
+        if "error" not in payload:
+            return payload["user_id"], payload.get("role", "user")
+    return ANONYMOUS_TENANT, "user"
+
+
 ### 🔐 AES ENCRYPTION ###
 def encrypt_data(data: str) -> str:
     """
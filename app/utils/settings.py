@@ -0,0 +1,143 @@
+"""
+settings.py - settings.yaml as Environment Defaults
+----------------------------------------------------
+🔹 Features:
+- Reads configs/settings.yaml (or SETTINGS_FILE) once, when the `app` package is imported
+- Every mapped key becomes the default of its environment variable, so the
+  modules' `os.getenv(...)` constants pick it up; variables already set win
+- One table maps `section.key` to the variable named in the key's comment
+
+📌 Dependencies:
+- PyYAML
+"""
+
+import os
+from typing import Dict
+
+import yaml
+
+### 🔧 CONFIGURATION ###
+SETTINGS_FILE = os.getenv(
+    "SETTINGS_FILE",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                 "configs", "settings.yaml"),
+)
+
+# settings.yaml key → environment variable read by the module that uses it
+SETTINGS_ENV = {
+    "models.tokenizer_cache_size": "TOKENIZER_CACHE_SIZE",
+    "models.tokenizer_cache_max_chars": "TOKENIZER_CACHE_MAX_CHARS",
+    "models.asr_model": "ASR_MODEL_NAME",
+    "models.warmup": "WARMUP_MODELS",
+    "models.pinned": "PINNED_MODELS",
+    "models.ram_budget_mb": "MODEL_RAM_BUDGET_MB",
+    "models.vram_budget_mb": "MODEL_VRAM_BUDGET_MB",
+    "models.cpu_quantization": "CPU_QUANTIZATION",
+    "models.cpu_parity_check": "CPU_PARITY_CHECK",
+    "models.parity_max_kl": "PARITY_MAX_KL",
+    "models.eviction_policy": "MODEL_EVICTION_POLICY",
+    "inference.batch_size": "BATCH_SIZE",
+    "inference.max_batch_wait_ms": "MAX_BATCH_WAIT_MS",
+    "inference.speculative_decoding": "USE_SPECULATIVE",
+    "inference.draft_model": "DRAFT_MODEL_NAME",
+    "inference.speculative_k": "SPECULATIVE_K",
+    "inference.speculative_min_acceptance": "SPECULATIVE_MIN_ACCEPTANCE",
+    "inference.max_samples": "MAX_SAMPLES",
+    "storage.vector_index_type": "VECTOR_INDEX_TYPE",
+    "storage.vector_train_min": "VECTOR_TRAIN_MIN",
+    "storage.ivf_nlist": "VECTOR_IVF_NLIST",
+    "storage.retrain_growth": "VECTOR_RETRAIN_GROWTH",
+    "storage.pq_m": "VECTOR_PQ_M",
+    "storage.pq_bits": "VECTOR_PQ_BITS",
+    "storage.hnsw_m": "VECTOR_HNSW_M",
+    "storage.hnsw_ef_construction": "VECTOR_HNSW_EF_CONSTRUCTION",
+    "storage.nprobe": "VECTOR_NPROBE",
+    "storage.ef_search": "VECTOR_EF_SEARCH",
+    "storage.snapshot_every": "VECTOR_SNAPSHOT_EVERY",
+    "storage.delta_max": "VECTOR_DELTA_MAX",
+    "storage.ingest_batch_size": "INGEST_BATCH_SIZE",
+    "storage.ingest_workers": "INGEST_WORKERS",
+    "storage.ingest_commit_every": "INGEST_COMMIT_EVERY",
+    "storage.ingest_chunking": "INGEST_CHUNKING",
+    "storage.chunk_max_tokens": "CHUNK_MAX_TOKENS",
+    "storage.chunk_overlap_tokens": "CHUNK_OVERLAP_TOKENS",
+    "storage.ingest_dedup": "INGEST_DEDUP",
+    "storage.dedup_threshold": "DEDUP_THRESHOLD",
+    "storage.dedup_num_perm": "DEDUP_NUM_PERM",
+    "storage.dedup_bands": "DEDUP_BANDS",
+    "cache.cache_size": "CACHE_SIZE",
+    "cache.max_memory_mb": "CACHE_MAX_MB",
+    "cache.sweep_interval": "CACHE_SWEEP_INTERVAL",
+    "cache.l1_ttl": "CACHE_L1_TTL",
+    "cache.response_cache_ttl": "RESPONSE_CACHE_TTL",
+    "cache.model_version": "MODEL_VERSION",
+    "cache.prefix_cache_mb": "PREFIX_CACHE_MB",
+    "cache.paged_kv_mb": "PAGED_KV_MB",
+    "cache.paged_kv_gather_mb": "PAGED_KV_GATHER_MB",
+    "cache.kv_block_size": "KV_BLOCK_SIZE",
+    "sessions.ttl": "SESSION_TTL",
+    "sessions.max_messages": "SESSION_MAX_MESSAGES",
+    "sessions.compress_min_bytes": "SESSION_COMPRESS_MIN_BYTES",
+    "context_window.token_budget": "CONTEXT_TOKEN_BUDGET",
+    "context_window.memory_budget": "CONTEXT_MEMORY_BUDGET",
+    "context_window.memory_top_k": "CONTEXT_MEMORY_TOP_K",
+    "context_window.trim_ratio": "CONTEXT_TRIM_RATIO",
+    "constrained_decoding.grammar_cache_size": "GRAMMAR_CACHE_SIZE",
+    "constrained_decoding.max_states": "GRAMMAR_MAX_STATES",
+    "constrained_decoding.max_repeat": "GRAMMAR_MAX_REPEAT",
+    "constrained_decoding.json_depth": "GRAMMAR_JSON_DEPTH",
+    "semantic_cache.enabled": "SEMANTIC_CACHE_ENABLED",
+    "semantic_cache.threshold": "SEMANTIC_CACHE_THRESHOLD",
+    "semantic_cache.max_entries": "SEMANTIC_CACHE_SIZE",
+    "semantic_cache.ttl": "SEMANTIC_CACHE_TTL",
+    "admission.max_inflight_tokens": "ADMISSION_MAX_INFLIGHT_TOKENS",
+    "admission.max_queue": "ADMISSION_MAX_QUEUE",
+    "admission.max_queue_per_tenant": "ADMISSION_MAX_QUEUE_PER_TENANT",
+    "admission.fair_queue_quantum": "FAIR_QUEUE_QUANTUM",
+    "admission.queue_timeout": "ADMISSION_QUEUE_TIMEOUT",
+    "admission.image_tokens_per_mb": "IMAGE_TOKENS_PER_MB",
+    "admission.audio_tokens_per_mb": "AUDIO_TOKENS_PER_MB",
+    "batch_jobs.jobs_dir": "BATCH_JOBS_DIR",
+    "batch_jobs.max_inflight": "BATCH_JOB_MAX_INFLIGHT",
+    "batch_jobs.sort_window": "BATCH_JOB_SORT_WINDOW",
+    "batch_jobs.max_tokens": "BATCH_JOB_MAX_TOKENS",
+    "batch_jobs.auto_resume": "BATCH_JOBS_AUTO_RESUME",
+}
+
+
+def settings_env(settings: dict) -> Dict[str, str]:
+    """The environment defaults a parsed settings.yaml defines: {variable: value}."""
+    env = {}
+    for key, variable in SETTINGS_ENV.items():
+        section, _, name = key.partition(".")
+        value = (settings.get(section) or {}).get(name)
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            value = "true" if value else "false"
+        elif isinstance(value, (list, tuple)):
+            value = ",".join(str(v) for v in value)
+        env[variable] = str(value)
+    return env
+
+
+def load_settings(path: str = SETTINGS_FILE) -> Dict[str, str]:
+    """
+    Sets settings.yaml values as defaults of their environment variables.
+
+    Must run before the modules reading them are imported (see `app/__init__.py`).
+    A missing file is not an error: the modules' own defaults apply.
+
+    Returns:
+        dict: The variables that were set from the file.
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        settings = yaml.safe_load(f) or {}
+    applied = {}
+    for variable, value in settings_env(settings).items():
+        if variable not in os.environ:
+            os.environ[variable] = value
+            applied[variable] = value
+    return applied
@@ -2,6 +2,7 @@ import faiss
 import numpy as np
 import os
 import pickle
+from app.core.vector_store import VECTOR_EF_SEARCH, VECTOR_INDEX_TYPE, VECTOR_NPROBE, create_index
 
 EMBEDDINGS_DIR = "data/embeddings"
 INDEX_FILE = os.path.join(EMBEDDINGS_DIR, "faiss_index.bin")
@@ -19,7 +20,9 @@ def save_embeddings(vectors, metadata):
         os.makedirs(EMBEDDINGS_DIR)
 
     d = vectors.shape[1]  # Dimensionality of vectors
-    index = faiss.IndexFlatL2(d)
+    index = create_index(VECTOR_INDEX_TYPE, d, len(vectors))  # Exact unless VECTOR_INDEX_TYPE says otherwise
+    if not index.is_trained:
+        index.train(vectors)
     index.add(vectors)
 
     faiss.write_index(index, INDEX_FILE)
@@ -32,13 +35,17 @@ def load_embeddings():
     Loads FAISS index and metadata.
     
     Returns:
-        index (faiss.IndexFlatL2): FAISS index object.
+        index (faiss.Index): FAISS index object.
         metadata (list): List of metadata associated with embeddings.
     """
     if not os.path.exists(INDEX_FILE) or not os.path.exists(METADATA_FILE):
         return None, None
 
     index = faiss.read_index(INDEX_FILE)
+    if isinstance(index, faiss.IndexIVF):
+        index.nprobe = VECTOR_NPROBE
+    elif isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = VECTOR_EF_SEARCH
 
     with open(METADATA_FILE, "rb") as f:
         metadata = pickle.load(f)
@@ -0,0 +1,66 @@
+"""
+batch_infer.py - Offline Batch Inference CLI
+---------------------------------------------
+Runs a JSONL file of prompts through the local model without the API server.
+
+    python scripts/batch_infer.py prompts.jsonl results.jsonl --max-tokens 256
+    python scripts/batch_infer.py --resume data/batch_jobs/<job id>
+
+Each input line holds `prompt` or `messages` (plus optional `id`,
+`max_tokens`, `temperature`); results are appended to the output as they
+complete. After a crash, `--resume` continues where the job stopped.
+"""
+
+import os
+import sys
+import asyncio
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.core.batch_jobs import BATCH_JOB_MAX_INFLIGHT, BATCH_JOB_MAX_TOKENS, BatchJob, BatchJobManager
+
+PROGRESS_INTERVAL = 5.0  # Seconds between progress lines
+
+
+async def run_with_progress(manager: BatchJobManager, job: BatchJob):
+    task = asyncio.create_task(manager.run(job))
+    while not task.done():
+        await asyncio.wait([task], timeout=PROGRESS_INTERVAL)
+        p = job.progress()
+        eta = f", ETA {p['eta_seconds']:.0f}s" if p["eta_seconds"] is not None else ""
+        print(f"📊 {p['completed']}/{p['total']} ({p['percent']}%), {p['failed']} failed, "
+              f"{p['requests_per_second']} req/s, {p['tokens_per_second']} tokens/s{eta}", flush=True)
+    return task.result()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a JSONL file of prompts through the JC1 model.")
+    parser.add_argument("input", nargs="?", help="Input JSONL file")
+    parser.add_argument("output", nargs="?", help="Output JSONL file (default: inside the job directory)")
+    parser.add_argument("--resume", metavar="JOB_DIR", help="Continue an interrupted job from its directory")
+    parser.add_argument("--max-tokens", type=int, default=BATCH_JOB_MAX_TOKENS)
+    parser.add_argument("--temperature", type=float, default=0.0)
+    parser.add_argument("--max-inflight", type=int, default=BATCH_JOB_MAX_INFLIGHT,
+                        help="Prompts in the scheduler at once (use the batch size or more offline)")
+    args = parser.parse_args()
+
+    if args.resume:
+        job = BatchJob.load(args.resume)
+        manager = BatchJobManager(jobs_dir=os.path.dirname(os.path.abspath(args.resume)),
+                                  max_inflight=args.max_inflight)
+    elif args.input:
+        manager = BatchJobManager(max_inflight=args.max_inflight)
+        job = manager.create(input_path=args.input, output_path=args.output, max_tokens=args.max_tokens,
+                             temperature=args.temperature)
+        print(f"🚀 Job {job.id}: {job.total} prompts (resume with --resume {job.directory})")
+    else:
+        parser.error("an input file or --resume is required")
+
+    job = asyncio.run(run_with_progress(manager, job))
+    print(f"✅ Job {job.id} {job.status}: results in {job.output_path}")
+    sys.exit(0 if job.status == "completed" else 1)
+
+
+if __name__ == "__main__":
+    main()
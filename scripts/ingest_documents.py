@@ -0,0 +1,73 @@
+"""
+ingest_documents.py - Bulk Document Ingestion CLI
+--------------------------------------------------
+Embeds and stores a corpus in the retriever's database and vector index.
+
+    python scripts/ingest_documents.py corpus.jsonl docs/ --batch-size 512 --workers 4
+
+JSONL lines hold `text` (plus an optional `source`); other files are one
+document each, directories are walked for .jsonl / .txt / .md. Long
+documents are chunked and duplicate chunks dropped before embedding.
+Rerunning the same command after a crash continues after the last
+committed batch.
+"""
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.core.ingest import (INGEST_BATCH_SIZE, INGEST_CHUNKING, INGEST_COMMIT_EVERY, INGEST_DEDUP, INGEST_WORKERS,
+                             BulkIngester)
+from app.core.retriever import DB_PATH, METADATA_DB, DocumentRetriever
+
+PROGRESS_INTERVAL = 5.0  # Seconds between progress lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk-ingest documents into the JC1 retriever.")
+    parser.add_argument("paths", nargs="+", help="JSONL / text files or directories")
+    parser.add_argument("--db", default=METADATA_DB, help="Document metadata database")
+    parser.add_argument("--index", default=DB_PATH, help="Vector index directory")
+    parser.add_argument("--dim", type=int, default=384, help="Embedding size of the model")
+    parser.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE, help="Texts per embedding call")
+    parser.add_argument("--workers", type=int, default=INGEST_WORKERS,
+                        help="Embedding processes on CPU (0 = in-process, e.g. on a GPU)")
+    parser.add_argument("--commit-every", type=int, default=INGEST_COMMIT_EVERY,
+                        help="Documents per transaction (and resume granularity)")
+    parser.add_argument("--no-chunking", action="store_true", default=not INGEST_CHUNKING,
+                        help="Embed documents whole (the model truncates long ones)")
+    parser.add_argument("--no-dedup", action="store_true", default=not INGEST_DEDUP,
+                        help="Keep exact and near-duplicate chunks")
+    args = parser.parse_args()
+
+    retriever = DocumentRetriever(args.dim, args.db, index_path=args.index)
+    ingester = BulkIngester(retriever, batch_size=args.batch_size, workers=args.workers,
+                            commit_every=args.commit_every, chunking=not args.no_chunking, dedup=not args.no_dedup)
+    last_print = 0.0
+
+    def report(stats: dict):
+        nonlocal last_print
+        if time.time() - last_print >= PROGRESS_INTERVAL:
+            last_print = time.time()
+            print(f"📊 {stats['documents']} chunks of {stats['records']} documents, {stats['docs_per_second']} chunks/s "
+                  f"(embedding {stats['embed_seconds']:.0f}s, storing {stats['store_seconds']:.0f}s)", flush=True)
+
+    try:
+        stats = ingester.ingest(args.paths, on_progress=report)
+    finally:
+        retriever.close()
+    resumed = f", resumed {stats['resumed_files']} files" if stats["resumed_files"] else ""
+    print(f"✅ {stats['documents']} chunks of {stats['records']} documents in {stats['seconds']:.1f}s "
+          f"({stats['docs_per_second']} chunks/s{resumed})")
+    dropped = stats["exact_duplicates"] + stats["near_duplicates"]
+    if dropped:
+        print(f"♻️ {stats['exact_duplicates']} exact + {stats['near_duplicates']} near duplicates dropped: "
+              f"{stats['index_bytes_saved'] / 1e6:.1f} MB of index, "
+              f"~{stats['embed_seconds_saved']:.1f}s of embedding saved")
+
+
+if __name__ == "__main__":
+    main()
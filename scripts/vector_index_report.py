@@ -0,0 +1,63 @@
+"""
+vector_index_report.py - Recall@k vs Latency of the Vector Index Types
+-----------------------------------------------------------------------
+Builds each index type over the document vectors stored in SQLite and
+measures recall@k against exact search for a sweep of nprobe / efSearch.
+
+    python scripts/vector_index_report.py --types ivf_flat,ivf_pq,hnsw --top-k 10
+
+Use the table to pick VECTOR_INDEX_TYPE and VECTOR_NPROBE / VECTOR_EF_SEARCH.
+"""
+
+import os
+import sys
+import time
+import sqlite3
+import argparse
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.core.retriever import METADATA_DB
+from app.core.vector_store import INDEX_TYPES, VectorIndex, recall_report
+
+
+def load_vectors(path: str):
+    conn = sqlite3.connect(path)
+    rows = conn.execute("SELECT id, vector FROM documents").fetchall()
+    conn.close()
+    ids = np.array([row[0] for row in rows], dtype=np.int64)
+    vectors = np.frombuffer(b"".join(row[1] for row in rows), dtype=np.float32).reshape(len(rows), -1)
+    return ids, vectors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall@k versus latency of FAISS index types.")
+    parser.add_argument("--db", default=METADATA_DB, help="Document metadata database")
+    parser.add_argument("--types", default="ivf_flat,ivf_pq,hnsw", help=f"Comma-separated: {', '.join(INDEX_TYPES)}")
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=200, help="Stored documents sampled as queries")
+    parser.add_argument("--settings", help="Comma-separated nprobe / efSearch values (default: a standard sweep)")
+    args = parser.parse_args()
+
+    ids, vectors = load_vectors(args.db)
+    if not len(ids):
+        parser.error(f"no document vectors in {args.db}")
+    sample = np.random.default_rng(0).choice(len(ids), min(args.queries, len(ids)), replace=False)
+    settings = [int(v) for v in args.settings.split(",")] if args.settings else None
+    print(f"📊 {len(ids)} vectors of dim {vectors.shape[1]}, {len(sample)} queries, recall@{args.top_k}")
+
+    for index_type in args.types.split(","):
+        start = time.time()
+        index = VectorIndex(vectors.shape[1], index_type.strip(), train_min=0)
+        index.add(ids, vectors)
+        print(f"\n{index_type} (built in {time.time() - start:.1f}s)")
+        print(f"{'setting':>10} {'value':>6} {'recall':>7} {'latency ms':>11}")
+        for row in recall_report(index, ids, vectors, vectors[sample], args.top_k, settings):
+            value = "" if row["value"] is None else row["value"]
+            print(f"{row['setting']:>10} {value:>6} {row['recall']:>7.4f} {row['latency_ms']:>11.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+import time
+import pytest
+import numpy as np
+import torch
+from tokenizers import Tokenizer as RustTokenizer, models, pre_tokenizers
+from transformers import GPT2Config, GPT2LMHeadModel, PreTrainedTokenizerFast
+
+def make_word_tokenizer():
+    """Offline fast tokenizer with one token per word or punctuation mark (offsets included)."""
+    rust = RustTokenizer(models.WordLevel({"[UNK]": 0}, unk_token="[UNK]"))
+    rust.pre_tokenizer = pre_tokenizers.Whitespace()
+    return PreTrainedTokenizerFast(tokenizer_object=rust, unk_token="[UNK]")
+
+class BagOfWordsEmbedder:
+    """
+    Stand-in for the SentenceTransformer: hashed bag of lower-cased words, 32 dims.
+
+    `fail_after` encode calls it raises; `delay` seconds are spent per call.
+    """
+    def __init__(self, fail_after=None, delay=0.0):
+        self.calls = 0
+        self.fail_after = fail_after
+        self.delay = delay
+        self.tokenizer = make_word_tokenizer()
+
+    def encode(self, texts, batch_size=32):
+        self.calls += 1
+        if self.fail_after is not None and self.calls > self.fail_after:
+            raise RuntimeError("embedder crashed")
+        time.sleep(self.delay)
+        vectors = np.zeros((len(texts), 32), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in text.lower().replace("?", "").replace(".", "").split():
+                vectors[row, sum(map(ord, word)) % 32] += 1.0
+        return vectors
+
+@pytest.fixture
+def word_tokenizer():
+    """A fresh word-level tokenizer (see make_word_tokenizer)."""
+    return make_word_tokenizer()
+
+@pytest.fixture(scope="session")
+def bag_of_words():
+    """The BagOfWordsEmbedder class, to construct with its options or pass as an embedder factory."""
+    return BagOfWordsEmbedder
+
+@pytest.fixture(scope="session")
+def tiny_gpt2():
+    """Builds randomly initialised GPT-2s small enough to run instantly on CPU."""
+    def build(seed=0, n_layer=2, vocab_size=64, n_positions=128):
+        torch.manual_seed(seed)
+        config = GPT2Config(n_layer=n_layer, n_embd=32, n_head=2, vocab_size=vocab_size, n_positions=n_positions,
+                            bos_token_id=0, eos_token_id=0)
+        return GPT2LMHeadModel(config).eval()
+    return build
+
+@pytest.fixture(scope="module")
+def tiny_model(tiny_gpt2):
+    """A randomly initialised 2-layer GPT-2 that runs instantly on CPU."""
+    return tiny_gpt2()
+
+@pytest.fixture(scope="session")
+def greedy_reference():
+    """Greedy decoding without any KV cache, one sequence at a time."""
+    def decode(model, prompt, max_new_tokens):
+        ids = list(prompt)
+        with torch.no_grad():
+            for _ in range(max_new_tokens):
+                ids.append(int(model(torch.tensor([ids])).logits[0, -1].argmax()))
+        return ids[len(prompt):]
+    return decode
@@ -0,0 +1,87 @@
+import asyncio
+import pytest
+from app.core.admission import AdmissionController, AdmissionRejected, estimate_chat_cost, estimate_media_cost
+
+def test_cost_estimates():
+    """Chat cost covers prompt and max_tokens; media cost scales with upload size."""
+    assert estimate_chat_cost("x" * 400, 200) == 301
+    assert estimate_media_cost(2 * 1024 * 1024, 512) == 1024
+    assert estimate_media_cost(None, 512) == 1
+
+def test_requests_queue_until_budget_frees():
+    """Over budget, requests wait in FIFO order and are admitted as capacity returns."""
+    controller = AdmissionController(max_inflight_tokens=100, max_queue=10, queue_timeout=5)
+    order = []
+
+    async def request(name, cost, hold):
+        async with controller.admit(cost):
+            order.append(name)
+            await asyncio.sleep(hold)
+
+    async def run():
+        first = asyncio.create_task(request("a", 80, 0.05))
+        await asyncio.sleep(0)
+        rest = [asyncio.create_task(request(n, 50, 0.01)) for n in ("b", "c")]
+        await asyncio.sleep(0.01)
+        assert controller.queue_depth == 2 and controller.inflight_tokens == 80
+        await asyncio.gather(first, *rest)
+
+    asyncio.run(run())
+    assert order == ["a", "b", "c"]
+    stats = controller.get_stats()
+    assert stats["queued"] == 2 and stats["admitted"] == 3
+    assert stats["inflight_tokens"] == 0 and stats["queue_depth"] == 0
+    assert stats["max_queue_wait_seconds"] > 0
+
+def test_overload_is_shed_with_retry_after():
+    """A full queue or a missed deadline raises a 429 with Retry-After."""
+    controller = AdmissionController(max_inflight_tokens=100, max_queue=1, queue_timeout=0.05)
+
+    async def run():
+        await controller.acquire(100)
+        waiting = asyncio.create_task(controller.acquire(10))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as full:
+            await controller.acquire(10)
+        with pytest.raises(AdmissionRejected) as timeout:
+            await waiting
+        return full.value, timeout.value
+
+    full, timeout = asyncio.run(run())
+    assert full.status_code == 429 and full.reason == "queue full"
+    assert timeout.reason == "queue timeout"
+    assert int(timeout.headers["Retry-After"]) >= 1
+    stats = controller.get_stats()
+    assert stats["rejected_queue_full"] == 1 and stats["rejected_timeout"] == 1
+    assert stats["queue_depth"] == 0 and stats["inflight_tokens"] == 100
+
+def test_cancel_after_timeout_returns_no_budget():
+    """A waiter rejected by its deadline and cancelled in the same loop iteration never held tokens."""
+    controller = AdmissionController(max_inflight_tokens=100, queue_timeout=5)
+
+    async def run():
+        await controller.acquire(100)
+        waiting = asyncio.create_task(controller.acquire(50))
+        await asyncio.sleep(0)
+        controller._expire(controller._waiters.peek())
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+
+    asyncio.run(run())
+    stats = controller.get_stats()
+    assert stats["inflight_tokens"] == 100 and stats["inflight_requests"] == 1
+    assert stats["queue_depth"] == 0 and stats["queued_tokens"] == 0 and stats["abandoned"] == 1
+    controller.release(100)
+    assert controller.inflight_tokens == 0 and controller.inflight_requests == 0
+
+def test_oversized_request_runs_alone():
+    """A request larger than the whole budget is admitted once nothing else runs."""
+    controller = AdmissionController(max_inflight_tokens=10, queue_timeout=1)
+
+    async def run():
+        await controller.acquire(500)
+        controller.release(500)
+        return controller.get_stats()
+
+    assert asyncio.run(run())["admitted"] == 1
@@ -24,3 +24,8 @@ def test_speech_endpoint():
     response = client.post("/api/speech", files=files)
     assert response.status_code == 200
     assert "transcript" in response.json()
+
+def test_chat_stream_rejects_logprobs():
+    """Streaming cannot return log-probabilities, so asking for them is a 400."""
+    response = client.post("/api/chat/chat/stream", json={"message": "Hello JC1!", "logprobs": True})
+    assert response.status_code == 400
@@ -0,0 +1,97 @@
+import json
+import asyncio
+from app.core.batch_jobs import BatchJob, BatchJobManager
+
+class WordTokenizer:
+    """Stand-in for the Tokenizer wrapper: one id per word of the last message."""
+    def encode_chat_batch(self, conversations):
+        return [[1] * len(messages[-1]["content"].split()) for messages in conversations]
+
+def write_input(path, prompts):
+    with open(path, "w") as f:
+        for i, prompt in enumerate(prompts):
+            f.write(json.dumps({"id": f"p{i}", "prompt": prompt}) + "\n")
+
+def read_output(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+def make_manager(tmp_path, generate, **kwargs):
+    return BatchJobManager(jobs_dir=str(tmp_path / "jobs"), generate=generate, tokenizer=WordTokenizer(), **kwargs)
+
+def test_job_runs_shortest_prompts_first_as_batch_traffic(tmp_path):
+    """Prompts are submitted sorted by token length, with the batch priority class."""
+    seen = []
+
+    async def generate(messages, prompt_tokens, max_tokens, temperature, share):
+        seen.append((len(prompt_tokens), share.priority))
+        return messages[-1]["content"].upper(), 2
+
+    input_path = tmp_path / "in.jsonl"
+    write_input(input_path, ["a b c d", "a", "a b", "a b c"])
+    manager = make_manager(tmp_path, generate, max_inflight=1)
+    job = manager.create(input_path=str(input_path))
+    asyncio.run(manager.run(job))
+
+    assert [length for length, _ in seen] == [1, 2, 3, 4]
+    assert {priority for _, priority in seen} == {"batch"}
+    results = {r["id"]: r for r in read_output(job.output_path)}
+    assert results["p0"]["response"] == "A B C D" and results["p0"]["prompt_tokens"] == 4
+    progress = job.progress()
+    assert progress["status"] == "completed" and progress["completed"] == 4 and progress["completion_tokens"] == 8
+
+def test_job_resumes_from_its_output_after_a_crash(tmp_path):
+    """Finished ids are skipped, a torn last line is dropped, and progress is recounted."""
+    calls = []
+
+    async def generate(messages, prompt_tokens, max_tokens, temperature, share):
+        calls.append(messages[-1]["content"])
+        return "ok", 1
+
+    input_path = tmp_path / "in.jsonl"
+    write_input(input_path, ["one", "two", "three"])
+    manager = make_manager(tmp_path, generate)
+    job = manager.create(input_path=str(input_path))
+    with open(job.output_path, "w") as f:
+        f.write(json.dumps({"id": "p0", "response": "ok", "prompt_tokens": 1, "completion_tokens": 1}) + "\n")
+        f.write('{"id": "p1", "resp')  # Crash mid-write
+    job.status = "running"
+    job.save()
+
+    restarted = make_manager(tmp_path, generate)
+    interrupted = restarted.interrupted()
+    assert [j.id for j in interrupted] == [job.id]
+    asyncio.run(restarted.run(interrupted[0]))
+
+    assert sorted(calls) == ["three", "two"]
+    assert sorted(r["id"] for r in read_output(job.output_path)) == ["p0", "p1", "p2"]
+    assert BatchJob.load(job.directory).completed == 3
+
+def test_bad_lines_and_failures_are_reported_per_prompt(tmp_path):
+    """Malformed input and generation errors become error results; the job still completes."""
+    async def generate(messages, prompt_tokens, max_tokens, temperature, share):
+        if "boom" in messages[-1]["content"]:
+            raise RuntimeError("model exploded")
+        return "ok", 1
+
+    manager = make_manager(tmp_path, generate)
+    job = manager.create(data=b'{"prompt": "fine"}\nnot json\n{"prompt": "boom"}\n'
+                              b'{"prompt": "hot", "temperature": "very"}\n{"prompt": "long", "max_tokens": null}\n')
+    asyncio.run(manager.run(job))
+
+    errors = sorted(r["error"] for r in read_output(job.output_path) if "error" in r)
+    assert errors[0].startswith("Invalid input line 2") and errors[-1] == "model exploded"
+    assert job.progress()["failed"] == 4 and job.status == "completed"
+
+def test_jobs_are_listed_per_tenant(tmp_path):
+    """A tenant's listing only shows its own jobs, also after a restart."""
+    async def generate(messages, prompt_tokens, max_tokens, temperature, share):
+        return "ok", 1
+
+    manager = make_manager(tmp_path, generate)
+    mine = manager.create(data=b'{"prompt": "a"}\n', tenant="batch:alice")
+    manager.create(data=b'{"prompt": "b"}\n', tenant="batch:bob")
+
+    restarted = make_manager(tmp_path, generate)
+    assert [job["id"] for job in restarted.list_jobs(tenant="batch:alice")] == [mine.id]
+    assert len(restarted.list_jobs()) == 2
@@ -0,0 +1,138 @@
+import asyncio
+import threading
+import time
+from app.core.cache import CacheManager, LocalCache
+from app.core.response_cache import ResponseCache
+
+def test_local_cache_enforces_entry_and_byte_limits():
+    """Least recently used entries are evicted once either limit is hit."""
+    cache = LocalCache(max_entries=3, max_bytes=10_000, sweep_interval=None)
+    for key in ("a", "b", "c"):
+        cache.set(key, b"x" * 100)
+    assert cache.get("a") == b"x" * 100  # "a" becomes most recent
+    cache.set("d", b"x" * 100)
+    assert "b" not in cache and "a" in cache
+
+    cache.set("big", b"x" * 9_950)  # Forces out everything else
+    assert len(cache) == 1
+    assert cache.used_bytes == 9_950 + len("big")
+    assert cache.get_stats()["evictions"] == 4
+
+def test_local_cache_rejects_values_over_budget():
+    """A value bigger than the whole budget is never stored."""
+    cache = LocalCache(max_entries=10, max_bytes=50, sweep_interval=None)
+    cache.set("huge", b"x" * 100)
+    assert cache.get("huge") is None
+    assert cache.get_stats()["rejections"] == 1
+
+def test_sweeper_removes_expired_entries_without_reads():
+    """Expired entries disappear even if nobody asks for them again."""
+    cache = LocalCache(max_entries=10, max_bytes=10_000, sweep_interval=0.05)
+    try:
+        cache.set("short", b"v", ttl=0.05)
+        cache.set("long", b"v", ttl=60)
+        time.sleep(0.3)
+        assert "short" not in cache and "long" in cache
+        assert cache.get_stats()["expirations"] == 1
+    finally:
+        cache.close()
+
+def test_get_or_compute_coalesces_concurrent_misses():
+    """Threads missing the same key trigger exactly one computation."""
+    cache = CacheManager()
+    calls = []
+    release = threading.Event()
+
+    def expensive():
+        calls.append(1)
+        release.wait(2)
+        return {"answer": 42}
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_compute("k", expensive)))
+               for _ in range(8)]
+    for t in threads:
+        t.start()
+    time.sleep(0.1)
+    release.set()
+    for t in threads:
+        t.join()
+
+    assert len(calls) == 1
+    assert results == [{"answer": 42}] * 8
+    assert cache.get("k") == {"answer": 42}
+
+def test_async_get_or_compute_shares_result_and_errors():
+    """Coroutines share one in-flight computation, including its failure."""
+    cache = CacheManager()
+    calls = []
+
+    async def flaky():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        raise RuntimeError("model unavailable")
+
+    async def run():
+        return await asyncio.gather(*[cache.aget_or_compute("bad", flaky) for _ in range(5)],
+                                    return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert len(calls) == 1
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert cache.get("bad") is None
+
+def test_cancelled_leader_does_not_cancel_waiting_callers():
+    """The first caller going away leaves the shared computation running for the others."""
+    cache = CacheManager()
+
+    async def slow():
+        await asyncio.sleep(0.05)
+        return {"answer": 7}
+
+    async def run():
+        leader = asyncio.ensure_future(cache.aget_or_compute("slow", slow))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(cache.aget_or_compute("slow", slow))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        return await follower
+
+    assert asyncio.run(run()) == {"answer": 7}
+    assert cache.get("slow") == {"answer": 7}
+
+def test_set_without_ttl_never_expires():
+    """ttl=None stores the value without an expiry."""
+    cache = CacheManager()
+    cache.set("forever", {"v": 1}, ttl=None)
+    assert cache.get("forever") == {"v": 1}
+    cache.delete("forever")
+    assert cache.get("forever") is None
+
+def test_response_cache_hits_only_deterministic_requests():
+    """Greedy requests are cached per model version; sampled ones always bypass."""
+    manager = CacheManager()
+    calls = []
+
+    async def generate():
+        calls.append(1)
+        return "Paris"
+
+    async def run(cache, temperature):
+        return await cache.get_or_generate([1, 2, 3], {"max_new_tokens": 8, "temperature": temperature}, generate)
+
+    v1 = ResponseCache(manager, "tiny-llm", model_version="1")
+    assert asyncio.run(run(v1, 0.0)) == ("Paris", "MISS")
+    assert asyncio.run(run(v1, 0.0)) == ("Paris", "HIT")
+    assert asyncio.run(run(v1, 0.7)) == ("Paris", "BYPASS")
+
+    v2 = ResponseCache(manager, "tiny-llm", model_version="2")
+    assert asyncio.run(run(v2, 0.0)) == ("Paris", "MISS")
+    assert len(calls) == 3
+
+def test_response_cache_key_is_canonical():
+    """Parameter order does not change the key; any value change does."""
+    cache = ResponseCache(CacheManager(), "tiny-llm")
+    a = cache.make_key([1, 2], {"temperature": 0.0, "max_new_tokens": 8})
+    b = cache.make_key([1, 2], {"max_new_tokens": 8, "temperature": 0.0})
+    c = cache.make_key([1, 2], {"max_new_tokens": 9, "temperature": 0.0})
+    assert a == b != c
@@ -0,0 +1,40 @@
+import pytest
+from app.core.chunking import NearDuplicateFilter, TokenChunker
+
+def test_chunks_are_token_bounded_overlapping_slices(word_tokenizer):
+    """Every chunk fits the token budget, repeats the overlap and is a slice of the original text."""
+    tokenizer = word_tokenizer
+    text = " ".join(f"w{i}" for i in range(25))
+    chunker = TokenChunker(tokenizer, max_tokens=10, overlap=3)
+    chunks = chunker.split(text)
+    assert chunks == [" ".join(f"w{i}" for i in range(start, min(start + 10, 25))) for start in (0, 7, 14, 21)]
+    assert all(chunk in text for chunk in chunks)
+    assert chunker.split("short text") == ["short text"]
+    with pytest.raises(ValueError):
+        TokenChunker(tokenizer, max_tokens=4, overlap=4)
+
+def test_filter_flags_exact_and_near_duplicates():
+    """Case / spacing changes are exact duplicates, a small edit is near, other text is new."""
+    text = " ".join(f"Region {i} shipped {i * 7} units to warehouse {i * 13} on day {i * 3}." for i in range(20))
+    dedup = NearDuplicateFilter(threshold=0.8)
+    duplicate, content_hash, signature = dedup.check(text)
+    assert duplicate is None and signature.shape == (dedup.num_perm,)
+    dedup.add(content_hash, signature)
+
+    assert dedup.check("  " + text.upper())[0] == "exact"
+    assert dedup.check(text.replace("Region 3 shipped", "Region 3 delivered"))[0] == "near"
+    assert dedup.check("An unrelated note about the weather in the mountains this week.")[0] is None
+    assert len(dedup) == 1
+
+def test_forgotten_texts_are_no_longer_flagged():
+    """forget drops the oldest added texts, exact and near, leaving the newer ones."""
+    texts = [" ".join(f"{topic} fact {i} number {i * 11} is recorded here." for i in range(15))
+             for topic in ("Alpha", "Beta")]
+    dedup = NearDuplicateFilter(threshold=0.8)
+    for text in texts:
+        _, content_hash, signature = dedup.check(text)
+        dedup.add(content_hash, signature)
+    dedup.forget(1)
+    assert len(dedup) == 1
+    assert dedup.check(texts[0])[0] is None and dedup.check(texts[1])[0] == "exact"
+    assert dedup.check(texts[1].replace("fact 3 ", "fact three "))[0] == "near"
@@ -0,0 +1,64 @@
+from app.core.context_window import TURN_OVERHEAD_TOKENS, ContextWindowBuilder
+
+class CountingTokenizer:
+    """Stand-in for the registry tokenizer: one token per word, counting calls."""
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, text):
+        self.calls += 1
+        return len(text.split())
+
+def conversation(turns, words=10):
+    """Alternating user/assistant turns of `words` words each, all distinct."""
+    return [{"role": "user" if i % 2 == 0 else "assistant", "content": f"t{i} " + "w " * (words - 1)}
+            for i in range(turns)]
+
+def test_keeps_recent_turns_within_budget_and_reports_drops():
+    """Old turns are dropped first; system prompt and newest message always stay."""
+    per_turn = 10 + TURN_OVERHEAD_TOKENS
+    builder = ContextWindowBuilder(count_tokens=CountingTokenizer(), budget=per_turn * 5, trim_ratio=1.0)
+    messages = [{"role": "system", "content": "be brief"}] + conversation(9)
+
+    window = builder.build(messages)
+    assert window.messages[0]["role"] == "system"
+    assert window.messages[-1] is messages[-1]
+    assert window.used_tokens <= builder.budget
+    assert window.dropped_turns == 8 - (len(window.messages) - 2)
+    assert window.dropped_tokens == window.dropped_turns * per_turn
+    assert window.report()["dropped_tokens"] == window.dropped_tokens
+
+def test_turns_are_tokenized_once():
+    """Growing a session only tokenizes the new messages."""
+    counter = CountingTokenizer()
+    builder = ContextWindowBuilder(count_tokens=counter, budget=10_000)
+    history = conversation(20)
+    for n in range(1, len(history) + 1):
+        builder.build(history[:n], session_id="s1")
+    assert counter.calls == len(history)
+    assert builder.get_stats()["count_misses"] == len(history)
+
+def test_window_start_is_stable_between_trims():
+    """After a trim the next turns extend the same prefix instead of sliding it."""
+    per_turn = 10 + TURN_OVERHEAD_TOKENS
+    builder = ContextWindowBuilder(count_tokens=CountingTokenizer(), budget=per_turn * 10, trim_ratio=0.5)
+    history = conversation(30)
+
+    first_kept = []
+    for n in range(12, 21):
+        window = builder.build(history[:n], session_id="s1")
+        assert window.used_tokens <= builder.budget
+        first_kept.append(window.messages[0]["content"])
+    assert len(set(first_kept)) < len(first_kept) / 2  # Far fewer trims than turns
+    assert builder.get_stats()["trims"] <= 3
+
+def test_memory_fragments_fill_their_budget_before_the_latest_turn():
+    """Retrieved memory is packed best-first into its share, just before the new message."""
+    builder = ContextWindowBuilder(count_tokens=CountingTokenizer(), budget=200, memory_budget=30)
+    memory = ["paris is the capital of france", "the user likes short answers", "x " * 40]
+
+    window = builder.build(conversation(3), memory=memory)
+    assert window.memory_used == 2 and window.memory_dropped == 1
+    assert window.messages[-2]["role"] == "system"
+    assert "paris" in window.messages[-2]["content"]
+    assert window.dropped_tokens >= 40
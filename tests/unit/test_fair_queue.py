@@ -0,0 +1,59 @@
+import queue
+import pytest
+from app.core.fair_queue import FairQueue, FairShare
+
+def drain(fair_queue):
+    items = []
+    while len(fair_queue):
+        items.append(fair_queue.get_nowait())
+    return items
+
+def test_backlogged_tenant_does_not_starve_others():
+    """A tenant queueing a large batch first still shares turns with a later interactive user."""
+    fair_queue = FairQueue(quantum=100)
+    for i in range(20):
+        fair_queue.put(("bulk", i), cost=100, share=FairShare("bulk-key"))
+    for i in range(3):
+        fair_queue.put(("alice", i), cost=100, share=FairShare("alice"))
+
+    order = [tenant for tenant, _ in drain(fair_queue)]
+    assert order[:6] == ["bulk", "alice"] * 3
+
+def test_tokens_are_shared_by_role_weight():
+    """With equal backlogs an admin (weight 4) gets four times the tokens of a user (weight 1)."""
+    fair_queue = FairQueue(quantum=50)
+    for i in range(50):
+        fair_queue.put("admin", cost=100, share=FairShare("a", weight=4.0))
+        fair_queue.put("user", cost=100, share=FairShare("u", weight=1.0))
+
+    first = [fair_queue.get_nowait() for _ in range(25)]
+    assert first.count("admin") == 20 and first.count("user") == 5
+
+def test_interactive_class_is_served_before_batch():
+    """Batch items only run when no interactive work waits."""
+    fair_queue = FairQueue()
+    fair_queue.put("batch-1", cost=10, share=FairShare("job", priority="batch"))
+    fair_queue.put("chat-1", cost=10, share=FairShare("bob"))
+    fair_queue.put("batch-2", cost=10, share=FairShare("job", priority="batch"))
+    fair_queue.put("chat-2", cost=10, share=FairShare("bob"))
+    assert drain(fair_queue) == ["chat-1", "chat-2", "batch-1", "batch-2"]
+
+    with pytest.raises(ValueError):
+        FairShare("bob", priority="urgent")
+
+def test_remove_peek_and_wait_histograms():
+    """Removed items are skipped; peek matches get; waits land in per-tenant histograms."""
+    fair_queue = FairQueue()
+    fair_queue.put("x", cost=5, share=FairShare("t1"))
+    fair_queue.put("y", cost=5, share=FairShare("t2"))
+    assert fair_queue.remove("x") and not fair_queue.remove("x")
+    assert fair_queue.tenant_size("t1") == 0
+    assert fair_queue.peek() == "y" == fair_queue.get(timeout=0.1)
+    with pytest.raises(queue.Empty):
+        fair_queue.get(timeout=0.01)
+
+    stats = fair_queue.get_stats()
+    assert stats["queued"] == 0
+    assert stats["tenants"]["t2"]["served"] == 1 and sum(stats["tenants"]["t2"]["histogram"]) == 1
+    assert "t1" not in stats["tenants"]
+    assert stats["classes"]["interactive"]["tokens"] == 5
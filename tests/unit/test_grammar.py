@@ -0,0 +1,110 @@
+import json
+import asyncio
+import pytest
+import torch
+from app.core.grammar import Grammar, GrammarCache, GrammarError, TokenVocabulary, schema_to_regex
+from app.core.scheduler import BatchScheduler
+
+# Token 0 is end-of-sequence; the rest are JSON-ish pieces of various lengths
+VOCAB = [None, "{", "}", "[", "]", '"', ":", ",", " ", "true", "false", "null", '{"', '":', '",', '"}',
+         "name", "age", "tags", "ok", "a", "b", "c", "ab", "abc", "-", "0", "1", "2", "12", "3", "9", "x", "y",
+         "z", "ok\"", "\\", "n", ".", "e", "5", "42", " \"", "\":", "true}", "]}", "[\"", "\"]", "\",\"",
+         "do", "re", "mi", "fa", "so", "la", "ti", "\n", "\t", "A", "B", "C", "D", "E", "F"]
+SCHEMA = {
+    "type": "object",
+    "properties": {
+        "name": {"type": "string", "maxLength": 6},
+        "age": {"type": "integer"},
+        "tags": {"type": "array", "items": {"enum": ["a", "b"]}, "maxItems": 3},
+        "ok": {"type": "boolean"},
+    },
+    "required": ["name", "age"],
+}
+
+@pytest.fixture(scope="module")
+def tiny_model(tiny_gpt2):
+    """A randomly initialised 2-layer GPT-2 whose vocabulary is VOCAB."""
+    return tiny_gpt2(vocab_size=len(VOCAB), n_positions=256)
+
+def decode(token_ids):
+    return "".join(VOCAB[t] for t in token_ids if t != 0)
+
+def test_schema_regex_accepts_exactly_valid_documents():
+    """Optional properties may be skipped, required ones may not; limits are enforced."""
+    grammar = Grammar(schema_to_regex(SCHEMA), TokenVocabulary(VOCAB, eos_token_id=0))
+    assert grammar.matches('{"name": "ab", "age": 12}')
+    assert grammar.matches('{"name":"","age":-3,"tags":["a","b"],"ok":false}')
+    assert grammar.matches('{"name": "x", "age": 0, "ok": true}')
+    assert not grammar.matches('{"age": 12}')
+    assert not grammar.matches('{"name": "toolong!", "age": 1}')
+    assert not grammar.matches('{"name": "a", "age": 012}')
+    assert not grammar.matches('{"name": "a", "age": 1, "tags": ["c"]}')
+
+def test_string_patterns_cannot_break_out_of_the_string():
+    """A schema pattern never lets quotes, backslashes or control characters into the value unescaped."""
+    schema = {"type": "object", "properties": {"name": {"type": "string", "pattern": ".*"},
+                                               "ok": {"type": "string", "pattern": "[ -~]{1,3}|\""}},
+              "required": ["name", "ok"]}
+    grammar = Grammar(schema_to_regex(schema), TokenVocabulary(VOCAB, eos_token_id=0))
+    assert grammar.matches('{"name": "ab c", "ok": "x-9"}')
+    assert not grammar.matches('{"name": "a", "b": "c", "ok": "x"}')  # What ".*" used to allow
+    assert not grammar.matches('{"name": "a\\", "ok": "x"}')
+    assert not grammar.matches('{"name": "a\n", "ok": "x"}')
+    assert not grammar.matches('{"name": "a", "ok": """}')
+
+def test_masks_allow_only_viable_tokens_and_eos_at_the_end():
+    """A state's mask admits multi-character tokens that fit and end-of-sequence only when complete."""
+    vocab = TokenVocabulary(VOCAB, eos_token_id=0)
+    grammar = Grammar(r"(do|re)+ mi", vocab)
+    state = grammar.begin()
+    allowed = {VOCAB[i] for i in grammar.mask(state.state, len(VOCAB)).nonzero().flatten().tolist()}
+    assert allowed == {"do", "re"}
+    assert not state.advance(VOCAB.index("re"))
+    assert not state.advance(VOCAB.index(" "))
+    assert state.advance(VOCAB.index("mi"))  # Nothing can follow: the sequence ends without an EOS step
+    assert grammar.matches("redo mi") and not grammar.matches("mi")
+
+    numbers = Grammar(r"[0-9]+", vocab)
+    after_digit = numbers.next_state(numbers.start, VOCAB.index("12"))
+    mask = numbers.mask(after_digit, len(VOCAB) + 4)  # Model vocabularies may be padded
+    assert mask[0] and mask[VOCAB.index("42")] and not mask[VOCAB.index("a")] and not mask[len(VOCAB):].any()
+
+def test_constrained_generation_always_parses(tiny_model):
+    """Greedy and sampled outputs of a random model are valid JSON for the schema."""
+    # A bounded integer, so a random model cannot run into max_new_tokens mid-number
+    schema = {**SCHEMA, "properties": {**SCHEMA["properties"], "age": {"enum": [12, 42]}}}
+    grammar = Grammar(schema_to_regex(schema), TokenVocabulary(VOCAB, eos_token_id=0))
+    scheduler = BatchScheduler(tiny_model, batch_size=8, max_wait_ms=5, eos_token_id=0)
+    torch.manual_seed(3)
+
+    async def run():
+        greedy = scheduler.generate([1, 2, 3], 120, temperature=0.0, grammar=grammar)
+        sampled = scheduler.generate_n([4, 5], 6, 120, temperature=1.0, grammar=grammar)
+        return await asyncio.gather(greedy, sampled)
+
+    try:
+        greedy, sampled = asyncio.run(run())
+    finally:
+        scheduler.stop()
+
+    for output in [greedy] + [r.output_ids for r in sampled]:
+        document = json.loads(decode(output))
+        assert isinstance(document["name"], str) and document["age"] in (12, 42)
+        assert set(document) <= set(SCHEMA["properties"])
+    assert scheduler.stats["constrained_tokens"] > 0
+
+def test_grammar_cache_keys_on_the_schema():
+    """The same schema compiles once; key order does not matter; bad schemas raise GrammarError."""
+    cache = GrammarCache(max_size=1)
+    vocab = TokenVocabulary(VOCAB, eos_token_id=0)
+    first = cache.get({"type": "json_schema", "schema": {"type": "integer"}}, vocab)
+    again = cache.get({"schema": {"type": "integer"}, "type": "json_schema"}, vocab)
+    assert first is again and cache.get_stats()["hits"] == 1
+    assert cache.get({"type": "text"}, vocab) is None
+
+    cache.get({"type": "regex", "pattern": "(ab|c)+"}, vocab)
+    assert cache.get_stats()["evictions"] == 1
+    with pytest.raises(GrammarError):
+        cache.get({"type": "json_schema", "schema": {"type": "tuple"}}, vocab)
+    with pytest.raises(GrammarError):
+        cache.get({"type": "regex", "pattern": "(ab"}, vocab)
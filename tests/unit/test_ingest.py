@@ -0,0 +1,125 @@
+import json
+import functools
+import pytest
+from app.core.chunking import NearDuplicateFilter, TokenChunker
+from app.core.ingest import BulkIngester, iter_documents
+from app.core.retriever import DocumentRetriever
+
+def write_corpus(tmp_path, count):
+    corpus = tmp_path / "corpus.jsonl"
+    lines = [json.dumps({"text": f"Document number {i} about topic{i}.", "source": "bulk"}) for i in range(count)]
+    corpus.write_text("\n".join(lines[:3] + ["", "{not json"] + lines[3:]) + "\n")
+    (tmp_path / "notes").mkdir()
+    (tmp_path / "notes" / "paris.txt").write_text("Paris is the capital of France.")
+    (tmp_path / "notes" / "skip.bin").write_text("not picked up")
+    return [str(corpus), str(tmp_path / "notes")]
+
+def test_iter_documents_streams_files_and_skips_checkpointed_records(tmp_path):
+    """JSONL lines and text files become records; checkpoints skip consumed lines."""
+    paths = write_corpus(tmp_path, 5)
+    records = list(iter_documents(paths))
+    assert [r[3] for r in records] == [1, 2, 3, 6, 7, 1]
+    assert records[-1][0] == "Paris is the capital of France." and records[0][1] == "bulk"
+    resumed = list(iter_documents(paths, {records[0][2]: 6, records[-1][2]: 1}))
+    assert [r[0] for r in resumed] == ["Document number 4 about topic4."]
+
+def test_bulk_ingest_batches_and_reports_throughput(tmp_path, bag_of_words):
+    """Documents land in few transactions with consecutive ids and are searchable."""
+    paths = write_corpus(tmp_path, 45)
+    embedder = bag_of_words()
+    retriever = DocumentRetriever(32, str(tmp_path / "docs.db"), embedder=embedder, index_path=None)
+    progress = []
+    stats = BulkIngester(retriever, embedder, batch_size=8, commit_every=20).ingest(paths, progress.append)
+
+    assert stats["documents"] == 46 and stats["transactions"] == 2 and embedder.calls == 6
+    assert stats["docs_per_second"] > 0 and [p["documents"] for p in progress] == [24, 46]
+    assert len(retriever.index) == 46
+    assert retriever.search("capital of France", top_k=1)[0]["text"] == "Paris is the capital of France."
+    hit = retriever.search("Document number 17 about topic17", top_k=1)[0]
+    assert hit["source"] == "bulk" and hit["id"] == 18
+
+def test_bulk_ingest_resumes_after_a_crash(tmp_path, bag_of_words):
+    """A rerun stores exactly the documents the crashed run had not committed."""
+    paths = write_corpus(tmp_path, 45)
+    db, index_path = str(tmp_path / "docs.db"), str(tmp_path / "index")
+    retriever = DocumentRetriever(32, db, index_path=index_path)
+    with pytest.raises(RuntimeError):
+        BulkIngester(retriever, bag_of_words(fail_after=4), batch_size=8, commit_every=16).ingest(paths)
+    assert len(retriever.index) == 32  # Two committed transactions; the index is not closed
+    del retriever  # As after a crash, which also drops the index lock
+
+    reopened = DocumentRetriever(32, db, index_path=index_path)
+    stats = BulkIngester(reopened, bag_of_words(), batch_size=8, commit_every=16).ingest(paths)
+    texts = [row[0] for row in reopened.metadata_conn.execute("SELECT text FROM documents ORDER BY id")]
+    assert stats["documents"] == 14 and stats["resumed_files"] == 1
+    assert len(texts) == len(set(texts)) == 46 and len(reopened.index) == 46
+    assert BulkIngester(reopened, bag_of_words()).ingest(paths)["documents"] == 0
+
+def test_bulk_ingest_with_worker_processes(tmp_path, bag_of_words, word_tokenizer):
+    """Worker processes embed the batches; results arrive in input order."""
+    paths = write_corpus(tmp_path, 30)
+    retriever = DocumentRetriever(32, str(tmp_path / "docs.db"), index_path=None)
+    stats = BulkIngester(retriever, batch_size=4, workers=2, commit_every=10, embedder_factory=bag_of_words,
+                         chunker=TokenChunker(word_tokenizer, max_tokens=16, overlap=4)).ingest(paths)
+    assert stats["documents"] == 31
+    texts = [row[0] for row in retriever.metadata_conn.execute("SELECT text FROM documents ORDER BY id")]
+    assert texts == [record[0] for record in iter_documents(paths)]
+
+def test_worker_embed_time_excludes_waiting(tmp_path, bag_of_words):
+    """With workers, embed_seconds sums the encode calls, not the pool start-up or queueing."""
+    paths = write_corpus(tmp_path, 15)
+    retriever = DocumentRetriever(32, str(tmp_path / "docs.db"), index_path=None)
+    stats = BulkIngester(retriever, batch_size=4, workers=2, commit_every=8, chunking=False, dedup=False,
+                         embedder_factory=functools.partial(bag_of_words, delay=0.05)).ingest(paths)
+    assert stats["documents"] == 16
+    assert 4 * 0.05 <= stats["embed_seconds"] < 4 * 0.05 + 0.1
+
+def test_long_documents_are_chunked_and_duplicates_dropped(tmp_path, bag_of_words):
+    """Chunks point at their parent; repeated boilerplate is embedded once, also across runs."""
+    boilerplate = "Copyright Example Corp. All rights reserved. Do not redistribute without permission."
+    story = " ".join(f"Sentence {i} tells part {i} of the long story." for i in range(12))
+    corpus = tmp_path / "corpus.jsonl"
+    corpus.write_text("\n".join(json.dumps({"text": text, "source": "site"})
+                                  for text in [story, boilerplate, boilerplate.upper(), boilerplate + " Thanks."]))
+    embedder = bag_of_words()
+    retriever = DocumentRetriever(32, str(tmp_path / "docs.db"), embedder=embedder, index_path=None)
+    chunker = TokenChunker(embedder.tokenizer, max_tokens=30, overlap=5)
+    stats = BulkIngester(retriever, embedder, batch_size=4, chunker=chunker).ingest([str(corpus)])
+
+    assert stats["records"] == 4 and stats["parents"] == 1 and stats["chunks"] == len(chunker.split(story)) + 3
+    assert stats["exact_duplicates"] == 1 and stats["near_duplicates"] == 1
+    assert len(retriever.index) == stats["documents"] == stats["chunks"] - 2
+    assert stats["index_bytes_saved"] == 2 * (32 * 4 + 8) and stats["embed_seconds_saved"] >= 0
+
+    hit = retriever.search("Sentence 11 tells part 11 of the long story", top_k=1)[0]
+    assert hit["parent_id"] is not None and "Sentence 11 tells" in hit["text"]
+    assert retriever.get_parent(hit["parent_id"])["text"] == story
+    assert retriever.search(boilerplate, top_k=1)[0]["parent_id"] is None
+
+    again = tmp_path / "again.txt"
+    again.write_text("copyright example corp.   All rights reserved. Do not redistribute without permission!")
+    stats = BulkIngester(retriever, embedder, chunker=chunker).ingest([str(again)])
+    assert stats["documents"] == 0 and stats["exact_duplicates"] + stats["near_duplicates"] == 1
+
+def test_dedup_finds_stored_chunks_through_their_band_keys(tmp_path, bag_of_words):
+    """A fresh filter holds nothing, yet flags chunks of earlier runs, also in databases made before band keys."""
+    boilerplate = "Copyright Example Corp. All rights reserved. Do not redistribute without permission."
+    corpus = tmp_path / "corpus.txt"
+    corpus.write_text(boilerplate)
+    db = str(tmp_path / "docs.db")
+    retriever = DocumentRetriever(32, db, index_path=None)
+    BulkIngester(retriever, bag_of_words(), chunking=False).ingest([str(corpus)])
+
+    dedup = NearDuplicateFilter(store=retriever)
+    assert len(dedup) == 0
+    assert dedup.check(boilerplate.upper())[0] == "exact"
+    assert dedup.check(boilerplate + " Thanks.")[0] == "near"
+    assert dedup.check("An unrelated note about the weather.")[0] is None
+
+    retriever.metadata_conn.execute("DROP TABLE dedup_bands")
+    retriever.close()
+    reopened = DocumentRetriever(32, db, index_path=None)
+    assert NearDuplicateFilter(store=reopened).check(boilerplate + " Thanks.")[0] == "near"
+    reopened.delete_document(1)
+    assert NearDuplicateFilter(store=reopened).check(boilerplate + " Thanks.")[0] is None
+    assert reopened.metadata_conn.execute("SELECT COUNT(*) FROM dedup_bands").fetchone()[0] == 0
@@ -0,0 +1,141 @@
+import time
+import asyncio
+import pytest
+import torch
+from app.core.paged_kv import BlockAllocator, BlockTable, PagedKVCache
+from app.core.scheduler import BatchScheduler
+
+SLOT_BYTES = 2 * 2 * 32 * 4  # Keys + values, 2 layers, n_embd 32, float32
+
+def paged(model, num_blocks, block_size=4):
+    return PagedKVCache.for_model(model, budget_bytes=num_blocks * block_size * SLOT_BYTES, block_size=block_size)
+
+def test_allocator_reuses_freed_blocks():
+    """Blocks come back on the free list only when their last reference goes."""
+    allocator = BlockAllocator(2)
+    first, second = allocator.allocate(), allocator.allocate()
+    with pytest.raises(RuntimeError):
+        allocator.allocate()
+    allocator.share(first)
+    allocator.release(first)
+    assert allocator.num_free == 0 and not allocator.is_shared(first)
+    allocator.release(first)
+    assert allocator.allocate() == first
+    stats = allocator.get_stats()
+    assert stats["peak_used"] == 2 and stats["frees"] == 1 and stats["used_blocks"] == 2
+
+def test_forks_copy_a_shared_block_on_write():
+    """A fork shares full blocks for good and copies the partial one on its first write."""
+    cache = PagedKVCache(num_layers=1, num_heads=1, head_dim=2, budget_bytes=8 * 4 * 16, block_size=4)
+    layer = torch.arange(12, dtype=torch.float32).view(1, 1, 6, 2)
+    table = BlockTable()
+    cache.write(table, [(layer, layer + 100)])
+    fork = cache.fork(table)
+    assert fork.blocks == table.blocks and cache.get_stats()["shared_blocks"] == 2
+
+    cache.append([fork], [(torch.full((1, 1, 7, 2), -1.0), torch.full((1, 1, 7, 2), -2.0))])
+    assert fork.blocks[0] == table.blocks[0] and fork.blocks[1] != table.blocks[1]
+    assert cache.get_stats()["cow_copies"] == 1
+    (keys, values), = cache.gather([table, fork])[0]
+    assert torch.equal(keys[0, 0, 1:], layer[0, 0]) and torch.equal(values[0, 0, 1:], layer[0, 0] + 100)
+    assert torch.equal(keys[1, 0, :6], layer[0, 0]) and keys[1, 0, 6].tolist() == [-1.0, -1.0]
+
+    cache.free(fork)
+    cache.free(table)
+    assert cache.num_free_blocks == cache.num_blocks
+
+def test_paged_scheduler_matches_greedy_with_prefix_reuse(tiny_model, greedy_reference):
+    """Decoding from blocks gives the same tokens; a session's next turn reuses its blocks."""
+    scheduler = BatchScheduler(tiny_model, batch_size=4, max_wait_ms=5, paged_kv=paged(tiny_model, 64))
+    prompts = [([5, 6, 7], 4), ([9], 7), ([3, 4, 5, 6, 7, 8], 2), ([10, 11], 5)]
+    try:
+        results = [f.result(timeout=30) for f in [scheduler.submit(p, n) for p, n in prompts]]
+        first = scheduler.submit([1, 2, 3, 4, 5], 3, session_id="s").result(timeout=30)
+        follow_up = [1, 2, 3, 4, 5] + first + [6, 7]
+        second = scheduler.submit(follow_up, 3, session_id="s").result(timeout=30)
+    finally:
+        scheduler.stop()
+
+    for (prompt, n), output in zip(prompts, results):
+        assert output == greedy_reference(tiny_model, prompt, n)
+    assert second == greedy_reference(tiny_model, follow_up, 3)
+    stats = scheduler.paged_kv.get_stats()
+    assert stats["prefix_hits"] == 1 and stats["prefill_tokens_saved"] == 7
+    assert stats["used_blocks"] == 3  # Only the stored session prefix is left
+
+def test_paged_kv_runs_more_sequences_in_the_same_memory(tiny_model, greedy_reference):
+    """n samples share their prompt's blocks, so all run where dense KV would fit fewer."""
+    num_blocks, prompt, max_new, n = 32, list(range(1, 20)), 4, 8
+    dense_capacity = num_blocks * 4 // (len(prompt) + max_new)  # Contiguous rows reserve prompt + max_new
+    cache = PagedKVCache.for_model(tiny_model, budget_bytes=num_blocks * 4 * SLOT_BYTES, block_size=4,
+                                   gather_budget_bytes=n * (len(prompt) + max_new) * SLOT_BYTES)  # One step's view
+    scheduler = BatchScheduler(tiny_model, batch_size=n, max_wait_ms=5, paged_kv=cache)
+    try:
+        samples = asyncio.run(scheduler.generate_n(prompt, n, max_new, temperature=0.0))
+    finally:
+        scheduler.stop()
+
+    expected = greedy_reference(tiny_model, prompt, max_new)
+    assert all(s.output_ids == expected for s in samples)
+    assert scheduler.stats["peak_running"] == n > dense_capacity
+    assert scheduler.paged_kv.get_stats()["cow_copies"] == n - 1
+
+def test_full_pool_preempts_and_resumes(tiny_model, greedy_reference):
+    """Sequences that outgrow the pool are requeued and finish with unchanged outputs."""
+    scheduler = BatchScheduler(tiny_model, batch_size=4, max_wait_ms=20, paged_kv=paged(tiny_model, 6))
+    prompts = [([5, 6, 7], 10), ([9, 8], 10), ([3, 4], 10)]
+    try:
+        results = [f.result(timeout=60) for f in [scheduler.submit(p, n) for p, n in prompts]]
+        with pytest.raises(RuntimeError):
+            scheduler.submit(list(range(1, 30)), 2).result(timeout=30)
+    finally:
+        scheduler.stop()
+
+    for (prompt, n), output in zip(prompts, results):
+        assert output == greedy_reference(tiny_model, prompt, n)
+    assert scheduler.stats["preempted"] > 0
+    assert scheduler.paged_kv.num_free_blocks == scheduler.paged_kv.num_blocks
+
+def test_request_arriving_during_the_batch_wait_is_checked_against_the_pool(tiny_model, greedy_reference):
+    """A late arrival that would overflow the pool waits for the running batch instead of failing it."""
+    scheduler = BatchScheduler(tiny_model, batch_size=4, max_wait_ms=300, paged_kv=paged(tiny_model, 8))
+    first, second = list(range(1, 15)), list(range(20, 37))
+    try:
+        futures = [scheduler.submit(first, 2)]
+        time.sleep(0.05)
+        futures.append(scheduler.submit(second, 2))
+        results = [f.result(timeout=30) for f in futures]
+    finally:
+        scheduler.stop()
+
+    assert results == [greedy_reference(tiny_model, first, 2), greedy_reference(tiny_model, second, 2)]
+    assert scheduler.stats["failed"] == 0 and scheduler.stats["peak_running"] == 1
+
+def test_admission_checks_do_not_evict_session_prefixes(tiny_model):
+    """A request that is not admitted leaves stored prefixes alone; they count as reclaimable."""
+    cache = paged(tiny_model, 8)
+    scheduler = BatchScheduler(tiny_model, batch_size=4, paged_kv=cache)
+    table = BlockTable()
+    cache.write(table, [(torch.zeros(1, 2, 10, 16), torch.zeros(1, 2, 10, 16))] * 2)
+    cache.store_prefix("s", list(range(10)), table)
+    cache.free(table)
+    assert cache.num_free_blocks == 5 and cache.num_available_blocks == 8
+
+    oversized = scheduler.enqueue(list(range(40)), 2)
+    assert not scheduler._fits(oversized, [])
+    assert cache.get_stats()["sessions"] == 1 and cache.num_free_blocks == 5
+
+def test_gathered_view_stays_within_its_budget(tiny_model, greedy_reference):
+    """Rows are admitted and kept only while the padded per-step view fits the gather budget."""
+    cache = PagedKVCache.for_model(tiny_model, budget_bytes=64 * 4 * SLOT_BYTES, block_size=4,
+                                   gather_budget_bytes=2 * 16 * SLOT_BYTES)
+    scheduler = BatchScheduler(tiny_model, batch_size=4, max_wait_ms=20, paged_kv=cache)
+    prompts = [([5, 6, 7], 8), ([9, 8], 8), ([3, 4], 8), ([10, 11], 8)]
+    try:
+        results = [f.result(timeout=60) for f in [scheduler.submit(p, n) for p, n in prompts]]
+    finally:
+        scheduler.stop()
+
+    for (prompt, n), output in zip(prompts, results):
+        assert output == greedy_reference(tiny_model, prompt, n)
+    assert 0 < cache.get_stats()["peak_gather_bytes"] <= cache.gather_budget_bytes
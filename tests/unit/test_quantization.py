@@ -0,0 +1,48 @@
+import pytest
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM
+from app.core.scheduler import BatchScheduler
+from app.models.quantization import parity_check, quantize_for_cpu
+from app.models.registry import estimate_memory
+
+PROMPTS = [[1, 5, 9, 2, 7], [3, 3, 8], [11, 4, 6, 10, 12, 13]]
+
+def tiny_llama(seed):
+    torch.manual_seed(seed)
+    config = LlamaConfig(vocab_size=64, hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+                         num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=128,
+                         bos_token_id=0, eos_token_id=0)
+    model = LlamaForCausalLM(config).eval()
+    with torch.no_grad():
+        model.lm_head.weight.mul_(50)  # Confident predictions, like a trained model (no near-ties)
+    return model
+
+@pytest.mark.parametrize("mode", ["int8", "bf16"])
+def test_reduced_precision_model_matches_fp32(mode):
+    """int8 / bf16 weights keep the fp32 output distribution and shrink the model's memory."""
+    fp32_model = tiny_llama(seed=0)
+    model = quantize_for_cpu(fp32_model, mode)
+
+    report = parity_check(fp32_model, model, PROMPTS, max_new_tokens=4)
+    assert report["passed"]
+    assert report["mean_kl"] < 0.05
+    assert report["top1_agreement"] >= 0.8
+    assert estimate_memory(model)["cpu"] < estimate_memory(fp32_model)["cpu"]
+
+def test_parity_check_rejects_a_different_model():
+    """A model with unrelated weights fails the parity check."""
+    report = parity_check(tiny_llama(seed=0), tiny_llama(seed=1), PROMPTS, max_new_tokens=0)
+    assert not report["passed"]
+    assert report["greedy_match_rate"] is None
+
+def test_int8_model_serves_through_scheduler():
+    """The quantized model decodes through the continuous-batching scheduler."""
+    model = quantize_for_cpu(tiny_llama(seed=0), "int8")
+    scheduler = BatchScheduler(model, device="cpu", batch_size=4, max_wait_ms=5)
+    scheduler.start()
+    try:
+        futures = [scheduler.submit(prompt, max_new_tokens=6, temperature=0.0) for prompt in PROMPTS]
+        outputs = [future.result(timeout=60) for future in futures]
+    finally:
+        scheduler.stop()
+    assert all(len(output) == 6 for output in outputs)
@@ -0,0 +1,99 @@
+import time
+import threading
+import pytest
+import torch
+from app.models.registry import ModelRegistry
+
+def test_model_loads_once_under_concurrency():
+    """Concurrent first requests share a single load and the same handle."""
+    registry = ModelRegistry()
+    calls = []
+
+    def factory():
+        calls.append(1)
+        time.sleep(0.05)
+        return object()
+
+    registry.register("llm", factory)
+    assert registry.status()["llm"]["state"] == "unloaded"
+
+    handles = []
+    threads = [threading.Thread(target=lambda: handles.append(registry.get("llm"))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert all(handle is handles[0] for handle in handles)
+    status = registry.status()["llm"]
+    assert status["state"] == "loaded"
+    assert status["load_seconds"] >= 0.05
+
+def test_failed_load_is_reported_and_retried():
+    """A failing factory marks the model failed; the next get tries again."""
+    registry = ModelRegistry()
+    attempts = []
+
+    def factory():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise RuntimeError("weights missing")
+        return "model"
+
+    registry.register("asr", factory)
+    registry.warmup(["asr"])  # Logged, not raised
+    assert registry.status()["asr"]["state"] == "failed"
+    assert registry.status()["asr"]["error"] == "weights missing"
+
+    assert registry.get("asr") == "model"
+    assert registry.is_loaded("asr")
+    with pytest.raises(KeyError):
+        registry.get("unknown")
+
+def linear_factory(loads, name, features=256):
+    """Builds a CPU model of ~features² floats and counts how often it was loaded."""
+    def factory():
+        loads[name] = loads.get(name, 0) + 1
+        return torch.nn.Linear(features, features, bias=False)
+    return factory
+
+def test_lru_model_is_evicted_and_reloaded_on_demand():
+    """Over the RAM budget the least recently used model is unloaded, and reloaded on next use."""
+    model_mb = 256 * 256 * 4 / (1024 * 1024)
+    registry = ModelRegistry(ram_budget_mb=model_mb * 2.5)
+    loads = {}
+    for name in ("a", "b", "c"):
+        registry.register(name, linear_factory(loads, name))
+
+    registry.get("a")
+    registry.get("b")
+    registry.get("a")  # b is now the least recently used
+    registry.get("c")
+    assert registry.status()["b"]["state"] == "unloaded"
+    assert registry.is_loaded("a") and registry.is_loaded("c")
+    assert registry.get_stats()["ram_used_mb"] <= model_mb * 2.5
+
+    registry.get("b")
+    assert loads == {"a": 1, "b": 2, "c": 1}
+    assert registry.get_stats()["evictions"] == 2
+
+def test_pinned_and_in_use_models_stay_resident():
+    """Pinned models and models inside `use` are never evicted."""
+    model_mb = 256 * 256 * 4 / (1024 * 1024)
+    registry = ModelRegistry(ram_budget_mb=model_mb * 1.5, pinned=["llm"])
+    loads = {}
+    for name in ("llm", "caption", "ocr"):
+        registry.register(name, linear_factory(loads, name))
+
+    registry.get("llm")
+    with registry.use("caption"):
+        registry.get("ocr")  # Over budget, but llm is pinned and caption is in use
+        assert registry.is_loaded("llm") and registry.is_loaded("caption") and registry.is_loaded("ocr")
+    assert registry.get_stats()["over_budget"] >= 1
+
+    registry.get("caption")  # Still resident: no reload
+    registry.get("ocr")
+    registry.warmup(["caption"])
+    assert loads["caption"] == 1
+    assert registry.status()["llm"]["pinned"]
@@ -0,0 +1,213 @@
+import threading
+import pytest
+import numpy as np
+from app.core import vector_store
+from app.core.retriever import DocumentRetriever
+from app.core.vector_store import LOG_FILE, VectorIndex, recall_report
+from app.utils.memory import MemoryDB
+
+def test_hits_keep_their_ids_after_deletes(tmp_path, bag_of_words):
+    """Deleting a document must not shift which text a later index entry resolves to."""
+    retriever = DocumentRetriever(32, str(tmp_path / "docs.db"), embedder=bag_of_words(), index_path=None)
+    python = retriever.add_document("Python is a programming language.", "wiki")
+    rust = retriever.add_document("Rust is a systems language.", "wiki")
+    paris = retriever.add_document("Paris is the capital of France.", "atlas")
+
+    assert retriever.delete_document(python) and not retriever.delete_document(python)
+    hits = retriever.search("capital of France", top_k=5)
+    assert [hit["id"] for hit in hits] == [paris, rust]
+    assert hits[0]["text"] == "Paris is the capital of France." and hits[0]["source"] == "atlas"
+    assert hits[0]["distance"] < hits[1]["distance"]
+    assert retriever.retrieve_documents("Rust systems", top_k=1) == ["Rust is a systems language."]
+
+def test_memory_search_returns_scored_entries(tmp_path, bag_of_words):
+    """Memory hits carry their conversation and distance; cleared memory finds nothing."""
+    memory = MemoryDB(32, str(tmp_path / "memory.db"), embedder=bag_of_words(), index_path=None)
+    memory.add_memory("conv_1", "The capital of France is Paris.")
+    memory.add_memory("conv_2", "My favourite colour is green.")
+
+    hit = memory.search_memory("What is the capital of France?", top_k=1)[0]
+    assert hit["conversation_id"] == "conv_1" and hit["distance"] >= 0.0
+    memory.clear_memory()
+    assert memory.retrieve_memory("capital") == []
+
+def test_vector_index_searches_by_id():
+    """Ids are arbitrary 64-bit values; top_k beyond the index size is fine."""
+    index = VectorIndex(2)
+    index.add([7, 2 ** 40], np.array([[0.0, 0.0], [1.0, 1.0]]))
+    hits = index.search(np.array([0.9, 0.9]), 10)
+    assert [i for i, _ in hits] == [2 ** 40, 7]
+    assert [d for _, d in hits] == pytest.approx([0.02, 1.62], abs=1e-5)
+    assert index.remove([7]) == 1 and len(index) == 1
+
+@pytest.mark.parametrize("index_type", ["ivf_flat", "ivf_pq", "hnsw"])
+def test_approximate_index_trains_once_enough_vectors_exist(index_type):
+    """Exact until train_min; afterwards the ANN index answers, tunable per query and deletable."""
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((1200, 16)).astype(np.float32)
+    ids = np.arange(1200) * 3 + 1
+    index = VectorIndex(16, index_type, train_min=1000)
+    index.add(ids[:999], vectors[:999])
+    assert index.active_type == "flat"
+    index.add(ids[999:], vectors[999:])
+    assert index.active_type == index_type and len(index) == 1200
+
+    assert index.search(vectors[5], 1, nprobe=64, ef_search=128)[0][0] == ids[5]
+    assert index.remove([ids[5]]) == 1 and len(index) == 1199
+    assert ids[5] not in [i for i, _ in index.search(vectors[5], 10, nprobe=64)]
+
+    report = recall_report(index, ids[6:], vectors[6:], vectors[6:56], top_k=5)
+    assert report[0]["setting"] == "exact" and len(report) > 2
+    assert report[-1]["recall"] >= report[1]["recall"] and report[-1]["recall"] > 0.5
+
+@pytest.mark.parametrize("index_type", ["flat", "ivf_flat", "hnsw"])
+def test_persistent_index_reopens_from_snapshot_and_log(tmp_path, index_type):
+    """A reopened index memory-maps its snapshot, replays the log tail and keeps answering the same."""
+    rng = np.random.default_rng(1)
+    vectors = rng.standard_normal((600, 8)).astype(np.float32)
+    path = str(tmp_path / "index")
+    index = VectorIndex(8, index_type, train_min=500, path=path)
+    index.add(np.arange(1, 501), vectors[:500])  # Trains when approximate, which snapshots
+    index.snapshot()
+    index.add(np.arange(501, 601), vectors[500:])  # Only in the log
+    index.remove([3, 550])
+    expected = index.search(vectors[9], 5, nprobe=64, ef_search=128)
+    del index  # No close(): as after a crash, which also drops the directory lock
+
+    reopened = VectorIndex(8, index_type, train_min=500, path=path)
+    stats = reopened.get_stats()
+    assert stats["memory_mapped"] and stats["delta"] == 99 and stats["logged_ops"] == 2
+    assert reopened.active_type == index_type and len(reopened) == 598 and reopened.max_id == 600
+    assert reopened.search(vectors[9], 5, nprobe=64, ef_search=128) == expected
+    assert 550 not in [i for i, _ in reopened.search(vectors[549], 5, nprobe=64)]
+
+    assert reopened.remove([9]) == 1 and reopened.search(vectors[9], 1, nprobe=64)[0][0] != 9
+    reopened.close()
+    final = VectorIndex(8, index_type, path=path)
+    assert final.get_stats()["logged_ops"] == 0 and len(final) == 597
+
+def test_hnsw_tombstones_are_saved_instead_of_rebuilding(tmp_path, monkeypatch):
+    """A few deletes survive snapshot and reopen as tombstones; the graph is rebuilt only past the threshold."""
+    rng = np.random.default_rng(4)
+    vectors = rng.standard_normal((300, 8)).astype(np.float32)
+    path = str(tmp_path / "index")
+    index = VectorIndex(8, "hnsw", train_min=300, path=path)
+    index.add(np.arange(1, 301), vectors)  # Builds the graph and snapshots
+    index.close()
+    rebuilds = []
+    monkeypatch.setattr(VectorIndex, "_rebuild", lambda self, index_type: rebuilds.append(index_type))
+
+    reopened = VectorIndex(8, "hnsw", path=path)
+    reopened.remove([5])
+    reopened.close()
+    assert rebuilds == []
+    reopened = VectorIndex(8, "hnsw", path=path)
+    assert len(reopened) == 299 and reopened.get_stats()["tombstones"] == 1 and reopened.get_stats()["logged_ops"] == 0
+    assert 5 not in [i for i, _ in reopened.search(vectors[4], 5, ef_search=128)]
+    monkeypatch.undo()
+
+    reopened.remove(np.arange(10, 41))  # Past HNSW_MAX_TOMBSTONES of 300
+    reopened.close()
+    final = VectorIndex(8, "hnsw", path=path)
+    assert len(final) == 268 and "tombstones" not in final.get_stats()
+    final.close()
+
+def test_torn_log_tail_is_dropped(tmp_path):
+    """A record cut short by a crash is truncated; the complete records before it still replay."""
+    path = tmp_path / "index"
+    index = VectorIndex(2, path=str(path))
+    index.add([1], np.array([[0.0, 0.0]]))
+    index.add([2], np.array([[1.0, 1.0]]))
+    log = path / f"{LOG_FILE}.0"
+    log.write_bytes(log.read_bytes()[:-3])
+    del index
+
+    reopened = VectorIndex(2, path=str(path))
+    assert [i for i, _ in reopened.search(np.array([1.0, 1.0]), 5)] == [1]
+    reopened.add([3], np.array([[1.0, 1.0]]))
+    del reopened
+    assert [i for i, _ in VectorIndex(2, path=str(path)).search(np.array([1.0, 1.0]), 5)] == [3, 1]
+
+def test_ivf_index_is_retrained_as_the_corpus_grows(tmp_path):
+    """Lists sized for the first training are rebuilt from SQLite's vectors once the corpus has grown enough."""
+    rng = np.random.default_rng(3)
+    vectors = rng.standard_normal((800, 32)).astype(np.float32)
+    retriever = DocumentRetriever(32, str(tmp_path / "docs.db"), index_type="ivf_flat", index_path=None)
+    retriever.index.train_min = 200
+    retriever.add_documents([f"doc {i}" for i in range(200)], ["bulk"] * 200, vectors[:200])
+    assert retriever.index.get_stats()["nlist"] == 5 and retriever.index.trained_vectors == 200
+
+    retriever.add_documents([f"doc {i}" for i in range(200, 799)], ["bulk"] * 599, vectors[200:799])
+    assert not retriever.index.needs_retrain
+    retriever.add_documents(["doc 799"], ["bulk"], vectors[799:])  # Reaches 4x the training size
+    stats = retriever.index.get_stats()
+    assert stats["nlist"] == 20 and stats["trained_vectors"] == 800 and stats["vectors"] == 800
+    assert retriever.index.search(vectors[500], 1, nprobe=20)[0][0] == 501
+    retriever.close()
+
+def test_large_delta_is_folded_into_a_snapshot(tmp_path, monkeypatch):
+    """Adds on top of a mapped snapshot are folded once the delta reaches its limit, even in few operations."""
+    monkeypatch.setattr(vector_store, "VECTOR_DELTA_MAX", 100)
+    rng = np.random.default_rng(2)
+    path = str(tmp_path / "index")
+    index = VectorIndex(8, path=path)
+    index.add(np.arange(1, 51), rng.standard_normal((50, 8)))
+    index.snapshot()
+    index.add(np.arange(51, 141), rng.standard_normal((90, 8)))
+    assert index.get_stats()["delta"] == 90 and index.get_stats()["generation"] == 1
+    index.add(np.arange(141, 161), rng.standard_normal((20, 8)))
+    assert index.get_stats()["delta"] == 0 and index.get_stats()["generation"] == 2 and len(index) == 160
+    index.add(np.arange(161, 271), rng.standard_normal((110, 8)), snapshot=False)
+    del index  # The unsnapshotted delta is only in the log
+
+    reopened = VectorIndex(8, path=path)  # Replay never snapshots, so opening folds it
+    assert reopened.get_stats()["delta"] == 0 and reopened.get_stats()["generation"] == 3 and len(reopened) == 270
+    reopened.close()
+
+def test_index_directory_is_locked_while_open(tmp_path):
+    """A second opener of the same directory fails instead of deleting the first one's generations."""
+    path = str(tmp_path / "index")
+    index = VectorIndex(2, path=path)
+    index.add([1], np.array([[0.0, 0.0]]))
+    with pytest.raises(RuntimeError):
+        VectorIndex(2, path=path)
+    index.close()
+    assert len(VectorIndex(2, path=path)) == 1
+
+def test_retriever_catches_up_with_sqlite_on_open(tmp_path, bag_of_words):
+    """Documents stored while the index was not persisted are added from SQLite, not re-embedded."""
+    db, index_path = str(tmp_path / "docs.db"), str(tmp_path / "index")
+    retriever = DocumentRetriever(32, db, embedder=bag_of_words(), index_path=index_path)
+    paris = retriever.add_document("Paris is the capital of France.", "atlas")
+    retriever.close()
+    unindexed = DocumentRetriever(32, db, embedder=bag_of_words(), index_path=None)
+    rust = unindexed.add_document("Rust is a systems language.", "wiki")
+    unindexed.close()
+
+    reopened = DocumentRetriever(32, db, embedder=None, index_path=index_path)
+    assert reopened.index.max_id == rust and len(reopened.index) == 2
+    reopened._embedder = bag_of_words()
+    assert [hit["id"] for hit in reopened.search("capital of France", top_k=2)] == [paris, rust]
+    reopened.close()
+
+def test_concurrent_writers_get_distinct_ids(tmp_path):
+    """Two connections storing batches at once never hand out the same ids."""
+    db = str(tmp_path / "docs.db")
+    writers = [DocumentRetriever(32, db, index_path=None) for _ in range(2)]
+    ids, barrier = [[], []], threading.Barrier(2)
+
+    def write(n):
+        barrier.wait()
+        for batch in range(20):
+            texts = [f"writer {n} batch {batch} doc {i}" for i in range(5)]
+            ids[n] += writers[n].add_documents(texts, ["w"] * 5, np.ones((5, 32), dtype=np.float32))
+
+    threads = [threading.Thread(target=write, args=(n,)) for n in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(set(ids[0] + ids[1])) == 200
+    stored = dict(writers[0].metadata_conn.execute("SELECT id, text FROM documents"))
+    assert all(stored[doc_id].startswith(f"writer {n} ") for n in range(2) for doc_id in ids[n])
@@ -0,0 +1,165 @@
+import time
+import asyncio
+import pytest
+import torch
+from app.core.kv_cache import PrefixCache
+from app.core.scheduler import BatchScheduler
+
+def test_continuous_batching_matches_sequential_greedy(tiny_model, greedy_reference):
+    """Sequences joining and leaving mid-batch must decode exactly like batch size 1."""
+    scheduler = BatchScheduler(tiny_model, batch_size=2, max_wait_ms=5)
+    prompts = [([5, 6, 7], 4), ([9], 7), ([3, 4, 5, 6, 7, 8], 2), ([10, 11], 5)]
+    try:
+        futures = [scheduler.submit(p, n) for p, n in prompts]
+        results = [f.result(timeout=30) for f in futures]
+    finally:
+        scheduler.stop()
+
+    for (prompt, n), output in zip(prompts, results):
+        assert output == greedy_reference(tiny_model, prompt, n)
+    assert scheduler.stats["completed"] == len(prompts)
+
+def test_async_callers_resolve_independently(tiny_model, greedy_reference):
+    """Concurrent coroutines each get back their own continuation."""
+    scheduler = BatchScheduler(tiny_model, batch_size=8, max_wait_ms=20)
+
+    async def run():
+        return await asyncio.gather(
+            scheduler.generate([1, 2, 3], 3),
+            scheduler.generate([4, 5], 6),
+        )
+
+    try:
+        short, long = asyncio.run(run())
+    finally:
+        scheduler.stop()
+
+    assert short == greedy_reference(tiny_model, [1, 2, 3], 3)
+    assert long == greedy_reference(tiny_model, [4, 5], 6)
+
+def test_stream_yields_tokens_and_cancels_on_close(tiny_model, greedy_reference):
+    """Closing a token stream early frees the sequence's batch slot."""
+    scheduler = BatchScheduler(tiny_model, batch_size=4, max_wait_ms=5)
+
+    async def consume_two():
+        received = []
+        stream = scheduler.stream([7, 8, 9], 50)
+        async for token_id in stream:
+            received.append(token_id)
+            if len(received) == 2:
+                break
+        await stream.aclose()
+        return received
+
+    try:
+        received = asyncio.run(consume_two())
+        scheduler.submit([1, 2], 2).result(timeout=30)  # Next step boundary has passed
+    finally:
+        scheduler.stop()
+
+    assert received == greedy_reference(tiny_model, [7, 8, 9], 2)
+    assert scheduler.stats["cancelled"] == 1
+    assert scheduler.running == 0
+
+def test_prefix_cache_reuses_previous_turn(tiny_model, greedy_reference):
+    """A follow-up turn restores the cached prefix and still decodes identically."""
+    cache = PrefixCache(budget_bytes=10 * 1024 * 1024)
+    scheduler = BatchScheduler(tiny_model, batch_size=4, max_wait_ms=5, prefix_cache=cache)
+    first_prompt = [3, 1, 4, 1, 5]
+    try:
+        first_reply = scheduler.submit(first_prompt, 4, session_id="u1").result(timeout=30)
+        second_prompt = first_prompt + first_reply + [9, 2, 6]
+        second_reply = scheduler.submit(second_prompt, 5, session_id="u1").result(timeout=30)
+    finally:
+        scheduler.stop()
+
+    assert second_reply == greedy_reference(tiny_model, second_prompt, 5)
+    stats = cache.get_stats()
+    assert stats["hits"] == 1 and stats["misses"] == 1
+    # Everything but the last sampled token of turn one was already in the cache
+    assert stats["prefill_tokens_saved"] == len(first_prompt) + len(first_reply) - 1
+
+def test_prefix_cache_evicts_least_recently_used():
+    """The memory budget is enforced by dropping the oldest session."""
+    kv = [(torch.zeros(1, 2, 4, 8), torch.zeros(1, 2, 4, 8))]
+    entry_bytes = 2 * 2 * 4 * 8 * 4
+    cache = PrefixCache(budget_bytes=2 * entry_bytes)
+    cache.store("a", [1, 2, 3, 4], kv)
+    cache.store("b", [1, 2, 3, 4], kv)
+    assert cache.lookup("a", [1, 2, 3, 4, 5]) is not None  # "a" becomes most recent
+    cache.store("c", [1, 2, 3, 4], kv)
+
+    assert cache.lookup("b", [1, 2, 3, 4, 5]) is None
+    assert cache.get_stats()["evictions"] == 1
+    assert cache.used_bytes == 2 * entry_bytes
+
+def test_generate_n_forks_one_prefill(tiny_model, greedy_reference):
+    """n sequences share the prompt's prefill; greedy forks all match the reference."""
+    scheduler = BatchScheduler(tiny_model, batch_size=4, max_wait_ms=5)
+    prompt = [2, 7, 1, 8, 2, 8]
+    try:
+        requests = asyncio.run(scheduler.generate_n(prompt, 3, 5, temperature=0.0, logprobs=True))
+    finally:
+        scheduler.stop()
+
+    reference = greedy_reference(tiny_model, prompt, 5)
+    assert [r.output_ids for r in requests] == [reference] * 3
+    for r in requests:
+        assert len(r.output_logprobs) == len(r.output_ids) and all(lp <= 0 for lp in r.output_logprobs)
+    assert scheduler.stats["forked_sequences"] == 2
+    assert scheduler.stats["prefill_tokens_shared"] == 2 * len(prompt)
+
+def test_generate_n_samples_independently(tiny_model):
+    """With temperature, forks draw their own tokens after the shared prompt."""
+    torch.manual_seed(1)
+    scheduler = BatchScheduler(tiny_model, batch_size=8, max_wait_ms=5)
+    try:
+        requests = asyncio.run(scheduler.generate_n([3, 3, 3], 6, 8, temperature=1.5))
+    finally:
+        scheduler.stop()
+
+    outputs = {tuple(r.output_ids) for r in requests}
+    assert len(requests) == 6 and len(outputs) > 1
+    assert all(r.output_logprobs == [] for r in requests)  # Not requested
+
+def test_group_arriving_during_the_batch_wait_waits_for_free_rows(tiny_model, greedy_reference):
+    """n samples that arrive while the batch fills join only once n rows are free."""
+    scheduler = BatchScheduler(tiny_model, batch_size=2, max_wait_ms=300)
+    try:
+        single = scheduler.submit([5, 6, 7], 3)
+        time.sleep(0.05)
+        group = scheduler.enqueue_n([9, 8], 2, 3)
+        outputs = [single.result(timeout=30)] + [r.future.result(timeout=30) for r in group]
+    finally:
+        scheduler.stop()
+
+    assert outputs == [greedy_reference(tiny_model, [5, 6, 7], 3)] + [greedy_reference(tiny_model, [9, 8], 3)] * 2
+    assert scheduler.stats["peak_running"] == 2
+
+def test_exclusive_runner_has_the_model_to_itself(tiny_model, greedy_reference):
+    """A run_alone decoder waits for the batch to drain, and requests queued after it wait for it."""
+    scheduler = BatchScheduler(tiny_model, batch_size=4, max_wait_ms=5)
+    futures, seen = [], []
+
+    def runner(prompt, limit):
+        seen.append((scheduler.running, futures[0].done(), futures[1].running()))
+        time.sleep(0.05)
+        return greedy_reference(tiny_model, prompt, limit)
+
+    async def run():
+        alone = asyncio.ensure_future(scheduler.run_alone([9, 8], 3, runner))
+        await asyncio.sleep(0)  # Queued behind the first request
+        futures.append(scheduler.submit([1, 2], 2))
+        return await alone
+
+    try:
+        futures.append(scheduler.submit([5, 6, 7], 12))
+        output = asyncio.run(run())
+        results = [f.result(timeout=30) for f in futures]
+    finally:
+        scheduler.stop()
+
+    assert seen == [(0, True, False)]
+    assert output == greedy_reference(tiny_model, [9, 8], 3)
+    assert results == [greedy_reference(tiny_model, [5, 6, 7], 12), greedy_reference(tiny_model, [1, 2], 2)]
+    assert scheduler.get_stats()["exclusive_runs"] == 1 and scheduler.get_stats()["completed"] == 3
@@ -0,0 +1,59 @@
+import pytest
+from app.core.semantic_cache import SemanticCache
+
+@pytest.fixture
+def make_cache(bag_of_words):
+    """Enabled semantic caches on the bag-of-words embedder."""
+    return lambda **kwargs: SemanticCache(embedder=bag_of_words(), enabled=True, **kwargs)
+
+def test_similar_prompt_hits_within_tenant_only(make_cache):
+    """Paraphrases hit the tenant's own entries; other tenants stay isolated."""
+    cache = make_cache(threshold=0.8)
+    cache.add("acme", "what is the capital of france", "Paris")
+
+    hit, _ = cache.lookup("acme", "The capital of France?")
+    assert hit is not None and hit.response == "Paris" and hit.similarity >= 0.8
+    assert cache.lookup("globex", "The capital of France?")[0] is None
+    assert cache.lookup("acme", "how do I reset my password")[0] is None
+    assert cache.get_stats()["hits"] == 1
+
+def test_entries_are_bounded_and_false_hits_counted(make_cache):
+    """Oldest entries are evicted; reported false hits are dropped and counted."""
+    cache = make_cache(threshold=0.99, max_entries=2)
+    first = cache.add("acme", "alpha", "A")
+    cache.add("acme", "beta", "B")
+    cache.add("acme", "gamma", "C")
+    assert cache.lookup("acme", "alpha")[0] is None
+    assert cache.get_stats()["evictions"] == 1
+
+    hit, _ = cache.lookup("acme", "beta")
+    assert cache.report_false_hit("acme", hit.entry_id)
+    assert cache.lookup("acme", "beta")[0] is None
+    assert not cache.report_false_hit("acme", first)
+    stats = cache.get_stats()
+    assert stats["false_hits"] == 1 and stats["false_hit_rate"] == 1.0
+
+def test_answers_are_reused_only_for_the_same_generation_parameters(make_cache):
+    """A reply made with other max_tokens / temperature is not served, even for the same prompt."""
+    cache = make_cache(threshold=0.8)
+    cache.add("acme", "what is the capital of france", "Paris, the capital.", params={"max_tokens": 200})
+    cache.add("acme", "what is the capital of france", "Paris", params={"max_tokens": 5})
+
+    assert cache.lookup("acme", "The capital of France?", {"max_tokens": 5})[0].response == "Paris"
+    assert cache.lookup("acme", "The capital of France?", {"max_tokens": 200})[0].response == "Paris, the capital."
+    assert cache.lookup("acme", "The capital of France?", {"max_tokens": 50})[0] is None
+
+def test_hit_tracking_is_dropped_with_its_entries(make_cache):
+    """Expired, evicted-tenant and cleared entries take their hit similarity with them."""
+    cache = make_cache(threshold=0.8, max_tenants=2)
+    for n in range(20):
+        cache.add(f"tenant{n}", "what is the capital of france", "Paris")
+        assert cache.lookup(f"tenant{n}", "The capital of France?")[0] is not None
+    tracked = lambda: sum(len(t.hit_similarity) for t in cache._tenants.values())
+    assert tracked() == 2
+
+    cache.ttl = -1
+    assert cache.lookup("tenant19", "The capital of France?")[0] is None
+    assert tracked() == 1
+    cache.clear()
+    assert tracked() == 0 and cache.get_stats()["tenants"] == 0
@@ -0,0 +1,89 @@
+import time
+from app.core.cache import CacheManager
+from app.core.session_store import Session, SessionStore, decode_session, encode_session
+
+class TurnTokenizer:
+    """Stand-in for the Tokenizer wrapper: one id per word of "<role> content" turns."""
+    def __init__(self):
+        self.encoded_words = 0
+
+    def render(self, messages, add_generation_prompt):
+        text = "".join(f"<{m['role']}> {m['content']} </s> " for m in messages)
+        return text + "<assistant> " if add_generation_prompt else text
+
+    def encode(self, text):
+        words = text.split()
+        self.encoded_words += len(words)
+        return [sum(map(ord, word)) % 1000 for word in words]
+
+    def encode_chat_incremental(self, messages, cached_tokens=None, cached_messages=0, add_generation_prompt=True):
+        text = self.render(messages, add_generation_prompt)
+        if cached_tokens is not None and cached_messages:
+            cached_text = self.render(messages[:cached_messages], False)
+            if text.startswith(cached_text):
+                return list(cached_tokens) + self.encode(text[len(cached_text):])
+        return self.encode(text)
+
+def make_store(**kwargs):
+    return SessionStore(cache=CacheManager(), tokenizer=TurnTokenizer(), **kwargs)
+
+def test_binary_encoding_round_trips():
+    """Messages (including non-standard roles and unicode) and token ids survive encoding."""
+    messages = [{"role": "system", "content": "Be brief."}, {"role": "user", "content": "Größe? 🚀"},
+                {"role": "critic", "content": "x" * 5000}]
+    session = Session(messages, token_ids=[1, 2, 70000], token_messages=2)
+
+    data = encode_session(session)
+    decoded = decode_session(data)
+    assert decoded.messages == messages
+    assert decoded.token_ids.tolist() == [1, 2, 70000] and decoded.token_messages == 2
+    assert len(data) < 5000  # The long message was compressed
+
+def test_new_turns_only_tokenize_the_delta():
+    """Saving and prompting a growing session encodes each turn once, not the whole history."""
+    store = make_store()
+    history = []
+    for turn in range(10):
+        session = store.load("u1")
+        messages = list(session.messages) + [{"role": "user", "content": f"question {turn} " * 20}]
+        prompt = store.prompt_tokens(session, messages)
+        assert prompt == store._tokenizer.encode(store._tokenizer.render(messages, True))  # Same as a full encode
+        history = messages + [{"role": "assistant", "content": f"answer {turn} " * 20}]
+        store.save("u1", history, previous=session)
+
+    stored = store.load("u1")
+    assert stored.messages == history and stored.token_messages == len(history)
+    assert store.get_stats()["tokens_reused"] > 5 * store.get_stats()["tokens_encoded"]
+
+def test_edited_history_is_retokenized_and_sessions_expire():
+    """A history that no longer extends the stored one gets fresh ids; idle sessions expire."""
+    store = make_store(ttl=1)
+    store.save("u1", [{"role": "user", "content": "a"}, {"role": "assistant", "content": "b"}])
+    edited = store.save("u1", [{"role": "user", "content": "c"}])
+    assert edited.token_ids.tolist() == store._tokenizer.encode("<user> c </s>")
+
+    time.sleep(1.1)
+    assert store.load("u1").messages == []
+
+def test_long_sessions_are_trimmed():
+    """Beyond max_messages the oldest turns are dropped."""
+    store = make_store(max_messages=8)
+    messages = [{"role": "user", "content": str(i)} for i in range(9)]
+    session = store.save("u1", messages)
+    assert len(session.messages) == 6 and session.messages[-1]["content"] == "8"
+    assert store.get_stats()["trims"] == 1
+
+def test_trimming_a_session_resets_its_context_window_start(monkeypatch):
+    """Trimmed turns shift the kept ones to new indices, so the remembered window start is dropped."""
+    from app.core.context_window import ContextWindowBuilder
+    from app.utils import memory
+
+    builder = ContextWindowBuilder(count_tokens=lambda text: len(text.split()), budget=40, trim_ratio=0.5)
+    monkeypatch.setattr(memory, "session_store", make_store(max_messages=8))
+    monkeypatch.setattr(memory, "context_builder", builder)
+    messages = [{"role": "user", "content": f"{i} " + "w " * 9} for i in range(9)]
+    builder.build(messages, session_id="u1")
+    assert builder.get_stats()["tracked_sessions"] == 1
+
+    session = memory.store_context("u1", messages)
+    assert len(session.messages) == 6 and builder.get_stats()["tracked_sessions"] == 0
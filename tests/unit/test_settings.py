@@ -0,0 +1,26 @@
+import os
+import re
+import yaml
+from app.utils.settings import SETTINGS_FILE, load_settings, settings_env
+
+def test_settings_yaml_values_become_env_defaults(tmp_path, monkeypatch):
+    """Mapped keys set their variable unless it is already set; bools and lists are stringified."""
+    path = tmp_path / "settings.yaml"
+    path.write_text("inference:\n  batch_size: 4\n  max_batch_wait_ms: 25\n"
+                    "semantic_cache:\n  enabled: true\nmodels:\n  warmup: [tokenizer, llm]\n  llm_model: x\n")
+    for variable in ("BATCH_SIZE", "MAX_BATCH_WAIT_MS", "SEMANTIC_CACHE_ENABLED", "WARMUP_MODELS"):
+        monkeypatch.delenv(variable, raising=False)
+    monkeypatch.setenv("MAX_BATCH_WAIT_MS", "5")
+
+    applied = load_settings(str(path))
+    assert applied == {"BATCH_SIZE": "4", "SEMANTIC_CACHE_ENABLED": "true", "WARMUP_MODELS": "tokenizer,llm"}
+    assert os.environ["BATCH_SIZE"] == "4" and os.environ["MAX_BATCH_WAIT_MS"] == "5"
+    assert load_settings(str(tmp_path / "missing.yaml")) == {}
+
+def test_shipped_settings_map_every_annotated_key():
+    """Each `(ENV_NAME)` comment in configs/settings.yaml has a mapping entry."""
+    with open(SETTINGS_FILE) as f:
+        annotated = set(re.findall(r"\(([A-Z][A-Z0-9_]+)\)\s*$", f.read(), re.MULTILINE))
+    with open(SETTINGS_FILE) as f:
+        mapped = set(settings_env(yaml.safe_load(f)))
+    assert annotated - {"LLM"} == mapped
@@ -0,0 +1,29 @@
+import pytest
+from app.models.speculative import SpeculativeDecoder
+
+@pytest.fixture(scope="module")
+def target(tiny_gpt2):
+    return tiny_gpt2(seed=0, n_layer=3, n_positions=256)
+
+@pytest.mark.parametrize("k", [1, 3, 5])
+def test_speculative_output_matches_greedy(target, k, greedy_reference, tiny_gpt2):
+    """Whatever the draft proposes, the output is exactly the target's greedy output."""
+    decoder = SpeculativeDecoder(target, tiny_gpt2(seed=1, n_positions=256), k=k, min_acceptance=0.0)
+    for prompt in ([1, 2, 3], [7], [5, 9, 11, 13, 17]):
+        assert decoder.generate(prompt, 20) == greedy_reference(target, prompt, 20)
+
+def test_identical_draft_accepts_everything(target, greedy_reference):
+    """A draft equal to the target has a 100% acceptance rate."""
+    decoder = SpeculativeDecoder(target, target, k=4)
+    assert decoder.generate([4, 8, 15], 16) == greedy_reference(target, [4, 8, 15], 16)
+    stats = decoder.get_stats()
+    assert stats["acceptance_rate"] == 1.0
+    assert stats["rounds"] < 16
+
+def test_low_acceptance_falls_back_to_plain_decoding(target, greedy_reference, tiny_gpt2):
+    """A useless draft is abandoned mid-request and then skipped globally."""
+    decoder = SpeculativeDecoder(target, tiny_gpt2(seed=2, n_positions=256), k=4, min_acceptance=0.99,
+                                 window=2, probe_interval=3)
+    assert decoder.generate([3, 3, 3], 30) == greedy_reference(target, [3, 3, 3], 30)
+    assert decoder.get_stats()["fallbacks"] == 1
+    assert [decoder.should_speculate() for _ in range(3)] == [False, False, True]
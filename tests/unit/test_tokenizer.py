@@ -0,0 +1,110 @@
+import pytest
+pytest.importorskip("sentencepiece")
+import numpy as np
+import torch
+from tokenizers import Tokenizer as RustTokenizer, decoders, models, pre_tokenizers
+from transformers import PreTrainedTokenizerFast
+from app.models import tokenizer as tokenizer_module
+
+def byte_level_tokenizer():
+    """Tiny offline byte-level BPE tokenizer (Llama-3 style: multi-byte characters span tokens)."""
+    alphabet = pre_tokenizers.ByteLevel.alphabet()
+    vocab = {"<pad>": 0, "<s>": 1, **{ch: i + 2 for i, ch in enumerate(sorted(alphabet))}}
+    rust = RustTokenizer(models.BPE(vocab=vocab, merges=[]))
+    rust.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    rust.decoder = decoders.ByteLevel()
+    return PreTrainedTokenizerFast(tokenizer_object=rust, pad_token="<pad>", bos_token="<s>", eos_token="<s>")
+
+@pytest.fixture
+def tokenizer(monkeypatch):
+    monkeypatch.setattr(tokenizer_module.AutoTokenizer, "from_pretrained", lambda *a, **k: byte_level_tokenizer())
+    monkeypatch.setattr(tokenizer_module, "TOKENIZER_TYPE", "auto")
+    return tokenizer_module.Tokenizer()
+
+def test_encode_batch_pads_left_with_masks(tokenizer):
+    """Batch encoding matches single encodes, left-padded, as numpy or torch."""
+    texts = ["hi", "hello there", ""]
+    batch = tokenizer.encode_batch(texts)
+    assert batch["input_ids"].shape == batch["attention_mask"].shape == (3, len(tokenizer.encode("hello there")))
+    for row, text in enumerate(texts):
+        ids = tokenizer.encode(text)
+        assert batch["input_ids"][row, batch["attention_mask"][row] == 1].tolist() == ids
+        assert batch["attention_mask"][row].sum() == len(ids)
+    assert batch["attention_mask"][0, 0] == 0  # Left padding
+
+    tensors = tokenizer.encode_batch(texts, return_tensors="pt", padding_side="right")
+    assert isinstance(tensors["input_ids"], torch.Tensor) and tensors["attention_mask"][0, -1] == 0
+    assert tokenizer.decode_batch(tensors["input_ids"][:2]) == ["hi", "hello there"]
+
+def test_repeated_texts_come_from_the_cache(tokenizer):
+    """Cached texts skip the tokenizer; only misses go into the batched call."""
+    system_prompt = "You are JC1, a helpful assistant."
+    tokenizer.encode(system_prompt)
+    result = tokenizer.encode_batch([system_prompt, "new text"], return_tensors=None)
+    stats = tokenizer.get_stats()
+    assert stats["cache_hits"] == 1 and stats["cache_misses"] == 2 and stats["batch_calls"] == 2
+
+    result["input_ids"][0].append(99)  # Callers get copies; the cache stays intact
+    assert tokenizer.encode(system_prompt) == result["input_ids"][0][:-1]
+
+def test_incremental_detokenizer_matches_full_decode(tokenizer):
+    """Streamed deltas add up to decode(all tokens) and never split a multi-byte character."""
+    text = "Größe: 42 km² — 🚀 done"
+    tokens = tokenizer.encode(text)
+    detokenizer = tokenizer.detokenizer()
+    deltas, widest_window = [], 0
+    for token in tokens:
+        deltas.append(detokenizer.add(token))
+        widest_window = max(widest_window, len(detokenizer.tokens) - detokenizer.prefix_offset)
+    deltas.append(detokenizer.flush())
+    assert "".join(deltas) == tokenizer.decode(tokens) == text
+    assert not any("\ufffd" in delta for delta in deltas)
+    assert widest_window <= 5  # Each step decodes a few tokens, not the whole output
+
+def test_vocabulary_for_constrained_decoding(tokenizer):
+    """Token texts skip special tokens and partial UTF-8 bytes; a grammar compiles against them."""
+    from app.core.grammar import Grammar
+    vocab = tokenizer.vocabulary()
+    assert vocab is tokenizer.vocabulary() and vocab.eos_token_id == 1
+    assert vocab.strings[0] is None and vocab.strings[1] is None
+    assert vocab.strings[tokenizer.encode("{")[-1]] == "{"
+    assert vocab.strings[tokenizer.encode(" ")[-1]] == " "
+    assert vocab.strings[tokenizer.encode("é")[-1]] is None  # Second byte of a two-byte character
+
+    grammar = Grammar(r'\{"ok": (true|false)\}', vocab)
+    state = grammar.start
+    for token_id in tokenizer.encode('{"ok": true}'):
+        state = grammar.next_state(state, token_id)
+    assert grammar.is_accepting(state) and grammar.mask(state, vocab.size)[1]
+
+def sentencepiece_style_tokenizer(chat_template=None):
+    """Tiny offline BPE with a "▁" word prefix and trained merges, so pieces cross line breaks."""
+    from tokenizers import trainers
+    rust = RustTokenizer(models.BPE(unk_token="<unk>"))
+    rust.pre_tokenizer = pre_tokenizers.Metaspace(replacement="▁", prepend_scheme="first")
+    rust.decoder = decoders.Metaspace(replacement="▁", prepend_scheme="first")
+    corpus = ["user: hi\nassistant: hello there\n", "user: how are you?\nassistant: fine, thanks\n"] * 20
+    special = ["<unk>", "<s>", "</s>", "<|im_start|>", "<|im_end|>"]
+    rust.train_from_iterator(corpus, trainers.BpeTrainer(vocab_size=120, special_tokens=special))
+    return PreTrainedTokenizerFast(tokenizer_object=rust, unk_token="<unk>", bos_token="<s>", eos_token="</s>",
+                                   additional_special_tokens=special[3:], chat_template=chat_template)
+
+CHATML = ("{% for m in messages %}<|im_start|>{{ m['role'] }}\n{{ m['content'] }}<|im_end|>\n{% endfor %}"
+          "{% if add_generation_prompt %}<|im_start|>assistant\n{% endif %}")
+
+@pytest.mark.parametrize("chat_template", [None, CHATML])
+def test_incremental_chat_encoding_matches_a_full_encode(monkeypatch, chat_template):
+    """Turn-by-turn encoding gives the full encode's ids, even where pieces merge across the old end."""
+    monkeypatch.setattr(tokenizer_module.AutoTokenizer, "from_pretrained",
+                        lambda *a, **k: sentencepiece_style_tokenizer(chat_template))
+    monkeypatch.setattr(tokenizer_module, "TOKENIZER_TYPE", "auto")
+    tokenizer = tokenizer_module.Tokenizer()
+    turns = ["hi", "hello there", "how are you?", "fine, thanks", "hi", "hello"]
+    messages = [{"role": "user" if i % 2 == 0 else "assistant", "content": c} for i, c in enumerate(turns)]
+
+    cached = None
+    for count in range(1, len(messages) + 1):
+        expected = tokenizer.encode_chat_incremental(messages[:count], add_generation_prompt=False)
+        cached = tokenizer.encode_chat_incremental(messages[:count], cached, count - 1, add_generation_prompt=False)
+        assert cached == expected
+    assert tokenizer.encode_chat_incremental(messages, cached, len(messages)) == tokenizer.encode_chat(messages)